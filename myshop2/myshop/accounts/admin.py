@@ -7,8 +7,10 @@ from .models import (
     Customer,
     Address,
     LoginAttempt,
+    LoginAttemptDailyStats,
     AccountLock,
     VerificationCode,
+    OutgoingEmail,
     UserSession,
 )
 
@@ -131,6 +133,36 @@ class LoginAttemptAdmin(admin.ModelAdmin):
         return qs.select_related()
 
 
+@admin.register(LoginAttemptDailyStats)
+class LoginAttemptDailyStatsAdmin(admin.ModelAdmin):
+    """Admin for LoginAttemptDailyStats - rolled-up history of old login attempts"""
+    list_display = [
+        'day',
+        'success',
+        'failure_reason',
+        'security_tier',
+        'attempts',
+        'unique_emails',
+        'unique_ips'
+    ]
+    list_filter = ['success', 'security_tier', 'failure_reason']
+    date_hierarchy = 'day'
+    ordering = ['-day']
+    readonly_fields = [
+        'day',
+        'success',
+        'failure_reason',
+        'security_tier',
+        'attempts',
+        'unique_emails',
+        'unique_ips'
+    ]
+    
+    def has_add_permission(self, request):
+        """Stats are written by the rollup_login_attempts command only"""
+        return False
+
+
 @admin.register(AccountLock)
 class AccountLockAdmin(admin.ModelAdmin):
     """Admin for AccountLock model - Locked accounts management"""
@@ -276,6 +308,55 @@ class VerificationCodeAdmin(admin.ModelAdmin):
     delete_expired_codes.short_description = "Delete expired codes"
 
 
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    """Admin for OutgoingEmail - the queue sent by run_email_worker"""
+    list_display = [
+        'to_email',
+        'template',
+        'status',
+        'attempts',
+        'next_attempt_at',
+        'created_at',
+        'sent_at'
+    ]
+    list_filter = ['status', 'template', 'created_at']
+    search_fields = ['to_email', 'subject']
+    ordering = ['-created_at']
+    readonly_fields = [
+        'template',
+        'to_email',
+        'from_email',
+        'subject',
+        'body_text',
+        'body_html',
+        'dedupe_key',
+        'status',
+        'attempts',
+        'next_attempt_at',
+        'claimed_at',
+        'last_error',
+        'created_at',
+        'sent_at'
+    ]
+    
+    def has_add_permission(self, request):
+        """Emails are queued by the application only"""
+        return False
+    
+    actions = ['retry_now']
+    
+    def retry_now(self, request, queryset):
+        """Queue failed or waiting emails to be sent on the worker's next run"""
+        from django.utils import timezone
+        count = queryset.filter(status__in=['pending', 'failed']).update(
+            status='pending', attempts=0, next_attempt_at=timezone.now()
+        )
+        self.message_user(request, f'{count} email(s) will be sent on the next worker run.')
+    
+    retry_now.short_description = "Retry selected emails now"
+
+
 # ============================================================================
 # ADMIN SITE CUSTOMIZATION
 # ============================================================================
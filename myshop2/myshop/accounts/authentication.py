@@ -0,0 +1,28 @@
+"""
+API authentication for customer apps.
+"""
+import logging
+
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .session_activity import touch_session
+
+logger = logging.getLogger('security')
+
+
+class ActivityJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that also records activity on the token's UserSession.
+    The time goes to the cache; the database is written at most once per
+    SESSION_ACTIVITY_FLUSH_SECONDS per session (see accounts.session_activity).
+    """
+
+    def authenticate(self, request):
+        result = super().authenticate(request)
+        if result is not None:
+            try:
+                touch_session(result[1].get('jti'))
+            except Exception as e:
+                # Activity tracking must never fail a request
+                logger.warning(f"Could not record session activity: {str(e)}")
+        return result
@@ -0,0 +1,182 @@
+"""
+Queued email delivery.
+
+queue_email() stores an email in the OutgoingEmail outbox, in the caller's transaction,
+and returns at once. The run_email_worker command sends the queue in batches (the
+``worker`` process of the Procfile / render.yaml; set EMAIL_OUTBOX_WORKER=true where it
+runs). Without a worker, each email is sent by the process that queued it once the
+transaction commits, together with a few earlier emails that are due for a retry:
+
+- Each batch is sent over one backend connection (``get_connection()``), instead of a
+  new thread and SMTP connection per email.
+- A failed email is retried with exponential backoff (EMAIL_OUTBOX_BACKOFF_SECONDS,
+  doubling up to EMAIL_OUTBOX_MAX_BACKOFF_SECONDS) and marked failed after
+  EMAIL_OUTBOX_MAX_ATTEMPTS.
+- Emails claimed by a worker that died mid-batch are picked up again after
+  EMAIL_OUTBOX_CLAIM_TIMEOUT seconds (so delivery is at least once).
+- The same template to the same recipient is queued once per dedupe window
+  (EMAIL_OUTBOX_DEDUPE_SECONDS, per template), so a lock storm sends one alert, not
+  hundreds. Callers whose emails carry something new each time (a code, a link) pass it
+  as ``dedupe_on`` so only exact repeats are dropped.
+"""
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+logger = logging.getLogger('security')
+
+MAX_ATTEMPTS = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+BACKOFF_SECONDS = getattr(settings, 'EMAIL_OUTBOX_BACKOFF_SECONDS', 30)
+MAX_BACKOFF_SECONDS = getattr(settings, 'EMAIL_OUTBOX_MAX_BACKOFF_SECONDS', 60 * 60)
+CLAIM_TIMEOUT = getattr(settings, 'EMAIL_OUTBOX_CLAIM_TIMEOUT', 5 * 60)
+# Without a worker, due retries sent along with each new email
+RETRIES_PER_SEND = 5
+# template -> seconds; 'default' for templates not listed
+DEDUPE_SECONDS = {
+    'default': 5 * 60,
+    'security_warning': 15 * 60,
+    'account_locked': 15 * 60,
+    **getattr(settings, 'EMAIL_OUTBOX_DEDUPE_SECONDS', {}),
+}
+
+
+def _dedupe_key(template, to_email, dedupe_on):
+    return hashlib.sha256(f'{template}\0{to_email.lower()}\0{dedupe_on}'.encode()).hexdigest()
+
+
+def queue_email(template, to_email, subject, body_text, body_html='', from_email=None, dedupe_on=''):
+    """
+    Queue an email for the worker.
+
+    Returns the OutgoingEmail, or None if the same email was already queued within the
+    template's dedupe window.
+    """
+    dedupe_key = _dedupe_key(template, to_email, dedupe_on)
+    window = DEDUPE_SECONDS.get(template, DEDUPE_SECONDS['default'])
+    if window:
+        # cache.add is atomic, so concurrent requests can't both queue; the query
+        # covers a cleared cache
+        if not cache.add(f'email_outbox:dedupe:{dedupe_key}', True, window):
+            logger.info(f"Skipped duplicate {template} email to {to_email}")
+            return None
+        duplicate = OutgoingEmail.objects.filter(
+            dedupe_key=dedupe_key, created_at__gte=timezone.now() - timedelta(seconds=window)
+        ).exclude(status='failed').exists()
+        if duplicate:
+            logger.info(f"Skipped duplicate {template} email to {to_email}")
+            return None
+
+    outgoing = OutgoingEmail.objects.create(
+        template=template,
+        to_email=to_email,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        subject=subject,
+        body_text=body_text,
+        body_html=body_html,
+        dedupe_key=dedupe_key,
+    )
+    logger.info(f"Email queued for {to_email} ({template})")
+    if not getattr(settings, 'EMAIL_OUTBOX_WORKER', False):
+        # Nothing else sends the queue: send it here, after the row is committed
+        transaction.on_commit(lambda: _send_without_worker(outgoing.pk))
+    return outgoing
+
+
+def _send_without_worker(outgoing_id):
+    """Send a just-queued email, then a few earlier ones that are due for a retry"""
+    send_queued_emails(batch_size=1, ids=[outgoing_id])
+    send_queued_emails(batch_size=RETRIES_PER_SEND)
+
+
+def _claim_batch(batch_size, now, ids=None):
+    """Mark up to ``batch_size`` due emails (optionally only those in ``ids``) as sending and return them."""
+    stale = now - timedelta(seconds=CLAIM_TIMEOUT)
+    with transaction.atomic():
+        due = OutgoingEmail.objects.select_for_update(skip_locked=True).filter(
+            Q(status='pending', next_attempt_at__lte=now) | Q(status='sending', claimed_at__lt=stale)
+        )
+        if ids is not None:
+            due = due.filter(pk__in=ids)
+        batch = list(due.order_by('next_attempt_at', 'pk')[:batch_size])
+        OutgoingEmail.objects.filter(pk__in=[outgoing.pk for outgoing in batch]).update(
+            status='sending', claimed_at=now
+        )
+    return batch
+
+
+def _to_message(outgoing, connection):
+    msg = EmailMultiAlternatives(
+        subject=outgoing.subject,
+        body=outgoing.body_text,
+        from_email=outgoing.from_email or settings.DEFAULT_FROM_EMAIL,
+        to=[outgoing.to_email],
+        connection=connection,
+    )
+    if outgoing.body_html:
+        msg.attach_alternative(outgoing.body_html, "text/html")
+    return msg
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception as e:
+        logger.warning(f"Error closing email connection: {e}")
+
+
+def retry_delay(attempts):
+    """Seconds before the next try of an email that has failed ``attempts`` times"""
+    return min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+
+def send_queued_emails(batch_size=50, now=None, ids=None):
+    """
+    Send one batch of due emails (optionally only those in ``ids``) over a single connection.
+    Returns (sent, failed) - failed counts emails that will be retried or gave up.
+    """
+    now = now or timezone.now()
+    batch = _claim_batch(batch_size, now, ids)
+    if not batch:
+        return 0, 0
+
+    sent_ids = []
+    failed = 0
+    connection = get_connection(fail_silently=False)
+    try:
+        for outgoing in batch:
+            try:
+                # Opened here rather than by send_messages(), which would close it again
+                # after each email; after a failure this reconnects
+                connection.open()
+                connection.send_messages([_to_message(outgoing, connection)])
+            except Exception as e:
+                failed += 1
+                _close(connection)
+                outgoing.attempts += 1
+                outgoing.last_error = str(e)[:1000]
+                if outgoing.attempts >= MAX_ATTEMPTS:
+                    outgoing.status = 'failed'
+                    logger.error(f"Giving up on email to {outgoing.to_email} ({outgoing.template}): {e}")
+                else:
+                    outgoing.status = 'pending'
+                    outgoing.next_attempt_at = now + timedelta(seconds=retry_delay(outgoing.attempts))
+                    logger.warning(f"Email to {outgoing.to_email} failed, retry {outgoing.attempts}: {e}")
+                outgoing.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+            else:
+                sent_ids.append(outgoing.pk)
+    finally:
+        _close(connection)
+
+    OutgoingEmail.objects.filter(pk__in=sent_ids).update(
+        status='sent', sent_at=timezone.now(), attempts=F('attempts') + 1, last_error=''
+    )
+    return len(sent_ids), failed
@@ -1,15 +1,18 @@
 """
 Email Service for Security Notifications
 Sends warning emails, verification codes, and unlock links.
+
+Emails are queued in the outbox (accounts.email_outbox) and sent by the
+run_email_worker command, so a request never waits for SMTP.
 """
 import logging
-import threading
-from django.core.mail import send_mail, EmailMultiAlternatives
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.utils import timezone
 
+from .email_outbox import queue_email
+
 logger = logging.getLogger('security')
 
 
@@ -17,22 +20,14 @@ logger = logging.getLogger('security')
 # NON-BLOCKING EMAIL SENDER
 # ============================================================================
 
-def send_email_async(msg):
+def send_email_async(msg, template='generic', dedupe_on=''):
     """
-    Send email in background thread to prevent blocking the request.
-    If email fails, it doesn't crash the login.
+    Queue an EmailMultiAlternatives in the outbox instead of sending it in the request.
+    If queueing fails, it doesn't crash the login.
     """
-    def _send():
-        try:
-            msg.send(fail_silently=True)
-            logger.info(f"Email sent successfully to {msg.to}")
-        except Exception as e:
-            logger.error(f"Failed to send email to {msg.to}: {str(e)}")
-    
-    # Start background thread - returns immediately
-    thread = threading.Thread(target=_send, daemon=True)
-    thread.start()
-    logger.info(f"Email queued for {msg.to}")
+    html = next((content for content, mimetype in getattr(msg, 'alternatives', []) if mimetype == 'text/html'), '')
+    for to_email in msg.to:
+        queue_email(template, to_email, msg.subject, msg.body, html, from_email=msg.from_email, dedupe_on=dedupe_on)
 
 
 # ============================================================================
@@ -338,14 +333,7 @@ class SecurityEmailService:
             )
             text_content = strip_tags(html_content)
             
-            msg = EmailMultiAlternatives(
-                subject=subject,
-                body=text_content,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                to=[email]
-            )
-            msg.attach_alternative(html_content, "text/html")
-            send_email_async(msg)  # Non-blocking!
+            queue_email('security_warning', email, subject, text_content, html_content)  # Non-blocking!
             
             logger.info(f"Warning email queued for {email}")
             return True
@@ -374,14 +362,7 @@ IP Address: {ip_address}
 If you didn't request this, please secure your account immediately.
             """.strip()
             
-            msg = EmailMultiAlternatives(
-                subject=subject,
-                body=text_content,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                to=[email]
-            )
-            msg.attach_alternative(html_content, "text/html")
-            send_email_async(msg)  # Non-blocking!
+            queue_email('verification_code', email, subject, text_content, html_content, dedupe_on=code)  # Non-blocking!
             
             logger.info(f"Verification code queued for {email}")
             return True
@@ -426,14 +407,7 @@ IPs: {', '.join(lock_obj.ip_addresses[:3])}
 If this wasn't you, reset your password immediately.
             """.strip()
             
-            msg = EmailMultiAlternatives(
-                subject=subject,
-                body=text_content,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                to=[email]
-            )
-            msg.attach_alternative(html_content, "text/html")
-            send_email_async(msg)  # Non-blocking!
+            queue_email('account_locked', email, subject, text_content, html_content, dedupe_on=lock_obj.unlock_token)  # Non-blocking!
             
             # Update lock record
             lock_obj.email_sent = True
@@ -457,14 +431,7 @@ If this wasn't you, reset your password immediately.
             html_content = get_unlock_success_email_html(email, unlocked_at)
             text_content = strip_tags(html_content)
             
-            msg = EmailMultiAlternatives(
-                subject=subject,
-                body=text_content,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                to=[email]
-            )
-            msg.attach_alternative(html_content, "text/html")
-            send_email_async(msg)  # Non-blocking!
+            queue_email('unlock_success', email, subject, text_content, html_content)  # Non-blocking!
 
             logger.info(f"Unlock success email queued for {email}")
             return True
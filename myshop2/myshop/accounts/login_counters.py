@@ -0,0 +1,266 @@
+"""
+Time-bucketed login failure counters.
+
+Before every login LoginSecurityService needs the email's failures in the last minute,
+two minutes, hour and day, the IP's failures in the last minute and hour, and the time of
+the email's last failure. Instead of counting LoginAttempt rows for each (an ever-growing
+table), failures are counted in cache buckets at three resolutions and all of them are
+read back with one get_many().
+
+LoginAttempt stays the source of truth: an email or IP without counters (new, evicted,
+or not resynced for LOGIN_COUNTER_RESYNC_SECONDS) is rebuilt from its rows with one
+query, and failures recorded afterwards are added to the buckets. Windows are counted in
+whole buckets, so a count may include up to one bucket (10 s / 5 min / 1 h) more than the
+window - never less.
+
+The counters are only used in a cache shared by every worker (Redis via
+RATE_LIMIT_CACHE_ALIAS). In a per-process cache (locmem, the default) each worker would
+only add the failures it recorded itself between resyncs, multiplying every limit by the
+number of workers, so there each snapshot is counted from LoginAttempt instead: one query
+over the email's and the IP's failures of the last day.
+"""
+import math
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone as dt_timezone
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+
+from .utils import is_shared_cache
+
+CACHE_ALIAS = getattr(settings, 'LOGIN_COUNTER_CACHE_ALIAS', getattr(settings, 'RATE_LIMIT_CACHE_ALIAS', 'default'))
+# How long counters are trusted before being rebuilt from LoginAttempt
+RESYNC_SECONDS = getattr(settings, 'LOGIN_COUNTER_RESYNC_SECONDS', 15 * 60)
+
+# resolution -> (bucket seconds, longest window it answers)
+RESOLUTIONS = {
+    'fine': (10, 120),
+    'hour': (300, 3600),
+    'day': (3600, 86400),
+}
+# Resolutions kept per subject kind; the finest one covering a window answers it
+KIND_RESOLUTIONS = {
+    'email': ('fine', 'hour', 'day'),
+    'ip': ('fine', 'hour'),
+}
+KIND_FIELDS = {'email': 'email', 'ip': 'ip_address'}
+
+
+def _bucket_starts(size, window, now):
+    """Starts of the buckets overlapping (now - window, now]"""
+    first = int((now - window) // size) * size
+    return range(first, int(now // size) * size + 1, size)
+
+
+def _resolution_for(kind, window):
+    for resolution in KIND_RESOLUTIONS[kind]:
+        if RESOLUTIONS[resolution][1] >= window:
+            return resolution
+    raise ValueError(f'No {kind} counters cover a {window} second window')
+
+
+@dataclass
+class FailureSnapshot:
+    """Failure counters of one email and one IP, read at ``now``"""
+    now: float
+    # (kind, resolution) -> {bucket start: failures}
+    buckets: Dict[tuple, Dict[int, int]] = field(default_factory=lambda: defaultdict(dict))
+    last_failure: Optional[float] = None
+
+    def _series(self, kind, window):
+        resolution = _resolution_for(kind, window)
+        size = RESOLUTIONS[resolution][0]
+        series = sorted(
+            (start, count) for start, count in self.buckets[(kind, resolution)].items()
+            if start + size > self.now - window
+        )
+        return size, series
+
+    def count(self, kind, window):
+        """Failures of the email ('email') or IP ('ip') in the last ``window`` seconds"""
+        return sum(count for _, count in self._series(kind, window)[1])
+
+    def seconds_until_below(self, kind, limit, window):
+        """Seconds until fewer than ``limit`` failures fall within the window (0 if already)"""
+        size, series = self._series(kind, window)
+        total = sum(count for _, count in series)
+        for start, count in series:
+            if total < limit:
+                break
+            total -= count
+            if total < limit:
+                # This bucket leaves the window once its last second is ``window`` seconds old
+                return max(1, math.ceil(start + size + window - self.now))
+        return 0
+
+    def seconds_since_last_failure(self):
+        return None if self.last_failure is None else self.now - self.last_failure
+
+
+def _bucket_failures(kind, timestamps, now):
+    """{(resolution, bucket start): failures} of a subject's failure timestamps"""
+    buckets = Counter()
+    for timestamp in timestamps:
+        for resolution in KIND_RESOLUTIONS[kind]:
+            size, window = RESOLUTIONS[resolution]
+            start = int(timestamp // size) * size
+            if start + size > now - window:
+                buckets[(resolution, start)] += 1
+    return buckets
+
+
+def _since(kind, now):
+    """Oldest failure time any bucket of ``kind`` can hold"""
+    longest = max(RESOLUTIONS[resolution][0] + RESOLUTIONS[resolution][1] for resolution in KIND_RESOLUTIONS[kind])
+    return datetime.fromtimestamp(now - longest, tz=dt_timezone.utc)
+
+
+class LoginFailureCounters:
+
+    def __init__(self, alias=CACHE_ALIAS):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def enabled(self):
+        """Counters are kept only in a cache every worker shares"""
+        return is_shared_cache(self.alias)
+
+    @staticmethod
+    def _key(kind, subject, resolution, start):
+        return f'login_failures:{kind}:{subject}:{resolution}:{start}'
+
+    @staticmethod
+    def _synced_key(kind, subject):
+        return f'login_failures:{kind}:{subject}:synced'
+
+    @staticmethod
+    def _last_key(email):
+        return f'login_failures:email:{email}:last'
+
+    def snapshot(self, email, ip_address, now=None):
+        """Read every counter of ``email`` and ``ip_address`` (one get_many, plus a rebuild if needed)."""
+        now = time.time() if now is None else now
+        if not self.enabled:
+            return self.snapshot_from_db(email, ip_address, now)
+        subjects = {'email': email, 'ip': ip_address}
+        bucket_keys = {}
+        for kind, subject in subjects.items():
+            for resolution in KIND_RESOLUTIONS[kind]:
+                size, window = RESOLUTIONS[resolution]
+                for start in _bucket_starts(size, window, now):
+                    bucket_keys[self._key(kind, subject, resolution, start)] = (kind, resolution, start)
+        synced_keys = {kind: self._synced_key(kind, subject) for kind, subject in subjects.items()}
+        values = self.cache.get_many([*bucket_keys, *synced_keys.values(), self._last_key(email)])
+
+        snapshot = FailureSnapshot(now=now, last_failure=values.get(self._last_key(email)))
+        for kind, subject in subjects.items():
+            if synced_keys[kind] in values:
+                continue
+            buckets, last_failure = self.rebuild(kind, subject, now)
+            for (resolution, start), count in buckets.items():
+                values[self._key(kind, subject, resolution, start)] = count
+            if kind == 'email':
+                snapshot.last_failure = last_failure
+
+        for key, (kind, resolution, start) in bucket_keys.items():
+            if values.get(key):
+                snapshot.buckets[(kind, resolution)][start] = values[key]
+        return snapshot
+
+    def snapshot_from_db(self, email, ip_address, now=None):
+        """Count the failures of ``email`` and ``ip_address`` from LoginAttempt (one query)."""
+        from .models import LoginAttempt
+
+        now = time.time() if now is None else now
+        rows = LoginAttempt.objects.filter(
+            Q(email=email, created_at__gte=_since('email', now))
+            | Q(ip_address=ip_address, created_at__gte=_since('ip', now)),
+            success=False,
+        ).values_list('created_at', 'email', 'ip_address')
+        timestamps = {'email': [], 'ip': []}
+        for created_at, row_email, row_ip in rows:
+            if row_email == email:
+                timestamps['email'].append(created_at.timestamp())
+            if row_ip == ip_address:
+                timestamps['ip'].append(created_at.timestamp())
+
+        snapshot = FailureSnapshot(now=now, last_failure=max(timestamps['email'], default=None))
+        for kind in ('email', 'ip'):
+            for (resolution, start), count in _bucket_failures(kind, timestamps[kind], now).items():
+                snapshot.buckets[(kind, resolution)][start] = count
+        return snapshot
+
+    def rebuild(self, kind, subject, now=None):
+        """
+        Recount a subject's buckets from LoginAttempt (one query) and store them.
+        Returns ({(resolution, bucket start): failures}, last failure timestamp or None).
+        """
+        from .models import LoginAttempt
+
+        now = time.time() if now is None else now
+        timestamps = [
+            created_at.timestamp() for created_at in LoginAttempt.objects.filter(
+                **{KIND_FIELDS[kind]: subject}, success=False, created_at__gte=_since(kind, now)
+            ).values_list('created_at', flat=True)
+        ]
+        buckets = _bucket_failures(kind, timestamps, now)
+
+        cache = self.cache
+        for resolution in KIND_RESOLUTIONS[kind]:
+            size, window = RESOLUTIONS[resolution]
+            # Empty buckets are stored too, so stale counts from before the rebuild are overwritten
+            cache.set_many({
+                self._key(kind, subject, resolution, start): buckets.get((resolution, start), 0)
+                for start in _bucket_starts(size, window, now)
+            }, window + size)
+        last_failure = max(timestamps, default=None)
+        if kind == 'email':
+            if last_failure is None:
+                cache.delete(self._last_key(subject))
+            else:
+                cache.set(self._last_key(subject), last_failure, RESOLUTIONS['day'][1])
+        cache.set(self._synced_key(kind, subject), True, RESYNC_SECONDS)
+        return dict(buckets), last_failure
+
+    def record_failure(self, email, ip_address, now=None):
+        """Count a failed attempt that was just saved as a LoginAttempt row."""
+        if not self.enabled:
+            # Snapshots read the row itself
+            return
+        now = time.time() if now is None else now
+        cache = self.cache
+        subjects = {'email': email, 'ip': ip_address}
+        synced = cache.get_many([self._synced_key(kind, subject) for kind, subject in subjects.items()])
+        for kind, subject in subjects.items():
+            if self._synced_key(kind, subject) not in synced:
+                # Not built yet: the next snapshot rebuilds it, including this row
+                continue
+            for resolution in KIND_RESOLUTIONS[kind]:
+                size, window = RESOLUTIONS[resolution]
+                key = self._key(kind, subject, resolution, int(now // size) * size)
+                cache.add(key, 0, window + size)
+                try:
+                    cache.incr(key)
+                except ValueError:
+                    cache.add(key, 1, window + size)
+        cache.set(self._last_key(email), now, RESOLUTIONS['day'][1])
+
+    def reset(self, email=None, ip_address=None):
+        """Forget the counters of an email and/or IP; they are rebuilt on the next snapshot."""
+        keys = []
+        if email:
+            keys += [self._synced_key('email', email), self._last_key(email)]
+        if ip_address:
+            keys.append(self._synced_key('ip', ip_address))
+        self.cache.delete_many(keys)
+
+
+login_failure_counters = LoginFailureCounters()
@@ -0,0 +1,220 @@
+"""
+Batched clean-up of the security tables (the security_maintenance command).
+
+Every step walks its rows in ascending primary-key ranges of at most ``batch_size`` rows,
+each range updated or deleted in its own short transaction, so no step holds locks on a
+large part of a table. Steps only touch rows that still need it, so an interrupted run
+loses nothing: running it again picks up the rows that are left.
+
+Steps (group.name):
+- sessions.expire: deactivate sessions whose refresh token expired
+- sessions.purge: delete sessions inactive for USER_SESSION_RETENTION_DAYS
+- attempts.rollup: roll login attempts older than LOGIN_ATTEMPT_RETENTION_DAYS up into
+  LoginAttemptDailyStats and delete them, one day per transaction (see rollup_login_attempts)
+- codes.purge: delete verification codes expired for VERIFICATION_CODE_RETENTION_DAYS
+- locks.expire: release account locks whose time is up
+- locks.purge: delete locks released ACCOUNT_LOCK_RETENTION_DAYS ago
+- invitations.expire: mark supplier invitations past expires_at as expired
+- invitations.purge: delete expired/cancelled invitations after
+  SUPPLIER_INVITATION_RETENTION_DAYS (their store names can be invited again)
+- emails.purge: delete sent outbox emails after EMAIL_OUTBOX_RETENTION_DAYS
+"""
+import time
+from dataclasses import dataclass
+from datetime import datetime, time as dt_time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+
+def _retention(name, default_days):
+    return timedelta(days=getattr(settings, name, default_days))
+
+
+@dataclass
+class StepResult:
+    name: str
+    rows: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def run_in_pk_batches(name, queryset, action, batch_size=1000, pause=0):
+    """
+    Apply ``action(batch_queryset) -> rows affected`` to ``queryset`` one primary-key
+    range of at most ``batch_size`` rows at a time, each in its own transaction.
+    """
+    result = StepResult(name)
+    started = time.monotonic()
+    last_pk = 0
+    while True:
+        # The pk closing this range; None when fewer than batch_size rows are left
+        upper = next(iter(
+            queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[batch_size - 1:batch_size]
+        ), None)
+        batch = queryset.filter(pk__gt=last_pk)
+        if upper is not None:
+            batch = batch.filter(pk__lte=upper)
+        with transaction.atomic():
+            result.rows += action(batch)
+        result.batches += 1
+        if upper is None:
+            break
+        last_pk = upper
+        if pause:
+            time.sleep(pause)
+    result.seconds = time.monotonic() - started
+    return result
+
+
+def _delete(batch):
+    return batch.delete()[0]
+
+
+# ============================================================================
+# STEPS
+# ============================================================================
+
+def expire_sessions(now, **options):
+    from .models import UserSession
+    return run_in_pk_batches(
+        'sessions.expire', UserSession.objects.filter(is_active=True, expires_at__lt=now),
+        lambda batch: batch.update(is_active=False, revoked_at=now, revoked_reason='expired'), **options
+    )
+
+
+def purge_sessions(now, **options):
+    from .models import UserSession
+    cutoff = now - _retention('USER_SESSION_RETENTION_DAYS', 90)
+    return run_in_pk_batches(
+        'sessions.purge', UserSession.objects.filter(is_active=False, revoked_at__lt=cutoff), _delete, **options
+    )
+
+
+def _rollup_day(attempts, day, batch_size, pause):
+    """Add one day of login attempts to the daily stats and delete them. Returns a StepResult."""
+    from .models import LoginAttemptDailyStats
+
+    start = timezone.make_aware(datetime.combine(day, dt_time.min))
+    day_attempts = attempts.filter(created_at__gte=start, created_at__lt=start + timedelta(days=1))
+    # Distinct emails/IPs are only exact over the whole day, so it is aggregated in one query
+    groups = day_attempts.values('success', 'failure_reason', 'security_tier').annotate(
+        attempts=Count('id'),
+        unique_emails=Count('email', distinct=True),
+        unique_ips=Count('ip_address', distinct=True),
+    ).order_by()
+    for group in groups:
+        totals = {name: group[name] for name in ('attempts', 'unique_emails', 'unique_ips')}
+        stats, created = LoginAttemptDailyStats.objects.select_for_update().get_or_create(
+            day=day, success=group['success'], failure_reason=group['failure_reason'],
+            security_tier=group['security_tier'], defaults=totals,
+        )
+        if not created:
+            LoginAttemptDailyStats.objects.filter(pk=stats.pk).update(
+                **{name: F(name) + value for name, value in totals.items()}
+            )
+    return run_in_pk_batches('attempts.rollup', day_attempts, _delete, batch_size=batch_size, pause=pause)
+
+
+def rollup_login_attempts(now, days=None, batch_size=1000, pause=0):
+    """
+    Roll up attempts from before the start of the day ``days`` (default: retention) days ago.
+
+    Each day is aggregated with one query and its rows deleted in pk batches, all in one
+    transaction: the day's stats are only written together with the deletion of its rows,
+    so an interrupted run never counts a day twice.
+    """
+    from .models import LoginAttempt
+    days = getattr(settings, 'LOGIN_ATTEMPT_RETENTION_DAYS', 30) if days is None else days
+    cutoff_day = timezone.localdate(now) - timedelta(days=days)
+    cutoff = timezone.make_aware(datetime.combine(cutoff_day, dt_time.min))
+    attempts = LoginAttempt.objects.filter(created_at__lt=cutoff)
+    result = StepResult('attempts.rollup')
+    started = time.monotonic()
+    for day in attempts.dates('created_at', 'day'):
+        with transaction.atomic():
+            day_result = _rollup_day(attempts, day, batch_size, pause)
+        result.rows += day_result.rows
+        result.batches += day_result.batches
+    result.seconds = time.monotonic() - started
+    return result
+
+
+def purge_verification_codes(now, **options):
+    from .models import VerificationCode
+    cutoff = now - _retention('VERIFICATION_CODE_RETENTION_DAYS', 7)
+    return run_in_pk_batches(
+        'codes.purge', VerificationCode.objects.filter(expires_at__lt=cutoff), _delete, **options
+    )
+
+
+def expire_account_locks(now, **options):
+    from .models import AccountLock
+    return run_in_pk_batches(
+        'locks.expire', AccountLock.objects.filter(is_active=True, expires_at__lt=now),
+        lambda batch: batch.update(is_active=False, unlocked_at=now, unlocked_by='auto_expire'), **options
+    )
+
+
+def purge_account_locks(now, **options):
+    from .models import AccountLock
+    cutoff = now - _retention('ACCOUNT_LOCK_RETENTION_DAYS', 90)
+    return run_in_pk_batches(
+        'locks.purge', AccountLock.objects.filter(is_active=False, expires_at__lt=cutoff), _delete, **options
+    )
+
+
+def expire_supplier_invitations(now, **options):
+    from suppliers.models import SupplierInvitation
+    return run_in_pk_batches(
+        'invitations.expire',
+        SupplierInvitation.objects.filter(is_used=False, status__in=['pending', 'sent'], expires_at__lt=now),
+        lambda batch: batch.update(status='expired'), **options
+    )
+
+
+def purge_supplier_invitations(now, **options):
+    from suppliers.models import SupplierInvitation
+    cutoff = now - _retention('SUPPLIER_INVITATION_RETENTION_DAYS', 30)
+    return run_in_pk_batches(
+        'invitations.purge',
+        SupplierInvitation.objects.filter(status__in=['expired', 'cancelled'], expires_at__lt=cutoff), _delete,
+        **options
+    )
+
+
+def purge_sent_emails(now, **options):
+    from .models import OutgoingEmail
+    cutoff = now - _retention('EMAIL_OUTBOX_RETENTION_DAYS', 30)
+    return run_in_pk_batches(
+        'emails.purge', OutgoingEmail.objects.filter(status='sent', sent_at__lt=cutoff), _delete, **options
+    )
+
+
+STEPS = (
+    ('sessions', expire_sessions),
+    ('sessions', purge_sessions),
+    ('attempts', rollup_login_attempts),
+    ('codes', purge_verification_codes),
+    ('locks', expire_account_locks),
+    ('locks', purge_account_locks),
+    ('invitations', expire_supplier_invitations),
+    ('invitations', purge_supplier_invitations),
+    ('emails', purge_sent_emails),
+)
+GROUPS = tuple(dict.fromkeys(group for group, _ in STEPS))
+
+
+def run_maintenance(groups=None, now=None, batch_size=1000, pause=0):
+    """Run the steps of the given groups (default: all), in order. Returns their StepResults."""
+    now = now or timezone.now()
+    return [
+        step(now, batch_size=batch_size, pause=pause)
+        for group, step in STEPS if groups is None or group in groups
+    ]
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from accounts.maintenance import rollup_login_attempts
+
+
+class Command(BaseCommand):
+    help = (
+        'Roll login attempts older than the retention period up into LoginAttemptDailyStats '
+        'and delete them, one day per transaction, so an interrupted run can simply be '
+        'started again. Login security only looks at the last '
+        '24 hours, so the rolled-up rows are not needed for it. Also part of security_maintenance.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'LOGIN_ATTEMPT_RETENTION_DAYS', 30),
+            help="Keep this many days of individual attempts (default: LOGIN_ATTEMPT_RETENTION_DAYS or 30)",
+        )
+        parser.add_argument("--batch-size", type=int, default=5000, help="Rows deleted per statement")
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            self.stderr.write(self.style.ERROR('--days must be at least 1'))
+            return
+        result = rollup_login_attempts(timezone.now(), days=options['days'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Rolled up {result.rows} login attempt(s) in {result.batches} batch(es).'
+        ))
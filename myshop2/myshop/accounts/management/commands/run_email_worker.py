@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.email_outbox import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = (
+        "Send the emails queued in the outbox (OutgoingEmail), one connection per batch.\n"
+        "Failed emails are retried with backoff. Run from cron, or keep it running with --loop; "
+        "several workers can run side by side."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep sending, checking for new emails every --interval seconds",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait when the queue is empty with --loop (default: 5)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Emails sent per connection (default: 50)",
+        )
+        parser.add_argument(
+            "--max-batches",
+            type=int,
+            default=20,
+            help="Batches sent per run before pausing (default: 20)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            sent = failed = 0
+            for _ in range(options["max_batches"]):
+                batch_sent, batch_failed = send_queued_emails(batch_size=options["batch_size"])
+                sent += batch_sent
+                failed += batch_failed
+                if batch_sent + batch_failed < options["batch_size"]:
+                    break
+            if sent or failed or not options["loop"]:
+                self.stdout.write(self.style.SUCCESS(f"Sent {sent} emails, {failed} failed."))
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
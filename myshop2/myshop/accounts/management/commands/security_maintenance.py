@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.maintenance import GROUPS, run_maintenance
+
+
+class Command(BaseCommand):
+    help = (
+        "Expire and clean up the security tables: sessions, login attempts (rolled up into "
+        "daily stats), verification codes, account locks, supplier invitations and sent "
+        "outbox emails.\n"
+        "Rows are handled in primary-key batches, each in its own short transaction; running "
+        "an interrupted run again picks up the rows that are left. Run from cron, or keep it "
+        "running with --loop."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--only",
+            nargs="+",
+            choices=GROUPS,
+            help="Run only these groups (default: all)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Rows per batch/transaction (default: 1000)",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to sleep between batches, to leave room for other traffic (default: 0)",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep running every --interval seconds",
+        )
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=15 * 60,
+            help="Seconds between runs with --loop (default: 900)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            results = run_maintenance(
+                groups=options["only"], batch_size=options["batch_size"], pause=options["pause"]
+            )
+            for result in results:
+                self.stdout.write(
+                    f"{result.name}: {result.rows} rows in {result.batches} batches, "
+                    f"{result.seconds:.2f}s ({result.rows_per_second:.0f} rows/s)"
+                )
+            self.stdout.write(self.style.SUCCESS(f"Done: {sum(result.rows for result in results)} rows."))
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.1 on 2026-10-17 06:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0023_alter_customer_token_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoginAttemptDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True)),
+                ('success', models.BooleanField(default=False)),
+                ('failure_reason', models.CharField(blank=True, max_length=100)),
+                ('security_tier', models.IntegerField(default=1)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('unique_emails', models.PositiveIntegerField(default=0, help_text='Distinct emails (summed if a day is rolled up in parts)')),
+                ('unique_ips', models.PositiveIntegerField(default=0, help_text='Distinct IPs (summed if a day is rolled up in parts)')),
+            ],
+            options={
+                'verbose_name': 'Login Attempt Daily Stats',
+                'verbose_name_plural': 'Login Attempt Daily Stats',
+                'ordering': ['-day'],
+                'unique_together': {('day', 'success', 'failure_reason', 'security_tier')},
+            },
+        ),
+    ]
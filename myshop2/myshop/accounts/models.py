@@ -5,7 +5,7 @@ from django.utils import timezone
 import uuid
 import secrets
 from datetime import timedelta
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.conf import settings
 
@@ -365,6 +365,7 @@ def create_customer_profile(sender, instance, created, **kwargs):
         # You can add additional logic here if needed
         pass  # Customer is already the user model, so nothing to do
 
+
 class Address(models.Model):
     customer = models.ForeignKey('Customer', on_delete=models.CASCADE, related_name='addresses')
     label = models.CharField(max_length=50, blank=True, help_text='e.g. Home, Work, etc.')
@@ -452,6 +453,30 @@ class LoginAttempt(models.Model):
         return f"{status} - {self.email} from {self.ip_address} [{self.created_at}]"
 
 
+class LoginAttemptDailyStats(models.Model):
+    """
+    Daily totals of login attempts older than the retention period.
+    Written by the rollup_login_attempts command before it deletes the rows.
+    """
+    day = models.DateField(db_index=True)
+    success = models.BooleanField(default=False)
+    failure_reason = models.CharField(max_length=100, blank=True)
+    security_tier = models.IntegerField(default=1)
+    attempts = models.PositiveIntegerField(default=0)
+    unique_emails = models.PositiveIntegerField(default=0, help_text="Distinct emails (summed if a day is rolled up in parts)")
+    unique_ips = models.PositiveIntegerField(default=0, help_text="Distinct IPs (summed if a day is rolled up in parts)")
+
+    class Meta:
+        ordering = ['-day']
+        unique_together = ('day', 'success', 'failure_reason', 'security_tier')
+        verbose_name = 'Login Attempt Daily Stats'
+        verbose_name_plural = 'Login Attempt Daily Stats'
+
+    def __str__(self):
+        status = "Success" if self.success else f"Failed ({self.failure_reason or 'unknown'})"
+        return f"{self.day} - {status}, tier {self.security_tier}: {self.attempts}"
+
+
 class AccountLock(models.Model):
     """
     Tracks account locks due to suspicious activity.
@@ -629,6 +654,48 @@ class VerificationCode(models.Model):
 # USER SESSION MODEL - Multi-device tracking
 # ============================================================================
 
+class OutgoingEmail(models.Model):
+    """
+    Email outbox. Emails are queued here (accounts.email_outbox.queue_email) in the
+    request and sent by the run_email_worker command, so they survive restarts and
+    are retried when the SMTP server fails.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
+    template = models.CharField(max_length=50, db_index=True, help_text="Kind of email, e.g. verification_code")
+    to_email = models.EmailField()
+    from_email = models.CharField(max_length=254, blank=True)
+    subject = models.CharField(max_length=255)
+    body_text = models.TextField()
+    body_html = models.TextField(blank=True)
+    dedupe_key = models.CharField(max_length=64, help_text="Hash of template + recipient (+ content key)")
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(null=True, blank=True, help_text="When a worker picked it up")
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+            models.Index(fields=['dedupe_key', '-created_at']),
+        ]
+        verbose_name = 'Outgoing Email'
+        verbose_name_plural = 'Outgoing Emails'
+
+    def __str__(self):
+        return f"{self.get_status_display()} - {self.template} to {self.to_email}"
+
+
 class UserSession(models.Model):
     """
     Tracks active user sessions across multiple devices.
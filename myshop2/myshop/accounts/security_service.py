@@ -1,7 +1,16 @@
 """
 Production-Grade Login Security Service
 Implements 5-tier progressive security with speed-based attack detection.
+
+Progressive delays never sleep inside the request: after a failed login the next attempt
+for that email is allowed only once the tier's delay has passed since the last failure.
+Earlier attempts are rejected at once (429 + Retry-After) without checking the password,
+so an attack burst can't tie up the workers that legitimate logins need.
+
+Failure counts come from the time-bucketed counters in login_counters: one cache
+multi-get per check with a shared cache, otherwise one query over LoginAttempt.
 """
+import math
 import time
 import logging
 from datetime import timedelta
@@ -10,6 +19,8 @@ from django.core.cache import cache
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
+from .login_counters import login_failure_counters
+
 logger = logging.getLogger('security')
 
 # Import models - these will be available after Django initialization
@@ -47,7 +58,7 @@ class SecurityConfig:
     HOUR_WINDOW = 3600      # seconds
     DAY_WINDOW = 86400      # seconds
     
-    # Progressive delays (in seconds)
+    # Progressive delays (in seconds): minimum time between the last failure and the next attempt
     TIER_2_DELAY = 2        # 2 seconds
     TIER_3_DELAY = 5        # 5 seconds
     TIER_4_DELAY = 10       # 10 seconds
@@ -127,32 +138,23 @@ class LoginSecurityService:
         )
         
         if not success:
+            login_failure_counters.record_failure(self.email, self.ip_address)
             logger.warning(
                 f"Failed login: {self.email} from {self.ip_address} "
                 f"(Tier {security_tier}, Reason: {failure_reason})"
             )
     
+    def failure_snapshot(self):
+        """Failure counters of this email and IP (see login_counters)"""
+        return login_failure_counters.snapshot(self.email, self.ip_address)
+    
     def get_failed_attempts_count(self, time_window_seconds):
-        """Get count of failed attempts within time window"""
-        _ensure_models_loaded()
-        since = timezone.now() - timedelta(seconds=time_window_seconds)
-        
-        return LoginAttempt.objects.filter(
-            email=self.email,
-            success=False,
-            created_at__gte=since
-        ).count()
+        """Get count of failed attempts within time window (up to 24 hours)"""
+        return self.failure_snapshot().count('email', time_window_seconds)
     
     def get_failed_attempts_from_ip(self, time_window_seconds):
-        """Get count of failed attempts from this IP within time window"""
-        _ensure_models_loaded()
-        since = timezone.now() - timedelta(seconds=time_window_seconds)
-        
-        return LoginAttempt.objects.filter(
-            ip_address=self.ip_address,
-            success=False,
-            created_at__gte=since
-        ).count()
+        """Get count of failed attempts from this IP within time window (up to 1 hour)"""
+        return self.failure_snapshot().count('ip', time_window_seconds)
     
     # ========================================================================
     # ACCOUNT LOCK MANAGEMENT
@@ -266,6 +268,24 @@ class LoginSecurityService:
     # TIER DETERMINATION
     # ========================================================================
     
+    @staticmethod
+    def tier_for_failed_count(failed_count, fast_attack=False):
+        """
+        Tier and progressive delay for a number of failed attempts in the last 24 hours.
+        Returns: (tier, delay_seconds)
+        """
+        if fast_attack:
+            return 5, 0
+        if failed_count <= SecurityConfig.TIER_1_MAX:
+            return 1, 0
+        if failed_count <= SecurityConfig.TIER_2_MAX:
+            return 2, SecurityConfig.TIER_2_DELAY
+        if failed_count <= SecurityConfig.TIER_3_MAX:
+            return 3, SecurityConfig.TIER_3_DELAY
+        if failed_count <= SecurityConfig.TIER_4_MAX:
+            return 4, SecurityConfig.TIER_4_DELAY
+        return 5, 0
+    
     def determine_security_tier(self):
         """
         Determine which security tier should be applied based on failed attempts.
@@ -281,16 +301,8 @@ class LoginSecurityService:
         failed_count = self.get_failed_attempts_count(SecurityConfig.DAY_WINDOW)
         
         # Determine tier and delay
-        if failed_count <= SecurityConfig.TIER_1_MAX:
-            return 1, failed_count, 0
-        elif failed_count <= SecurityConfig.TIER_2_MAX:
-            return 2, failed_count, SecurityConfig.TIER_2_DELAY
-        elif failed_count <= SecurityConfig.TIER_3_MAX:
-            return 3, failed_count, SecurityConfig.TIER_3_DELAY
-        elif failed_count <= SecurityConfig.TIER_4_MAX:
-            return 4, failed_count, SecurityConfig.TIER_4_DELAY
-        else:
-            return 5, failed_count, 0
+        tier, delay = self.tier_for_failed_count(failed_count)
+        return tier, failed_count, delay
     
     # ========================================================================
     # MAIN SECURITY CHECK
@@ -299,12 +311,14 @@ class LoginSecurityService:
     def check_security(self):
         """
         Main security check before allowing login attempt.
-        OPTIMIZED: Single database query instead of 5 separate queries.
+        OPTIMIZED: Every count comes from one failure snapshot (see login_counters).
         
         Returns: {
             'allowed': bool,
             'tier': int,
             'delay': int (seconds),
+            'throttled': bool (rejected until retry_after; the password isn't checked),
+            'retry_after': int (seconds),
             'message': str,
             'requires_captcha': bool,
             'requires_verification': bool,
@@ -316,6 +330,8 @@ class LoginSecurityService:
             'allowed': True,
             'tier': 1,
             'delay': 0,
+            'throttled': False,
+            'retry_after': 0,
             'message': '',
             'requires_captcha': False,
             'requires_verification': False,
@@ -334,31 +350,23 @@ class LoginSecurityService:
             })
             return result
         
-        # 2. OPTIMIZED: Fetch ALL failed attempts at once (ONE query instead of 4)
-        _ensure_models_loaded()
-        since_day = timezone.now() - timedelta(seconds=SecurityConfig.DAY_WINDOW)
-        
-        # Get all failed attempts for this email in last 24 hours
-        failed_attempts = list(LoginAttempt.objects.filter(
-            email=self.email,
-            success=False,
-            created_at__gte=since_day
-        ).values_list('created_at', 'ip_address'))
-        
-        # Process in memory (fast!) instead of 4 separate database queries
-        now = timezone.now()
-        failed_count_day = len(failed_attempts)
-        failed_count_hour = sum(1 for dt, _ in failed_attempts if (now - dt).total_seconds() <= SecurityConfig.HOUR_WINDOW)
-        failed_count_minute = sum(1 for dt, _ in failed_attempts if (now - dt).total_seconds() <= SecurityConfig.MINUTE_WINDOW)
-        failed_from_ip_hour = sum(1 for dt, ip in failed_attempts if ip == self.ip_address and (now - dt).total_seconds() <= SecurityConfig.HOUR_WINDOW)
+        # 2. OPTIMIZED: Read all counters at once (one cache multi-get or one query)
+        snapshot = self.failure_snapshot()
+        failed_count_day = snapshot.count('email', SecurityConfig.DAY_WINDOW)
+        failed_count_minute = snapshot.count('email', SecurityConfig.MINUTE_WINDOW)
+        failed_from_ip_hour = snapshot.count('ip', SecurityConfig.HOUR_WINDOW)
         
         # Fast attack detection (2 min window)
-        failed_fast = sum(1 for dt, _ in failed_attempts if (now - dt).total_seconds() <= 120)
+        failed_fast = snapshot.count('email', SecurityConfig.FAST_ATTACK_WINDOW)
         
-        # 3. Check IP rate limiting (using in-memory data)
+        # 3. Check rate limiting
         if failed_count_minute >= SecurityConfig.MAX_PER_MINUTE:
             result.update({
                 'allowed': False,
+                'throttled': True,
+                'retry_after': snapshot.seconds_until_below(
+                    'email', SecurityConfig.MAX_PER_MINUTE, SecurityConfig.MINUTE_WINDOW
+                ),
                 'message': 'Too many login attempts. Please wait a minute.',
             })
             return result
@@ -366,29 +374,36 @@ class LoginSecurityService:
         if failed_from_ip_hour >= SecurityConfig.MAX_PER_HOUR:
             result.update({
                 'allowed': False,
+                'throttled': True,
+                'retry_after': snapshot.seconds_until_below(
+                    'ip', SecurityConfig.MAX_PER_HOUR, SecurityConfig.HOUR_WINDOW
+                ),
                 'message': 'Too many failed attempts from your IP. Please try again later.',
             })
             return result
         
-        # 3. Determine security tier (using in-memory data - no extra queries!)
-        # Check for fast attack
-        if failed_fast >= SecurityConfig.FAST_ATTACK_THRESHOLD:
-            tier, delay = 5, 0
-        elif failed_count_day <= SecurityConfig.TIER_1_MAX:
-            tier, delay = 1, 0
-        elif failed_count_day <= SecurityConfig.TIER_2_MAX:
-            tier, delay = 2, SecurityConfig.TIER_2_DELAY
-        elif failed_count_day <= SecurityConfig.TIER_3_MAX:
-            tier, delay = 3, SecurityConfig.TIER_3_DELAY
-        elif failed_count_day <= SecurityConfig.TIER_4_MAX:
-            tier, delay = 4, SecurityConfig.TIER_4_DELAY
-        else:
-            tier, delay = 5, 0
+        # 3. Determine security tier (from the same snapshot - no extra queries!)
+        tier, delay = self.tier_for_failed_count(
+            failed_count_day, fast_attack=failed_fast >= SecurityConfig.FAST_ATTACK_THRESHOLD
+        )
         
         result['tier'] = tier
         result['delay'] = delay
         result['failed_count'] = failed_count_day
         
+        # Progressive delay: too soon after the last failure -> reject now, don't sleep
+        since_last_failure = snapshot.seconds_since_last_failure()
+        if delay and since_last_failure is not None:
+            wait = delay - since_last_failure
+            if wait > 0:
+                result.update({
+                    'allowed': False,
+                    'throttled': True,
+                    'retry_after': math.ceil(wait),
+                    'message': f'Too many failed attempts. Please wait {math.ceil(wait)} second(s) before trying again.',
+                })
+                return result
+        
         # 4. Apply tier-specific rules
         if tier == 1:
             # Normal operation
@@ -434,16 +449,13 @@ class LoginSecurityService:
         """
         Handle a failed login attempt with all security measures.
         
-        Returns: Same format as check_security() plus action taken
+        Returns: Same format as check_security() plus action taken, with retry_after set to
+        the delay the next attempt must wait (enforced by check_security, nothing sleeps here)
         """
         # Get security status
         security = self.check_security()
         tier = security['tier']
         
-        # Apply progressive delay (simulate processing time)
-        if security['delay'] > 0:
-            time.sleep(security['delay'])
-        
         # Record the attempt
         self.record_attempt(
             success=False,
@@ -466,6 +478,9 @@ class LoginSecurityService:
             code = self.create_verification_code()
             security['verification_code_sent'] = True
         
+        # Delay before the next attempt, counting this failure
+        _, security['retry_after'] = self.tier_for_failed_count(security['failed_count'] + 1)
+        
         return security
     
     # ========================================================================
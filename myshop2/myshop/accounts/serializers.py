@@ -1,7 +1,8 @@
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.exceptions import TokenError
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
-from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.exceptions import AuthenticationFailed, Throttled, ValidationError
 from .models import Customer, Address
 from .security_service import LoginSecurityService
 from .email_service import SecurityEmailService
@@ -15,6 +16,7 @@ class EmailTokenObtainPairSerializer(TokenObtainPairSerializer):
     """
     Enhanced JWT Token serializer with 5-tier progressive security.
     Implements rate limiting, progressive delays, CAPTCHA, email verification, and account locking.
+    Progressive delays are enforced as 429 + Retry-After on attempts that come too early.
     """
     username_field = User.EMAIL_FIELD
     
@@ -47,20 +49,25 @@ class EmailTokenObtainPairSerializer(TokenObtainPairSerializer):
                 # STEP 1: Pre-authentication security checks
                 # ====================================================================
                 security_check = security.check_security()
-                
-                if not security_check['allowed']:
-                    # Account is locked or rate limited
-                    security.record_attempt(
-                        success=False,
-                        failure_reason=security_check.get('message', 'rate_limited'),
-                        security_tier=security_check['tier']
-                    )
-                    raise AuthenticationFailed(security_check['message'])
             except Exception as e:
                 # Security features failed, log and continue without them
                 logger.warning(f"Security features unavailable: {str(e)}")
                 security = None
                 security_check = None
+            
+            if security_check and not security_check['allowed']:
+                if security_check.get('throttled'):
+                    # Too soon after the last failure: answer 429 + Retry-After right away.
+                    # The password isn't checked, so this isn't recorded as a failed attempt.
+                    raise Throttled(wait=security_check['retry_after'], detail=security_check['message'])
+                
+                # Account is locked
+                security.record_attempt(
+                    success=False,
+                    failure_reason='account_locked',
+                    security_tier=security_check['tier']
+                )
+                raise AuthenticationFailed(security_check['message'])
         
         tier = security_check['tier'] if security_check else 1
         
@@ -132,12 +139,12 @@ class EmailTokenObtainPairSerializer(TokenObtainPairSerializer):
             # ================================================================
             try:
                 from .session_utils import create_or_update_session
-                from rest_framework_simplejwt.tokens import RefreshToken
+                from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
                 from django.db import OperationalError
                 
-                # Get the tokens
+                # Get the tokens (the access token that was issued, so its jti identifies the session)
                 refresh = RefreshToken(data['refresh'])
-                access = refresh.access_token
+                access = AccessToken(data['access'])
                 
                 # Create/update session
                 session = create_or_update_session(
@@ -231,27 +238,37 @@ class CustomTokenRefreshSerializer(TokenRefreshSerializer):
     Prevents use of tokens that were invalidated via "logout all devices".
     """
     def validate(self, attrs):
-        from .session_utils import validate_token_version
+        from .session_activity import UnknownUser, get_token_state
+        from .session_utils import rotate_session_tokens
+        from rest_framework_simplejwt.state import token_backend
         
         # First validate the refresh token normally
         refresh = self.token_class(attrs["refresh"])
         
-        # Get user and validate token version
+        # Validate token version and account state (one query, so revocation applies at once)
         try:
-            user_id = refresh.payload.get('user_id')
-            User = get_user_model()
-            user = User.objects.get(id=user_id)
-            
-            # Check if token version matches
-            if not validate_token_version(user, refresh.payload):
-                raise TokenError("Token has been invalidated. Please login again.")
-        
-        except User.DoesNotExist:
+            token_version, is_active = get_token_state(refresh.payload.get('user_id'))
+        except UnknownUser:
             raise TokenError("User no longer exists")
+        if refresh.payload.get('token_version', 0) != token_version:
+            raise TokenError("Token has been invalidated. Please login again.")
+        if not is_active:
+            raise TokenError("User account is disabled.")
         
         # Continue with normal validation
+        old_refresh_jti = refresh.payload.get('jti')
         data = super().validate(attrs)
         data['user_id'] = refresh.payload.get('user_id')
+        
+        # Keep the session pointing at the new tokens, for activity tracking and revocation
+        try:
+            rotate_session_tokens(
+                old_refresh_jti,
+                access_token=token_backend.decode(data['access']),
+                refresh_token=token_backend.decode(data['refresh']) if 'refresh' in data else refresh.payload,
+            )
+        except Exception as e:
+            logger.warning(f"Could not update session after refresh: {str(e)}")
         return data
 
 class UserSerializer(serializers.ModelSerializer):
@@ -0,0 +1,167 @@
+"""
+Session activity and token-version checks without a database write per request.
+
+- ``touch_session()`` runs on every JWT-authenticated request (ActivityJWTAuthentication).
+  It stores the time in the cache. At most once per SESSION_ACTIVITY_FLUSH_SECONDS per
+  session, the session is queued for a flush. Queued sessions get their last_activity
+  written with one bulk_update, once the process has SESSION_ACTIVITY_FLUSH_BATCH of
+  them or the interval has passed. Screens that list sessions overlay the cached times
+  (``apply_cached_activity``), so they are current even between flushes.
+  Queued sessions are also flushed on later requests and by a timer once the interval
+  has passed, so a process that goes idle still writes what it queued.
+- ``get_token_state()`` reads a user's token_version and is_active with one query. It is
+  deliberately not cached: a per-process cache would keep accepting tokens on the other
+  workers after "log out all devices", deactivation (also by queryset update) or deletion.
+
+Sessions are identified by the jti of their current access token (UserSession.session_key),
+which the refresh serializer updates when tokens rotate.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('security')
+
+FLUSH_SECONDS = getattr(settings, 'SESSION_ACTIVITY_FLUSH_SECONDS', 5 * 60)
+FLUSH_BATCH = getattr(settings, 'SESSION_ACTIVITY_FLUSH_BATCH', 100)
+# Cached activity must outlive a flush interval, plus the wait for a flush
+ACTIVITY_TIMEOUT = 4 * FLUSH_SECONDS
+SESSION_ID_TIMEOUT = 24 * 60 * 60
+
+_pending = set()  # session ids waiting for a flush in this process
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+_flush_timer = None
+
+
+def _session_id_key(session_key):
+    return f'session_activity:id:{session_key}'
+
+
+def _last_seen_key(session_id):
+    return f'session_activity:last:{session_id}'
+
+
+def _flush_gate_key(session_id):
+    return f'session_activity:gate:{session_id}'
+
+
+def remember_session(session):
+    """Cache the id of a session under its access-token jti (after login or refresh)."""
+    cache.set(_session_id_key(session.session_key), session.pk, SESSION_ID_TIMEOUT)
+
+
+def _session_id(session_key):
+    session_id = cache.get(_session_id_key(session_key))
+    if session_id is None:
+        from .models import UserSession
+
+        # 0: no session for this token (e.g. issued before session tracking); don't look again
+        session_id = UserSession.objects.filter(session_key=session_key).values_list('pk', flat=True).first() or 0
+        cache.set(_session_id_key(session_key), session_id, SESSION_ID_TIMEOUT)
+    return session_id
+
+
+def touch_session(session_key, now=None):
+    """Record activity on the session whose access token has jti ``session_key``."""
+    if not session_key:
+        return
+    session_id = _session_id(session_key)
+    if not session_id:
+        return
+    now = now or time.time()
+    cache.set(_last_seen_key(session_id), now, ACTIVITY_TIMEOUT)
+    queued = cache.add(_flush_gate_key(session_id), True, FLUSH_SECONDS)
+    with _pending_lock:
+        if queued:
+            _pending.add(session_id)
+            _schedule_flush()
+        due = bool(_pending) and (len(_pending) >= FLUSH_BATCH or time.monotonic() - _last_flush >= FLUSH_SECONDS)
+    if due:
+        flush_session_activity()
+
+
+def _timed_flush():
+    from django.db import connection
+
+    try:
+        flush_session_activity()
+    finally:
+        # Runs in its own thread, with its own connection
+        connection.close()
+
+
+def _schedule_flush():
+    """Flush the queue once the interval has passed, even if no request comes. Called with _pending_lock held."""
+    global _flush_timer
+    if _flush_timer is not None:
+        return
+    _flush_timer = threading.Timer(FLUSH_SECONDS, _timed_flush)
+    _flush_timer.daemon = True
+    _flush_timer.start()
+
+
+def flush_session_activity():
+    """Write the cached last_activity of queued sessions with one bulk_update. Returns the count."""
+    from .models import UserSession
+
+    global _last_flush, _flush_timer
+    with _pending_lock:
+        session_ids = list(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+    if not session_ids:
+        return 0
+
+    keys = {_last_seen_key(session_id): session_id for session_id in session_ids}
+    sessions = [
+        UserSession(pk=keys[key], last_activity=datetime.fromtimestamp(timestamp, tz=dt_timezone.utc))
+        for key, timestamp in cache.get_many(list(keys)).items()
+    ]
+    try:
+        UserSession.objects.bulk_update(sessions, ['last_activity'])
+    except Exception as e:
+        # Activity is best effort; the cached times are still shown until they expire
+        logger.warning(f"Could not flush session activity: {str(e)}")
+        return 0
+    return len(sessions)
+
+
+def apply_cached_activity(sessions):
+    """Set last_activity of the given sessions to their cached time when it is newer."""
+    sessions = list(sessions)
+    cached = cache.get_many([_last_seen_key(session.pk) for session in sessions])
+    for session in sessions:
+        timestamp = cached.get(_last_seen_key(session.pk))
+        if timestamp is not None:
+            seen = datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+            if session.last_activity is None or seen > session.last_activity:
+                session.last_activity = seen
+    return sessions
+
+
+class UnknownUser(Exception):
+    """The user of a token no longer exists"""
+
+
+def get_token_state(user_id):
+    """
+    (token_version, is_active) of a user, read from the database (one query).
+    token_version may be None for old rows.
+
+    Raises:
+        UnknownUser: if there is no such user
+    """
+    from django.contrib.auth import get_user_model
+
+    state = get_user_model().objects.filter(pk=user_id).values_list('token_version', 'is_active').first()
+    if state is None:
+        raise UnknownUser(user_id)
+    return state
@@ -4,9 +4,11 @@ Device fingerprinting, session tracking, and helper functions
 """
 
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone as dt_timezone
 import re
 
+from .session_activity import remember_session
+
 # Optional import - if user_agents is not installed, use fallback
 try:
     import user_agents
@@ -148,13 +150,7 @@ def create_or_update_session(user, request, access_token, refresh_token):
     access_jti = str(access_token.get('jti', ''))
     refresh_jti = str(refresh_token.get('jti', ''))
     
-    # Calculate expiration (from refresh token)
-    refresh_exp = refresh_token.get('exp')
-    if refresh_exp:
-        expires_at = timezone.datetime.fromtimestamp(refresh_exp, tz=timezone.utc)
-    else:
-        # Default: 30 days
-        expires_at = timezone.now() + timedelta(days=30)
+    expires_at = _refresh_expiry(refresh_token)
     
     # Check if session already exists for this device
     device_id = device_info.get('device_id')
@@ -178,7 +174,11 @@ def create_or_update_session(user, request, access_token, refresh_token):
         existing_session.expires_at = expires_at
         existing_session.location_city = location['city']
         existing_session.location_country = location['country']
-        existing_session.save()
+        existing_session.save(update_fields=[
+            'session_key', 'refresh_token_jti', 'ip_address', 'user_agent', 'last_activity',
+            'expires_at', 'location_city', 'location_country',
+        ])
+        remember_session(existing_session)
         return existing_session
     else:
         # Create new session
@@ -197,9 +197,41 @@ def create_or_update_session(user, request, access_token, refresh_token):
             location_country=location['country'],
             expires_at=expires_at,
         )
+        remember_session(session)
         return session
 
 
+def _refresh_expiry(refresh_token):
+    """Session expiration from a refresh token payload"""
+    refresh_exp = refresh_token.get('exp')
+    if refresh_exp:
+        return datetime.fromtimestamp(refresh_exp, tz=dt_timezone.utc)
+    # Default: 30 days
+    return timezone.now() + timedelta(days=30)
+
+
+def rotate_session_tokens(old_refresh_jti, access_token, refresh_token):
+    """
+    Point a session at the tokens issued by a refresh (one UPDATE).
+    
+    Args:
+        old_refresh_jti: JTI of the refresh token that was used
+        access_token: new JWT access token payload
+        refresh_token: new JWT refresh token payload
+    
+    Returns:
+        int: number of sessions updated (0 if the refresh token has no session)
+    """
+    from .models import UserSession
+    
+    return UserSession.objects.filter(refresh_token_jti=old_refresh_jti, is_active=True).update(
+        session_key=str(access_token.get('jti', '')),
+        refresh_token_jti=str(refresh_token.get('jti', '')),
+        expires_at=_refresh_expiry(refresh_token),
+        last_activity=timezone.now(),
+    )
+
+
 def validate_token_version(user, token):
     """
     Validate that the token's version matches the user's current token_version.
@@ -218,23 +250,9 @@ def validate_token_version(user, token):
 
 def cleanup_expired_sessions():
     """
-    Clean up expired sessions.
-    Should be run periodically (e.g., daily cron job).
+    Deactivate expired sessions, in primary-key batches.
+    Run periodically by the security_maintenance command.
     """
-    from .models import UserSession
-    
-    cutoff = timezone.now()
-    expired = UserSession.objects.filter(
-        is_active=True,
-        expires_at__lt=cutoff
-    )
+    from .maintenance import expire_sessions
     
-    count = expired.count()
-    expired.update(
-        is_active=False,
-        revoked_at=cutoff,
-        revoked_reason='expired'
-    )
-    
-    return count
-
+    return expire_sessions(timezone.now()).rows
@@ -1,3 +1,446 @@
+import json
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from accounts.email_outbox import queue_email, retry_delay, send_queued_emails
+from accounts.login_counters import login_failure_counters
+from accounts.models import Customer, LoginAttempt, LoginAttemptDailyStats, OutgoingEmail, UserSession
+from accounts.security_service import LoginSecurityService, SecurityConfig
+from accounts import session_activity
+from accounts.maintenance import run_in_pk_batches
+from accounts.models import AccountLock, VerificationCode
+from suppliers.models import SupplierInvitation
+
+
+class ProgressiveLoginDelayTest(TestCase):
+    email = 'user@example.com'
+
+    def setUp(self):
+        cache.clear()
+        Customer.objects.create_user(username='user', email=self.email, password='correct-password',
+                                     first_name='Test', last_name='User')
+
+    def _login(self, password):
+        return self.client.post('/accounts/token/', data=json.dumps({'email': self.email, 'password': password}),
+                                content_type='application/json')
+
+    def _fail(self, count):
+        for _ in range(count):
+            self.assertEqual(self._login('wrong').status_code, 401)
+
+    def _age_attempts(self, seconds):
+        LoginAttempt.objects.update(created_at=timezone.now() - timedelta(seconds=seconds))
+        cache.clear()  # counters are rebuilt from the aged rows
+
+    @patch('time.sleep')
+    def test_early_retry_is_rejected_without_sleeping(self, sleep):
+        self._fail(4)  # tier 2: 2 seconds between attempts
+        response = self._login('correct-password')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
+        sleep.assert_not_called()
+        # Throttled attempts don't count as failures
+        self.assertEqual(LoginAttempt.objects.count(), 4)
+
+        self._age_attempts(3)
+        response = self._login('correct-password')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn('access', response.json())
+
+    def test_delay_grows_with_tier(self):
+        for _ in range(6):
+            self._fail(1)
+            self._age_attempts(71)  # out of the per-minute window, including its 10-second bucket
+        # 7 failures: tier 3, 5 seconds between attempts
+        self._fail(1)
+        response = self._login('wrong')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '5')
+
+    def test_per_minute_limit_reports_retry_after(self):
+        for seconds in (50, 40, 30, 20, 10):
+            LoginAttempt.objects.create(email=self.email, ip_address='127.0.0.1', success=False,
+                                        failure_reason='invalid_credentials', security_tier=1)
+            LoginAttempt.objects.filter(created_at__gt=timezone.now() - timedelta(seconds=1)).update(
+                created_at=timezone.now() - timedelta(seconds=seconds)
+            )
+        response = self._login('correct-password')
+        self.assertEqual(response.status_code, 429)
+        # The oldest failure leaves the window in 10 seconds, rounded up to its 10-second bucket
+        self.assertTrue(10 <= int(response['Retry-After']) <= 20, response['Retry-After'])
+
+
+class LoginFailureCountersTest(TestCase):
+    email = 'user@example.com'
+    ip = '10.0.0.1'
+
+    def setUp(self):
+        cache.clear()
+        # The counters are only kept in a cache shared by every worker
+        shared = patch('accounts.login_counters.is_shared_cache', return_value=True)
+        shared.start()
+        self.addCleanup(shared.stop)
+
+    def _attempt(self, seconds_ago, email=None, ip=None, success=False):
+        attempt = LoginAttempt.objects.create(email=email or self.email, ip_address=ip or self.ip, success=success)
+        LoginAttempt.objects.filter(pk=attempt.pk).update(created_at=timezone.now() - timedelta(seconds=seconds_ago))
+
+    def test_counts_are_rebuilt_from_login_attempts(self):
+        for seconds_ago in (30, 90, 1800, 7200, 90000):
+            self._attempt(seconds_ago)
+        self._attempt(30, ip='10.0.0.2')
+        self._attempt(30, email='other@example.com')
+        self._attempt(30, success=True)
+
+        snapshot = login_failure_counters.snapshot(self.email, self.ip)
+        self.assertEqual(snapshot.count('email', SecurityConfig.MINUTE_WINDOW), 2)
+        self.assertEqual(snapshot.count('email', SecurityConfig.HOUR_WINDOW), 4)
+        self.assertEqual(snapshot.count('email', SecurityConfig.DAY_WINDOW), 5)
+        self.assertEqual(snapshot.count('ip', SecurityConfig.MINUTE_WINDOW), 2)
+        self.assertEqual(snapshot.count('ip', SecurityConfig.HOUR_WINDOW), 4)
+        self.assertAlmostEqual(snapshot.seconds_since_last_failure(), 30, delta=2)
+
+    def test_warm_check_runs_no_queries(self):
+        self._attempt(30)
+        login_failure_counters.snapshot(self.email, self.ip)
+        login_failure_counters.record_failure(self.email, self.ip)
+        with CaptureQueriesContext(connection) as queries:
+            snapshot = login_failure_counters.snapshot(self.email, self.ip)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(snapshot.count('email', SecurityConfig.MINUTE_WINDOW), 2)
+        self.assertEqual(snapshot.count('ip', SecurityConfig.HOUR_WINDOW), 2)
+        self.assertLess(snapshot.seconds_since_last_failure(), 2)
+
+    def test_security_check_does_not_count_rows(self):
+        self._attempt(30)
+        request = type('Request', (), {'META': {'REMOTE_ADDR': self.ip}})()
+        LoginSecurityService(request, self.email).check_security()
+        with CaptureQueriesContext(connection) as queries:
+            result = LoginSecurityService(request, self.email).check_security()
+        self.assertTrue(result['allowed'])
+        self.assertFalse([q for q in queries if 'login_attempt' in q['sql'].lower()])
+
+    def test_per_process_cache_counts_from_login_attempts(self):
+        self._attempt(30)
+        with patch('accounts.login_counters.is_shared_cache', return_value=False):
+            login_failure_counters.snapshot(self.email, self.ip)
+            # Recorded by another worker: no counter saw it
+            self._attempt(20, email='other@example.com')
+            self._attempt(10)
+            with CaptureQueriesContext(connection) as queries:
+                snapshot = login_failure_counters.snapshot(self.email, self.ip)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(snapshot.count('email', SecurityConfig.MINUTE_WINDOW), 2)
+        self.assertEqual(snapshot.count('ip', SecurityConfig.MINUTE_WINDOW), 3)
+        self.assertAlmostEqual(snapshot.seconds_since_last_failure(), 10, delta=2)
+
+
+class RollupLoginAttemptsTest(TestCase):
+
+    def _attempt(self, days_ago, **fields):
+        attempt = LoginAttempt.objects.create(ip_address=fields.pop('ip_address', '10.0.0.1'), **fields)
+        LoginAttempt.objects.filter(pk=attempt.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+
+    def test_old_attempts_are_rolled_up_and_deleted(self):
+        self._attempt(40, email='a@example.com', failure_reason='invalid_credentials')
+        self._attempt(40, email='b@example.com', failure_reason='invalid_credentials', ip_address='10.0.0.2')
+        self._attempt(40, email='a@example.com', success=True)
+        self._attempt(35, email='a@example.com', failure_reason='invalid_credentials')
+        self._attempt(1, email='a@example.com', failure_reason='invalid_credentials')
+
+        call_command('rollup_login_attempts', '--days', '30', '--batch-size', '1', stdout=StringIO())
+
+        self.assertEqual(LoginAttempt.objects.count(), 1)
+        failed = LoginAttemptDailyStats.objects.filter(success=False, failure_reason='invalid_credentials')
+        self.assertEqual(failed.count(), 2)
+        oldest = failed.order_by('day').first()
+        self.assertEqual((oldest.attempts, oldest.unique_emails, oldest.unique_ips), (2, 2, 2))
+        self.assertEqual(LoginAttemptDailyStats.objects.get(success=True).attempts, 1)
+
+        # Nothing left to roll up: running again changes nothing
+        call_command('rollup_login_attempts', '--days', '30', stdout=StringIO())
+        self.assertEqual(LoginAttemptDailyStats.objects.get(success=True).attempts, 1)
+
+
+class CountingEmailBackend(LocmemEmailBackend):
+    """Locmem backend that counts connections and bounces @bounce.test recipients"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.opened = 0
+        self.is_open = False
+
+    def open(self):
+        if self.is_open:
+            return False
+        self.opened += 1
+        self.is_open = True
+        return True
+
+    def close(self):
+        self.is_open = False
+
+    def send_messages(self, messages):
+        if any(to.endswith('@bounce.test') for message in messages for to in message.to):
+            raise ConnectionError('mailbox unavailable')
+        return super().send_messages(messages)
+
+
+class EmailOutboxTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.backend = CountingEmailBackend()
+        patcher = patch('accounts.email_outbox.get_connection', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batch_is_sent_over_one_connection(self):
+        for i in range(3):
+            queue_email('generic', f'user{i}@example.com', 'Hello', 'Text', '<p>Text</p>')
+        self.assertEqual(len(mail.outbox), 0)  # nothing is sent in the request
+
+        self.assertEqual(send_queued_emails(), (3, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(self.backend.opened, 1)
+        self.assertEqual(mail.outbox[0].alternatives[0][1], 'text/html')
+        self.assertEqual(OutgoingEmail.objects.filter(status='sent').count(), 3)
+        self.assertEqual(send_queued_emails(), (0, 0))
+
+    def test_without_a_worker_each_email_is_sent_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            queue_email('generic', 'user@example.com', 'Hello', 'Text')
+            self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(OutgoingEmail.objects.get().status, 'sent')
+
+        with self.settings(EMAIL_OUTBOX_WORKER=True), self.captureOnCommitCallbacks(execute=True):
+            queue_email('generic', 'other@example.com', 'Hello', 'Text')
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_same_template_and_recipient_is_queued_once_per_window(self):
+        self.assertIsNotNone(queue_email('account_locked', 'user@example.com', 'Locked', 'Text'))
+        self.assertIsNone(queue_email('account_locked', 'user@example.com', 'Locked', 'Text'))
+        cache.clear()  # the outbox itself still knows about the first one
+        self.assertIsNone(queue_email('account_locked', 'user@example.com', 'Locked', 'Text'))
+        self.assertIsNotNone(queue_email('account_locked', 'other@example.com', 'Locked', 'Text'))
+        # A new code is a different email
+        self.assertIsNotNone(queue_email('verification_code', 'user@example.com', 'Code', '1', dedupe_on='111111'))
+        self.assertIsNotNone(queue_email('verification_code', 'user@example.com', 'Code', '2', dedupe_on='222222'))
+        self.assertIsNone(queue_email('verification_code', 'user@example.com', 'Code', '2', dedupe_on='222222'))
+        self.assertEqual(OutgoingEmail.objects.count(), 4)
+
+    def test_failures_are_retried_with_backoff(self):
+        queue_email('generic', 'user@bounce.test', 'Hello', 'Text')
+        queue_email('generic', 'user@example.com', 'Hello', 'Text')
+        now = timezone.now()
+
+        self.assertEqual(send_queued_emails(now=now), (1, 1))
+        failed = OutgoingEmail.objects.get(to_email='user@bounce.test')
+        self.assertEqual((failed.status, failed.attempts), ('pending', 1))
+        self.assertEqual(failed.next_attempt_at, now + timedelta(seconds=retry_delay(1)))
+        self.assertIn('mailbox unavailable', failed.last_error)
+
+        # Not due yet
+        self.assertEqual(send_queued_emails(now=now + timedelta(seconds=1)), (0, 0))
+        later = now
+        for attempt in range(2, 6):
+            later += timedelta(seconds=retry_delay(attempt - 1))
+            self.assertEqual(send_queued_emails(now=later), (0, 1))
+        failed.refresh_from_db()
+        self.assertEqual((failed.status, failed.attempts), ('failed', 5))
+        self.assertEqual(send_queued_emails(now=later + timedelta(days=1)), (0, 0))
+
+    def test_emails_of_a_dead_worker_are_picked_up_again(self):
+        queue_email('generic', 'user@example.com', 'Hello', 'Text')
+        OutgoingEmail.objects.update(status='sending', claimed_at=timezone.now())
+        self.assertEqual(send_queued_emails(), (0, 0))
+        self.assertEqual(send_queued_emails(now=timezone.now() + timedelta(minutes=10)), (1, 0))
+
+
+class SessionActivityTest(TestCase):
+    email = 'user@example.com'
+
+    def setUp(self):
+        cache.clear()
+        session_activity._pending.clear()
+        timer = patch('accounts.session_activity.threading.Timer')
+        self.timer = timer.start()
+        self.addCleanup(timer.stop)
+        self.addCleanup(setattr, session_activity, '_flush_timer', None)
+        self.user = Customer.objects.create_user(username='user', email=self.email, password='correct-password',
+                                                 first_name='Test', last_name='User')
+
+    def _login(self, device_id):
+        response = self.client.post('/accounts/token/', data=json.dumps({
+            'email': self.email, 'password': 'correct-password', 'device_info': {'id': device_id, 'platform': 'ios'},
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def _get(self, tokens):
+        return self.client.get('/accounts/sessions/current/', HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+
+    def _refresh(self, tokens):
+        return self.client.post('/accounts/token/refresh/', data=json.dumps({'refresh': tokens['refresh']}),
+                                content_type='application/json')
+
+    @staticmethod
+    def _session_writes(queries):
+        return [q for q in queries if 'accounts_usersession' in q['sql'] and q['sql'].startswith('UPDATE')]
+
+    @patch('accounts.session_activity.FLUSH_BATCH', 2)
+    def test_activity_is_written_in_bulk_at_most_once_per_interval(self):
+        phone, tablet = self._login('phone'), self._login('tablet')
+        self.assertEqual(UserSession.objects.filter(user=self.user).count(), 2)
+        UserSession.objects.update(last_activity=timezone.now() - timedelta(hours=1))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self._get(phone).status_code, 200)
+            self.assertEqual(self._get(phone).status_code, 200)
+        self.assertEqual(self._session_writes(queries), [])
+
+        with CaptureQueriesContext(connection) as queries:
+            self._get(tablet)  # second queued session: one bulk UPDATE for both
+            for _ in range(3):
+                self._get(phone)
+                self._get(tablet)
+        self.assertEqual(len(self._session_writes(queries)), 1)
+        recent = timezone.now() - timedelta(minutes=1)
+        self.assertEqual(UserSession.objects.filter(last_activity__gte=recent).count(), 2)
+
+    def test_queued_activity_is_flushed_by_a_later_request_or_the_timer(self):
+        tokens = self._login('phone')
+        UserSession.objects.update(last_activity=timezone.now() - timedelta(hours=1))
+        self._get(tokens)
+        self.timer.assert_called_once_with(session_activity.FLUSH_SECONDS, session_activity._timed_flush)
+        self.timer.return_value.start.assert_called_once_with()
+
+        # The session is not queued again, but the interval has passed: this request flushes it
+        with patch('accounts.session_activity._last_flush', time.monotonic() - session_activity.FLUSH_SECONDS):
+            with CaptureQueriesContext(connection) as queries:
+                self._get(tokens)
+        self.assertEqual(len(self._session_writes(queries)), 1)
+        self.timer.return_value.cancel.assert_called_once_with()
+        self.assertGreater(UserSession.objects.get().last_activity, timezone.now() - timedelta(minutes=1))
+
+    def test_session_list_shows_cached_activity(self):
+        tokens = self._login('phone')
+        UserSession.objects.update(last_activity=timezone.now() - timedelta(hours=1))
+        self._get(tokens)
+        response = self.client.get('/accounts/sessions/', HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        last_activity = response.json()['sessions'][0]['last_activity']
+        self.assertGreater(last_activity, (timezone.now() - timedelta(minutes=1)).isoformat())
+
+    def test_refresh_checks_token_state_with_one_query(self):
+        tokens = self._login('phone')
+        tokens = {**tokens, **self._refresh(tokens).json()}
+        session = UserSession.objects.get(user=self.user)
+        self.assertEqual(session.refresh_token_jti, RefreshToken(tokens['refresh'])['jti'])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self._refresh(tokens)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(len([q for q in queries if 'accounts_customer' in q['sql']]), 1)
+        tokens = {**tokens, **response.json()}
+
+        # Revocation applies at once, also when it bypasses save()
+        Customer.objects.filter(pk=self.user.pk).update(is_active=False)
+        response = self._refresh(tokens)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['detail'], 'User account is disabled.')
+
+        Customer.objects.filter(pk=self.user.pk).update(is_active=True)
+        self.user.invalidate_all_tokens()
+        response = self._refresh(tokens)
+        self.assertEqual(response.status_code, 401)
+
+
+class SecurityMaintenanceTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = Customer.objects.create_user(username='user', email='user@example.com', password='pw',
+                                                 first_name='Test', last_name='User')
+
+    def _session(self, key, **fields):
+        return UserSession.objects.create(user=self.user, session_key=key, refresh_token_jti=key,
+                                          ip_address='10.0.0.1', **fields)
+
+    def test_cleans_every_table_in_batches(self):
+        now = timezone.now()
+        live = self._session('live', expires_at=now + timedelta(days=1))
+        expired = [self._session(f'expired{i}', expires_at=now - timedelta(hours=1)) for i in range(3)]
+        self._session('old', expires_at=now - timedelta(days=200), is_active=False,
+                      revoked_at=now - timedelta(days=100))
+        for days_ago in (40, 40, 1):
+            attempt = LoginAttempt.objects.create(email='user@example.com', ip_address='10.0.0.1')
+            LoginAttempt.objects.filter(pk=attempt.pk).update(created_at=now - timedelta(days=days_ago))
+        VerificationCode.objects.create(email='user@example.com', ip_address='10.0.0.1',
+                                        expires_at=now - timedelta(days=10))
+        VerificationCode.objects.create(email='user@example.com', ip_address='10.0.0.1')
+        lock = AccountLock.objects.create(email='user@example.com', expires_at=now - timedelta(minutes=1))
+        invitation = SupplierInvitation.objects.create(email='s@example.com', store_name='Store')
+        SupplierInvitation.objects.filter(pk=invitation.pk).update(expires_at=now - timedelta(hours=1))
+        old_invitation = SupplierInvitation.objects.create(email='o@example.com', store_name='Old store')
+        SupplierInvitation.objects.filter(pk=old_invitation.pk).update(status='expired',
+                                                                       expires_at=now - timedelta(days=60))
+
+        out = StringIO()
+        call_command('security_maintenance', '--batch-size', '2', stdout=out)
+
+        self.assertTrue(UserSession.objects.get(pk=live.pk).is_active)
+        self.assertFalse(UserSession.objects.filter(pk__in=[s.pk for s in expired], is_active=True).exists())
+        self.assertFalse(UserSession.objects.filter(session_key='old').exists())
+        self.assertEqual(LoginAttempt.objects.count(), 1)
+        self.assertEqual(LoginAttemptDailyStats.objects.get().attempts, 2)
+        self.assertEqual(VerificationCode.objects.count(), 1)
+        lock.refresh_from_db()
+        self.assertEqual((lock.is_active, lock.unlocked_by), (False, 'auto_expire'))
+        self.assertEqual(SupplierInvitation.objects.get(pk=invitation.pk).status, 'expired')
+        self.assertFalse(SupplierInvitation.objects.filter(pk=old_invitation.pk).exists())
+        self.assertIn('sessions.expire: 3 rows in 2 batches', out.getvalue())
+        self.assertIn('rows/s', out.getvalue())
+
+    def test_interrupted_step_is_picked_up_by_the_next_run(self):
+        sessions = [self._session(f's{i}', expires_at=timezone.now()) for i in range(5)]
+        calls = []
+
+        def fail_on_second_batch(batch):
+            calls.append(batch)
+            if len(calls) == 2:
+                raise RuntimeError('interrupted')
+            return batch.update(is_active=False)
+
+        active = UserSession.objects.filter(is_active=True)
+        with self.assertRaises(RuntimeError):
+            run_in_pk_batches('test.step', active, fail_on_second_batch, batch_size=2)
+        self.assertEqual(active.count(), 3)
+        result = run_in_pk_batches('test.step', active, fail_on_second_batch, batch_size=2)
+        self.assertEqual((result.rows, result.batches), (3, 2))
+        self.assertFalse(UserSession.objects.filter(pk__in=[s.pk for s in sessions], is_active=True).exists())
+
+    def test_rollup_counts_distinct_emails_and_ips_per_day(self):
+        now = timezone.now()
+        for i in range(5):
+            attempt = LoginAttempt.objects.create(email=f'user{i % 2}@example.com', ip_address='10.0.0.1')
+            LoginAttempt.objects.filter(pk=attempt.pk).update(created_at=now - timedelta(days=40))
+
+        call_command('rollup_login_attempts', '--batch-size', '2', stdout=StringIO())
 
-# Create your tests here.
+        stats = LoginAttemptDailyStats.objects.get()
+        self.assertEqual((stats.attempts, stats.unique_emails, stats.unique_ips), (5, 2, 1))
+        self.assertFalse(LoginAttempt.objects.exists())
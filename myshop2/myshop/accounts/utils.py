@@ -1,7 +1,17 @@
-from django.core.cache import cache
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.conf import settings
 from datetime import datetime, timedelta
 
+def is_shared_cache(alias):
+    """
+    True if every process sees the same entries in the cache ``alias``. Locmem (the
+    default) and dummy caches are per process, so counters and invalidations kept in
+    them don't reach the other workers.
+    """
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
+
 def get_client_ip(request):
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
@@ -10,6 +20,28 @@ def get_client_ip(request):
         ip = request.META.get('REMOTE_ADDR')
     return ip
 
+def _jwt_user_id(request):
+    """User ID from a valid Bearer token, without loading the user"""
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+    from rest_framework_simplejwt.settings import api_settings
+
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else None
+    if raw_token is None:
+        return None
+    try:
+        token = authentication.get_validated_token(raw_token)
+    except (InvalidToken, TokenError):
+        return None
+    return token.get(api_settings.USER_ID_CLAIM)
+
+def request_user_id(request):
+    """ID of the session or Bearer-token user of a request, None for guests"""
+    user = getattr(request, 'user', None)
+    return user.pk if user is not None and user.is_authenticated else _jwt_user_id(request)
+
 def is_rate_limited(request, key_prefix, max_attempts=5, cooldown_minutes=15):
     """
     Check if a request should be rate limited.
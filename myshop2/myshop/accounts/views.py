@@ -2,7 +2,6 @@ from django.shortcuts import render, redirect
 from django.contrib.auth import login, logout, get_user_model, authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.conf import settings
@@ -26,6 +25,7 @@ from .forms import (
 from .models import Customer, Address
 from shop.models import Product
 from .utils import is_rate_limited, get_client_ip
+from .email_outbox import queue_email
 from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
 from rest_framework import status
 from django.views.decorators.csrf import csrf_exempt
@@ -63,21 +63,7 @@ class CustomTokenRefreshView(TokenRefreshView):
                     status=status.HTTP_401_UNAUTHORIZED
                 )
             
-            # Check if user exists and is active
-            try:
-                user = User.objects.get(id=user_id)
-                if not user.is_active:
-                    return Response(
-                        {"detail": "User account is disabled."},
-                        status=status.HTTP_401_UNAUTHORIZED
-                    )
-            except User.DoesNotExist:
-                return Response(
-                    {"detail": "User no longer exists."},
-                    status=status.HTTP_401_UNAUTHORIZED
-                )
-            
-            # If we get here, the user exists and is active
+            # The serializer has checked that the user exists, is active and the token is current
             return Response(serializer.validated_data, status=status.HTTP_200_OK)
             
         except TokenError as e:
@@ -425,18 +411,9 @@ def register(request):
             plain_message = strip_tags(html_message)
             
             try:
-                # Send verification email (non-blocking - in background thread)
-                from django.core.mail import EmailMultiAlternatives
-                from accounts.email_service import send_email_async
-                
-                msg = EmailMultiAlternatives(
-                    subject='Verify your email address',
-                    body=plain_message,
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    to=[user.email]
-                )
-                msg.attach_alternative(html_message, "text/html")
-                send_email_async(msg)  # Non-blocking!
+                # Queue verification email (sent by run_email_worker)
+                queue_email('email_verification', user.email, 'Verify your email address',
+                            plain_message, html_message, dedupe_on=token or '')  # Non-blocking!
                 
                 print(f"DEBUG: Verification email queued for {user.email}")
                 
@@ -558,14 +535,9 @@ def password_reset_request(request):
                 html_message = render_to_string('accounts/email/password_reset_email.html', context)
                 plain_message = strip_tags(html_message)
                 
-                send_mail(
-                    'Password Reset Request',
-                    plain_message,
-                    settings.DEFAULT_FROM_EMAIL,
-                    [user.email],
-                    html_message=html_message,
-                    fail_silently=False,
-                )
+                # Queued, sent by run_email_worker
+                queue_email('password_reset', user.email, 'Password Reset Request',
+                            plain_message, html_message, dedupe_on=token)
                 
                 messages.success(request, 'Password reset instructions have been sent to your email.')
                 return redirect('accounts:login')
@@ -925,6 +897,7 @@ from django.utils.decorators import method_decorator
 from .security_service import validate_unlock_token, LoginSecurityService
 from .email_service import SecurityEmailService
 from .models import AccountLock, VerificationCode, LoginAttempt
+from .login_counters import login_failure_counters
 import logging
 
 logger = logging.getLogger('security')
@@ -1147,8 +1120,6 @@ class DeleteAccountView(APIView):
         import logging
         from django.contrib.auth.hashers import check_password
         from .models import LoginAttempt, AccountLock, VerificationCode
-        from accounts.email_service import send_email_async
-        from django.core.mail import EmailMultiAlternatives
         
         logger = logging.getLogger('security')
         
@@ -1195,6 +1166,7 @@ class DeleteAccountView(APIView):
                 email=f'deleted_user_{user_id}@deleted.local',
                 user_agent='[deleted]'
             )
+            login_failure_counters.reset(email=email)
             
             # Delete account locks
             deleted_locks = AccountLock.objects.filter(email=email).count()
@@ -1258,16 +1230,9 @@ If you did not request this deletion, please contact our support team immediatel
 This is an automated message. Your account data has been permanently removed from our systems.
                 """
                 
-                msg = EmailMultiAlternatives(
-                    subject='Account Deletion Confirmation',
-                    body=plain_message,
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    to=[email]
-                )
-                msg.attach_alternative(html_message, "text/html")
-                
-                # Send in background (non-blocking)
-                send_email_async(msg)
+                # Queued, sent by run_email_worker (non-blocking)
+                queue_email('account_deleted', email, 'Account Deletion Confirmation',
+                            plain_message, html_message)
                 
                 logger.info(f"Account deletion confirmation email queued for {email}")
             except Exception as email_error:
@@ -1355,8 +1320,10 @@ class UserSessionsListView(APIView):
         current_ip = get_client_ip(request)
         
         try:
-            # Get all active sessions
-            sessions = user.get_active_sessions()
+            # Get all active sessions, with activity not yet written to the database
+            from .session_activity import apply_cached_activity
+            sessions = apply_cached_activity(user.get_active_sessions())
+            sessions.sort(key=lambda session: session.last_activity, reverse=True)
         except OperationalError as e:
             # Table doesn't exist yet (migrations not run)
             logger.error(f"UserSession table not found: {str(e)}")
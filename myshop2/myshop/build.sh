@@ -20,6 +20,16 @@ echo ""
 echo "🔄 Running migrations..."
 python manage.py migrate --no-input
 
+# Fill the attribute filter index the first time (signals keep it current afterwards)
+echo ""
+echo "🗂  Building the attribute index..."
+python manage.py build_attribute_index --if-empty
+
+# Same for the product search documents
+echo ""
+echo "🔎 Building the search index..."
+python manage.py build_search_index --if-empty
+
 # Collect static files
 echo ""
 echo "📁 Collecting static files..."
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Load test: legitimate login throughput during a credential-stuffing burst.
+
+Runs a baseline phase (legitimate logins only), then an attack phase in which attacker
+threads try wrong passwords against a list of accounts while the legitimate threads keep
+logging in. Each request uses its own X-Forwarded-For address, like a botnet (and so the
+per-IP middleware limit doesn't hide the login path being measured).
+
+With progressive delays done by time.sleep() in the request, every attacker request past
+tier 1 holds a worker for 2-10 seconds and legitimate logins starve. With the retry-after
+model early attempts are answered 429 immediately and legitimate throughput holds.
+
+Usage (server with a single sync worker makes the difference obvious):
+    python manage.py runserver --nothreading 127.0.0.1:8000
+    python load_test_login.py --user user@example.com:password
+"""
+import argparse
+import random
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def random_ip():
+    return f"10.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(1, 254)}"
+
+
+def login(session, base_url, email, password, timeout):
+    start = time.perf_counter()
+    try:
+        response = session.post(
+            f"{base_url}/accounts/token/",
+            json={"email": email, "password": password},
+            headers={"X-Forwarded-For": random_ip()},
+            timeout=timeout,
+        )
+        status = response.status_code
+    except requests.RequestException:
+        status = "error"
+    return status, time.perf_counter() - start
+
+
+def run_phase(args, attackers, duration):
+    """Run legitimate (and attacker) threads for ``duration`` seconds and collect results"""
+    stop = threading.Event()
+    legit_results = []
+    attack_results = []
+    lock = threading.Lock()
+
+    def legit_worker(email, password):
+        session = requests.Session()
+        while not stop.is_set():
+            result = login(session, args.base_url, email, password, args.timeout)
+            with lock:
+                legit_results.append(result)
+
+    def attack_worker():
+        session = requests.Session()
+        while not stop.is_set():
+            victim = f"victim{random.randrange(args.victims)}@example.com"
+            result = login(session, args.base_url, victim, f"guess-{random.random()}", args.timeout)
+            with lock:
+                attack_results.append(result)
+
+    users = [user.split(":", 1) for user in args.user]
+    with ThreadPoolExecutor(max_workers=args.legit_threads + attackers) as pool:
+        for i in range(args.legit_threads):
+            email, password = users[i % len(users)]
+            pool.submit(legit_worker, email, password)
+        for _ in range(attackers):
+            pool.submit(attack_worker)
+        time.sleep(duration)
+        stop.set()
+    return legit_results, attack_results
+
+
+def report(name, legit_results, attack_results, duration):
+    ok = [elapsed for status, elapsed in legit_results if status == 200]
+    print(f"\n{name}")
+    print(f"  legitimate logins: {len(ok)} ok / {len(legit_results)} sent "
+          f"-> {len(ok) / duration:.1f} logins/s")
+    if ok:
+        ok.sort()
+        print(f"  latency: p50 {statistics.median(ok) * 1000:.0f} ms, "
+              f"p95 {ok[int(len(ok) * 0.95) - 1 if len(ok) > 1 else 0] * 1000:.0f} ms, "
+              f"max {ok[-1] * 1000:.0f} ms")
+    other = Counter(status for status, _ in legit_results if status != 200)
+    if other:
+        print(f"  legitimate non-200 responses: {dict(other)}")
+    if attack_results:
+        print(f"  attacker requests: {len(attack_results)} -> {dict(Counter(s for s, _ in attack_results))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--user", action="append", required=True,
+                        help="Legitimate account as email:password (repeatable)")
+    parser.add_argument("--victims", type=int, default=100,
+                        help="Number of accounts attacked (victim<N>@example.com; they needn't exist)")
+    parser.add_argument("--legit-threads", type=int, default=2)
+    parser.add_argument("--attackers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per phase")
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    legit, _ = run_phase(args, attackers=0, duration=args.duration)
+    report("Baseline (no attack)", legit, [], args.duration)
+    legit, attack = run_phase(args, attackers=args.attackers, duration=args.duration)
+    report(f"Under attack ({args.attackers} attacker threads)", legit, attack, args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -79,6 +79,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'shop.middleware.IdempotencyMiddleware',  # Replays retried checkout/cart requests (Idempotency-Key)
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
@@ -178,9 +179,64 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
-    }
+    },
+    # Rendered catalog API responses (shop.response_cache)
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog-responses',
+    },
 }
 
+# Set REDIS_URL to share the catalog response cache (and its generation counter) between workers
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES['catalog'] = {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': REDIS_URL,
+        'OPTIONS': {'CLIENT_CLASS': 'django_redis.client.DefaultClient'},
+        'KEY_PREFIX': 'myshop',
+    }
+
+CATALOG_CACHE_ALIAS = 'catalog'
+CATALOG_CACHE_TIMEOUT = 5 * 60
+
+# Rate-limit counters (shop.rate_limiting). With REDIS_URL they are shared by all workers
+# and updated with Lua scripts; otherwise each process counts in its local memory.
+RATE_LIMIT_CACHE_ALIAS = 'default'
+if REDIS_URL:
+    CACHES['ratelimit'] = {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': REDIS_URL,
+        'OPTIONS': {'CLIENT_CLASS': 'django_redis.client.DefaultClient'},
+        'KEY_PREFIX': 'myshop-rl',
+    }
+    RATE_LIMIT_CACHE_ALIAS = 'ratelimit'
+# 'fixed_window', 'sliding_window' or 'token_bucket'
+RATE_LIMIT_ALGORITHM = 'sliding_window'
+
+# Special-offer views/clicks (shop.offer_analytics) are buffered in this cache and flushed
+# every OFFER_ANALYTICS_FLUSH_INTERVAL seconds when it is shared (REDIS_URL); with locmem
+# they are written to the database directly.
+OFFER_ANALYTICS_CACHE_ALIAS = RATE_LIMIT_CACHE_ALIAS
+OFFER_ANALYTICS_FLUSH_INTERVAL = 60
+
+# Login failure counters (accounts.login_counters) share the rate-limit cache; they are
+# rebuilt from LoginAttempt when missing and every LOGIN_COUNTER_RESYNC_SECONDS. Without a
+# shared cache (REDIS_URL) failures are counted from LoginAttempt on every check.
+LOGIN_COUNTER_RESYNC_SECONDS = 15 * 60
+# rollup_login_attempts (and security_maintenance) keep this many days of LoginAttempt rows
+LOGIN_ATTEMPT_RETENTION_DAYS = 30
+# Retention of the other security tables, cleaned by `manage.py security_maintenance`
+USER_SESSION_RETENTION_DAYS = 90
+VERIFICATION_CODE_RETENTION_DAYS = 7
+ACCOUNT_LOCK_RETENTION_DAYS = 90
+SUPPLIER_INVITATION_RETENTION_DAYS = 30
+EMAIL_OUTBOX_RETENTION_DAYS = 30
+
+# Session last_activity is kept in the cache and written at most once per this many
+# seconds per session (accounts.session_activity)
+SESSION_ACTIVITY_FLUSH_SECONDS = 5 * 60
+
 # File Upload Settings
 DATA_UPLOAD_MAX_MEMORY_SIZE = 20971520  # 20MB
 FILE_UPLOAD_MAX_MEMORY_SIZE = 20971520  # 20MB
@@ -194,6 +250,13 @@ EMAIL_HOST_USER = 'hamiltonwatchbrands@gmail.com'
 EMAIL_HOST_PASSWORD = 'npkj lzmr xdbi vpfi'
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 SERVER_EMAIL = EMAIL_HOST_USER
+# Emails are queued in the outbox and sent by `manage.py run_email_worker --loop` (the
+# worker service in render.yaml / the Procfile). Set EMAIL_OUTBOX_WORKER=true where that
+# worker runs; otherwise each email is sent by the web process once its transaction commits.
+EMAIL_OUTBOX_WORKER = os.environ.get('EMAIL_OUTBOX_WORKER', '').lower() in ('1', 'true', 'yes')
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_BACKOFF_SECONDS = 30  # doubles after every failure
+EMAIL_OUTBOX_MAX_BACKOFF_SECONDS = 60 * 60
 
 # Site URL for invitation links
 SITE_URL = 'http://127.0.0.1:8000'
@@ -227,7 +290,7 @@ ACCOUNT_EMAIL_CONFIRMATION_ANONYMOUS_REDIRECT_URL = '/accounts/login/'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.SessionAuthentication',  # For admin users
-        'rest_framework_simplejwt.authentication.JWTAuthentication',  # For API users
+        'accounts.authentication.ActivityJWTAuthentication',  # For API users (JWT + session activity)
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.AllowAny',
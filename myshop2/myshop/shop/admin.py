@@ -7,7 +7,8 @@ from .models import (
     Category, Product, ProductAttribute, ProductImage, ProductVariantImage, Order, OrderItem, Tag, 
     Attribute, ProductAttributeValue, NewAttributeValue, CategoryAttribute, AttributeValue,
     DeletedProduct, Wishlist, CategoryGender, CategoryGroup, CategorySubgroup,
-    SpecialOffer, SpecialOfferProduct, ProductVariant, Cart, CartItem
+    SpecialOffer, SpecialOfferProduct, SpecialOfferHourlyStats, ProductVariant, Cart, CartItem,
+    StockReservation
 )
 from .forms import ProductForm, TagForm
 from suppliers.models import SupplierAdmin, User as SupplierUser
@@ -987,8 +988,8 @@ class ProductVariantAdmin(admin.ModelAdmin):
         return color_map.get(color, '#6c757d')
 
 class ProductImageAdmin(admin.ModelAdmin):
-    list_display = ['product', 'image', 'is_primary', 'order', 'created_at']
-    list_filter = ['is_primary', 'created_at']
+    list_display = ['product', 'image', 'is_primary', 'order', 'processing', 'created_at']
+    list_filter = ['is_primary', 'processing', 'created_at']
     search_fields = ['product__name']
     
     def get_form(self, request, obj=None, **kwargs):
@@ -1017,16 +1018,18 @@ class OrderItemInline(admin.TabularInline):
 class OrderAdmin(admin.ModelAdmin):
     list_display = ['id', 'first_name', 'last_name', 'email',
                    'address', 'postal_code', 'city', 'paid',
-                   'get_total_cost_display', 'created', 'updated']
+                   'get_total_cost_display', 'item_count', 'created', 'updated']
     list_filter = ['paid', 'created', 'updated']
+    readonly_fields = ['total_toman', 'item_count']
     inlines = [OrderItemInline]
     search_fields = ['first_name', 'last_name', 'email']
     
     def get_total_cost_display(self, obj):
         if obj.pk:
-            return f"{float(obj.get_total_cost()):,.0f} تومان"
+            return f"{float(obj.total_toman):,.0f} تومان"
         return "-"
     get_total_cost_display.short_description = 'Total Cost'
+    get_total_cost_display.admin_order_field = 'total_toman'
 
 
 class OrderItemAdmin(admin.ModelAdmin):
@@ -1235,7 +1238,7 @@ admin.site.register(ProductImage, ProductImageAdmin)
 class ProductVariantImageAdmin(admin.ModelAdmin):
     """Admin interface for ProductVariantImage model"""
     list_display = ['variant', 'variant_sku_display', 'image_preview', 'is_primary', 'order', 'created_at']
-    list_filter = ['is_primary', 'created_at', 'variant__product']
+    list_filter = ['is_primary', 'processing', 'created_at', 'variant__product']
     search_fields = ['variant__sku', 'variant__product__name']
     list_editable = ['is_primary', 'order']
     
@@ -1367,6 +1370,34 @@ class SpecialOfferAdmin(admin.ModelAdmin):
                 raise e
 
 
+@admin.register(SpecialOfferHourlyStats)
+class SpecialOfferHourlyStatsAdmin(admin.ModelAdmin):
+    """Hourly views/clicks per offer, written by flush_offer_analytics"""
+    list_display = ['offer', 'hour', 'views', 'clicks', 'ctr_display']
+    list_filter = ['offer']
+    date_hierarchy = 'hour'
+    list_select_related = ['offer']
+    readonly_fields = ['offer', 'hour', 'views', 'clicks']
+    
+    def ctr_display(self, obj):
+        return f"{obj.click_through_rate}%"
+    ctr_display.short_description = 'CTR'
+    
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    """Stock held by cart items until checkout, or until release_expired_reservations runs"""
+    list_display = ['cart_item', 'product', 'variant', 'quantity', 'expires_at']
+    list_select_related = ['cart_item', 'product', 'variant']
+    readonly_fields = ['cart_item', 'product', 'variant', 'quantity', 'expires_at', 'created_at']
+    
+    def has_add_permission(self, request):
+        return False
+
+
 @admin.register(SpecialOfferProduct)
 class SpecialOfferProductAdmin(admin.ModelAdmin):
     """Admin interface for SpecialOfferProduct model"""
@@ -1,8 +1,9 @@
-from django.http import JsonResponse
+from collections import defaultdict
+from django.http import JsonResponse, StreamingHttpResponse
 from django.db.models import Q
 from django.db import models
 from django.shortcuts import get_object_or_404
-from .models import Product, Attribute, NewAttributeValue, Category, ProductAttributeValue, CategoryGroup, CategoryGender, SpecialOffer, SpecialOfferProduct, ProductVariant
+from .models import Product, Attribute, NewAttributeValue, Category, ProductAttributeValue, CategoryGroup, CategorySubgroup, CategoryGender, SpecialOffer, SpecialOfferProduct, ProductVariant
 from decimal import InvalidOperation
 from django.views.decorators.http import require_GET
 from django.views.decorators.csrf import csrf_exempt
@@ -11,6 +12,13 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from .serializers import ProductSerializer, SpecialOfferSerializer
+from .attribute_index import filter_products_by_attributes, filter_variants_by_attributes, get_indexed_attribute_keys
+from .facets import PRICE_FILTER_KEYS, compute_facets, get_category_snapshot
+from .category_tree import CategoryTree
+from .response_cache import cache_catalog_response
+from .offer_analytics import record_offer_views
+from .cursor_pagination import InvalidCursor, cursor_pagination_data, paginate_by_cursor, resolve_keyset_sort
+from .variant_matrix import get_variant_matrix
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.pagination import PageNumberPagination
@@ -101,11 +109,7 @@ class CategoryProductFilterView(APIView):
         
         # Also include attribute keys that actually exist in products of this category
         # This ensures we can filter by any attribute that exists in the products
-        products_in_category = Product.objects.filter(category=category, is_active=True)
-        legacy_keys = set(products_in_category.values_list('legacy_attribute_set__key', flat=True).distinct())
-        new_keys = set(products_in_category.values_list('attribute_values__attribute__key', flat=True).distinct())
-        product_attribute_keys = legacy_keys | new_keys
-        product_attribute_keys = {k for k in product_attribute_keys if k}  # Remove None values
+        product_attribute_keys = get_indexed_attribute_keys(category=category)
         
         # Combine category attributes with product attributes
         valid_attribute_keys = valid_attribute_keys | product_attribute_keys
@@ -114,6 +118,7 @@ class CategoryProductFilterView(APIView):
         multi_value_filters = {}
         price_filters = {}
         sort_params = {}
+        pagination_requested = False
         
         # Handle both DRF request.query_params and Django request.GET
         query_params = getattr(request, 'query_params', request.GET)
@@ -135,9 +140,12 @@ class CategoryProductFilterView(APIView):
                 value = query_params.get(key)
                 if value and value.strip():
                     sort_params[key] = value
+            elif key in ['page', 'per_page', 'cursor', 'count']:
+                # Pagination parameters are valid on their own
+                pagination_requested = True
 
         # Return empty result if no valid filters
-        if query_params and not multi_value_filters and not price_filters and not sort_params:
+        if query_params and not multi_value_filters and not price_filters and not sort_params and not pagination_requested:
             return Response({
                 "products": [], 
                 "pagination": {"current_page": 1, "total_pages": 1, "total_items": 0, "has_next": False, "has_previous": False}
@@ -154,67 +162,9 @@ class CategoryProductFilterView(APIView):
             except (ValueError, TypeError):
                 continue
         
-        # Apply attribute filters only if we have valid attributes
+        # Apply attribute filters through the attribute index (single grouped subquery)
         if multi_value_filters:
-            for attr_key, values in multi_value_filters.items():
-                if len(values) == 1:
-                    # Single value - case insensitive match
-                    matching_ids_legacy = Product.objects.filter(
-                        category=category,
-                        legacy_attribute_set__key=attr_key,
-                        legacy_attribute_set__value__iexact=values[0]
-                    ).values_list('id', flat=True)
-                    
-                    matching_ids_new = Product.objects.filter(
-                        category=category,
-                        attribute_values__attribute__key=attr_key,
-                        attribute_values__attribute_value__value__iexact=values[0]
-                    ).values_list('id', flat=True)
-                    
-                    matching_ids_custom = Product.objects.filter(
-                        category=category,
-                        attribute_values__attribute__key=attr_key,
-                        attribute_values__custom_value__iexact=values[0]
-                    ).values_list('id', flat=True)
-                    
-                    # Combine all matching IDs
-                    all_matching_ids = set(matching_ids_legacy) | set(matching_ids_new) | set(matching_ids_custom)
-                    products = products.filter(id__in=all_matching_ids)
-                else:
-                    # Multiple values - use case insensitive __in filtering
-                    # Fix: Use Q objects to combine multiple OR conditions
-                    from django.db.models import Q
-                    
-                    # Build OR conditions for each value
-                    legacy_conditions = Q()
-                    new_conditions = Q()
-                    custom_conditions = Q()
-                    
-                    for value in values:
-                        legacy_conditions |= Q(
-                            category=category,
-                            legacy_attribute_set__key=attr_key,
-                            legacy_attribute_set__value__iexact=value
-                        )
-                        new_conditions |= Q(
-                            category=category,
-                            attribute_values__attribute__key=attr_key,
-                            attribute_values__attribute_value__value__iexact=value
-                        )
-                        custom_conditions |= Q(
-                            category=category,
-                            attribute_values__attribute__key=attr_key,
-                            attribute_values__custom_value__iexact=value
-                        )
-                    
-                    # Get matching IDs for each system
-                    matching_ids_legacy = Product.objects.filter(legacy_conditions).values_list('id', flat=True)
-                    matching_ids_new = Product.objects.filter(new_conditions).values_list('id', flat=True)
-                    matching_ids_custom = Product.objects.filter(custom_conditions).values_list('id', flat=True)
-                    
-                    # Combine all matching IDs
-                    all_matching_ids = set(matching_ids_legacy) | set(matching_ids_new) | set(matching_ids_custom)
-                    products = products.filter(id__in=all_matching_ids)
+            products = filter_products_by_attributes(products, multi_value_filters, category=category)
         
         products = products.distinct()
         
@@ -253,16 +203,27 @@ class CategoryProductFilterView(APIView):
             products = products.order_by('-created_at')
 
         paginator = ProductPagination()
-        paginated_qs = paginator.paginate_queryset(products, request)
-        serializer = ProductSerializer(paginated_qs, many=True, context={'request': request})
-
-        pagination = {
-            "current_page": paginator.page.number,
-            "total_pages": paginator.page.paginator.num_pages,
-            "total_items": paginator.page.paginator.count,
-            "has_next": paginator.page.has_next(),
-            "has_previous": paginator.page.has_previous(),
-        }
+        if 'cursor' in query_params:
+            # Opt-in keyset pagination for infinite scroll
+            sort_by = resolve_keyset_sort(sort_by)
+            page_size = paginator.get_page_size(request)
+            try:
+                page = paginate_by_cursor(products, sort_by, sort_order != 'asc', query_params.get('cursor'), page_size)
+            except InvalidCursor as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            serializer = ProductSerializer(page.items, many=True, context={'request': request})
+            pagination = cursor_pagination_data(page, page_size, products, query_params.get('count'))
+        else:
+            paginated_qs = paginator.paginate_queryset(products, request)
+            serializer = ProductSerializer(paginated_qs, many=True, context={'request': request})
+
+            pagination = {
+                "current_page": paginator.page.number,
+                "total_pages": paginator.page.paginator.num_pages,
+                "total_items": paginator.page.paginator.count,
+                "has_next": paginator.page.has_next(),
+                "has_previous": paginator.page.has_previous(),
+            }
 
         return Response({
             "products": serializer.data,
@@ -295,12 +256,8 @@ class ProductsFilterView(APIView):
         price_filters = {}
         special_filters = {}
         
-        # Get all possible attribute keys from both systems
-        legacy_keys = set(products.values_list('legacy_attribute_set__key', flat=True).distinct())
-        new_keys = set(products.values_list('attribute_values__attribute__key', flat=True).distinct())
-        all_attribute_keys = legacy_keys | new_keys
-        # Remove None values
-        all_attribute_keys = {key for key in all_attribute_keys if key}
+        # Get all possible attribute keys from both systems (via the attribute index)
+        all_attribute_keys = get_indexed_attribute_keys()
         
         # Handle both DRF request.query_params and Django request.GET
         query_params = getattr(request, 'query_params', request.GET)
@@ -370,48 +327,8 @@ class ProductsFilterView(APIView):
             except (ValueError, TypeError):
                 continue
         
-        # Apply attribute filters
-        for attr_key, values in multi_value_filters.items():
-            if len(values) == 1:
-                # Single value - case insensitive match
-                matching_ids_legacy = Product.objects.filter(
-                    legacy_attribute_set__key=attr_key,
-                    legacy_attribute_set__value__iexact=values[0]
-                ).values_list('id', flat=True)
-                
-                matching_ids_new = Product.objects.filter(
-                    attribute_values__attribute__key=attr_key,
-                    attribute_values__attribute_value__value__iexact=values[0]
-                ).values_list('id', flat=True)
-                
-                matching_ids_custom = Product.objects.filter(
-                    attribute_values__attribute__key=attr_key,
-                    attribute_values__custom_value__iexact=values[0]
-                ).values_list('id', flat=True)
-                
-                # Combine all matching IDs
-                all_matching_ids = set(matching_ids_legacy) | set(matching_ids_new) | set(matching_ids_custom)
-                products = products.filter(id__in=all_matching_ids)
-            else:
-                # Multiple values - use case insensitive __in filtering
-                matching_ids_legacy = Product.objects.filter(
-                    legacy_attribute_set__key=attr_key,
-                    legacy_attribute_set__value__iexact__in=values
-                ).values_list('id', flat=True)
-                
-                matching_ids_new = Product.objects.filter(
-                    attribute_values__attribute__key=attr_key,
-                    attribute_values__attribute_value__value__iexact__in=values
-                ).values_list('id', flat=True)
-                
-                matching_ids_custom = Product.objects.filter(
-                    attribute_values__attribute__key=attr_key,
-                    attribute_values__custom_value__iexact__in=values
-                ).values_list('id', flat=True)
-                
-                # Combine all matching IDs
-                all_matching_ids = set(matching_ids_legacy) | set(matching_ids_new) | set(matching_ids_custom)
-                products = products.filter(id__in=all_matching_ids)
+        # Apply attribute filters through the attribute index (single grouped subquery)
+        products = filter_products_by_attributes(products, multi_value_filters)
         
         # Apply ordering and distinct
         products = products.distinct()
@@ -452,16 +369,27 @@ class ProductsFilterView(APIView):
         
         # Pagination
         paginator = ProductPagination()
-        paginated_qs = paginator.paginate_queryset(products, request)
-        serializer = ProductSerializer(paginated_qs, many=True, context={'request': request})
-
-        pagination = {
-            "current_page": paginator.page.number,
-            "total_pages": paginator.page.paginator.num_pages,
-            "total_items": paginator.page.paginator.count,
-            "has_next": paginator.page.has_next(),
-            "has_previous": paginator.page.has_previous(),
-        }
+        if 'cursor' in query_params:
+            # Opt-in keyset pagination for infinite scroll
+            sort_by = resolve_keyset_sort(sort_by)
+            page_size = paginator.get_page_size(request)
+            try:
+                page = paginate_by_cursor(products, sort_by, sort_order != 'asc', query_params.get('cursor'), page_size)
+            except InvalidCursor as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            serializer = ProductSerializer(page.items, many=True, context={'request': request})
+            pagination = cursor_pagination_data(page, page_size, products, query_params.get('count'))
+        else:
+            paginated_qs = paginator.paginate_queryset(products, request)
+            serializer = ProductSerializer(paginated_qs, many=True, context={'request': request})
+
+            pagination = {
+                "current_page": paginator.page.number,
+                "total_pages": paginator.page.paginator.num_pages,
+                "total_items": paginator.page.paginator.count,
+                "has_next": paginator.page.has_next(),
+                "has_previous": paginator.page.has_previous(),
+            }
 
         return Response({
             "products": serializer.data,
@@ -832,6 +760,7 @@ def wishlist_status(request):
 
 # Gender-based category and product API endpoints
 
+@cache_catalog_response()
 @api_view(['GET'])
 def api_categories_with_gender(request):
     """
@@ -1298,9 +1227,7 @@ def api_organized_categories(request):
     """
     try:
         # Get only visible leaf categories (categories with products, no subcategories)
-        visible_categories = Category.objects.filter(
-            is_visible=True
-        ).prefetch_related('parent', 'product_set')
+        tree = CategoryTree()
         
         organized = {
             'men': [],
@@ -1309,21 +1236,24 @@ def api_organized_categories(request):
             'general': []
         }
         
-        for category in visible_categories:
+        for category in tree.categories:
+            if not category.is_visible:
+                continue
             # Skip container categories (they should not be visible directly)
-            if category.is_container_category():
+            if tree.is_container(category):
                 continue
                 
             # Get display section (auto-detect if not set)
             section = category.get_display_section()
+            parent = tree.parent(category)
             
             category_data = {
                 'id': category.id,
                 'name': category.name,
                 'label': category.get_display_name(),
-                'product_count': category.get_product_count(),
-                'parent_name': category.parent.name if category.parent else None,
-                'parent_id': category.parent.id if category.parent else None,
+                'product_count': tree.product_count(category),
+                'parent_name': parent.name if parent else None,
+                'parent_id': parent.id if parent else None,
                 'gender': category.get_gender(),
                 'section': section
             }
@@ -1352,6 +1282,7 @@ def api_organized_categories(request):
             'error': str(e)
         }, status=500) 
 
+@cache_catalog_response()
 @api_view(['GET'])
 def api_direct_categories(request):
     """
@@ -1934,14 +1865,64 @@ def api_improved_categories(request):
     - Product counts at each level
     """
     try:
-        # Get all active category groups
-        groups = CategoryGroup.objects.filter(is_active=True).prefetch_related(
-            'subgroups__categories__product_set',
-            'subgroups__children__categories__product_set'
-        ).order_by('display_order', 'name')
+        # Groups, subgroups and the category tree are each loaded once; counts come from the tree
+        tree = CategoryTree()
+        groups = list(CategoryGroup.objects.filter(is_active=True).order_by('display_order', 'name'))
+        subgroups = CategorySubgroup.objects.filter(group__in=groups).order_by('display_order', 'name')
+        
+        subgroups_by_group = defaultdict(list)
+        children_by_subgroup = defaultdict(list)
+        for subgroup in subgroups:
+            if subgroup.is_active:
+                subgroups_by_group[subgroup.group_id].append(subgroup)
+                if subgroup.parent_id:
+                    children_by_subgroup[subgroup.parent_id].append(subgroup)
+        
+        categories_by_subgroup = defaultdict(list)
+        for category in tree.categories:
+            if category.subgroup_id:
+                categories_by_subgroup[category.subgroup_id].append(category)
+        
+        def subgroup_product_count(subgroup):
+            return sum(tree.product_count(category) for category in categories_by_subgroup[subgroup.id])
+        
+        def subgroup_payload(subgroup, supports_gender):
+            subgroup_data = {
+                'id': subgroup.id,
+                'name': subgroup.name,
+                'label': subgroup.get_display_name(),
+                'product_count': subgroup_product_count(subgroup),
+                'categories': []
+            }
+            
+            # Get visible categories for this subgroup
+            categories = [category for category in categories_by_subgroup[subgroup.id] if category.is_visible]
+            
+            if supports_gender:
+                # Group by gender
+                gender_categories = {}
+                for category in categories:
+                    gender_name = category.get_gender() or 'عمومی'
+                    if gender_name not in gender_categories:
+                        gender_categories[gender_name] = {
+                            'gender': gender_name,
+                            'category_id': category.id,
+                            'product_count': tree.product_count(category)
+                        }
+                subgroup_data['categories'].extend(gender_categories.values())
+            elif categories:
+                # No gender support, just add the category directly
+                category = categories[0]
+                subgroup_data['categories'].append({
+                    'gender': None,
+                    'category_id': category.id,
+                    'product_count': tree.product_count(category)
+                })
+            return subgroup_data
         
         groups_data = []
         for group in groups:
+            group_subgroups = subgroups_by_group[group.id]
             group_data = {
                 'id': group.id,
                 'name': group.name,
@@ -1949,87 +1930,19 @@ def api_improved_categories(request):
                 'description': group.description,
                 'icon': group.icon,
                 'supports_gender': group.supports_gender,
-                'product_count': group.get_product_count(),
+                'product_count': sum(subgroup_product_count(subgroup) for subgroup in group_subgroups),
                 'subgroups': []
             }
             
-            # Get subgroups for this group
-            subgroups = group.subgroups.filter(is_active=True).order_by('display_order', 'name')
-            for subgroup in subgroups:
-                subgroup_data = {
-                    'id': subgroup.id,
-                    'name': subgroup.name,
-                    'label': subgroup.get_display_name(),
-                    'product_count': subgroup.get_product_count(),
-                    'categories': []
-                }
-                
-                # Get categories for this subgroup
-                categories = subgroup.categories.filter(is_visible=True).select_related('gender')
-                
-                if group.supports_gender:
-                    # Group by gender
-                    gender_categories = {}
-                    for category in categories:
-                        gender_name = category.get_gender() or 'عمومی'
-                        if gender_name not in gender_categories:
-                            gender_categories[gender_name] = {
-                                'gender': gender_name,
-                                'category_id': category.id,
-                                'product_count': category.get_product_count()
-                            }
-                    
-                    # Add gender categories to subgroup
-                    for gender_data in gender_categories.values():
-                        subgroup_data['categories'].append(gender_data)
-                else:
-                    # No gender support, just add the category directly
-                    if categories.exists():
-                        category = categories.first()
-                        subgroup_data['categories'].append({
-                            'gender': None,
-                            'category_id': category.id,
-                            'product_count': category.get_product_count()
-                        })
+            for subgroup in group_subgroups:
+                subgroup_data = subgroup_payload(subgroup, group.supports_gender)
                 
                 # Add children subgroups if any
-                children = subgroup.children.filter(is_active=True).order_by('display_order', 'name')
-                if children.exists():
-                    subgroup_data['children'] = []
-                    for child in children:
-                        child_data = {
-                            'id': child.id,
-                            'name': child.name,
-                            'label': child.get_display_name(),
-                            'product_count': child.get_product_count(),
-                            'categories': []
-                        }
-                        
-                        # Get categories for child subgroup
-                        child_categories = child.categories.filter(is_visible=True).select_related('gender')
-                        if group.supports_gender:
-                            child_gender_categories = {}
-                            for category in child_categories:
-                                gender_name = category.get_gender() or 'عمومی'
-                                if gender_name not in child_gender_categories:
-                                    child_gender_categories[gender_name] = {
-                                        'gender': gender_name,
-                                        'category_id': category.id,
-                                        'product_count': category.get_product_count()
-                                    }
-                            
-                            for gender_data in child_gender_categories.values():
-                                child_data['categories'].append(gender_data)
-                        else:
-                            if child_categories.exists():
-                                category = child_categories.first()
-                                child_data['categories'].append({
-                                    'gender': None,
-                                    'category_id': category.id,
-                                    'product_count': category.get_product_count()
-                                })
-                        
-                        subgroup_data['children'].append(child_data)
+                children = children_by_subgroup[subgroup.id]
+                if children:
+                    subgroup_data['children'] = [
+                        subgroup_payload(child, group.supports_gender) for child in children
+                    ]
                 
                 group_data['subgroups'].append(subgroup_data)
             
@@ -2139,6 +2052,7 @@ def api_group_products(request, group_id):
             'error': str(e)
         }, status=500)
 
+@cache_catalog_response()
 @api_view(['GET'])
 def api_genders_list(request):
     """
@@ -2739,9 +2653,12 @@ def api_flattened_categories_by_gender(request, parent_id):
         gender_name = request.GET.get('gender_name')
         include_products = request.GET.get('include_products', 'true').lower() == 'true'
         
+        # Load the whole tree once; every lookup below is in memory
+        tree = CategoryTree()
+        
         # Get the parent category
-        parent_category = Category.objects.filter(id=parent_id, is_visible=True).first()
-        if not parent_category:
+        parent_category = tree.get(int(parent_id))
+        if not parent_category or not parent_category.is_visible:
             return Response({
                 'success': False,
                 'error': 'Parent category not found'
@@ -2765,37 +2682,29 @@ def api_flattened_categories_by_gender(request, parent_id):
                 'error': 'Gender not found'
             }, status=404)
         
+        def is_neutral(category):
+            # General/unisex (active genders only) or unassigned
+            if category.gender_id is None:
+                return True
+            return category.gender.name in ('general', 'unisex') and category.gender.is_active
+        
+        visible_children = tree.children(parent_category)
+        
         # Get direct children with this gender
-        direct_children = Category.objects.filter(
-            gender=gender,
-            parent=parent_category,
-            is_visible=True
-        ).prefetch_related('product_set')
+        direct_children = [category for category in visible_children if category.gender_id == gender.id]
         
         # Get neutral children (general/unisex) and unassigned children, plus their gender-specific subcategories
-        neutral_genders = CategoryGender.objects.filter(
-            models.Q(name='general') | models.Q(name='unisex'),
-            is_active=True
-        )
-        
-        neutral_children = Category.objects.filter(
-            models.Q(gender__in=neutral_genders) | models.Q(gender__isnull=True),
-            parent=parent_category,
-            is_visible=True
-        ).prefetch_related('product_set')
+        neutral_children = [category for category in visible_children if is_neutral(category)]
         
         # Get gender-specific subcategories of neutral children
         nested_gender_categories = []
         for neutral_child in neutral_children:
-            gender_specific = Category.objects.filter(
-                gender=gender,
-                parent=neutral_child,
-                is_visible=True
-            ).prefetch_related('product_set')
-            nested_gender_categories.extend(gender_specific)
+            nested_gender_categories.extend(
+                category for category in tree.children(neutral_child) if category.gender_id == gender.id
+            )
         
         # Combine both lists
-        all_categories = list(direct_children) + nested_gender_categories
+        all_categories = direct_children + nested_gender_categories
         
         # Prepare response data
         categories_data = []
@@ -2803,23 +2712,24 @@ def api_flattened_categories_by_gender(request, parent_id):
         nested_count = 0
         
         for category in all_categories:
+            parent = tree.parent(category)
             category_data = {
                 'id': category.id,
                 'name': category.name,
                 'label': category.get_display_name(),
-                'parent_id': category.parent.id,
-                'parent_name': category.parent.name,
-                'parent_label': category.parent.get_display_name(),
+                'parent_id': parent.id,
+                'parent_name': parent.name,
+                'parent_label': parent.get_display_name(),
                 'has_gender_assignment': category.gender is not None,
-                'category_type': 'direct_child' if category.parent == parent_category else 'nested_gender_specific'
+                'category_type': 'direct_child' if parent == parent_category else 'nested_gender_specific'
             }
             
-            if category.parent != parent_category:
+            if parent != parent_category:
                 # This is a nested category, include info about its neutral parent
                 category_data['neutral_parent'] = {
-                    'id': category.parent.id,
-                    'name': category.parent.name,
-                    'label': category.parent.get_display_name()
+                    'id': parent.id,
+                    'name': parent.name,
+                    'label': parent.get_display_name()
                 }
                 nested_count += 1
             else:
@@ -2833,18 +2743,14 @@ def api_flattened_categories_by_gender(request, parent_id):
                 }
             
             if include_products:
-                category_data['product_count'] = category.get_product_count()
+                category_data['product_count'] = tree.product_count(category)
             
             categories_data.append(category_data)
         
         # Get statistics
-        total_direct_children = Category.objects.filter(parent=parent_category, is_visible=True).count()
-        total_neutral_children = neutral_children.count()
-        total_unassigned_children = Category.objects.filter(
-            gender__isnull=True,
-            parent=parent_category,
-            is_visible=True
-        ).count()
+        total_direct_children = len(visible_children)
+        total_neutral_children = len(neutral_children)
+        total_unassigned_children = sum(1 for category in visible_children if category.gender_id is None)
         
         return Response({
             'success': True,
@@ -3023,15 +2929,23 @@ def api_gender_category_tree(request):
     try:
         # Get all active genders
         genders = CategoryGender.objects.filter(is_active=True).order_by('display_order', 'name')
+        tree = CategoryTree()
+        
+        def get_subcategories_recursive(parent_category):
+            subcategories = []
+            for subcategory in tree.children(parent_category):
+                subcategories.append({
+                    'id': subcategory.id,
+                    'name': subcategory.name,
+                    'label': subcategory.get_display_name(),
+                    'parent_id': parent_category.id,
+                    'product_count': tree.product_count(subcategory),
+                    'subcategories': get_subcategories_recursive(subcategory)
+                })
+            return subcategories
         
         tree_data = []
         for gender in genders:
-            # Get categories with this gender
-            categories = Category.objects.filter(
-                gender=gender,
-                is_visible=True
-            ).prefetch_related('product_set', 'subcategories')
-            
             gender_data = {
                 'gender': {
                     'id': gender.id,
@@ -3041,33 +2955,19 @@ def api_gender_category_tree(request):
                 'categories': []
             }
             
-            for category in categories:
-                category_data = {
+            # Categories with this gender, each with its visible subtree
+            for category in tree.categories:
+                if category.gender_id != gender.id or not category.is_visible:
+                    continue
+                parent = tree.parent(category)
+                gender_data['categories'].append({
                     'id': category.id,
                     'name': category.name,
                     'label': category.get_display_name(),
-                    'parent_id': category.parent.id if category.parent else None,
-                    'product_count': category.get_product_count(),
-                    'subcategories': []
-                }
-                
-                # Get subcategories recursively
-                def get_subcategories_recursive(parent_category):
-                    subcategories = []
-                    for subcategory in parent_category.subcategories.filter(is_visible=True):
-                        subcategory_data = {
-                            'id': subcategory.id,
-                            'name': subcategory.name,
-                            'label': subcategory.get_display_name(),
-                            'parent_id': parent_category.id,
-                            'product_count': subcategory.get_product_count(),
-                            'subcategories': get_subcategories_recursive(subcategory)
-                        }
-                        subcategories.append(subcategory_data)
-                    return subcategories
-                
-                category_data['subcategories'] = get_subcategories_recursive(category)
-                gender_data['categories'].append(category_data)
+                    'parent_id': parent.id if parent else None,
+                    'product_count': tree.product_count(category),
+                    'subcategories': get_subcategories_recursive(category)
+                })
             
             tree_data.append(gender_data)
         
@@ -3495,6 +3395,57 @@ def api_category_dynamic_attribute_values(request, category_id):
         }, status=500)
 
 
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def api_category_facets(request, category_id):
+    """
+    Get every attribute key -> value -> product count for a category in one call
+    URL: /api/category/{category_id}/facets/
+    
+    Accepts the same filter parameters as the category filter endpoint:
+    - <attribute_key>=<value> (repeatable, e.g. ?brand=Rolex&brand=Omega)
+    - price_toman__gte / price_toman__lte (also price__gte / price__lte)
+    
+    Counts for a key are computed with that key's own selection ignored, so each
+    value shows how many products the screen would show if it were picked.
+    
+    Example: /api/category/1027/facets/?brand=Rolex&price_toman__lte=50000000
+    """
+    try:
+        category = Category.objects.get(id=category_id)
+    except Category.DoesNotExist:
+        return Response({'error': 'Category not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    snapshot = get_category_snapshot(category)
+    valid_attribute_keys = set(snapshot['values']) | set(snapshot['meta'])
+
+    filters = {}
+    price_filters = {}
+    for key in request.query_params.keys():
+        if key in valid_attribute_keys:
+            values = [v for v in request.query_params.getlist(key) if v.strip()]
+            if values:
+                filters[key] = values
+        elif key in PRICE_FILTER_KEYS:
+            value = request.query_params.get(key)
+            if value and value.strip():
+                price_filters[key] = value
+
+    result = compute_facets(category, filters=filters, price_filters=price_filters)
+
+    return Response({
+        'category': {
+            'id': category.id,
+            'name': category.name
+        },
+        'total_products': result['total_products'],
+        'price_range': result['price_range'],
+        'facets': result['facets'],
+        'filters_applied': filters,
+        'price_filters_applied': price_filters,
+    })
+
+
 # Simple admin-lite API to get/set categorization key without navigating forms
 @api_view(['GET', 'POST'])
 @permission_classes([AllowAny])  # adjust to IsAdminUser if needed
@@ -3530,6 +3481,7 @@ def api_category_categorization_key(request, category_id):
     except Exception as e:
         return Response({'error': str(e)}, status=500)
 
+@cache_catalog_response()
 @api_view(['GET'])
 def api_leaf_categories(request):
     """
@@ -3728,10 +3680,32 @@ def api_special_offer_categories(request, offer_id):
         }, status=500)
 
 
+def _record_active_offer_views():
+    """Count a view for every currently valid offer in the analytics buffer"""
+    now = timezone.now()
+    record_offer_views(SpecialOffer.objects.filter(
+        enabled=True,
+        is_active=True,
+        valid_from__lte=now,
+    ).filter(
+        Q(valid_until__isnull=True) | Q(valid_until__gte=now)
+    ).values_list('id', flat=True))
+
+
 class SpecialOffersAPIView(APIView):
     """API endpoint for retrieving active special offers"""
     permission_classes = [AllowAny]
     
+    def dispatch(self, request, *args, **kwargs):
+        if request.method == 'GET':
+            # Views are counted on every request, including ones served from the response cache
+            _record_active_offer_views()
+        return self._cached_dispatch(request, *args, **kwargs)
+    
+    @method_decorator(cache_catalog_response())
+    def _cached_dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+    
     def get(self, request):
         """Get all currently active special offers"""
         try:
@@ -3756,12 +3730,7 @@ class SpecialOffersAPIView(APIView):
             ).prefetch_related('products__product__images', 'products__product__category')
             
             # Filter offers that are currently valid
-            valid_offers = []
-            for offer in offers:
-                if offer.is_currently_valid():
-                    # Increment view count for analytics
-                    offer.increment_views()
-                    valid_offers.append(offer)
+            valid_offers = [offer for offer in offers if offer.is_currently_valid()]
             
             # Apply pagination
             total_count = len(valid_offers)
@@ -4262,12 +4231,7 @@ class SpecialOffersByTypeAPIView(APIView):
             ).prefetch_related('products__product__images', 'products__product__category')
             
             # Filter offers that are currently valid
-            valid_offers = []
-            for offer in offers:
-                if offer.is_currently_valid():
-                    # Increment view count for analytics
-                    offer.increment_views()
-                    valid_offers.append(offer)
+            valid_offers = [offer for offer in offers if offer.is_currently_valid()]
             
             # Serialize the offers
             serializer = SpecialOfferSerializer(
@@ -4798,23 +4762,20 @@ class ProductsWithSaleInfoAPIView(APIView):
     def get(self, request):
         """Get products with sale information"""
         try:
-            # Get all active products
-            products = Product.objects.filter(is_active=True).prefetch_related(
-                'specialofferproduct_set__offer',
-                'images',
-                'productattribute_set__attribute'
-            )
+            # Get all active products; offer prices come from the in-memory offer map
+            products = Product.objects.filter(is_active=True)
             
             # Serialize with sale info
             serializer = ProductSerializer(products, many=True, context={'request': request})
+            data = serializer.data
             
             # Add sale statistics
-            total_products = products.count()
-            products_on_sale = sum(1 for product in products if product.is_on_sale)
+            total_products = len(data)
+            products_on_sale = sum(1 for item in data if item['has_discount'])
             
             return Response({
                 'success': True,
-                'products': serializer.data,
+                'products': data,
                 'statistics': {
                     'total_products': total_products,
                     'products_on_sale': products_on_sale,
@@ -4928,10 +4889,8 @@ def get_product_image_url(product):
 
 def serialize_order(order):
     items = []
-    subtotal = 0.0
     for it in order.items.select_related('product').all():
         line = float(it.price) * it.quantity
-        subtotal += line
         items.append({
             'id': it.id,
             'product': {
@@ -4957,8 +4916,8 @@ def serialize_order(order):
         'updated': order.updated.isoformat(),
         'paid': order.paid,
         'totals': {
-            'grand_total': subtotal,
-            'item_count': sum(i['quantity'] for i in items),
+            'grand_total': float(order.total_toman),
+            'item_count': order.item_count,
         },
         'items': items,
     }
@@ -4987,9 +4946,7 @@ def api_orders_list(request):
     if sort in ['created', '-created', 'updated', '-updated']:
         orders = orders.order_by(sort)
     elif sort in ['total', '-total']:
-        # Annotate totals via Python after fetch; simple approach due to model simplicity
-        orders = list(orders)
-        orders.sort(key=lambda o: float(sum(i.price * i.quantity for i in o.items.all())), reverse=sort == '-total')
+        orders = orders.order_by(sort.replace('total', 'total_toman'), '-created')
     else:
         orders = orders.order_by('-created')
 
@@ -5040,17 +4997,54 @@ def api_orders_update_paid(request, order_id):
 
 @api_view(['GET'])
 def api_orders_export_csv(request):
-    from .models import Order
-    import csv
-    from io import StringIO
-    
-    sio = StringIO()
-    writer = csv.writer(sio)
-    writer.writerow(['id','first_name','last_name','email','created','paid','item_count','grand_total'])
-    for o in Order.objects.all().order_by('-created'):
-        total = sum(i.price * i.quantity for i in o.items.all())
-        writer.writerow([o.id, o.first_name, o.last_name, o.email, o.created.isoformat(), o.paid, o.items.count(), total])
-    return Response({'success': True, 'content_type': 'text/csv', 'filename': 'orders.csv', 'data': sio.getvalue()})
+    """
+    CSV export of the orders wrapped in JSON (success, content_type, filename, data).
+    URL: /api/orders/export/csv/
+    Kept for existing clients: the whole file is built in memory, so large exports should
+    use the streaming endpoint below. Takes the same date_from, date_to and paid filters.
+    """
+    from .order_export import OrderExportError, export_queryset, export_rows, stream_csv
+
+    try:
+        orders = export_queryset(
+            date_from=request.GET.get('date_from'),
+            date_to=request.GET.get('date_to'),
+            paid=request.GET.get('paid'),
+        )
+    except OrderExportError as e:
+        return Response({'success': False, 'error': str(e)}, status=400)
+    return Response({
+        'success': True, 'content_type': 'text/csv', 'filename': 'orders.csv',
+        'data': ''.join(stream_csv(export_rows(orders))),
+    })
+
+
+@api_view(['GET'])
+def api_orders_export(request, file_type='csv'):
+    """
+    Stream an export of the orders (see shop/order_export.py).
+    URL: /api/orders/export/stream/<csv|xlsx|ods>/
+    Parameters:
+        - date_from, date_to: YYYY-MM-DD, both days included
+        - paid: 'true' | 'false'
+        - gzip: 'true' to gzip a CSV export
+    """
+    from .order_export import OrderExportError, export_orders, export_queryset
+
+    try:
+        orders = export_queryset(
+            date_from=request.GET.get('date_from'),
+            date_to=request.GET.get('date_to'),
+            paid=request.GET.get('paid'),
+        )
+        content, content_type, filename = export_orders(
+            orders, file_type=file_type, compress=request.GET.get('gzip') == 'true'
+        )
+    except OrderExportError as e:
+        return Response({'success': False, 'error': str(e)}, status=400)
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 
 # ========================================
@@ -5222,6 +5216,28 @@ def api_product_variants(request, product_id):
         }, status=500)
 
 
+@api_view(['GET'])
+def api_product_variant_matrix(request, product_id):
+    """
+    Variant matrix of a product: attribute axes and their values, every variant's
+    combination with price and stock, the availability bitmap and the images per
+    distinctive attribute value (see shop/variant_matrix.py)
+    URL: /api/products/{product_id}/variant-matrix/
+    """
+    matrix = get_variant_matrix(product_id)
+    if matrix is None:
+        return Response({
+            'success': False,
+            'error': 'Product not found'
+        }, status=404)
+
+    image_groups = [
+        {**group, 'images': [request.build_absolute_uri(url) for url in group['images']]}
+        for group in matrix['image_groups']
+    ]
+    return Response({'success': True, **matrix, 'image_groups': image_groups})
+
+
 @api_view(['GET'])
 def api_variants_by_attributes(request):
     """
@@ -5246,15 +5262,15 @@ def api_variants_by_attributes(request):
         if product_id:
             variants = variants.filter(product_id=product_id)
         
-        # Filter by attributes (dynamic filtering)
-        for key, value in request.GET.items():
-            if key.startswith('attr_'):
-                attr_name = key[5:]  # Remove 'attr_' prefix
-                # Use JSONField lookup for SQLite compatibility
-                variants = variants.filter(**{f'attributes__{attr_name}': value})
+        # Filter by attributes through the VariantAttribute index
+        variants = filter_variants_by_attributes(variants, {
+            key[5:]: value for key, value in request.GET.items() if key.startswith('attr_')
+        })
         
         # Order by SKU
-        variants = variants.order_by('sku')
+        variants = variants.select_related('product__category').prefetch_related(
+            'images', 'product__images'
+        ).order_by('sku')
         
         # Paginate results
         paginator = Paginator(variants, limit)
@@ -5304,9 +5320,8 @@ def api_variants_by_attributes(request):
 def get_product_image_url(product, request=None):
     """Get product image URL with full absolute URL"""
     try:
-        first_image = product.images.filter(is_primary=True).first()
-        if not first_image:
-            first_image = product.images.first()
+        # Primary images sort first; all() lets callers prefetch the images
+        first_image = next(iter(product.images.all()), None)
         if first_image and first_image.image:
             url = first_image.image.url
             if not url.startswith(('http://', 'https://')):
@@ -5330,7 +5345,7 @@ def get_variant_image_url(variant, request=None):
     """Get variant-specific image URL, fallback to product image"""
     try:
         # First try to get variant-specific images
-        variant_image = variant.images.first()
+        variant_image = next(iter(variant.images.all()), None)
         if variant_image and variant_image.image:
             url = variant_image.image.url
             if not url.startswith(('http://', 'https://')):
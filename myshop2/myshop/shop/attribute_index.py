@@ -0,0 +1,233 @@
+"""
+Attribute index for product filtering.
+
+Products carry attributes in two places: the legacy ProductAttribute (key/value) rows and
+the flexible ProductAttributeValue rows (predefined or custom value). Filtering against
+both used to take three queries per filter key. ProductAttributeIndex flattens them into
+one table of normalized (product, category, key, value) rows so every attribute filter of
+a request resolves in a single indexed subquery.
+
+VariantAttribute does the same for the attributes JSON of ProductVariant, so variants
+can be looked up by attribute across products without scanning every variant.
+"""
+from django.db import transaction
+from django.db.models import Count, Q
+
+from .models import (
+    Product, ProductAttribute, ProductAttributeValue, ProductAttributeIndex, ProductVariant, VariantAttribute,
+)
+
+
+def normalize_attribute_value(value):
+    """Normalize an attribute value for index storage and lookups (trimmed, single-spaced, lowercase)."""
+    if value is None:
+        return ''
+    return ' '.join(str(value).split()).lower()
+
+
+def _legacy_row(attr, category_id):
+    value = normalize_attribute_value(attr.value)
+    key = (attr.key or '').strip()
+    if not key or not value:
+        return None
+    return ProductAttributeIndex(
+        product_id=attr.product_id,
+        category_id=category_id,
+        attr_key=key,
+        attr_value=value,
+        legacy_attribute=attr,
+    )
+
+
+def _attribute_value_row(pav, category_id):
+    value = normalize_attribute_value(pav.get_display_value())
+    key = (pav.attribute.key or '').strip()
+    if not key or not value:
+        return None
+    return ProductAttributeIndex(
+        product_id=pav.product_id,
+        category_id=category_id,
+        attr_key=key,
+        attr_value=value,
+        product_attribute_value=pav,
+    )
+
+
+def index_legacy_attribute(attr):
+    """Replace the index row for a single legacy ProductAttribute and return the product's category ID."""
+    category_id = Product.objects.filter(pk=attr.product_id).values_list('category_id', flat=True).first()
+    if category_id is None:
+        return None
+    with transaction.atomic():
+        ProductAttributeIndex.objects.filter(legacy_attribute=attr).delete()
+        row = _legacy_row(attr, category_id)
+        if row:
+            row.save()
+    return category_id
+
+
+def index_product_attribute_value(pav):
+    """Replace the index row for a single ProductAttributeValue and return the product's category ID."""
+    category_id = Product.objects.filter(pk=pav.product_id).values_list('category_id', flat=True).first()
+    if category_id is None:
+        return None
+    with transaction.atomic():
+        ProductAttributeIndex.objects.filter(product_attribute_value=pav).delete()
+        row = _attribute_value_row(pav, category_id)
+        if row:
+            row.save()
+    return category_id
+
+
+def rebuild_attribute_index(product_ids=None, batch_size=1000):
+    """
+    Rebuild index rows from scratch, for all products or only the given product IDs.
+
+    Returns the number of rows written.
+    """
+    legacy_qs = ProductAttribute.objects.select_related('product').only('id', 'key', 'value', 'product__category_id')
+    value_qs = ProductAttributeValue.objects.select_related('product', 'attribute', 'attribute_value').only(
+        'id', 'custom_value', 'product__category_id', 'attribute__key', 'attribute_value__value'
+    )
+    stale_qs = ProductAttributeIndex.objects.all()
+    if product_ids is not None:
+        legacy_qs = legacy_qs.filter(product_id__in=product_ids)
+        value_qs = value_qs.filter(product_id__in=product_ids)
+        stale_qs = stale_qs.filter(product_id__in=product_ids)
+
+    written = 0
+    with transaction.atomic():
+        stale_qs.delete()
+        for source_qs, build_row in ((legacy_qs, _legacy_row), (value_qs, _attribute_value_row)):
+            batch = []
+            for obj in source_qs.iterator(chunk_size=batch_size):
+                row = build_row(obj, obj.product.category_id)
+                if row:
+                    batch.append(row)
+                if len(batch) >= batch_size:
+                    ProductAttributeIndex.objects.bulk_create(batch)
+                    written += len(batch)
+                    batch = []
+            if batch:
+                ProductAttributeIndex.objects.bulk_create(batch)
+                written += len(batch)
+    return written
+
+
+def _variant_rows(variant_id, product_id, attributes):
+    rows = []
+    for key, value in (attributes or {}).items():
+        key = (key or '').strip()
+        value = normalize_attribute_value(value)
+        if key and value:
+            rows.append(VariantAttribute(variant_id=variant_id, product_id=product_id, attr_key=key, attr_value=value))
+    return rows
+
+
+def index_variant_attributes(variant):
+    """Replace the index rows of a single ProductVariant."""
+    with transaction.atomic():
+        VariantAttribute.objects.filter(variant_id=variant.pk).delete()
+        VariantAttribute.objects.bulk_create(_variant_rows(variant.pk, variant.product_id, variant.attributes))
+
+
+def rebuild_variant_attribute_index(product_ids=None, batch_size=1000):
+    """Rebuild VariantAttribute rows for all variants or those of the given products. Returns rows written."""
+    variants = ProductVariant.objects.values_list('id', 'product_id', 'attributes')
+    stale_qs = VariantAttribute.objects.all()
+    if product_ids is not None:
+        variants = variants.filter(product_id__in=product_ids)
+        stale_qs = stale_qs.filter(product_id__in=product_ids)
+
+    written = 0
+    with transaction.atomic():
+        stale_qs.delete()
+        batch = []
+        for variant_id, product_id, attributes in variants.iterator(chunk_size=batch_size):
+            batch.extend(_variant_rows(variant_id, product_id, attributes))
+            if len(batch) >= batch_size:
+                VariantAttribute.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            VariantAttribute.objects.bulk_create(batch)
+            written += len(batch)
+    return written
+
+
+def filter_variants_by_attributes(variants, filters):
+    """
+    Restrict a ProductVariant queryset to variants having every ``key: value`` of ``filters``
+    (one value per key), through one grouped subquery on VariantAttribute.
+
+    Blank values and keys no variant has are dropped first, like unknown filters on the
+    product list, so they don't empty the result. While the index hasn't been built yet
+    (build_attribute_index, run on deploy) the attributes JSON is matched directly instead.
+    """
+    filters = {
+        key.strip(): value for key, value in filters.items()
+        if key.strip() and normalize_attribute_value(value)
+    }
+    if filters:
+        known_keys = set(
+            VariantAttribute.objects.filter(attr_key__in=filters).values_list('attr_key', flat=True).distinct()
+        )
+        if len(known_keys) < len(filters) and not VariantAttribute.objects.exists():
+            for key, value in filters.items():
+                variants = variants.filter(**{f'attributes__{key}': value})
+            return variants
+        filters = {key: value for key, value in filters.items() if key in known_keys}
+    if not filters:
+        return variants
+
+    condition = Q()
+    for key, value in filters.items():
+        condition |= Q(attr_key=key, attr_value=normalize_attribute_value(value))
+    matching_ids = (
+        VariantAttribute.objects.filter(condition)
+        .values('variant_id')
+        .annotate(matched_keys=Count('attr_key', distinct=True))
+        .filter(matched_keys=len(filters))
+        .values('variant_id')
+    )
+    return variants.filter(id__in=matching_ids)
+
+
+def get_indexed_attribute_keys(category=None):
+    """Return the set of attribute keys present on active products (optionally within a category)."""
+    qs = ProductAttributeIndex.objects.filter(product__is_active=True)
+    if category is not None:
+        qs = qs.filter(category=category)
+    return set(qs.values_list('attr_key', flat=True).distinct())
+
+
+def filter_products_by_attributes(products, filters, category=None):
+    """
+    Restrict a product queryset to products matching every attribute filter.
+
+    Args:
+        products: Product queryset to narrow down
+        filters: dict of attribute key -> list of accepted values (OR within a key, AND across keys)
+        category: optional Category to scope the index lookup to
+
+    Returns:
+        QuerySet: products filtered through one grouped subquery on the attribute index
+    """
+    if not filters:
+        return products
+
+    condition = Q()
+    for key, values in filters.items():
+        normalized = {normalize_attribute_value(v) for v in values}
+        condition |= Q(attr_key=key, attr_value__in=normalized)
+
+    matches = ProductAttributeIndex.objects.filter(condition)
+    if category is not None:
+        matches = matches.filter(category=category)
+    matching_ids = (
+        matches.values('product_id')
+        .annotate(matched_keys=Count('attr_key', distinct=True))
+        .filter(matched_keys=len(filters))
+        .values('product_id')
+    )
+    return products.filter(id__in=matching_ids)
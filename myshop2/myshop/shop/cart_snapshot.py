@@ -0,0 +1,120 @@
+"""
+Cart snapshot.
+
+Loads a cart's items together with everything the cart screens need (product, category,
+variant, images, category attributes, attribute values) in a fixed number of queries,
+and prices every line once. The cart API, checkout and Cart.get_total_price all read
+their totals from here, so they agree and none of them queries per item.
+"""
+import logging
+from dataclasses import dataclass, field
+from decimal import InvalidOperation
+from typing import Dict, List
+
+from django.db.models import Prefetch
+
+from .models import CartItem, ProductAttributeValue
+
+logger = logging.getLogger(__name__)
+
+# Category attributes shown under each cart line
+BASKET_ATTRIBUTES_LIMIT = 2
+
+
+@dataclass
+class CartLine:
+    item: CartItem
+    unit_price: float
+    total_price: float
+    # Total at the variant's or product's undiscounted price
+    original_total_price: float
+    # Variant attribute key -> Persian label from the category's attributes
+    attribute_labels: Dict[str, str] = field(default_factory=dict)
+    # [{'key', 'value', 'display_name'}] for category attributes marked display_in_basket
+    basket_attributes: List[dict] = field(default_factory=list)
+
+
+@dataclass
+class CartSnapshot:
+    cart: object
+    lines: List[CartLine] = field(default_factory=list)
+    total_items: int = 0
+    total_price: float = 0
+    total_original_price: float = 0
+
+    @classmethod
+    def load(cls, cart, details=True):
+        """
+        Build the snapshot of a cart.
+
+        Args:
+            cart: the Cart to load
+            details: also load images and attributes for display (six queries instead of one)
+        """
+        items = CartItem.objects.filter(cart=cart).select_related('product', 'variant')
+        if details:
+            items = items.select_related('product__category').prefetch_related(
+                'product__images',
+                'variant__images',
+                'product__category__category_attributes',
+                'product__legacy_attribute_set',
+                Prefetch(
+                    'product__attribute_values',
+                    queryset=ProductAttributeValue.objects.select_related('attribute', 'attribute_value'),
+                ),
+            )
+
+        snapshot = cls(cart=cart)
+        for item in items:
+            try:
+                line = cls._price_line(item)
+            except (TypeError, ValueError, AttributeError, InvalidOperation):
+                logger.warning('Could not price cart item %s, left out of the cart', item.id, exc_info=True)
+                continue
+            if details:
+                cls._add_details(line)
+            snapshot.lines.append(line)
+            snapshot.total_items += item.quantity
+            snapshot.total_price += line.total_price
+            snapshot.total_original_price += line.original_total_price
+        return snapshot
+
+    @staticmethod
+    def _price_line(item):
+        unit_price = item.get_unit_price_toman()
+        if item.variant and item.variant.price_toman:
+            original_unit_price = float(item.variant.price_toman)
+        else:
+            original_unit_price = float(item.product.price_toman) if item.product.price_toman else 0
+        return CartLine(
+            item=item,
+            unit_price=unit_price,
+            total_price=item.get_total_price(),
+            original_total_price=original_unit_price * item.quantity,
+        )
+
+    @staticmethod
+    def _add_details(line):
+        product = line.item.product
+        category_attributes = list(product.category.category_attributes.all()) if product.category else []
+        line.attribute_labels = {attr.key: attr.label_fa for attr in category_attributes}
+
+        values = {}
+        for legacy in product.legacy_attribute_set.all():
+            if legacy.value:
+                values.setdefault(legacy.key, legacy.value)
+        # The new attribute system wins over legacy rows
+        for pav in product.attribute_values.all():
+            value = pav.get_display_value()
+            if value:
+                values[pav.attribute.key] = value
+
+        basket_attributes = [attr for attr in category_attributes if attr.display_in_basket]
+        for attr in basket_attributes[:BASKET_ATTRIBUTES_LIMIT]:
+            value = values.get(attr.key)
+            if value and str(value).strip():
+                line.basket_attributes.append({
+                    'key': attr.key,
+                    'value': str(value),
+                    'display_name': attr.label_fa,
+                })
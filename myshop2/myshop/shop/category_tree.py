@@ -0,0 +1,215 @@
+"""
+Materialized category tree.
+
+CategoryClosure stores every (ancestor, descendant, depth) pair of the Category tree, so
+subtree lookups are one indexed query instead of one query per node. On top of it:
+
+- descendant_ids() returns a category's subtree IDs in one query,
+- get_category_product_counts() returns direct and recursive active product counts for
+  every category, cached in the CATALOG_CACHE_ALIAS cache until a product or category
+  change commits (for CATEGORY_COUNTS_LOCAL_CACHE_TIMEOUT seconds at most when that
+  alias is per-process, since the invalidation then only reaches the writing worker),
+- CategoryTree loads all categories once and answers children, effective type and
+  product count questions in memory, for endpoints that render the whole tree.
+
+The closure rows are maintained by the Category signals in shop/signals.py.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count
+
+from accounts.utils import is_shared_cache
+
+from .models import Category, CategoryClosure, Product
+
+PRODUCT_COUNTS_CACHE_KEY = 'categories:product_counts'
+PRODUCT_COUNTS_CACHE_TIMEOUT = getattr(settings, 'CATEGORY_COUNTS_CACHE_TIMEOUT', 60 * 60)
+PRODUCT_COUNTS_LOCAL_CACHE_TIMEOUT = getattr(settings, 'CATEGORY_COUNTS_LOCAL_CACHE_TIMEOUT', 60)
+
+
+def _cache_alias():
+    return getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')
+
+
+def rebuild_category_closure():
+    """
+    Rebuild the whole closure table from Category.parent.
+
+    Categories caught in a parent cycle only get their depth-0 row. Returns the number
+    of rows written.
+    """
+    parents = dict(Category.objects.values_list('id', 'parent_id'))
+    children = defaultdict(list)
+    for category_id, parent_id in parents.items():
+        if parent_id is not None and parent_id in parents:
+            children[parent_id].append(category_id)
+
+    rows = []
+    reached = set()
+    # Walk down from the roots, carrying the ancestor chain of each node
+    stack = [(category_id, []) for category_id, parent_id in parents.items() if parent_id not in parents]
+    while stack:
+        category_id, ancestors = stack.pop()
+        reached.add(category_id)
+        chain = ancestors + [category_id]
+        for depth, ancestor_id in enumerate(reversed(chain)):
+            rows.append(CategoryClosure(ancestor_id=ancestor_id, descendant_id=category_id, depth=depth))
+        for child_id in children[category_id]:
+            if child_id not in reached:
+                stack.append((child_id, chain))
+
+    for category_id in parents.keys() - reached:
+        rows.append(CategoryClosure(ancestor_id=category_id, descendant_id=category_id, depth=0))
+
+    with transaction.atomic():
+        CategoryClosure.objects.all().delete()
+        CategoryClosure.objects.bulk_create(rows, batch_size=1000)
+    invalidate_category_product_counts()
+    return len(rows)
+
+
+def sync_category_closure(category, created=False):
+    """Insert the closure rows of a new category, or move its subtree after a parent change."""
+    if created:
+        rows = [CategoryClosure(ancestor_id=category.pk, descendant_id=category.pk, depth=0)]
+        if category.parent_id:
+            rows.extend(
+                CategoryClosure(ancestor_id=ancestor_id, descendant_id=category.pk, depth=depth + 1)
+                for ancestor_id, depth in CategoryClosure.objects.filter(
+                    descendant_id=category.parent_id
+                ).values_list('ancestor_id', 'depth')
+            )
+        CategoryClosure.objects.bulk_create(rows)
+        return
+
+    current_parent_id = CategoryClosure.objects.filter(
+        descendant_id=category.pk, depth=1
+    ).values_list('ancestor_id', flat=True).first()
+    if current_parent_id == category.parent_id:
+        return
+
+    subtree = list(CategoryClosure.objects.filter(ancestor_id=category.pk).values_list('descendant_id', 'depth'))
+    subtree_ids = [descendant_id for descendant_id, _ in subtree]
+    if not subtree or category.parent_id in subtree_ids:
+        # Missing rows or a parent cycle: fall back to a full rebuild
+        rebuild_category_closure()
+        return
+
+    with transaction.atomic():
+        # Detach the subtree from its old ancestors, then attach it under the new parent
+        CategoryClosure.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+        if category.parent_id:
+            ancestors = CategoryClosure.objects.filter(
+                descendant_id=category.parent_id
+            ).values_list('ancestor_id', 'depth')
+            CategoryClosure.objects.bulk_create([
+                CategoryClosure(ancestor_id=ancestor_id, descendant_id=descendant_id,
+                                depth=ancestor_depth + descendant_depth + 1)
+                for ancestor_id, ancestor_depth in ancestors
+                for descendant_id, descendant_depth in subtree
+            ])
+
+
+def detach_category_closure(category):
+    """Before a category is deleted, cut its children's subtrees loose (children become roots)."""
+    strict_subtree = CategoryClosure.objects.filter(ancestor_id=category.pk, depth__gt=0).values_list(
+        'descendant_id', flat=True
+    )
+    subtree_ids = list(strict_subtree)
+    if subtree_ids:
+        CategoryClosure.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+
+
+def descendant_ids(category_id, include_self=True):
+    """Return the IDs of every category below the given one (and the category itself by default)."""
+    qs = CategoryClosure.objects.filter(ancestor_id=category_id)
+    if not include_self:
+        qs = qs.filter(depth__gt=0)
+    return list(qs.values_list('descendant_id', flat=True))
+
+
+def invalidate_category_product_counts():
+    """Drop the cached per-category product counts once the current transaction commits."""
+    transaction.on_commit(lambda: caches[_cache_alias()].delete(PRODUCT_COUNTS_CACHE_KEY))
+
+
+def get_category_product_counts():
+    """
+    Return active product counts for every category.
+
+    Returns:
+        dict: 'direct' maps category ID -> products in that category, 'recursive' maps
+        category ID -> products in the category and all of its descendants
+    """
+    cache = caches[_cache_alias()]
+    counts = cache.get(PRODUCT_COUNTS_CACHE_KEY)
+    if counts is None:
+        direct = dict(
+            Product.objects.filter(is_active=True)
+            .values('category_id')
+            .annotate(count=Count('id'))
+            .values_list('category_id', 'count')
+        )
+        recursive = dict(
+            CategoryClosure.objects.filter(descendant__product__is_active=True)
+            .values('ancestor_id')
+            .annotate(count=Count('descendant__product'))
+            .values_list('ancestor_id', 'count')
+        )
+        counts = {'direct': direct, 'recursive': recursive}
+        timeout = PRODUCT_COUNTS_CACHE_TIMEOUT if is_shared_cache(_cache_alias()) else PRODUCT_COUNTS_LOCAL_CACHE_TIMEOUT
+        cache.set(PRODUCT_COUNTS_CACHE_KEY, counts, timeout)
+    return counts
+
+
+class CategoryTree:
+    """
+    All categories loaded in one query, with children and product counts resolved in memory.
+
+    Mirrors the Category model helpers (get_effective_category_type, get_product_count)
+    so tree endpoints can render every node without further queries.
+    """
+
+    def __init__(self):
+        self.categories = list(Category.objects.select_related('gender', 'group', 'subgroup').order_by('name'))
+        self.by_id = {category.id: category for category in self.categories}
+        self._children = defaultdict(list)
+        for category in self.categories:
+            if category.parent_id in self.by_id:
+                self._children[category.parent_id].append(category)
+        counts = get_category_product_counts()
+        self.direct_counts = counts['direct']
+        self.recursive_counts = counts['recursive']
+
+    def get(self, category_id):
+        return self.by_id.get(category_id)
+
+    def parent(self, category):
+        return self.by_id.get(category.parent_id)
+
+    def children(self, category, visible_only=True):
+        """Direct subcategories ordered by name, like category.subcategories.all()"""
+        children = self._children.get(category.id, [])
+        if visible_only:
+            return [child for child in children if child.is_visible]
+        return list(children)
+
+    def effective_type(self, category):
+        """Same rules as Category.get_effective_category_type"""
+        if category.category_type != 'auto':
+            return category.category_type
+        if self._children.get(category.id):
+            return 'container'
+        return 'direct'
+
+    def is_container(self, category):
+        return self.effective_type(category) == 'container'
+
+    def product_count(self, category):
+        """Same result as Category.get_product_count"""
+        if self.is_container(category):
+            return self.recursive_counts.get(category.id, 0)
+        return self.direct_counts.get(category.id, 0)
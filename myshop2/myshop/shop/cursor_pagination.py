@@ -0,0 +1,191 @@
+"""
+Keyset (cursor) pagination for product listings.
+
+OFFSET pagination reads and discards every row before the requested page, so deep
+pages get slower and counts have to be recomputed on every call. Cursor mode instead
+remembers the (sort value, id) of the last row served and asks for rows after it,
+which an index on (field, id) answers at the same cost on any page.
+
+Cursors are opaque URL-safe strings; clients pass them back unchanged as ``?cursor=``.
+An empty ``?cursor=`` requests the first page in cursor mode.
+"""
+import base64
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Optional
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+# Sort fields that can be paginated by keyset (non-null, indexed together with id)
+KEYSET_SORT_FIELDS = ('created_at', 'price_toman', 'name')
+DEFAULT_SORT_FIELD = 'created_at'
+
+# Upper bound for the non-PostgreSQL approximate count
+APPROXIMATE_COUNT_CAP = 10000
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor can't be decoded or belongs to a different sort order"""
+
+
+@dataclass
+class CursorPage:
+    items: List = field(default_factory=list)
+    next_cursor: Optional[str] = None
+    previous_cursor: Optional[str] = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _decode_value(sort_field, raw):
+    if sort_field in ('created_at', 'created'):
+        value = parse_datetime(raw) if isinstance(raw, str) else None
+        if value is None:
+            raise InvalidCursor('Invalid cursor')
+        return value
+    if sort_field == 'price_toman':
+        try:
+            return Decimal(raw)
+        except (ArithmeticError, TypeError, ValueError):
+            raise InvalidCursor('Invalid cursor')
+    if not isinstance(raw, str):
+        raise InvalidCursor('Invalid cursor')
+    return raw
+
+
+def encode_cursor(sort_field, descending, obj, direction):
+    payload = {
+        's': sort_field,
+        'o': 'desc' if descending else 'asc',
+        'v': _encode_value(getattr(obj, sort_field)),
+        'id': obj.pk,
+        'd': direction,
+    }
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort_field, descending):
+    """Return (value, id, direction) from a cursor issued for the same sort order."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if payload['s'] != sort_field or payload['o'] != ('desc' if descending else 'asc'):
+            raise InvalidCursor('Cursor does not match the requested sort order')
+        if payload['d'] not in ('next', 'prev'):
+            raise InvalidCursor('Invalid cursor')
+        return _decode_value(sort_field, payload['v']), int(payload['id']), payload['d']
+    except InvalidCursor:
+        raise
+    except (ValueError, KeyError, TypeError, UnicodeError):
+        raise InvalidCursor('Invalid cursor')
+
+
+def resolve_keyset_sort(sort_by):
+    """Map a requested sort field onto one that supports cursor pagination."""
+    return sort_by if sort_by in KEYSET_SORT_FIELDS else DEFAULT_SORT_FIELD
+
+
+def paginate_by_cursor(queryset, sort_field, descending, cursor, page_size):
+    """
+    Return one page of ``queryset`` ordered by (sort_field, id).
+
+    Args:
+        queryset: filtered queryset (any existing ordering is replaced)
+        sort_field: one of KEYSET_SORT_FIELDS
+        descending: True for newest/most expensive/Z-A first
+        cursor: cursor from a previous page, or empty for the first page
+        page_size: number of items per page
+
+    Raises:
+        InvalidCursor: if the cursor is malformed or was issued for another sort order
+    """
+    direction = 'next'
+    if cursor:
+        value, last_id, direction = decode_cursor(cursor, sort_field, descending)
+        # Walking backwards flips the comparison and the ordering
+        forward = descending if direction == 'next' else not descending
+        op = 'lt' if forward else 'gt'
+        queryset = queryset.filter(
+            Q(**{f'{sort_field}__{op}': value}) | Q(**{sort_field: value, f'id__{op}': last_id})
+        )
+    else:
+        forward = descending
+
+    prefix = '-' if forward else ''
+    rows = list(queryset.order_by(f'{prefix}{sort_field}', f'{prefix}id')[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if direction == 'prev':
+        rows.reverse()
+        has_before, has_after = has_more, True
+    else:
+        has_before, has_after = bool(cursor), has_more
+
+    page = CursorPage(items=rows)
+    if rows:
+        if has_after:
+            page.next_cursor = encode_cursor(sort_field, descending, rows[-1], 'next')
+        if has_before:
+            page.previous_cursor = encode_cursor(sort_field, descending, rows[0], 'prev')
+    return page
+
+
+def approximate_count(queryset):
+    """
+    Cheap row count for "about N results" displays.
+
+    On PostgreSQL this is the planner's row estimate for the query; elsewhere it is an
+    exact count capped at APPROXIMATE_COUNT_CAP.
+    """
+    queryset = queryset.order_by()
+    if connection.vendor == 'postgresql':
+        try:
+            plan = json.loads(queryset.explain(format='json'))
+            return int(plan[0]['Plan']['Plan Rows'])
+        except (ValueError, KeyError, IndexError, TypeError):
+            pass
+    return queryset[:APPROXIMATE_COUNT_CAP].count()
+
+
+def cursor_pagination_data(page, page_size, queryset=None, count_mode=None):
+    """
+    Build the ``pagination`` block of a cursor-mode response.
+
+    ``count_mode`` is taken from ``?count=``: 'exact' runs COUNT(*), 'approx' uses
+    approximate_count(), anything else leaves the total out (constant cost per page).
+    """
+    data = {
+        'mode': 'cursor',
+        'per_page': page_size,
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
+        'has_next': page.has_next,
+        'has_previous': page.has_previous,
+    }
+    if queryset is not None and count_mode == 'exact':
+        data['total_items'] = queryset.count()
+        data['total_is_approximate'] = False
+    elif queryset is not None and count_mode == 'approx':
+        data['total_items'] = approximate_count(queryset)
+        data['total_is_approximate'] = True
+    return data
@@ -0,0 +1,190 @@
+"""
+Facet counts for category filter screens.
+
+For every category we keep a cached snapshot built from ProductAttributeIndex:
+the product-ID set behind each (key, value) pair plus each active product's price.
+Given the active filters, counts for every key/value are then pure set arithmetic,
+so the filter screen gets all keys, values, counts and price ranges from one call.
+
+Snapshots live in the CATALOG_CACHE_ALIAS cache and are invalidated per category by the
+signals in shop/signals.py, once the change commits. The deletes only reach every worker
+when that alias is shared (Redis); with a per-process cache snapshots are kept for
+FACET_LOCAL_CACHE_TIMEOUT seconds only.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from accounts.utils import is_shared_cache
+
+from .attribute_index import normalize_attribute_value
+from .models import Product, ProductAttributeIndex
+
+FACET_CACHE_PREFIX = 'facets:category:'
+FACET_CACHE_TIMEOUT = getattr(settings, 'FACET_CACHE_TIMEOUT', 60 * 60)
+FACET_LOCAL_CACHE_TIMEOUT = getattr(settings, 'FACET_LOCAL_CACHE_TIMEOUT', 60)
+
+PRICE_FILTER_KEYS = ('price_toman__gte', 'price_toman__lte', 'price__gte', 'price__lte')
+
+
+def _cache_alias():
+    return getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')
+
+
+def _cache_key(category_id):
+    return f'{FACET_CACHE_PREFIX}{category_id}'
+
+
+def invalidate_category_facets(*category_ids):
+    """Drop cached facet snapshots for the given categories once the current transaction commits."""
+    keys = [_cache_key(cid) for cid in category_ids if cid is not None]
+    if keys:
+        # After commit, so no request caches the old rows again once they are dropped
+        transaction.on_commit(lambda: caches[_cache_alias()].delete_many(keys))
+
+
+def _build_snapshot(category):
+    """Load the ID sets, prices and configured labels for one category."""
+    prices = {
+        pid: float(price or 0)
+        for pid, price in Product.objects.filter(category=category, is_active=True).values_list('id', 'price_toman')
+    }
+
+    values = {}  # key -> normalized value -> {'label': str, 'ids': set}
+    rows = ProductAttributeIndex.objects.filter(category=category, product__is_active=True).values_list(
+        'product_id', 'attr_key', 'attr_value',
+        'legacy_attribute__value',
+        'product_attribute_value__attribute_value__value',
+        'product_attribute_value__custom_value',
+    )
+    for product_id, key, value, legacy_value, predefined_value, custom_value in rows:
+        entry = values.setdefault(key, {}).setdefault(value, {'label': None, 'ids': set()})
+        if entry['label'] is None:
+            original = predefined_value or custom_value or legacy_value
+            entry['label'] = ' '.join(original.split()) if original else value
+        entry['ids'].add(product_id)
+
+    # Labels and ordering configured on the category take precedence
+    meta = {}
+    for attr in category.category_attributes.prefetch_related('values'):
+        meta[attr.key] = {
+            'label_fa': attr.label_fa,
+            'display_order': attr.display_order,
+            'value_order': {
+                normalize_attribute_value(v.value): (v.display_order, v.value) for v in attr.values.all()
+            },
+        }
+
+    return {'prices': prices, 'values': values, 'meta': meta}
+
+
+def get_category_snapshot(category):
+    """Return the cached facet snapshot for a category, building it on a miss."""
+    cache = caches[_cache_alias()]
+    snapshot = cache.get(_cache_key(category.id))
+    if snapshot is None:
+        snapshot = _build_snapshot(category)
+        timeout = FACET_CACHE_TIMEOUT if is_shared_cache(_cache_alias()) else FACET_LOCAL_CACHE_TIMEOUT
+        cache.set(_cache_key(category.id), snapshot, timeout)
+    return snapshot
+
+
+def _price_range(ids, prices):
+    if not ids:
+        return {'min': None, 'max': None}
+    selected = [prices[pid] for pid in ids]
+    return {'min': min(selected), 'max': max(selected)}
+
+
+def compute_facets(category, filters=None, price_filters=None):
+    """
+    Compute value counts for every attribute key of a category under the active filters.
+
+    Counts for a key ignore that key's own selection (disjunctive faceting), so the
+    screen can show how many products each alternative value would yield.
+
+    Args:
+        category: Category instance
+        filters: dict of attribute key -> list of selected values
+        price_filters: dict using the PRICE_FILTER_KEYS query parameter names
+
+    Returns:
+        dict: total_products, price_range and a list of facets with per-value counts
+    """
+    snapshot = get_category_snapshot(category)
+    prices = snapshot['prices']
+    values = snapshot['values']
+    meta = snapshot['meta']
+    filters = filters or {}
+    price_filters = price_filters or {}
+
+    # Products passing the price filters
+    base_ids = set(prices)
+    for param, raw in price_filters.items():
+        try:
+            bound = float(raw)
+        except (TypeError, ValueError):
+            continue
+        if param.endswith('__gte'):
+            base_ids = {pid for pid in base_ids if prices[pid] >= bound}
+        elif param.endswith('__lte'):
+            base_ids = {pid for pid in base_ids if prices[pid] <= bound}
+
+    # Products matching each selected key (OR within a key)
+    selected_ids = {}
+    for key, selected in filters.items():
+        key_values = values.get(key, {})
+        matched = set()
+        for value in selected:
+            entry = key_values.get(normalize_attribute_value(value))
+            if entry:
+                matched |= entry['ids']
+        selected_ids[key] = matched
+
+    def _matching_except(excluded_key):
+        ids = base_ids
+        for key, matched in selected_ids.items():
+            if key != excluded_key:
+                ids = ids & matched
+        return ids
+
+    matching_ids = _matching_except(None)
+
+    facets = []
+    for key, key_values in values.items():
+        candidates = _matching_except(key)
+        key_meta = meta.get(key, {})
+        value_order = key_meta.get('value_order', {})
+        selected = {normalize_attribute_value(v) for v in filters.get(key, [])}
+
+        facet_values = []
+        for value, entry in key_values.items():
+            ids = entry['ids'] & candidates
+            ordering = value_order.get(value)
+            facet_values.append({
+                'value': ordering[1] if ordering else entry['label'],
+                'count': len(ids),
+                'price_range': _price_range(ids, prices),
+                'selected': value in selected,
+                '_order': ordering[0] if ordering else None,
+            })
+
+        facet_values.sort(key=lambda v: (v['_order'] is None, v['_order'] or 0, -v['count'], v['value']))
+        for item in facet_values:
+            del item['_order']
+
+        facets.append({
+            'key': key,
+            'label_fa': key_meta.get('label_fa') or key,
+            'display_order': key_meta.get('display_order'),
+            'values': facet_values,
+        })
+
+    facets.sort(key=lambda f: (f['display_order'] is None, f['display_order'] or 0, f['key']))
+
+    return {
+        'total_products': len(matching_ids),
+        'price_range': _price_range(matching_ids, prices),
+        'facets': facets,
+    }
+
@@ -0,0 +1,187 @@
+"""
+Idempotency keys for retried API requests.
+
+Clients send an ``Idempotency-Key`` header (a UUID made once per user action, e.g. when
+"Pay" is tapped) with POST/PUT/PATCH/DELETE requests they may retry. The first request
+with a key runs normally and its response is stored, scoped to the user (or the guest's
+device) and tied to a hash of the request. A retry with the same key gets the stored
+response back without running the view again; a new key is a new request.
+
+- Responses are stored in IdempotencyRecord with a copy in the cache, so most replays
+  never reach the database.
+- A retry that arrives while the first request is still running waits up to
+  IDEMPOTENCY_WAIT_SECONDS for its response, and gets a 409 if it takes longer.
+- Reusing a key for a different request (method, path, query or body) gets a 422.
+- 5xx and 429 responses aren't stored, so those requests can be retried with the same key.
+- Keys expire after IDEMPOTENCY_KEY_TTL seconds (default 24 hours); purge_expired_keys()
+  deletes the expired rows.
+"""
+import hashlib
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+
+from accounts.utils import request_user_id
+
+from .models import IdempotencyRecord
+
+KEY_HEADER = 'Idempotency-Key'
+REPLAY_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+KEY_TTL = getattr(settings, 'IDEMPOTENCY_KEY_TTL', 24 * 60 * 60)
+# How long a duplicate waits for the first request before getting a 409
+WAIT_SECONDS = getattr(settings, 'IDEMPOTENCY_WAIT_SECONDS', 5)
+# A request still running after this long is assumed dead and its key can be taken over
+LOCK_TIMEOUT = getattr(settings, 'IDEMPOTENCY_LOCK_TIMEOUT', 60)
+
+# Paths whose unsafe requests honour the header
+IDEMPOTENT_PATHS = getattr(settings, 'IDEMPOTENCY_PATHS', (
+    r'^/shop/api/customer/checkout/$',
+    r'^/shop/api/customer/cart/$',
+    r'^/shop/api/v1/wishlist/toggle/$',
+))
+IDEMPOTENT_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+@dataclass
+class StoredResponse:
+    request_hash: str
+    status_code: Optional[int] = None  # None while the first request is still running
+    content_type: str = ''
+    body: bytes = b''
+
+    @property
+    def completed(self):
+        return self.status_code is not None
+
+    def to_response(self):
+        response = HttpResponse(self.body, status=self.status_code, content_type=self.content_type or None)
+        response[REPLAY_HEADER] = 'true'
+        return response
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def request_scope(request):
+    """Hash of who sent the request (user, else guest device ID); None if unknown."""
+    user_id = request_user_id(request)
+    if user_id is not None:
+        return _hash('user', user_id)
+    device_id = request.headers.get('X-Device-ID', '').strip().lower()
+    if device_id:
+        return _hash('device', device_id)
+    return None
+
+
+def request_fingerprint(request):
+    """Hash of everything that makes two requests the same request."""
+    return _hash(request.method, request.path, request.META.get('QUERY_STRING', ''), request.body)
+
+
+def _cache_key(scope, key):
+    return f'idempotency:{_hash(scope, key)}'
+
+
+def _from_record(record):
+    return StoredResponse(
+        request_hash=record.request_hash,
+        status_code=record.status_code,
+        content_type=record.content_type,
+        body=bytes(record.body),
+    )
+
+
+def lookup(scope, key):
+    """Return the StoredResponse of an unexpired key (finished or not), or None."""
+    stored = cache.get(_cache_key(scope, key))
+    if stored is not None:
+        return stored
+    record = IdempotencyRecord.objects.filter(scope=scope, key=key, expires_at__gt=timezone.now()).first()
+    if record is None:
+        return None
+    stored = _from_record(record)
+    if stored.completed:
+        cache.set(_cache_key(scope, key), stored, max(1, int((record.expires_at - timezone.now()).total_seconds())))
+    return stored
+
+
+def begin(scope, key, request_hash):
+    """
+    Claim a key for a request about to run.
+
+    Returns None if the caller now owns the key (and must call complete() or abandon()),
+    otherwise the StoredResponse of the request that owns it.
+    """
+    stored = cache.get(_cache_key(scope, key))
+    if stored is not None:
+        return stored
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            IdempotencyRecord.objects.create(
+                scope=scope, key=key, request_hash=request_hash, expires_at=now + timedelta(seconds=KEY_TTL),
+            )
+        return None
+    except IntegrityError:
+        pass
+
+    record = IdempotencyRecord.objects.filter(scope=scope, key=key).first()
+    if record is None:
+        # The owner gave the key up in the meantime
+        return begin(scope, key, request_hash)
+    stale = record.status_code is None and record.created_at <= now - timedelta(seconds=LOCK_TIMEOUT)
+    if record.expires_at <= now or stale:
+        # Take the key over, unless another request just did
+        taken = IdempotencyRecord.objects.filter(pk=record.pk, created_at=record.created_at).update(
+            request_hash=request_hash, status_code=None, content_type='', body=b'',
+            created_at=now, expires_at=now + timedelta(seconds=KEY_TTL),
+        )
+        return None if taken else begin(scope, key, request_hash)
+
+    stored = _from_record(record)
+    if stored.completed:
+        cache.set(_cache_key(scope, key), stored, max(1, int((record.expires_at - now).total_seconds())))
+    return stored
+
+
+def is_storable(response):
+    """Server errors, rate limits and streams are not replayed, so the client can retry them."""
+    return not response.streaming and response.status_code < 500 and response.status_code != 429
+
+
+def complete(scope, key, request_hash, response):
+    """Store the response of a request that owned its key."""
+    stored = StoredResponse(
+        request_hash=request_hash,
+        status_code=response.status_code,
+        content_type=response.get('Content-Type', ''),
+        body=response.content,
+    )
+    IdempotencyRecord.objects.filter(scope=scope, key=key, request_hash=request_hash, status_code=None).update(
+        status_code=stored.status_code, content_type=stored.content_type, body=stored.body,
+    )
+    cache.set(_cache_key(scope, key), stored, KEY_TTL)
+
+
+def abandon(scope, key, request_hash):
+    """Release a key without storing a response, so the request can be retried."""
+    IdempotencyRecord.objects.filter(scope=scope, key=key, request_hash=request_hash, status_code=None).delete()
+
+
+def purge_expired_keys(now=None):
+    """Delete expired records. Returns the number deleted."""
+    deleted, _ = IdempotencyRecord.objects.filter(expires_at__lte=now or timezone.now()).delete()
+    return deleted
@@ -0,0 +1,171 @@
+"""
+Product and variant image processing off the request path.
+
+Saving a new ProductImage/ProductVariantImage stores the original upload as it is and
+marks the row ``processing``; its SHA-256 (for duplicate detection) is computed by
+streaming the file in chunks, never reading it whole. The process_images command is the
+worker: it takes batches of processing images, encodes them to WebP in a process pool
+(one process per core by default, so the images of a bulk upload are encoded in
+parallel), swaps the stored file for the WebP version and clears the flag. Until then the
+original is served.
+
+An image that can't be encoded keeps its original file. Workers claim images in the cache
+and only write a result if the row still has the file they read, so several workers can
+run side by side.
+"""
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 64 * 1024
+MAX_SIZE = getattr(settings, 'IMAGE_MAX_SIZE', 1600)
+# Files larger than this are kept as uploaded
+MAX_SOURCE_BYTES = getattr(settings, 'IMAGE_MAX_SOURCE_BYTES', 20 * 1024 * 1024)
+WEBP_QUALITY = getattr(settings, 'IMAGE_WEBP_QUALITY', 80)
+# 0 (fastest) - 6 (slowest); above 4 the files get only slightly smaller
+WEBP_METHOD = getattr(settings, 'IMAGE_WEBP_METHOD', 4)
+CLAIM_TIMEOUT = getattr(settings, 'IMAGE_PROCESSING_CLAIM_TIMEOUT', 10 * 60)
+
+
+def file_sha256(file):
+    """SHA-256 hex digest of a Django File, read in chunks. The file is left at position 0."""
+    digest = hashlib.sha256()
+    for chunk in file.chunks(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def needs_processing(image_field):
+    """True if an uploaded image still has to be converted to WebP"""
+    return bool(image_field) and not image_field.name.lower().endswith('.webp')
+
+
+def webp_name(name):
+    return os.path.splitext(name)[0] + '.webp'
+
+
+def encode_webp(data, max_size=MAX_SIZE):
+    """
+    Encode image bytes as WebP, at most ``max_size`` pixels on the longer side.
+
+    Runs in the worker processes, so it only takes and returns bytes.
+    """
+    img = Image.open(BytesIO(data))
+    # JPEGs can be decoded at a reduced scale, much faster than decoding in full and
+    # resizing; draft() never goes below the requested size
+    img.draft('RGB', (max_size, max_size))
+    # Not copied to the output; dropping it also avoids profile warnings on convert
+    img.info.pop('icc_profile', None)
+    if img.mode in ('RGBA', 'P'):
+        img = img.convert('RGB')
+    if max(img.size) > max_size:
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+
+    output = BytesIO()
+    img.save(output, format='WEBP', quality=WEBP_QUALITY, method=WEBP_METHOD, lossless=False, icc_profile=None)
+    return output.getvalue()
+
+
+def _image_models():
+    from .models import ProductImage, ProductVariantImage
+    return ProductImage, ProductVariantImage
+
+
+def _claim_key(image):
+    return f'image_pipeline:claim:{image._meta.label_lower}:{image.pk}'
+
+
+def claim_pending_images(batch_size=20):
+    """Up to ``batch_size`` processing images not claimed by another worker, oldest first."""
+    claimed = []
+    for model in _image_models():
+        for image in model.objects.filter(processing=True).order_by('pk')[:batch_size - len(claimed)]:
+            if cache.add(_claim_key(image), True, CLAIM_TIMEOUT):
+                claimed.append(image)
+    return claimed
+
+
+def _read(image):
+    with image.image.storage.open(image.image.name, 'rb') as f:
+        return f.read()
+
+
+def _finish(image, source_name, webp_data):
+    """Store the WebP version of ``image`` and clear its processing flag."""
+    storage = image.image.storage
+    new_name = storage.save(webp_name(source_name), ContentFile(webp_data)) if webp_data else None
+    with transaction.atomic():
+        current = type(image).objects.select_for_update().filter(pk=image.pk, processing=True).first()
+        if current is None or current.image.name != source_name:
+            # Deleted, replaced or done by another worker meanwhile
+            if new_name:
+                storage.delete(new_name)
+            return False
+        if new_name:
+            current.image.name = new_name
+        current.processing = False
+        current.save(update_fields=['image', 'processing'])
+        if new_name:
+            transaction.on_commit(lambda: storage.delete(source_name))
+    return True
+
+
+def process_images(images, executor=None):
+    """
+    Encode the given processing images and store the results. ``executor`` (e.g. a
+    ProcessPoolExecutor) runs the encoding; without one the images are encoded here,
+    one after another. Returns the number of images finished.
+    """
+    sources = {}
+    for image in images:
+        try:
+            sources[image] = _read(image) if image.image.size <= MAX_SOURCE_BYTES else None
+        except Exception as e:
+            logger.warning(f"Could not read {image.image.name}: {e}")
+            sources[image] = None
+
+    pending = {image: data for image, data in sources.items() if data is not None}
+    if executor:
+        # Submit everything first so the whole batch is encoded in parallel
+        pending = {image: executor.submit(encode_webp, data) for image, data in pending.items()}
+
+    finished = 0
+    for image in images:
+        source_name = image.image.name
+        webp_data = None
+        if image in pending:
+            try:
+                webp_data = pending[image].result() if executor else encode_webp(pending[image])
+            except Exception as e:
+                # Unsupported or broken files stay as uploaded
+                logger.warning(f"Could not convert {source_name} to WebP: {e}")
+        try:
+            finished += _finish(image, source_name, webp_data)
+        finally:
+            cache.delete(_claim_key(image))
+    return finished
+
+
+def process_pending_images(batch_size=20, executor=None):
+    """Claim and process one batch of images. Returns (finished, claimed)."""
+    images = claim_pending_images(batch_size)
+    if not images:
+        return 0, 0
+    return process_images(images, executor), len(images)
+
+
+def make_executor(workers=None):
+    """A process pool for encoding, or None to encode in this process (``workers`` <= 1)."""
+    workers = workers if workers is not None else os.cpu_count() or 1
+    return ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
@@ -0,0 +1,197 @@
+"""
+Stock reservations and checkout stock accounting.
+
+Stock is only ever changed with conditional UPDATEs
+(``stock_quantity = stock_quantity - q WHERE stock_quantity >= q``), so two requests can
+never both take the last unit, whatever the isolation level.
+
+- Adding or changing a cart item reserves its quantity for STOCK_RESERVATION_TTL seconds
+  (StockReservation), taking it off stock_quantity immediately.
+- Removing the item puts the reserved stock back (CartItem pre_delete signal).
+- Checkout claims the cart's reservations and takes whatever is not covered by one,
+  in the same transaction as the order and its items.
+- release_expired_reservations() (the release_expired_reservations command, a cron job
+  in render.yaml) returns the stock of reservations that expired before checkout. When a
+  SKU runs short, its expired reservations are also released on the spot before giving
+  up, so abandoned carts never keep stock between runs.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OrderItem, Product, ProductVariant, StockReservation
+from .suggestions import suggestion_index
+
+RESERVATION_TTL = getattr(settings, 'STOCK_RESERVATION_TTL', 15 * 60)
+
+
+class OutOfStock(Exception):
+    """Raised when a product or variant doesn't have the requested quantity left"""
+
+    def __init__(self, product_id, variant_id, requested, available):
+        self.product_id = product_id
+        self.variant_id = variant_id
+        self.requested = requested
+        self.available = available
+        super().__init__(f'Only {available} items available in stock')
+
+
+def _stock_queryset(product_id, variant_id):
+    if variant_id:
+        return ProductVariant.objects.filter(pk=variant_id)
+    return Product.objects.filter(pk=product_id)
+
+
+def take_stock(product_id, variant_id, quantity):
+    """Atomically decrement stock by ``quantity``; raise OutOfStock if not enough is left."""
+    if quantity <= 0:
+        return
+    taken = _stock_queryset(product_id, variant_id).filter(stock_quantity__gte=quantity).update(
+        stock_quantity=F('stock_quantity') - quantity
+    )
+    if not taken:
+        available = _stock_queryset(product_id, variant_id).values_list('stock_quantity', flat=True).first() or 0
+        raise OutOfStock(product_id, variant_id, quantity, available)
+
+
+def return_stock(product_id, variant_id, quantity):
+    """Put ``quantity`` back into stock."""
+    if quantity > 0:
+        _stock_queryset(product_id, variant_id).update(stock_quantity=F('stock_quantity') + quantity)
+
+
+def _take_stock_or_release_expired(product_id, variant_id, quantity, keep_cart_item_ids=()):
+    """take_stock(), releasing the SKU's expired reservations (except those of ``keep_cart_item_ids``) if it runs short"""
+    try:
+        take_stock(product_id, variant_id, quantity)
+    except OutOfStock:
+        if not release_expired_reservations(
+            product_id=product_id, variant_id=variant_id, exclude_cart_item_ids=keep_cart_item_ids
+        ):
+            raise
+        take_stock(product_id, variant_id, quantity)
+
+
+def reserve_cart_item(cart_item):
+    """
+    Hold stock for a cart item's current quantity and restart its reservation timer.
+
+    Raises:
+        OutOfStock: if the additional quantity isn't available (nothing is changed)
+    """
+    with transaction.atomic():
+        reservation = StockReservation.objects.select_for_update().filter(cart_item=cart_item).first()
+        reserved = reservation.quantity if reservation else 0
+        delta = cart_item.quantity - reserved
+        if delta > 0:
+            _take_stock_or_release_expired(cart_item.product_id, cart_item.variant_id, delta, [cart_item.pk])
+        else:
+            return_stock(cart_item.product_id, cart_item.variant_id, -delta)
+
+        expires_at = timezone.now() + timedelta(seconds=RESERVATION_TTL)
+        if reservation is None:
+            StockReservation.objects.create(
+                cart_item=cart_item, product_id=cart_item.product_id, variant_id=cart_item.variant_id,
+                quantity=cart_item.quantity, expires_at=expires_at,
+            )
+        else:
+            reservation.quantity = cart_item.quantity
+            reservation.expires_at = expires_at
+            reservation.save(update_fields=['quantity', 'expires_at'])
+
+
+def release_cart_item(cart_item):
+    """Drop a cart item's reservation and put its stock back."""
+    with transaction.atomic():
+        reservation = StockReservation.objects.select_for_update().filter(cart_item=cart_item).first()
+        if reservation is not None:
+            reservation.delete()
+            return_stock(reservation.product_id, reservation.variant_id, reservation.quantity)
+
+
+def _claim_reservations(cart_item_ids):
+    """Delete the reservations of these cart items and return cart_item_id -> reserved quantity."""
+    reservations = list(
+        StockReservation.objects.select_for_update().filter(cart_item_id__in=cart_item_ids)
+        .values_list('id', 'cart_item_id', 'quantity')
+    )
+    StockReservation.objects.filter(id__in=[reservation_id for reservation_id, _, _ in reservations]).delete()
+    return {cart_item_id: quantity for _, cart_item_id, quantity in reservations}
+
+
+def commit_checkout(order, lines):
+    """
+    Take the stock for a checkout and create its order items, all or nothing.
+
+    Reservations of the cart items (expired or not: their stock is still held) count
+    toward the quantity; the rest is taken with one conditional UPDATE per SKU.
+
+    Args:
+        order: the Order being placed
+        lines: CartLine objects from CartSnapshot (item + unit_price)
+
+    Raises:
+        OutOfStock: for the first SKU that can't be covered; the transaction is rolled
+        back, so reservations, stock and order items are left untouched
+    """
+    with transaction.atomic():
+        reserved = _claim_reservations([line.item.id for line in lines])
+        needed = defaultdict(int)  # (product_id, variant_id) -> quantity still to take
+        for line in lines:
+            item = line.item
+            needed[(item.product_id, item.variant_id)] += item.quantity - reserved.get(item.id, 0)
+
+        # A fixed SKU order keeps concurrent checkouts from deadlocking on each other's rows
+        for (product_id, variant_id), quantity in sorted(needed.items(), key=lambda e: (e[0][0], e[0][1] or 0)):
+            if quantity > 0:
+                _take_stock_or_release_expired(product_id, variant_id, quantity)
+            else:
+                # More was reserved than is being bought
+                return_stock(product_id, variant_id, -quantity)
+
+        order_items = OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_id=line.item.product_id, price=line.unit_price, quantity=line.item.quantity)
+            for line in lines
+        ])
+        # bulk_create sends no post_save, so refresh the order totals and the
+        # sales-weighted suggestions here
+        order.refresh_totals()
+        product_ids = {line.item.product_id for line in lines}
+        transaction.on_commit(lambda: suggestion_index.products_changed(product_ids, facets=False))
+        return order_items
+
+
+def release_expired_reservations(now=None, batch_size=500, product_id=None, variant_id=None,
+                                 exclude_cart_item_ids=()):
+    """
+    Return the stock of expired reservations, one batch per transaction.
+
+    Rows locked by a running checkout are skipped (where the database supports it) and
+    picked up by a later run. ``product_id``/``variant_id`` limit the release to one SKU.
+    Returns the number of reservations released.
+    """
+    now = now or timezone.now()
+    expired = StockReservation.objects.filter(expires_at__lt=now).exclude(cart_item_id__in=exclude_cart_item_ids)
+    if product_id is not None:
+        expired = expired.filter(product_id=product_id, variant_id=variant_id)
+    released = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                expired.select_for_update(skip_locked=True)
+                .order_by('pk')
+                .values_list('id', 'product_id', 'variant_id', 'quantity')[:batch_size]
+            )
+            if not batch:
+                return released
+            returned = defaultdict(int)
+            for _, product_id, variant_id, quantity in batch:
+                returned[(product_id, variant_id)] += quantity
+            StockReservation.objects.filter(id__in=[row[0] for row in batch]).delete()
+            for (product_id, variant_id), quantity in returned.items():
+                return_stock(product_id, variant_id, quantity)
+        released += len(batch)
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+
+from shop.attribute_index import rebuild_attribute_index, rebuild_variant_attribute_index
+from shop.models import ProductAttributeIndex, VariantAttribute
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the ProductAttributeIndex table from legacy ProductAttribute and "
+        "ProductAttributeValue rows, and the VariantAttribute table from variant attributes.\n"
+        "Signals keep the index current afterwards. Deploys run it with --if-empty (build.sh, "
+        "render.yaml); run it by hand whenever attributes were changed with bulk updates."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--product-id",
+            type=int,
+            action="append",
+            dest="product_ids",
+            help="Only rebuild rows for this product (can be repeated)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Rows per bulk insert (default: 1000)",
+        )
+        parser.add_argument(
+            "--if-empty",
+            action="store_true",
+            help="Only build tables that have no rows yet (first deploy after migrating)",
+        )
+
+    def handle(self, *args, **options):
+        product_ids = options["product_ids"]
+        batch_size = options["batch_size"]
+
+        scope = f"{len(product_ids)} product(s)" if product_ids else "all products"
+        self.stdout.write(f"Rebuilding attribute index for {scope}...")
+
+        if options["if_empty"] and ProductAttributeIndex.objects.exists():
+            self.stdout.write("Attribute index already built, skipped.")
+        else:
+            written = rebuild_attribute_index(product_ids=product_ids, batch_size=batch_size)
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {written} index rows ({ProductAttributeIndex.objects.count()} total)."
+            ))
+
+        if options["if_empty"] and VariantAttribute.objects.exists():
+            self.stdout.write("Variant attribute index already built, skipped.")
+        else:
+            written = rebuild_variant_attribute_index(product_ids=product_ids, batch_size=batch_size)
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {written} variant attribute rows ({VariantAttribute.objects.count()} total)."
+            ))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from shop.category_tree import rebuild_category_closure
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the CategoryClosure table from Category.parent.\n"
+        "Signals keep the table current afterwards; run this after loaddata or after "
+        "changing categories with raw SQL or bulk updates."
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rebuilding category closure table...")
+        written = rebuild_category_closure()
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} closure rows."))
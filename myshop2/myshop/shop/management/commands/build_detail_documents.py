@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from shop.product_detail import rebuild_all_detail_documents
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild every product's detail document (served by the public product detail API).\n"
+        "Signals keep documents current afterwards; run this after migrating, after loaddata "
+        "or after changing products, variants, images or attributes with raw SQL or bulk updates."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Products rebuilt per batch (default: 200)",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rebuilding product detail documents...")
+        written = rebuild_all_detail_documents(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Built {written} detail documents."))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import ProductSearchDocument
+from shop.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild every product's search document and the search backend index.\n"
+        "Signals keep documents current afterwards. Deploys run it with --if-empty (build.sh, "
+        "render.yaml); run it by hand after loaddata or after changing products, tags or brands "
+        "with raw SQL or bulk updates."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Products indexed per batch (default: 500)",
+        )
+        parser.add_argument(
+            "--if-empty",
+            action="store_true",
+            help="Only build when there are no search documents yet (first deploy after migrating)",
+        )
+
+    def handle(self, *args, **options):
+        if options["if_empty"] and ProductSearchDocument.objects.exists():
+            self.stdout.write("Search index already built, skipped.")
+            return
+        self.stdout.write("Rebuilding product search index...")
+        written = rebuild_search_index(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {written} products."))
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.similarity import TOP_K, build_similarity_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute the most similar products of every product (by tags and by attributes) "
+        "and store them in ProductSimilarity for the similar-products endpoints.\n"
+        "Run a full build nightly and --changed every few minutes to pick up products whose "
+        "tags, attributes, category, price or status changed since."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--changed",
+            action="store_true",
+            help="Only recompute products whose features changed since the last build, and those they affect",
+        )
+        parser.add_argument(
+            "--products",
+            type=str,
+            default="",
+            help="Comma-separated product IDs to recompute, with the products they affect",
+        )
+        parser.add_argument(
+            "--top-k",
+            type=int,
+            default=TOP_K,
+            help=f"Similar products stored per product and kind (default: {TOP_K})",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Products written per transaction (default: 500)",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            product_ids = [int(pk) for pk in options["products"].split(",") if pk.strip()] or None
+        except ValueError:
+            raise CommandError("--products must be comma-separated product IDs")
+        recomputed = build_similarity_index(
+            changed_only=options["changed"],
+            product_ids=product_ids,
+            top_k=options["top_k"],
+            batch_size=options["batch_size"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Recomputed similar products of {recomputed} products."))
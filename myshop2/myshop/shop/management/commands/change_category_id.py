@@ -60,6 +60,16 @@ class Command(BaseCommand):
                         "UPDATE shop_categoryattribute SET category_id = %s WHERE category_id = %s",
                         [new_id, old_id]
                     )
+                    
+                    # Update the attribute index rows of this category
+                    cursor.execute(
+                        "UPDATE shop_productattributeindex SET category_id = %s WHERE category_id = %s",
+                        [new_id, old_id]
+                    )
+                
+                # Closure rows reference the old ID; rebuild them from the updated parents
+                from shop.category_tree import rebuild_category_closure
+                rebuild_category_closure()
             
             self.stdout.write(
                 self.style.SUCCESS(f'Successfully changed category ID from {old_id} to {new_id}')
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.offer_analytics import flush_offer_analytics
+
+
+class Command(BaseCommand):
+    help = (
+        "Write buffered special-offer views/clicks to SpecialOffer counters and "
+        "SpecialOfferHourlyStats.\n"
+        "Run from cron, or keep it running with --loop. Counts are only buffered with a "
+        "cache shared with the web workers (e.g. Redis) and OFFER_ANALYTICS_FLUSH_INTERVAL "
+        "set; otherwise they are written directly and there is nothing to flush."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep flushing every --interval seconds",
+        )
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=60,
+            help="Seconds between flushes with --loop (default: 60)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            totals = flush_offer_analytics()
+            if totals is None:
+                self.stdout.write("Another flush is running, skipped.")
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    f"Flushed {totals['views']} views and {totals['clicks']} clicks."
+                ))
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
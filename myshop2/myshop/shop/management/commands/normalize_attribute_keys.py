@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
+from shop.attribute_index import rebuild_attribute_index
 from shop.models import Product, ProductAttribute
 
 
@@ -69,7 +70,10 @@ class Command(BaseCommand):
             return
 
         with transaction.atomic():
+            product_ids = list(qs.values_list("product_id", flat=True).distinct())
             updated = qs.update(key=to_key)
+            # Bulk update bypasses signals; refresh the attribute index for the touched products
+            rebuild_attribute_index(product_ids=product_ids)
 
         self.stdout.write(self.style.SUCCESS(
             f"Updated {updated} rows: '{from_key}' -> '{to_key}' in category {category_id}."
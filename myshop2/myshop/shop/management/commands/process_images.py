@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.image_pipeline import make_executor, process_pending_images
+
+
+class Command(BaseCommand):
+    help = (
+        "Convert uploaded product and variant images that are still processing to WebP.\n"
+        "Each batch is encoded in a process pool, so the images of an upload are converted "
+        "in parallel. Keep it running with --loop; the original images are served until then."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep converting, checking for new images every --interval seconds",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=2,
+            help="Seconds to wait when no image is waiting with --loop (default: 2)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=20,
+            help="Images claimed per batch (default: 20)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Encoding processes (default: one per CPU core; 1 encodes in this process)",
+        )
+
+    def handle(self, *args, **options):
+        executor = make_executor(options["workers"])
+        try:
+            while True:
+                finished = claimed = 0
+                while True:
+                    batch_finished, batch_claimed = process_pending_images(options["batch_size"], executor)
+                    finished += batch_finished
+                    claimed += batch_claimed
+                    if batch_claimed < options["batch_size"]:
+                        break
+                if claimed or not options["loop"]:
+                    self.stdout.write(self.style.SUCCESS(f"Processed {finished} of {claimed} images."))
+                if not options["loop"]:
+                    break
+                time.sleep(options["interval"])
+        finally:
+            if executor:
+                executor.shutdown()
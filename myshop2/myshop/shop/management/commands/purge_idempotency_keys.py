@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shop.idempotency import purge_expired_keys
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired Idempotency-Key records (IdempotencyRecord).\n"
+        "Expired keys are already ignored; this only keeps the table small. Run daily from cron."
+    )
+
+    def handle(self, *args, **options):
+        deleted = purge_expired_keys()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired idempotency records."))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.inventory import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = (
+        "Put the stock of expired cart reservations (StockReservation) back on sale.\n"
+        "Run from cron, or keep it running with --loop. Checkout still honours expired "
+        "reservations that haven't been released yet."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep releasing every --interval seconds",
+        )
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=60,
+            help="Seconds between runs with --loop (default: 60)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Reservations released per transaction (default: 500)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired_reservations(batch_size=options["batch_size"])
+            self.stdout.write(self.style.SUCCESS(f"Released {released} expired reservations."))
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -1,14 +1,16 @@
 """
 Global Rate Limiting Middleware
 Applies rate limiting to all API endpoints with configurable limits per URL pattern
+
+Idempotency Middleware
+Answers retried checkout/cart/wishlist requests carrying an Idempotency-Key from the stored response
 """
 import re
+import time
 import logging
-from django.core.cache import cache
 from django.http import JsonResponse
-from rest_framework.response import Response
-from rest_framework import status
 from accounts.utils import get_client_ip
+from .rate_limiting import get_rate_limiter
 
 logger = logging.getLogger('security')
 
@@ -20,7 +22,8 @@ class GlobalRateLimitMiddleware:
     """
     
     # URL patterns with their specific rate limits
-    # Format: (pattern_regex, max_requests, window_seconds, description)
+    # Format: (pattern_regex, max_requests, window_seconds, description[, algorithm])
+    # algorithm is one of shop.rate_limiting.RATE_LIMIT_ALGORITHMS (default: RATE_LIMIT_ALGORITHM)
     RATE_LIMIT_RULES = [
         # Critical authentication endpoints - reasonable limits for production
         (r'^/accounts/token/$', 20, 60, 'Login'),  # 20 requests per minute (allows tier system to work)
@@ -73,14 +76,19 @@ class GlobalRateLimitMiddleware:
     
     def __init__(self, get_response):
         self.get_response = get_response
-        # Compile regex patterns for performance
-        self.rate_limit_patterns = [
-            (re.compile(pattern), max_req, window, desc)
-            for pattern, max_req, window, desc in self.RATE_LIMIT_RULES
-        ]
-        self.excluded_patterns = [
-            re.compile(pattern) for pattern in self.EXCLUDED_PATTERNS
-        ]
+        # One combined regex per list: a single match() finds the first rule (in list order)
+        # matching the path; each rule's pattern is wrapped in a group whose index maps to the rule
+        self.rules = {}
+        alternatives = []
+        group = 1
+        for rule in self.RATE_LIMIT_RULES:
+            pattern, max_req, window, desc = rule[:4]
+            algorithm = rule[4] if len(rule) > 4 else None
+            alternatives.append(f'({pattern})')
+            self.rules[group] = (max_req, window, desc, algorithm)
+            group += 1 + re.compile(pattern).groups
+        self.rate_limit_pattern = re.compile('|'.join(alternatives))
+        self.excluded_pattern = re.compile('|'.join(f'(?:{pattern})' for pattern in self.EXCLUDED_PATTERNS))
     
     def __call__(self, request):
         try:
@@ -89,101 +97,166 @@ class GlobalRateLimitMiddleware:
                 return self.get_response(request)
             
             # Get rate limit for this URL
-            rate_limit = self._get_rate_limit(request.path)
+            rule = self._match_rule(request.path)
+            result = None
             
-            if rate_limit:
-                max_requests, window_seconds, description = rate_limit
+            if rule:
+                max_requests, window_seconds, description, algorithm = rule
                 
                 # Check rate limit
-                error_response = self._check_rate_limit(
+                result = self._check_rate_limit(
                     request, 
                     max_requests, 
                     window_seconds, 
-                    description
+                    description,
+                    algorithm
                 )
                 
-                if error_response:
-                    return error_response
-            
-            # Continue with the request
-            return self.get_response(request)
+                if result and not result.allowed:
+                    return self._rate_limited_response(request, result, max_requests, window_seconds)
         except Exception as e:
             # If middleware fails completely, log and continue (fail open)
             logger.error(f"Critical error in rate limit middleware: {str(e)}")
             return self.get_response(request)
+        
+        # Continue with the request
+        response = self.get_response(request)
+        if result:
+            for header, value in result.headers(window_seconds).items():
+                response.setdefault(header, value)
+        return response
     
     def _is_excluded(self, path):
         """Check if URL path should be excluded from rate limiting"""
-        for pattern in self.excluded_patterns:
-            if pattern.match(path):
-                return True
-        return False
+        return self.excluded_pattern.match(path) is not None
+    
+    def _match_rule(self, path):
+        """(max_requests, window_seconds, description, algorithm) of the first matching rule, or None"""
+        match = self.rate_limit_pattern.match(path)
+        if match is None:
+            return None
+        # lastindex is the outermost group that matched, i.e. the wrapper of the first matching rule
+        return self.rules[match.lastindex]
     
     def _get_rate_limit(self, path):
         """
         Get rate limit configuration for a given URL path.
         Returns (max_requests, window_seconds, description) or None
         """
-        # Check patterns in order (most specific first)
-        for pattern, max_req, window, desc in self.rate_limit_patterns:
-            if pattern.match(path):
-                return (max_req, window, desc)
-        return None
+        rule = self._match_rule(path)
+        return rule[:3] if rule else None
     
-    def _check_rate_limit(self, request, max_requests, window_seconds, description):
+    def _check_rate_limit(self, request, max_requests, window_seconds, description, algorithm=None):
         """
-        Check if request exceeds rate limit.
-        Returns error response if rate limited, None otherwise.
+        Count the request against its rule.
+        Returns the RateLimitResult, or None if the counters are unavailable (fail open).
         """
         try:
             # Get client IP
             client_ip = get_client_ip(request)
             
-            # Create cache key based on IP and path
-            cache_key = f'rate_limit_middleware_{client_ip}_{request.path}'
+            # Counters are kept per IP and path
+            result = get_rate_limiter().hit(
+                f'middleware:{client_ip}:{request.path}', max_requests, window_seconds, algorithm
+            )
             
-            # Get current request count (with error handling)
-            try:
-                request_count = cache.get(cache_key, 0)
-            except Exception as e:
-                # If cache fails, log and allow request (fail open)
-                logger.error(f"Cache error in rate limiting: {str(e)}")
-                return None
-            
-            # Check if limit exceeded
-            if request_count >= max_requests:
+            if not result.allowed:
                 logger.warning(
                     f"Rate limit exceeded: {description} - "
                     f"IP: {client_ip}, Path: {request.path}, "
-                    f"Count: {request_count}/{max_requests}"
+                    f"Limit: {max_requests}/{window_seconds}s"
                 )
-                
-                # Return appropriate response based on request type
-                if request.headers.get('Content-Type') == 'application/json' or \
-                   request.path.startswith('/api/') or \
-                   request.path.startswith('/shop/api/') or \
-                   request.path.startswith('/accounts/token/') or \
-                   request.path.startswith('/suppliers/auth/'):
-                    # API request - return JSON
-                    return JsonResponse({
-                        'detail': f'Too many requests. Limit: {max_requests} requests per {window_seconds} seconds.'
-                    }, status=429)
-                else:
-                    # Regular request - return JSON anyway for consistency
-                    return JsonResponse({
-                        'detail': f'Too many requests. Please try again later.'
-                    }, status=429)
-            
-            # Increment counter (with error handling)
-            try:
-                cache.set(cache_key, request_count + 1, window_seconds)
-            except Exception as e:
-                # If cache fails, log but allow request (fail open)
-                logger.error(f"Cache error setting rate limit: {str(e)}")
-            
-            return None
+            return result
         except Exception as e:
-            # If anything fails, log and allow request (fail open)
+            # If anything fails (e.g. Redis is down), log and allow request (fail open)
             logger.error(f"Error in rate limit middleware: {str(e)}")
             return None
+    
+    def _rate_limited_response(self, request, result, max_requests, window_seconds):
+        # Return appropriate response based on request type
+        if request.headers.get('Content-Type') == 'application/json' or \
+           request.path.startswith('/api/') or \
+           request.path.startswith('/shop/api/') or \
+           request.path.startswith('/accounts/token/') or \
+           request.path.startswith('/suppliers/auth/'):
+            # API request - return JSON
+            response = JsonResponse({
+                'detail': f'Too many requests. Limit: {max_requests} requests per {window_seconds} seconds.'
+            }, status=429)
+        else:
+            # Regular request - return JSON anyway for consistency
+            response = JsonResponse({
+                'detail': f'Too many requests. Please try again later.'
+            }, status=429)
+        for header, value in result.headers(window_seconds).items():
+            response[header] = value
+        return response
 
+
+class IdempotencyMiddleware:
+    """
+    Middleware that makes unsafe requests with an Idempotency-Key header safe to retry.
+    The first request with a key runs and its response is stored (shop/idempotency.py);
+    retries get that response back, duplicates arriving while it runs wait for it.
+    Must come after AuthenticationMiddleware.
+    """
+    
+    def __init__(self, get_response):
+        from . import idempotency
+        self.get_response = get_response
+        self.store = idempotency
+        self.patterns = [re.compile(pattern) for pattern in idempotency.IDEMPOTENT_PATHS]
+    
+    def __call__(self, request):
+        key = request.headers.get(self.store.KEY_HEADER, '').strip()
+        if (not key or request.method not in self.store.IDEMPOTENT_METHODS
+                or not any(pattern.match(request.path) for pattern in self.patterns)):
+            return self.get_response(request)
+        
+        if len(key) > self.store.MAX_KEY_LENGTH:
+            return JsonResponse({
+                'detail': f'{self.store.KEY_HEADER} must be at most {self.store.MAX_KEY_LENGTH} characters.'
+            }, status=400)
+        
+        scope = self.store.request_scope(request)
+        if scope is None:
+            # Nobody to scope the key to; the view rejects anonymous requests without a device ID itself
+            return self.get_response(request)
+        request_hash = self.store.request_fingerprint(request)
+        
+        stored = self.store.begin(scope, key, request_hash)
+        deadline = time.monotonic() + self.store.WAIT_SECONDS
+        delay = 0.05
+        while stored is not None:
+            if stored.request_hash != request_hash:
+                return JsonResponse({
+                    'detail': f'This {self.store.KEY_HEADER} was already used for a different request.'
+                }, status=422)
+            if stored.completed:
+                return stored.to_response()
+            if time.monotonic() >= deadline:
+                response = JsonResponse({
+                    'detail': 'A request with this Idempotency-Key is still being processed. Retry shortly.'
+                }, status=409)
+                response['Retry-After'] = '1'
+                return response
+            # Coalesce with the request that is already running
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            stored = self.store.lookup(scope, key) or self.store.begin(scope, key, request_hash)
+        
+        try:
+            response = self.get_response(request)
+        except Exception:
+            self.store.abandon(scope, key, request_hash)
+            raise
+        
+        try:
+            if self.store.is_storable(response):
+                self.store.complete(scope, key, request_hash, response)
+            else:
+                self.store.abandon(scope, key, request_hash)
+        except Exception as e:
+            # The response is already made; a retry will just run the view again
+            logger.error(f"Error storing idempotent response: {str(e)}")
+        return response
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.1 on 2026-10-17 06:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0047_cart_session_key_alter_cart_customer_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductAttributeIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attr_key', models.CharField(max_length=100)),
+                ('attr_value', models.CharField(max_length=255)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.category')),
+                ('legacy_attribute', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='index_rows', to='shop.productattribute')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attribute_index', to='shop.product')),
+                ('product_attribute_value', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='index_rows', to='shop.productattributevalue')),
+            ],
+            options={
+                'verbose_name': 'Product Attribute Index',
+                'verbose_name_plural': 'Product Attribute Index',
+                'indexes': [models.Index(fields=['category', 'attr_key', 'attr_value'], name='attr_idx_cat_key_val'), models.Index(fields=['attr_key', 'attr_value'], name='attr_idx_key_val')],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-17 06:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0049_category_closure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpecialOfferHourlyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(verbose_name='ساعت')),
+                ('views', models.PositiveIntegerField(default=0, verbose_name='بازدید')),
+                ('clicks', models.PositiveIntegerField(default=0, verbose_name='کلیک')),
+                ('offer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hourly_stats', to='shop.specialoffer', verbose_name='پیشنهاد')),
+            ],
+            options={
+                'verbose_name': 'آمار ساعتی پیشنهاد ویژه',
+                'verbose_name_plural': 'آمار ساعتی پیشنهادات ویژه',
+                'ordering': ['-hour'],
+                'unique_together': {('offer', 'hour')},
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.1 on 2026-10-17 06:21
+
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX shop_search_doc_vector_gin ON shop_productsearchdocument USING gin (search_vector)'
+        )
+    elif vendor == 'sqlite':
+        # rowid is the product ID
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE shop_productsearch_fts USING fts5("
+            "title, codes, brand, tags, category, "
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS shop_search_doc_vector_gin')
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS shop_productsearch_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0051_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='shop.product')),
+                ('title', models.TextField(blank=True)),
+                ('codes', models.TextField(blank=True, help_text='Model and SKU')),
+                ('brand', models.TextField(blank=True)),
+                ('tags', models.TextField(blank=True)),
+                ('category', models.TextField(blank=True, help_text='Category label and name')),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Product Search Document',
+                'verbose_name_plural': 'Product Search Documents',
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-17 06:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0054_idempotency_record'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='processing',
+            field=models.BooleanField(default=False, help_text='The original upload is stored and waiting to be converted to WebP'),
+        ),
+        migrations.AddField(
+            model_name='productvariantimage',
+            name='processing',
+            field=models.BooleanField(default=False, help_text='تصویر اصلی ذخیره شده و در انتظار تبدیل به WebP است', verbose_name='در حال پردازش'),
+        ),
+    ]
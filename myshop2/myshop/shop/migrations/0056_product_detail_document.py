@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-17 06:59
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0055_image_processing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDetailDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='detail_document', serialize=False, to='shop.product')),
+                ('data', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Product Detail Document',
+                'verbose_name_plural': 'Product Detail Documents',
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.1 on 2026-10-17 07:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0056_product_detail_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSimilarityState',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='similarity_state', serialize=False, to='shop.product')),
+                ('signature', models.CharField(max_length=64)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Product Similarity State',
+                'verbose_name_plural': 'Product Similarity States',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('tags', 'Tags'), ('attributes', 'Attributes')], max_length=20)),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('overlap', models.PositiveIntegerField(default=0, help_text='Shared tags or attribute values')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarities', to='shop.product')),
+                ('similar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.product')),
+            ],
+            options={
+                'verbose_name': 'Product Similarity',
+                'verbose_name_plural': 'Product Similarities',
+                'constraints': [models.UniqueConstraint(fields=('product', 'kind', 'rank'), name='unique_product_similarity_rank')],
+            },
+        ),
+    ]
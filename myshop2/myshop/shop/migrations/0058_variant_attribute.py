@@ -0,0 +1,29 @@
+# Generated by Django 5.2.1 on 2026-10-17 07:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0057_product_similarity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VariantAttribute',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attr_key', models.CharField(max_length=100)),
+                ('attr_value', models.CharField(max_length=255)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.product')),
+                ('variant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attribute_rows', to='shop.productvariant')),
+            ],
+            options={
+                'verbose_name': 'Variant Attribute',
+                'verbose_name_plural': 'Variant Attributes',
+                'indexes': [models.Index(fields=['attr_key', 'attr_value'], name='variant_attr_key_val')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.1 on 2026-10-17 07:07
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_order_totals(apps, schema_editor):
+    Order = apps.get_model('shop', 'Order')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+
+    def items(aggregate, output_field):
+        per_order = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+        return Coalesce(Subquery(per_order.annotate(value=aggregate).values('value')[:1]), Value(0),
+                        output_field=output_field)
+
+    Order.objects.update(
+        total_toman=items(Sum(F('price') * F('quantity'), output_field=models.DecimalField(max_digits=14, decimal_places=2)),
+                          models.DecimalField(max_digits=14, decimal_places=2)),
+        item_count=items(Sum('quantity'), models.PositiveIntegerField()),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0058_variant_attribute'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, help_text='Units ordered'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_toman',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['email', '-created', '-id'], name='shop_order_email_created'),
+        ),
+        migrations.RunPython(fill_order_totals, migrations.RunPython.noop),
+    ]
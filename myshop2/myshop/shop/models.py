@@ -12,6 +12,10 @@ from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 # Use Django's built-in JSONField for compatibility with both SQLite and PostgreSQL
 from django.db.models import JSONField
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.postgres.search import SearchVectorField
+from .persian import clean_persian_text
+from .image_pipeline import file_sha256, needs_processing
 
 
 # New models for improved category system (must be defined before Category model)
@@ -90,7 +94,7 @@ class CategorySubgroup(models.Model):
     
     def get_product_count(self):
         """Get product count for this subgroup across all gender variants"""
-        return sum(cat.get_product_count() for cat in self.categories.filter(is_active=True))
+        return sum(cat.get_product_count() for cat in self.categories.all())
 
 
 class Category(models.Model):
@@ -145,11 +149,9 @@ class Category(models.Model):
         return self.parent is not None
 
     def get_all_subcategories(self):
-        """Get all subcategories recursively"""
-        subcategories = list(self.subcategories.all())
-        for subcategory in list(subcategories):
-            subcategories.extend(subcategory.get_all_subcategories())
-        return subcategories
+        """Get all subcategories recursively (one query through the closure table)"""
+        from .category_tree import descendant_ids
+        return list(Category.objects.filter(id__in=descendant_ids(self.id, include_self=False)))
     
     def get_display_name(self):
         """Get the display label if available, otherwise return name"""
@@ -199,20 +201,20 @@ class Category(models.Model):
     def get_all_products(self):
         """Get all products for this category, handling both container and direct types"""
         if self.is_container_category():
-            # Get products from all subcategories
-            all_subcategories = self.get_all_subcategories()
-            from django.db.models import Q
-            query = Q(category=self)
-            for subcat in all_subcategories:
-                query |= Q(category=subcat)
-            return self.product_set.model.objects.filter(query, is_active=True)
+            # Get products from this category and all of its descendants
+            from .category_tree import descendant_ids
+            return self.product_set.model.objects.filter(category_id__in=descendant_ids(self.id), is_active=True)
         else:
             # Get products directly from this category
             return self.product_set.filter(is_active=True)
     
     def get_product_count(self):
-        """Get total product count for this category"""
-        return self.get_all_products().count()
+        """Get total product count for this category (from the cached per-category counts)"""
+        from .category_tree import get_category_product_counts
+        counts = get_category_product_counts()
+        if self.is_container_category():
+            return counts['recursive'].get(self.id, 0)
+        return counts['direct'].get(self.id, 0)
         
     def get_subcategory_product_counts(self):
         """Get product counts for each subcategory"""
@@ -272,6 +274,30 @@ class Category(models.Model):
         return list(self.category_attributes.values_list('key', flat=True))
 
 
+
+class CategoryClosure(models.Model):
+    """
+    Ancestor/descendant pairs of the category tree.
+
+    Every category has a depth-0 row pointing at itself plus one row per ancestor, so a
+    whole subtree (or ancestor chain) is a single indexed lookup. Kept in sync by the
+    Category signals in shop/signals.py; rebuild with the build_category_closure command.
+    """
+    ancestor = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        verbose_name = 'Category Closure'
+        verbose_name_plural = 'Category Closure'
+        unique_together = ('ancestor', 'descendant')
+        indexes = [
+            models.Index(fields=['descendant', 'depth'], name='cat_closure_desc_depth'),
+        ]
+
+    def __str__(self):
+        return f'{self.ancestor_id} -> {self.descendant_id} ({self.depth})'
+
 class Attribute(models.Model):
     """Reusable attributes that can be assigned to multiple categories"""
     ATTRIBUTE_TYPES = [
@@ -483,6 +509,12 @@ class Product(models.Model):
         verbose_name = 'محصول'
         verbose_name_plural = 'محصولات'
         ordering = ['-created_at']
+        indexes = [
+            # Keyset (cursor) pagination orders by (sort field, id)
+            models.Index(fields=['created_at', 'id'], name='product_created_id'),
+            models.Index(fields=['price_toman', 'id'], name='product_price_id'),
+            models.Index(fields=['name', 'id'], name='product_name_id'),
+        ]
 
     def __str__(self):
         return self.name
@@ -537,19 +569,8 @@ class Product(models.Model):
         """Set the value of a specific attribute for this product"""
         try:
             # Normalize the input value
-            if isinstance(value, str):
-                # Remove zero-width characters
-                value = value.replace('\u200c', '').replace('\u200d', '')
-                
-                # Normalize Arabic/Persian digits to standard digits
-                digit_map = str.maketrans(
-                    '۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩',
-                    '01234567890123456789'
-                )
-                value = value.translate(digit_map)
-                
-                # Replace multiple whitespaces with a single space and strip
-                value = ' '.join(value.split()).strip()
+            # Remove zero-width characters, normalize digits and whitespace
+            value = clean_persian_text(value)
 
             attribute = Attribute.objects.get(key=attribute_key)
             
@@ -619,6 +640,8 @@ class Product(models.Model):
             try:
                 old_product = Product.objects.get(pk=self.pk)
                 if old_product.category_id != self.category_id:
+                    # Remembered for post_save handlers that maintain per-category caches
+                    self._previous_category_id = old_product.category_id
                     # Category has changed, clean up invalid attributes
                     self._cleanup_attributes_on_category_change()
             except Product.DoesNotExist:
@@ -699,6 +722,156 @@ class ProductAttribute(models.Model):
         return f'{self.key}: {self.value}'
 
 
+class ProductAttributeIndex(models.Model):
+    """
+    Denormalized (product, category, key, value) rows used to resolve attribute filters.
+
+    One row per value of a legacy ProductAttribute or a ProductAttributeValue, with the
+    value normalized to lowercase. Kept in sync by signals in shop/signals.py; rebuild
+    with the build_attribute_index management command.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='attribute_index')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+')
+    attr_key = models.CharField(max_length=100)
+    attr_value = models.CharField(max_length=255)
+    legacy_attribute = models.ForeignKey(ProductAttribute, on_delete=models.CASCADE, null=True, blank=True,
+                                         related_name='index_rows')
+    product_attribute_value = models.ForeignKey(ProductAttributeValue, on_delete=models.CASCADE, null=True,
+                                                blank=True, related_name='index_rows')
+
+    class Meta:
+        verbose_name = 'Product Attribute Index'
+        verbose_name_plural = 'Product Attribute Index'
+        indexes = [
+            models.Index(fields=['category', 'attr_key', 'attr_value'], name='attr_idx_cat_key_val'),
+            models.Index(fields=['attr_key', 'attr_value'], name='attr_idx_key_val'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} - {self.attr_key}: {self.attr_value}'
+
+
+class VariantAttribute(models.Model):
+    """
+    Normalized (variant, key, value) rows of ProductVariant.attributes.
+
+    Lets variant lookups by attribute use an index instead of scanning the JSON field of
+    every variant. Values are normalized like ProductAttributeIndex. Kept in sync by
+    signals in shop/signals.py; rebuild with the build_attribute_index management command.
+    """
+    variant = models.ForeignKey('ProductVariant', on_delete=models.CASCADE, related_name='attribute_rows')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    attr_key = models.CharField(max_length=100)
+    attr_value = models.CharField(max_length=255)
+
+    class Meta:
+        verbose_name = 'Variant Attribute'
+        verbose_name_plural = 'Variant Attributes'
+        indexes = [
+            models.Index(fields=['attr_key', 'attr_value'], name='variant_attr_key_val'),
+        ]
+
+    def __str__(self):
+        return f'{self.variant_id} - {self.attr_key}: {self.attr_value}'
+
+
+class ProductSearchDocument(models.Model):
+    """
+    Precomputed, normalized search text of a product, one row per product.
+
+    Fields are stored already normalized (see shop/persian.py) and grouped by ranking
+    weight. The search backend in shop/search.py indexes them: a GIN-indexed tsvector in
+    search_vector on PostgreSQL, an FTS5 virtual table on SQLite. Kept in sync by signals
+    in shop/signals.py; rebuild with the build_search_index management command.
+    """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='search_document')
+    title = models.TextField(blank=True)
+    codes = models.TextField(blank=True, help_text='Model and SKU')
+    brand = models.TextField(blank=True)
+    tags = models.TextField(blank=True)
+    category = models.TextField(blank=True, help_text='Category label and name')
+    # Only populated on PostgreSQL
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Product Search Document'
+        verbose_name_plural = 'Product Search Documents'
+
+    def __str__(self):
+        return f'{self.product_id}: {self.title}'
+
+
+class ProductDetailDocument(models.Model):
+    """
+    Precomputed public detail response of a product, one row per product.
+
+    ``data`` is built by shop/product_detail.py with media paths as stored; the detail
+    endpoint only adds what depends on the request (absolute URLs, wishlist flag) and
+    live stock. Kept in sync by signals in shop/signals.py; rebuild with the
+    build_detail_documents management command.
+    """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='detail_document')
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Product Detail Document'
+        verbose_name_plural = 'Product Detail Documents'
+
+    def __str__(self):
+        return f'Detail document of product {self.product_id}'
+
+
+class ProductSimilarity(models.Model):
+    """
+    Precomputed top-K similar products of a product, one row per neighbour and kind.
+
+    Built offline by shop/similarity.py (the build_similarity_index command) from sparse
+    tag, attribute, category and price-bucket vectors; 'tags' and 'attributes' weight
+    those features differently. The similar-products endpoints read a product's rows in
+    rank order.
+    """
+    KIND_CHOICES = [
+        ('tags', 'Tags'),
+        ('attributes', 'Attributes'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='similarities')
+    similar = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+    overlap = models.PositiveIntegerField(default=0, help_text='Shared tags or attribute values')
+
+    class Meta:
+        verbose_name = 'Product Similarity'
+        verbose_name_plural = 'Product Similarities'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'kind', 'rank'], name='unique_product_similarity_rank'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} ~ {self.similar_id} ({self.kind}, {self.score:.3f})'
+
+
+class ProductSimilarityState(models.Model):
+    """Signature of the features a product's similarities were last computed from"""
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='similarity_state')
+    signature = models.CharField(max_length=64)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Product Similarity State'
+        verbose_name_plural = 'Product Similarity States'
+
+    def __str__(self):
+        return f'{self.product_id}: {self.signature}'
+
+
 class ProductVariant(models.Model):
     """Product variants (colors, sizes, etc.)"""
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='variants')
@@ -748,6 +921,10 @@ class ProductImage(models.Model):
     order = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     image_hash = models.CharField(max_length=64, blank=True, null=True)
+    processing = models.BooleanField(
+        default=False,
+        help_text='The original upload is stored and waiting to be converted to WebP'
+    )
 
     class Meta:
         ordering = ['-is_primary', 'order', 'created_at']
@@ -763,43 +940,22 @@ class ProductImage(models.Model):
 
     def calculate_image_hash(self):
         """Calculate a hash of the image content to identify duplicates"""
-        import hashlib
         if not self.image:
             return None
             
         try:
-            # Read image content
-            self.image.seek(0)
-            image_content = self.image.read()
-            # Calculate SHA-256 hash
-            hash_object = hashlib.sha256(image_content)
-            hex_dig = hash_object.hexdigest()
-            # Reset file pointer
-            self.image.seek(0)
-            return hex_dig
+            # Streamed in chunks rather than read into memory
+            return file_sha256(self.image)
         except Exception as e:
             print(f"Error calculating image hash: {e}")
             return None
 
     def _compress_image(self):
-        """Compress the image if it's not already in webp format"""
-        if not self.image:
-            return
-            
-        # Skip compression if already in webp format
-        if hasattr(self.image, 'name') and self.image.name.lower().endswith('.webp'):
-            print(f"Skipping compression - already in webp format: {self.image.name}")
-            return
-            
-        print(f"Compressing image: {getattr(self.image, 'name', 'unnamed')}")
-        
-        try:
-            from .utils import compress_image
-            # Compress the image
-            self.image = compress_image(self.image)
-            print(f"Compression complete: {self.image.name}")
-        except Exception as e:
-            print(f"Error during compression: {e}")
+        """
+        Mark the image for WebP conversion unless it is already WebP. The original is
+        stored as uploaded; the process_images worker converts it (shop.image_pipeline).
+        """
+        self.processing = needs_processing(self.image)
 
     def save(self, *args, **kwargs):
         # Check if compress parameter was passed
@@ -828,7 +984,7 @@ class ProductImage(models.Model):
         if compress and is_new:
             self._compress_image()
             
-        # Recalculate hash if compression was applied
+        # Hash could not be calculated before
         if not self.image_hash:
             self.image_hash = self.calculate_image_hash()
         
@@ -910,6 +1066,11 @@ class ProductVariantImage(models.Model):
         verbose_name='هش تصویر',
         help_text='هش یکتا برای تشخیص تصاویر تکراری'
     )
+    processing = models.BooleanField(
+        default=False,
+        verbose_name='در حال پردازش',
+        help_text='تصویر اصلی ذخیره شده و در انتظار تبدیل به WebP است'
+    )
 
     class Meta:
         ordering = ['-is_primary', 'order', 'created_at']
@@ -927,43 +1088,22 @@ class ProductVariantImage(models.Model):
 
     def calculate_image_hash(self):
         """Calculate a hash of the image content to identify duplicates"""
-        import hashlib
         if not self.image:
             return None
             
         try:
-            # Read image content
-            self.image.seek(0)
-            image_content = self.image.read()
-            # Calculate SHA-256 hash
-            hash_object = hashlib.sha256(image_content)
-            hex_dig = hash_object.hexdigest()
-            # Reset file pointer
-            self.image.seek(0)
-            return hex_dig
+            # Streamed in chunks rather than read into memory
+            return file_sha256(self.image)
         except Exception as e:
             print(f"Error calculating variant image hash: {e}")
             return None
 
     def _compress_image(self):
-        """Compress the image if it's not already in webp format"""
-        if not self.image:
-            return
-            
-        # Skip compression if already in webp format
-        if hasattr(self.image, 'name') and self.image.name.lower().endswith('.webp'):
-            print(f"Skipping compression - already in webp format: {self.image.name}")
-            return
-            
-        print(f"Compressing variant image: {getattr(self.image, 'name', 'unnamed')}")
-        
-        try:
-            from .utils import compress_image
-            # Compress the image
-            self.image = compress_image(self.image)
-            print(f"Variant image compression complete: {self.image.name}")
-        except Exception as e:
-            print(f"Error during variant image compression: {e}")
+        """
+        Mark the image for WebP conversion unless it is already WebP. The original is
+        stored as uploaded; the process_images worker converts it (shop.image_pipeline).
+        """
+        self.processing = needs_processing(self.image)
 
     def save(self, *args, **kwargs):
         # Check if compress parameter was passed
@@ -995,7 +1135,7 @@ class ProductVariantImage(models.Model):
         if compress and is_new:
             self._compress_image()
             
-        # Recalculate hash if compression was applied
+        # Hash could not be calculated before
         if not self.image_hash:
             self.image_hash = self.calculate_image_hash()
         
@@ -1055,6 +1195,52 @@ class OrderItem(models.Model):
         return self.price * self.quantity
 
 
+def _order_items_subquery(aggregate, output_field):
+    """Correlated subquery of an aggregate over an order's items (0 without items)"""
+    items = OrderItem.objects.filter(order=models.OuterRef('pk')).order_by().values('order')
+    return models.functions.Coalesce(
+        models.Subquery(items.annotate(value=aggregate).values('value')[:1]),
+        models.Value(0),
+        output_field=output_field,
+    )
+
+
+def _total_field():
+    return models.DecimalField(max_digits=14, decimal_places=2)
+
+
+def _items_total():
+    return models.Sum(models.F('price') * models.F('quantity'), output_field=_total_field())
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        """
+        Annotate ``items_total`` and ``items_quantity`` computed from the order items, for
+        reports that must not trust the stored totals (e.g. checking them).
+        """
+        return self.annotate(
+            items_total=_order_items_subquery(_items_total(), _total_field()),
+            items_quantity=_order_items_subquery(models.Sum('quantity'), models.PositiveIntegerField()),
+        )
+
+    def refresh_totals(self):
+        """Recompute the stored totals of these orders in one UPDATE. Returns the row count."""
+        return self.update(
+            total_toman=_order_items_subquery(_items_total(), _total_field()),
+            item_count=_order_items_subquery(models.Sum('quantity'), models.PositiveIntegerField()),
+        )
+
+    def summary(self):
+        """Number of orders, revenue and units sold, from the stored totals"""
+        return self.aggregate(
+            order_count=models.Count('pk'),
+            total_toman=models.functions.Coalesce(models.Sum('total_toman'), models.Value(0),
+                                                  output_field=models.DecimalField(max_digits=16, decimal_places=2)),
+            item_count=models.functions.Coalesce(models.Sum('item_count'), models.Value(0)),
+        )
+
+
 class Order(models.Model):
     first_name = models.CharField(max_length=50)
     last_name = models.CharField(max_length=50)
@@ -1065,15 +1251,32 @@ class Order(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     paid = models.BooleanField(default=False)
+    # Kept equal to the sums over the order items: refreshed on OrderItem saves and
+    # deletes (shop/signals.py) and by commit_checkout(), whose bulk_create sends no signals
+    total_toman = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0, help_text='Units ordered')
+
+    objects = OrderQuerySet.as_manager()
 
     class Meta:
         ordering = ('-created',)
+        indexes = [
+            # Customer order lists: filter on email, newest first
+            models.Index(fields=['email', '-created', '-id'], name='shop_order_email_created'),
+        ]
 
     def __str__(self):
         return f'Order {self.id}'
 
     def get_total_cost(self):
-        return sum(item.get_cost() for item in self.items.all())
+        return self.total_toman
+
+    def refresh_totals(self):
+        """Recompute the stored totals from the items, on this instance and in the database."""
+        totals = self.items.aggregate(total=_items_total(), quantity=models.Sum('quantity'))
+        self.total_toman = totals['total'] or 0
+        self.item_count = totals['quantity'] or 0
+        Order.objects.filter(pk=self.pk).update(total_toman=self.total_toman, item_count=self.item_count)
 
 
 class CategoryAttribute(models.Model):
@@ -1166,16 +1369,9 @@ class Cart(models.Model):
         return sum(item.quantity for item in self.items.all())
     
     def get_total_price(self):
-        """Get total price of all items in cart"""
-        from decimal import InvalidOperation
-        total = 0
-        for item in self.items.all():
-            try:
-                total += item.get_total_price()
-            except (TypeError, ValueError, AttributeError, InvalidOperation) as e:
-                print(f"⚠️ Error calculating price for cart item {item.id}: {e}")
-                continue
-        return total
+        """Get total price of all items in cart (one query, see shop/cart_snapshot.py)"""
+        from .cart_snapshot import CartSnapshot
+        return CartSnapshot.load(self, details=False).total_price
     
     def get_total_price_toman(self):
         """Get total price in Toman"""
@@ -1206,58 +1402,20 @@ class CartItem(models.Model):
         variant_str = f" - {self.variant}" if self.variant else ""
         return f"{self.product.name}{variant_str} x{self.quantity}"
     
+    @staticmethod
+    def _valid_price(price):
+        """Convert a price to float, treating missing, NaN and infinite values as 0"""
+        from decimal import Decimal
+        if price is None:
+            return 0
+        if isinstance(price, Decimal) and (price.is_nan() or price.is_infinite()):
+            return 0
+        return float(price)
+    
     def get_total_price(self):
         """Get total price for this item - prioritizes variant price over product price, uses reduced price if available"""
-        from decimal import InvalidOperation, Decimal
-        # Calculate unit price dynamically: variant price takes priority
-        unit_price = 0
-        try:
-            if self.variant:
-                try:
-                    variant_price = self.variant.price_toman
-                    if variant_price is not None:
-                        # Check if Decimal is valid (not NaN, not Infinity)
-                        if isinstance(variant_price, Decimal):
-                            if variant_price.is_nan() or variant_price.is_infinite():
-                                unit_price = 0
-                            else:
-                                unit_price = float(variant_price)
-                        else:
-                            unit_price = float(variant_price)
-                except (TypeError, ValueError, AttributeError, InvalidOperation) as e:
-                    print(f"Error converting variant price_toman to float: {e}")
-                    unit_price = 0
-            
-            if unit_price == 0:
-                # Use reduced price if available, otherwise original price
-                if self.product:
-                    try:
-                        if self.product.reduced_price_toman is not None:
-                            price_decimal = self.product.reduced_price_toman
-                            # Check if Decimal is valid (not NaN, not Infinity)
-                            if isinstance(price_decimal, Decimal):
-                                if price_decimal.is_nan() or price_decimal.is_infinite():
-                                    unit_price = 0
-                                else:
-                                    unit_price = float(price_decimal)
-                            else:
-                                unit_price = float(price_decimal)
-                        elif self.product.price_toman is not None:
-                            price_decimal = self.product.price_toman
-                            # Check if Decimal is valid (not NaN, not Infinity)
-                            if isinstance(price_decimal, Decimal):
-                                if price_decimal.is_nan() or price_decimal.is_infinite():
-                                    unit_price = 0
-                                else:
-                                    unit_price = float(price_decimal)
-                            else:
-                                unit_price = float(price_decimal)
-                    except (TypeError, ValueError, AttributeError, InvalidOperation) as e:
-                        print(f"Error converting product price_toman to float: {e}")
-                        unit_price = 0
-        except Exception as e:
-            print(f"Unexpected error in get_total_price: {e}")
-            unit_price = 0
+        from decimal import InvalidOperation
+        unit_price = self.get_unit_price_toman()
         
         # Ensure unit_price is a valid number before multiplication
         try:
@@ -1269,60 +1427,93 @@ class CartItem(models.Model):
             return 0
     
     def get_unit_price_toman(self):
-        """Get unit price in Toman - prioritizes variant price over product price, uses reduced price if available"""
-        from decimal import InvalidOperation, Decimal
+        """
+        Get unit price in Toman.
+        
+        Priority: variant price, then the product's reduced price, then the price from an
+        active special offer (resolved from the in-memory offer map), then the product price.
+        """
+        from decimal import InvalidOperation
+        from .pricing import get_offer_price
         # Calculate unit price dynamically: variant price takes priority
         unit_price = 0
         try:
             if self.variant:
                 try:
-                    variant_price = self.variant.price_toman
-                    if variant_price is not None:
-                        # Check if Decimal is valid (not NaN, not Infinity)
-                        if isinstance(variant_price, Decimal):
-                            if variant_price.is_nan() or variant_price.is_infinite():
-                                unit_price = 0
-                            else:
-                                unit_price = float(variant_price)
-                        else:
-                            unit_price = float(variant_price)
+                    unit_price = self._valid_price(self.variant.price_toman)
                 except (TypeError, ValueError, AttributeError, InvalidOperation) as e:
                     print(f"Error converting variant price_toman to float: {e}")
                     unit_price = 0
             
-            if unit_price == 0:
-                # Use reduced price if available, otherwise original price
-                if self.product:
-                    try:
-                        if self.product.reduced_price_toman is not None:
-                            price_decimal = self.product.reduced_price_toman
-                            # Check if Decimal is valid (not NaN, not Infinity)
-                            if isinstance(price_decimal, Decimal):
-                                if price_decimal.is_nan() or price_decimal.is_infinite():
-                                    unit_price = 0
-                                else:
-                                    unit_price = float(price_decimal)
-                            else:
-                                unit_price = float(price_decimal)
-                        elif self.product.price_toman is not None:
-                            price_decimal = self.product.price_toman
-                            # Check if Decimal is valid (not NaN, not Infinity)
-                            if isinstance(price_decimal, Decimal):
-                                if price_decimal.is_nan() or price_decimal.is_infinite():
-                                    unit_price = 0
-                                else:
-                                    unit_price = float(price_decimal)
-                            else:
-                                unit_price = float(price_decimal)
-                    except (TypeError, ValueError, AttributeError, InvalidOperation) as e:
-                        print(f"Error converting product price_toman to float: {e}")
-                        unit_price = 0
+            if unit_price == 0 and self.product:
+                try:
+                    if self.product.reduced_price_toman is not None:
+                        unit_price = self._valid_price(self.product.reduced_price_toman)
+                    else:
+                        offer_price = get_offer_price(self.product)
+                        if offer_price is not None:
+                            unit_price = self._valid_price(offer_price)
+                        else:
+                            unit_price = self._valid_price(self.product.price_toman)
+                except (TypeError, ValueError, AttributeError, InvalidOperation) as e:
+                    print(f"Error converting product price_toman to float: {e}")
+                    unit_price = 0
         except Exception as e:
             print(f"Unexpected error in get_unit_price_toman: {e}")
             unit_price = 0
         return unit_price
 
 
+class StockReservation(models.Model):
+    """
+    Stock held for a cart item.
+
+    Reserving takes the quantity off ProductVariant.stock_quantity (or
+    Product.stock_quantity for products without variants) right away, so stock_quantity
+    is what is still available to other shoppers. Checkout turns the reservation into a
+    sale; removing the item or letting the reservation expire puts the stock back (see
+    shop/inventory.py and the release_expired_reservations command).
+    """
+    cart_item = models.OneToOneField(CartItem, on_delete=models.CASCADE, related_name='reservation')
+    product = models.ForeignKey('Product', on_delete=models.CASCADE, related_name='+')
+    variant = models.ForeignKey('ProductVariant', on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Stock Reservation'
+        verbose_name_plural = 'Stock Reservations'
+
+    def __str__(self):
+        return f'{self.quantity} x {self.variant_id or self.product_id} until {self.expires_at:%Y-%m-%d %H:%M}'
+
+
+class IdempotencyRecord(models.Model):
+    """
+    Response stored for an Idempotency-Key, so retried requests are answered without
+    running the view again (see shop/idempotency.py and IdempotencyMiddleware).
+
+    A record without ``status_code`` belongs to a request that is still running.
+    """
+    scope = models.CharField(max_length=64)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    body = models.BinaryField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ['scope', 'key']
+        verbose_name = 'Idempotency Record'
+        verbose_name_plural = 'Idempotency Records'
+
+    def __str__(self):
+        return f'{self.key} ({self.status_code or "in progress"})'
+
+
 class Wishlist(models.Model):
     """Model to manage user wishlists"""
     PRIORITY_CHOICES = [
@@ -1457,14 +1648,14 @@ class SpecialOffer(models.Model):
         return int((self.valid_until - now).total_seconds())
     
     def increment_views(self):
-        """Increment view count"""
-        self.views_count += 1
-        self.save(update_fields=['views_count'])
+        """Count a view (views_count is updated now, or by the next flush when buffering)"""
+        from .offer_analytics import record_offer_views
+        record_offer_views([self.pk])
     
     def increment_clicks(self):
-        """Increment click count"""
-        self.clicks_count += 1
-        self.save(update_fields=['clicks_count'])
+        """Count a click (clicks_count is updated now, or by the next flush when buffering)"""
+        from .offer_analytics import record_offer_click
+        record_offer_click(self.pk)
 
 
 class SpecialOfferProduct(models.Model):
@@ -1528,5 +1719,28 @@ class SpecialOfferProduct(models.Model):
         super().save(*args, **kwargs)
 
 
+class SpecialOfferHourlyStats(models.Model):
+    """Views and clicks of a special offer per hour, written by the analytics flush"""
+    
+    offer = models.ForeignKey(SpecialOffer, on_delete=models.CASCADE, related_name='hourly_stats', verbose_name='پیشنهاد')
+    hour = models.DateTimeField(verbose_name='ساعت')
+    views = models.PositiveIntegerField(default=0, verbose_name='بازدید')
+    clicks = models.PositiveIntegerField(default=0, verbose_name='کلیک')
+    
+    class Meta:
+        ordering = ['-hour']
+        unique_together = ['offer', 'hour']
+        verbose_name = 'آمار ساعتی پیشنهاد ویژه'
+        verbose_name_plural = 'آمار ساعتی پیشنهادات ویژه'
+    
+    def __str__(self):
+        return f"{self.offer_id} @ {self.hour:%Y-%m-%d %H:00}"
+    
+    @property
+    def click_through_rate(self):
+        """Clicks per view as a percentage"""
+        return round(self.clicks * 100 / self.views, 2) if self.views else 0
+
+
 
 
@@ -0,0 +1,234 @@
+"""
+Buffered special-offer analytics.
+
+Views and clicks are counted with atomic cache increments, one counter per
+(offer, hour, kind), so the request path never writes to the database. A flush moves
+the accumulated deltas into SpecialOffer.views_count/clicks_count with a single
+F()-expression UPDATE and adds them to SpecialOfferHourlyStats for CTR trends.
+
+Buffering needs a cache shared by every process (OFFER_ANALYTICS_CACHE_ALIAS, e.g.
+Redis) and OFFER_ANALYTICS_FLUSH_INTERVAL: each process then starts a daemon thread that
+flushes every that many seconds, and the flush_offer_analytics management command (cron,
+or ``--loop``) can flush as well. Otherwise - with the default per-process locmem cache a
+separate flush would never see the counters - every view and click is written straight
+to the database with F() updates, as before buffering.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from accounts.utils import is_shared_cache
+
+logger = logging.getLogger(__name__)
+
+COUNTER_KEY_PREFIX = 'offer_stats:'
+LAST_FLUSHED_HOUR_KEY = 'offer_stats:last_flushed_hour'
+FLUSH_LOCK_KEY = 'offer_stats:flush_lock'
+# Counters outlive several missed flushes before the cache drops them
+COUNTER_TIMEOUT = 48 * 60 * 60
+LOOKBACK_HOURS = getattr(settings, 'OFFER_ANALYTICS_LOOKBACK_HOURS', 24)
+FLUSH_INTERVAL = getattr(settings, 'OFFER_ANALYTICS_FLUSH_INTERVAL', 0)
+
+KINDS = ('views', 'clicks')
+
+_flush_thread = None
+_flush_thread_lock = threading.Lock()
+
+
+def _cache_alias():
+    return getattr(settings, 'OFFER_ANALYTICS_CACHE_ALIAS', 'default')
+
+
+def _cache():
+    return caches[_cache_alias()]
+
+
+def buffering_enabled():
+    """True if counts are buffered in the cache, False if they are written directly"""
+    return bool(FLUSH_INTERVAL) and is_shared_cache(_cache_alias())
+
+
+def _hour_bucket(moment=None):
+    moment = moment or timezone.now()
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _counter_key(offer_id, hour, kind):
+    return f'{COUNTER_KEY_PREFIX}{offer_id}:{hour:%Y%m%d%H}:{kind}'
+
+
+def _increment(keys):
+    cache = _cache()
+    for key in keys:
+        cache.add(key, 0, COUNTER_TIMEOUT)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.add(key, 1, COUNTER_TIMEOUT)
+    _ensure_flush_thread()
+
+
+def _record_directly(offer_ids, kind):
+    """Add one ``kind`` to the offers' counters and current-hour stats in the database"""
+    from .models import SpecialOffer, SpecialOfferHourlyStats
+
+    offer_ids = list(offer_ids)
+    if not offer_ids:
+        return
+    hour = _hour_bucket()
+    stats = SpecialOfferHourlyStats.objects.filter(offer_id__in=offer_ids, hour=hour)
+    with transaction.atomic():
+        SpecialOffer.objects.filter(id__in=offer_ids).update(**{f'{kind}_count': F(f'{kind}_count') + 1})
+        if stats.update(**{kind: F(kind) + 1}) < len(offer_ids):
+            # First count of the hour for some offers; a concurrent request may create them too
+            missing = set(offer_ids) - set(stats.values_list('offer_id', flat=True))
+            SpecialOfferHourlyStats.objects.bulk_create(
+                [SpecialOfferHourlyStats(offer_id=offer_id, hour=hour) for offer_id in missing],
+                ignore_conflicts=True,
+            )
+            stats.filter(offer_id__in=missing).update(**{kind: F(kind) + 1})
+
+
+def record_offer_views(offer_ids):
+    """Count one view for each of the given offers."""
+    if not buffering_enabled():
+        _record_directly(offer_ids, 'views')
+        return
+    hour = _hour_bucket()
+    _increment([_counter_key(offer_id, hour, 'views') for offer_id in offer_ids])
+
+
+def record_offer_click(offer_id):
+    """Count one click for an offer."""
+    if not buffering_enabled():
+        _record_directly([offer_id], 'clicks')
+        return
+    _increment([_counter_key(offer_id, _hour_bucket(), 'clicks')])
+
+
+def _pending_hours(now):
+    """Hours whose counters may still hold unflushed deltas, oldest first."""
+    current = _hour_bucket(now)
+    oldest = current - timedelta(hours=LOOKBACK_HOURS)
+    last_flushed = _cache().get(LAST_FLUSHED_HOUR_KEY)
+    if last_flushed is not None and last_flushed > oldest:
+        # The last flushed hour may have received increments after that flush
+        oldest = last_flushed
+    hours = []
+    hour = oldest
+    while hour <= current:
+        hours.append(hour)
+        hour += timedelta(hours=1)
+    return hours
+
+
+def flush_offer_analytics():
+    """
+    Move buffered counters into the database.
+
+    Returns:
+        dict: total 'views' and 'clicks' flushed, or None if another flush holds the lock
+    """
+    from .models import SpecialOffer, SpecialOfferHourlyStats
+
+    cache = _cache()
+    if not cache.add(FLUSH_LOCK_KEY, 1, 5 * 60):
+        return None
+
+    try:
+        now = timezone.now()
+        hours = _pending_hours(now)
+        offer_ids = list(SpecialOffer.objects.values_list('id', flat=True))
+        keys = {
+            _counter_key(offer_id, hour, kind): (offer_id, hour, kind)
+            for offer_id in offer_ids for hour in hours for kind in KINDS
+        }
+        values = cache.get_many(list(keys))
+
+        deltas = {}  # (offer_id, hour) -> {'views': n, 'clicks': n}
+        for key, count in values.items():
+            if not count:
+                continue
+            # Subtract what was read so increments made meanwhile stay for the next flush
+            try:
+                cache.decr(key, count)
+            except ValueError:
+                pass
+            offer_id, hour, kind = keys[key]
+            deltas.setdefault((offer_id, hour), {'views': 0, 'clicks': 0})[kind] += count
+
+        totals = {'views': 0, 'clicks': 0}
+        per_offer = {}
+        for (offer_id, _), counts in deltas.items():
+            offer_totals = per_offer.setdefault(offer_id, {'views': 0, 'clicks': 0})
+            for kind in KINDS:
+                offer_totals[kind] += counts[kind]
+                totals[kind] += counts[kind]
+
+        if per_offer:
+            with transaction.atomic():
+                SpecialOffer.objects.filter(id__in=per_offer).update(**{
+                    f'{kind}_count': F(f'{kind}_count') + Case(
+                        *[When(id=offer_id, then=Value(counts[kind])) for offer_id, counts in per_offer.items()],
+                        default=Value(0),
+                        output_field=IntegerField(),
+                    )
+                    for kind in KINDS
+                })
+                _add_hourly_stats(SpecialOfferHourlyStats, deltas)
+
+        cache.set(LAST_FLUSHED_HOUR_KEY, _hour_bucket(now), None)
+        return totals
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
+
+
+def _add_hourly_stats(model, deltas):
+    existing = {
+        (row.offer_id, row.hour): row
+        for row in model.objects.filter(
+            offer_id__in={offer_id for offer_id, _ in deltas},
+            hour__in={hour for _, hour in deltas},
+        )
+    }
+    to_create, to_update = [], []
+    for (offer_id, hour), counts in deltas.items():
+        row = existing.get((offer_id, hour))
+        if row is None:
+            to_create.append(model(offer_id=offer_id, hour=hour, views=counts['views'], clicks=counts['clicks']))
+        else:
+            row.views += counts['views']
+            row.clicks += counts['clicks']
+            to_update.append(row)
+    model.objects.bulk_create(to_create)
+    model.objects.bulk_update(to_update, ['views', 'clicks'])
+
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush_offer_analytics()
+        except Exception:
+            logger.exception('Offer analytics flush failed')
+
+
+def _ensure_flush_thread():
+    """Start the background flush thread once per process while buffering."""
+    global _flush_thread
+    if not buffering_enabled() or _flush_thread is not None:
+        return
+    with _flush_thread_lock:
+        if _flush_thread is None:
+            _flush_thread = threading.Thread(
+                target=_flush_loop, args=(FLUSH_INTERVAL,), name='offer-analytics-flush', daemon=True
+            )
+            _flush_thread.start()
@@ -0,0 +1,178 @@
+"""
+Order export (the orders export endpoint).
+
+Exports are streamed: the response starts right away and memory use does not grow with
+the number of orders.
+
+- One query over the orders table alone: item counts (units) and grand totals are the
+  ones stored on Order, and the rows are read with iterator(chunk_size=...), a
+  server-side cursor where the database has them, so orders are never loaded all at once.
+- CSV rows are written as they are read, optionally gzip-compressed on the fly.
+- XLSX is written with openpyxl (the engine tablib uses for XLSX) in write-only mode,
+  which keeps rows in a temporary file rather than in memory; the file is then sent in
+  chunks. tablib itself builds the whole workbook in memory, so it is only used for ODS,
+  which has no streaming writer, and ODS exports are limited to ORDER_EXPORT_ODS_MAX_ROWS.
+"""
+import csv
+import tempfile
+import zlib
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import Order
+
+COLUMNS = ['id', 'first_name', 'last_name', 'email', 'created', 'paid', 'item_count', 'grand_total']
+FILE_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'ods': 'application/vnd.oasis.opendocument.spreadsheet',
+}
+CHUNK_SIZE = getattr(settings, 'ORDER_EXPORT_CHUNK_SIZE', 2000)
+# CSV output is sent in pieces of about this many bytes
+BUFFER_SIZE = 64 * 1024
+ODS_MAX_ROWS = getattr(settings, 'ORDER_EXPORT_ODS_MAX_ROWS', 50000)
+
+
+class OrderExportError(ValueError):
+    """Invalid export parameters, or a format that can't be produced here"""
+
+
+def _day_start(value, name):
+    day = parse_date(value) if value else None
+    if value and day is None:
+        raise OrderExportError(f'{name} must be a date (YYYY-MM-DD)')
+    return timezone.make_aware(datetime.combine(day, time.min)) if day else None
+
+
+def export_queryset(date_from=None, date_to=None, paid=None):
+    """
+    Orders to export, newest first. ``date_from``/``date_to`` are YYYY-MM-DD strings
+    (both days included), ``paid`` 'true' or 'false'.
+    """
+    orders = Order.objects.all()
+    start = _day_start(date_from, 'date_from')
+    end = _day_start(date_to, 'date_to')
+    # Ranges on the column itself, so an index on created can be used
+    if start:
+        orders = orders.filter(created__gte=start)
+    if end:
+        orders = orders.filter(created__lt=end + timedelta(days=1))
+    if paid is not None:
+        if paid not in ('true', 'false'):
+            raise OrderExportError("paid must be 'true' or 'false'")
+        orders = orders.filter(paid=(paid == 'true'))
+    return orders.order_by('-created', '-pk')
+
+
+def export_rows(orders, chunk_size=CHUNK_SIZE):
+    """The rows of an export_queryset(), as lists in COLUMNS order, read in chunks"""
+    values = orders.values_list(
+        'id', 'first_name', 'last_name', 'email', 'created', 'paid', 'item_count', 'total_toman'
+    )
+    for order_id, first_name, last_name, email, created, paid, item_count, grand_total in values.iterator(
+        chunk_size=chunk_size
+    ):
+        yield [order_id, first_name, last_name, email, created.isoformat(), paid, item_count, grand_total]
+
+
+class _Echo:
+    """File-like object for csv.writer that hands back what is written"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    """CSV text for ``rows``, header first, in pieces of about BUFFER_SIZE"""
+    writer = csv.writer(_Echo())
+    buffer = [writer.writerow(COLUMNS)]
+    size = len(buffer[0])
+    for row in rows:
+        line = writer.writerow(row)
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def gzip_stream(pieces):
+    """gzip-compress a stream of text pieces on the fly"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for piece in pieces:
+        data = compressor.compress(piece.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _file_chunks(f, chunk_size=BUFFER_SIZE):
+    f.seek(0)
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+def stream_xlsx(rows):
+    """An XLSX file of ``rows``, written through a temporary file and sent in chunks"""
+    # Imported here: openpyxl is only installed with tablib's xlsx extra
+    from openpyxl import Workbook
+
+    with tempfile.TemporaryFile() as f:
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('orders')
+        sheet.append(COLUMNS)
+        for row in rows:
+            sheet.append(row)
+        workbook.save(f)
+        yield from _file_chunks(f)
+
+
+def stream_ods(rows):
+    """An ODS file of ``rows``, built in memory by tablib"""
+    import tablib
+
+    dataset = tablib.Dataset(headers=COLUMNS, title='orders')
+    for count, row in enumerate(rows, start=1):
+        if count > ODS_MAX_ROWS:
+            # The response has started, so the error can only end it
+            raise OrderExportError(f'ODS exports are limited to {ODS_MAX_ROWS} orders')
+        dataset.append(row)
+    yield dataset.export('ods')
+
+
+def check_file_type(file_type):
+    """Raise OrderExportError unless ``file_type`` can be exported here"""
+    if file_type not in FILE_TYPES:
+        raise OrderExportError(f"Unknown export type '{file_type}' (use one of: {', '.join(FILE_TYPES)})")
+    module = {'xlsx': 'openpyxl', 'ods': 'odf'}.get(file_type)
+    if module:
+        try:
+            __import__(module)
+        except ImportError:
+            raise OrderExportError(f"{file_type.upper()} export needs tablib's {file_type} extra installed")
+
+
+def export_orders(orders, file_type='csv', compress=False, chunk_size=CHUNK_SIZE):
+    """
+    (content iterator, content type, filename) of an export of ``orders`` (an
+    export_queryset()). ``compress`` gzips CSV exports; XLSX and ODS are compressed already.
+    """
+    check_file_type(file_type)
+    rows = export_rows(orders, chunk_size)
+    if file_type == 'xlsx':
+        return stream_xlsx(rows), FILE_TYPES['xlsx'], 'orders.xlsx'
+    if file_type == 'ods':
+        if orders.count() > ODS_MAX_ROWS:
+            raise OrderExportError(f'ODS exports are limited to {ODS_MAX_ROWS} orders, use csv or xlsx')
+        return stream_ods(rows), FILE_TYPES['ods'], 'orders.ods'
+    if compress:
+        return gzip_stream(stream_csv(rows)), 'application/gzip', 'orders.csv.gz'
+    return stream_csv(rows), FILE_TYPES['csv'], 'orders.csv'
@@ -0,0 +1,60 @@
+"""
+Persian/Arabic text normalization.
+
+The same word reaches the database in several spellings: with or without zero-width
+joiners, with Arabic (ي ك) or Persian (ی ک) letters, with Persian, Arabic or Latin
+digits. clean_persian_text() removes the joiners, unifies digits and whitespace (what
+attribute values and keys are stored with); normalize_search_text() additionally folds
+letter variants, drops diacritics and lowercases, so documents and queries compare equal.
+"""
+import re
+
+ZERO_WIDTH_CHARS = ('\u200c', '\u200d')
+
+DIGIT_MAP = str.maketrans(
+    '۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩',
+    '01234567890123456789'
+)
+
+LETTER_MAP = str.maketrans({
+    'ي': 'ی',  # Arabic yeh
+    'ى': 'ی',  # Alef maksura
+    'ك': 'ک',  # Arabic kaf
+    'ۀ': 'ه',  # Heh with yeh above
+    'ة': 'ه',  # Teh marbuta
+    'أ': 'ا',
+    'إ': 'ا',
+    'ٱ': 'ا',
+    'ؤ': 'و',
+})
+
+# Harakat, superscript alef and tatweel
+DIACRITICS_RE = re.compile('[\u064b-\u065f\u0670\u0640]')
+
+# Word characters without the underscore, which search tokenizers treat as a separator
+TERM_RE = re.compile(r'[^\W_]+')
+
+
+def clean_persian_text(text, digits=True):
+    """Remove zero-width joiners, normalize digits (optional) and collapse whitespace."""
+    if not isinstance(text, str):
+        return text
+    for char in ZERO_WIDTH_CHARS:
+        text = text.replace(char, '')
+    if digits:
+        text = text.translate(DIGIT_MAP)
+    return ' '.join(text.split()).strip()
+
+
+def normalize_search_text(text):
+    """Normalize text for search documents and queries (letter variants folded, lowercase)."""
+    if not text:
+        return ''
+    text = clean_persian_text(str(text))
+    text = DIACRITICS_RE.sub('', text.translate(LETTER_MAP))
+    return text.lower()
+
+
+def search_terms(text):
+    """Split normalized search text into terms (letters and digits only)."""
+    return TERM_RE.findall(normalize_search_text(text))
@@ -0,0 +1,186 @@
+"""
+Active special-offer price resolver.
+
+Keeps a per-process map of product_id -> currently valid offer line so product
+responses, cart prices and sale listings resolve offer prices without querying
+SpecialOfferProduct/SpecialOffer each time.
+
+The map is rebuilt lazily:
+- when SpecialOffer/SpecialOfferProduct change (signals call invalidate_offer_prices
+  once the transaction commits),
+- when the next known offer start or end time passes,
+- when another process bumps the version key in the CATALOG_CACHE_ALIAS cache (checked
+  at most every PRICING_VERSION_CHECK_SECONDS). That only reaches the other workers when
+  the alias is shared (Redis); with a per-process cache (locmem) every process instead
+  rebuilds its map at least every PRICING_LOCAL_REFRESH_SECONDS, so an offer edit shows
+  up everywhere within that time.
+"""
+import math
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from accounts.utils import is_shared_cache
+
+VERSION_CACHE_KEY = 'pricing:offers:version'
+VERSION_CHECK_SECONDS = getattr(settings, 'PRICING_VERSION_CHECK_SECONDS', 5)
+# Without a shared cache other processes never see the version bump
+LOCAL_REFRESH_SECONDS = getattr(settings, 'PRICING_LOCAL_REFRESH_SECONDS', 10)
+
+
+def _cache_alias():
+    return getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')
+
+
+@dataclass(frozen=True)
+class ActiveOffer:
+    """The offer line currently applied to a product"""
+    offer_id: int
+    offer_product_id: int
+    discount_percentage: int
+    original_price: Optional[Decimal]
+    expires_at: Optional[datetime]
+
+    def discounted_price(self, product_price=None):
+        """Price after the offer discount, based on the line's original price or the given product price"""
+        original_price = self.original_price or product_price
+        if not original_price:
+            return None
+        if self.discount_percentage <= 0:
+            return Decimal(original_price)
+        discount_decimal = Decimal(str(self.discount_percentage)) / Decimal('100')
+        return Decimal(original_price) * (Decimal('1') - discount_decimal)
+
+
+class OfferPriceResolver:
+    """Process-local product_id -> ActiveOffer map with timeline-based refresh"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._offers: Dict[int, ActiveOffer] = {}
+        self._built = False
+        self._refresh_at: Optional[datetime] = None
+        self._version = None
+        self._version_checked_at: Optional[datetime] = None
+
+    def invalidate(self):
+        """Drop the local map and tell other processes to drop theirs"""
+        cache = caches[_cache_alias()]
+        try:
+            version = cache.incr(VERSION_CACHE_KEY)
+        except ValueError:
+            # Start from the clock so a lost counter never reuses an older version
+            cache.add(VERSION_CACHE_KEY, int(time.time() * 1000), None)
+            version = cache.incr(VERSION_CACHE_KEY)
+        with self._lock:
+            self._built = False
+            self._version = version
+
+    def get(self, product_id) -> Optional[ActiveOffer]:
+        """Return the active offer line for a product, or None"""
+        self._ensure_current()
+        return self._offers.get(product_id)
+
+    def _ensure_current(self):
+        now = timezone.now()
+        if self._version_checked_at is None or now - self._version_checked_at >= timedelta(seconds=VERSION_CHECK_SECONDS):
+            version = caches[_cache_alias()].get(VERSION_CACHE_KEY)
+            self._version_checked_at = now
+            if version != self._version:
+                self._version = version
+                self._built = False
+
+        if self._built and (self._refresh_at is None or now < self._refresh_at):
+            return
+
+        with self._lock:
+            if self._built and (self._refresh_at is None or now < self._refresh_at):
+                return
+            self._rebuild(now)
+
+    def _rebuild(self, now):
+        from .models import SpecialOfferProduct
+
+        lines = SpecialOfferProduct.objects.filter(
+            is_active=True,
+            offer__enabled=True,
+            offer__is_active=True,
+        ).filter(
+            Q(offer__valid_until__isnull=True) | Q(offer__valid_until__gte=now)
+        ).select_related('offer').order_by('display_order', 'created_at', 'pk')
+
+        offers = {}
+        refresh_at = None
+        for line in lines:
+            offer = line.offer
+            if offer.valid_from > now:
+                # Not started yet: rebuild once it starts
+                transition = offer.valid_from
+            else:
+                if line.product_id not in offers:
+                    offers[line.product_id] = ActiveOffer(
+                        offer_id=offer.id,
+                        offer_product_id=line.id,
+                        discount_percentage=line.discount_percentage,
+                        original_price=line.original_price,
+                        expires_at=offer.valid_until,
+                    )
+                # Valid through valid_until inclusive: rebuild just after it ends
+                transition = offer.valid_until + timedelta(microseconds=1) if offer.valid_until else None
+            if transition and (refresh_at is None or transition < refresh_at):
+                refresh_at = transition
+
+        if not is_shared_cache(_cache_alias()):
+            local_refresh_at = now + timedelta(seconds=LOCAL_REFRESH_SECONDS)
+            refresh_at = min(refresh_at, local_refresh_at) if refresh_at else local_refresh_at
+        self._offers = offers
+        self._refresh_at = refresh_at
+        self._built = True
+
+
+offer_price_resolver = OfferPriceResolver()
+
+
+def get_active_offer(product_id) -> Optional[ActiveOffer]:
+    """Return the currently valid offer line for a product, or None"""
+    return offer_price_resolver.get(product_id)
+
+
+def get_offer_price(product) -> Optional[Decimal]:
+    """Return the product's discounted price from an active offer with a positive discount, or None"""
+    offer = get_active_offer(product.pk)
+    if offer is None or offer.discount_percentage <= 0:
+        return None
+    return offer.discounted_price(product.price_toman)
+
+
+def seconds_until_next_offer_change(now=None) -> Optional[int]:
+    """Whole seconds until an enabled offer starts or ends, or None when none is scheduled"""
+    from .models import SpecialOffer
+
+    now = now or timezone.now()
+    bounds = SpecialOffer.objects.filter(enabled=True, is_active=True).aggregate(
+        next_start=Min('valid_from', filter=Q(valid_from__gt=now)),
+        next_end=Min('valid_until', filter=Q(valid_until__gte=now)),
+    )
+    transitions = [bounds['next_start']]
+    if bounds['next_end']:
+        # Valid through valid_until inclusive, like the resolver timeline
+        transitions.append(bounds['next_end'] + timedelta(microseconds=1))
+    transitions = [transition for transition in transitions if transition]
+    if not transitions:
+        return None
+    return max(1, math.ceil((min(transitions) - now).total_seconds()))
+
+
+def invalidate_offer_prices():
+    """Force every process to rebuild its offer map on next use"""
+    offer_price_resolver.invalidate()
@@ -0,0 +1,261 @@
+"""
+Precomputed product detail documents (the public product detail endpoint).
+
+build_detail_document() assembles what the endpoint returns about a product - its fields,
+category and supplier, images, attributes, display attributes, active variants and tags -
+with media URLs as stored. Documents are loaded in bulk (a fixed number of queries for
+any number of products) and saved in ProductDetailDocument:
+
+- Signals in shop/signals.py rebuild a product's document after the product, its
+  attributes, variants, images or tags change. Rebuilds run when the transaction commits,
+  once per product however many of its rows changed.
+- Changes that affect every product of a category (its name, attribute labels and
+  display settings) drop those documents instead; each is rebuilt on its next request.
+- render_detail_document() adds what depends on the request or on other rows: absolute
+  URLs, the wishlist flag, live stock (stock moves with conditional UPDATEs that send no
+  signals) and similar products.
+"""
+import threading
+
+from django.db import transaction
+from django.db.models import Prefetch
+
+from .models import Product, ProductAttributeValue, ProductDetailDocument, ProductVariant, Wishlist
+
+SIMILAR_PRODUCTS_LIMIT = 4
+
+_scheduled = threading.local()
+
+
+def _media_url(field):
+    return field.url if field else None
+
+
+def _is_blank(value):
+    return value is None or str(value).strip() == ''
+
+
+def _load_products(product_ids):
+    return Product.objects.filter(pk__in=product_ids).select_related('category', 'supplier').prefetch_related(
+        'images',
+        'tags',
+        'legacy_attribute_set',
+        'category__category_attributes',
+        Prefetch('attribute_values',
+                 queryset=ProductAttributeValue.objects.select_related('attribute', 'attribute_value')),
+        Prefetch('variants', queryset=ProductVariant.objects.filter(is_active=True).order_by('sku')
+                 .prefetch_related('images'), to_attr='active_variants'),
+    )
+
+
+def _variant_data(variant, distinctive_key, category_attributes):
+    # With a single attribute and no key set on the product, that attribute is the distinctive one
+    if not distinctive_key and variant.attributes and len(variant.attributes) == 1:
+        distinctive_key = next(iter(variant.attributes))
+    attributes = []
+    for key, value in (variant.attributes or {}).items():
+        attribute = {'key': key, 'value': value, 'isDistinctive': bool(distinctive_key and key == distinctive_key)}
+        if key in category_attributes:
+            if category_attributes[key].label_fa:
+                attribute['display_name'] = category_attributes[key].label_fa
+            attribute['priority'] = category_attributes[key].display_order
+        attributes.append(attribute)
+    return {
+        'id': variant.id,
+        'sku': variant.sku,
+        'attributes': attributes,
+        'price_toman': float(variant.price_toman),
+        'stock_quantity': variant.stock_quantity,
+        'is_active': variant.is_active,
+        'is_default': variant.is_default,
+        'isDistinctive': variant.isDistinctive,
+        'images': [
+            {'id': image.id, 'url': _media_url(image.image), 'is_primary': image.is_primary, 'order': image.order}
+            for image in variant.images.all() if image.image
+        ],
+    }
+
+
+def build_detail_document(product):
+    """The detail document of a product loaded by _load_products()."""
+    category_attributes = list(product.category.category_attributes.all()) if product.category else []
+    category_attributes_by_key = {attribute.key: attribute for attribute in category_attributes}
+
+    # key -> values, in the order the old per-key queries returned them
+    new_values = {}
+    for attribute_value in product.attribute_values.all():
+        new_values.setdefault(attribute_value.attribute.key, []).append(attribute_value.get_display_value())
+    legacy_values = {}
+    for legacy in product.legacy_attribute_set.all():
+        legacy_values.setdefault(legacy.key, []).append(legacy.value)
+
+    # Category-allowed attributes with a value, preferring the new system
+    attributes = []
+    for attribute in category_attributes:
+        value = next(iter(new_values.get(attribute.key, [])), None)
+        if not value:
+            value = next(iter(legacy_values.get(attribute.key, [])), None)
+        if not _is_blank(value):
+            attributes.append({'key': attribute.key, 'value': value})
+
+    variants = product.active_variants
+    display_attributes = []
+    for attribute in category_attributes:
+        if not attribute.is_displayed_in_product:
+            continue
+        values = [variant.attributes[attribute.key] for variant in variants
+                  if variant.attributes and attribute.key in variant.attributes]
+        values += legacy_values.get(attribute.key, []) + new_values.get(attribute.key, [])
+        value = next((value for value in values if not _is_blank(value)), None)
+        if value is not None:
+            display_attributes.append({
+                'key': attribute.key,
+                'display_name': attribute.label_fa,
+                'priority': attribute.display_order,
+                'value': value,
+            })
+
+    variants_data = [
+        _variant_data(variant, product.distinctive_attribute_key, category_attributes_by_key) for variant in variants
+    ]
+    return {
+        'id': product.id,
+        'name': product.name,
+        'description': product.description or '',
+        'price_toman': float(product.price_toman),
+        'price_usd': float(product.price_usd) if product.price_usd else None,
+        'reduced_price_toman': float(product.reduced_price_toman) if product.reduced_price_toman else None,
+        'discount_percentage': float(product.discount_percentage) if product.discount_percentage else None,
+        'model': product.model,
+        'sku': product.sku,
+        'stock_quantity': product.stock_quantity,
+        'created_at': product.created_at.timestamp(),
+        'category': {'id': product.category.id, 'name': product.category.name} if product.category else None,
+        'supplier': {'id': product.supplier.id, 'name': str(product.supplier)} if product.supplier else None,
+        'images': [
+            {'id': image.id, 'url': _media_url(image.image), 'is_primary': image.is_primary}
+            for image in product.images.all() if image.image
+        ],
+        'attributes': attributes,
+        'display_attributes': display_attributes,
+        'variants': variants_data,
+        'variants_count': len(variants_data),
+        'total_stock': sum(variant['stock_quantity'] for variant in variants_data),
+        'tags': [{'id': tag.id, 'name': tag.name} for tag in product.tags.all()],
+    }
+
+
+def rebuild_detail_documents(product_ids):
+    """Rebuild the documents of the given products. Returns {product_id: data}."""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+    documents = {product.pk: build_detail_document(product) for product in _load_products(product_ids)}
+    with transaction.atomic():
+        ProductDetailDocument.objects.filter(product_id__in=product_ids).delete()
+        ProductDetailDocument.objects.bulk_create([
+            ProductDetailDocument(product_id=product_id, data=data) for product_id, data in documents.items()
+        ])
+    return documents
+
+
+def rebuild_all_detail_documents(batch_size=200):
+    """Rebuild every product's document. Returns the number of documents written."""
+    product_ids = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+    ProductDetailDocument.objects.exclude(product_id__in=product_ids).delete()
+    total = 0
+    for start in range(0, len(product_ids), batch_size):
+        total += len(rebuild_detail_documents(product_ids[start:start + batch_size]))
+    return total
+
+
+def _rebuild_scheduled():
+    product_ids = getattr(_scheduled, 'product_ids', set())
+    _scheduled.product_ids = set()
+    rebuild_detail_documents(product_ids)
+
+
+def schedule_detail_rebuild(product_ids):
+    """Rebuild the documents of the given products when the current transaction commits."""
+    product_ids = {product_id for product_id in product_ids if product_id}
+    if not product_ids:
+        return
+    # Per thread, as each thread has its own connection and transaction
+    if not hasattr(_scheduled, 'product_ids'):
+        _scheduled.product_ids = set()
+    _scheduled.product_ids |= product_ids
+    # The first callback to run rebuilds everything scheduled so far; the rest find nothing left
+    transaction.on_commit(_rebuild_scheduled)
+
+
+def drop_detail_documents(queryset):
+    """Drop the documents of a Product queryset; they are rebuilt when next requested."""
+    ProductDetailDocument.objects.filter(product__in=queryset).delete()
+
+
+def get_active_detail_document(product_id):
+    """(data, live stock) of an active product, building its document if missing; None if not found."""
+    row = ProductDetailDocument.objects.filter(
+        product_id=product_id, product__is_active=True
+    ).values_list('data', 'product__stock_quantity').first()
+    if row is not None:
+        return row
+    stock = Product.objects.filter(pk=product_id, is_active=True).values_list('stock_quantity', flat=True).first()
+    if stock is None:
+        return None
+    return rebuild_detail_documents([product_id])[product_id], stock
+
+
+def similar_products(product_id, category_id, limit=SIMILAR_PRODUCTS_LIMIT):
+    """Other active products of the same category, with relative image URLs"""
+    if category_id is None:
+        return []
+    products = Product.objects.filter(category_id=category_id, is_active=True).exclude(
+        pk=product_id
+    ).prefetch_related('images')[:limit]
+    data = []
+    for similar in products:
+        image = next(iter(similar.images.all()), None)
+        data.append({
+            'id': similar.id,
+            'name': similar.name,
+            'price_toman': float(similar.price_toman),
+            'price_usd': float(similar.price_usd) if similar.price_usd else None,
+            'reduced_price_toman': float(similar.reduced_price_toman) if similar.reduced_price_toman else None,
+            'discount_percentage': float(similar.discount_percentage) if similar.discount_percentage else None,
+            'image_url': _media_url(image.image) if image else None,
+        })
+    return data
+
+
+def render_detail_document(request, data, stock_quantity, user_id=None):
+    """
+    The endpoint response for a stored document: absolute URLs, live stock, similar
+    products and, for a signed-in user, ``is_in_wishlist``.
+    """
+    def absolute(url):
+        return request.build_absolute_uri(url) if url else url
+
+    variant_stock = dict(ProductVariant.objects.filter(
+        product_id=data['id'], is_active=True
+    ).values_list('id', 'stock_quantity'))
+    variants = [
+        {
+            **variant,
+            'stock_quantity': variant_stock.get(variant['id'], variant['stock_quantity']),
+            'images': [{**image, 'url': absolute(image['url'])} for image in variant['images']],
+        }
+        for variant in data['variants']
+    ]
+    similar = similar_products(data['id'], data['category']['id'] if data['category'] else None)
+    response = {
+        **data,
+        'stock_quantity': stock_quantity,
+        'images': [{**image, 'url': absolute(image['url'])} for image in data['images']],
+        'variants': variants,
+        'total_stock': sum(variant['stock_quantity'] for variant in variants),
+        'similar_products': [{**product, 'image_url': absolute(product['image_url'])} for product in similar],
+    }
+    if user_id is not None:
+        response['is_in_wishlist'] = Wishlist.objects.filter(customer_id=user_id, product_id=data['id']).exists()
+    return response
@@ -1,16 +1,258 @@
 """
 Rate Limiting Utilities for Cart Endpoints
 Provides IP-based and Device ID-based rate limiting with proper security measures
+
+Rate limit engine
+Counters are only ever changed with atomic increments (or a Lua script on Redis), so
+concurrent requests can't both take the last slot. Three algorithms:
+- fixed_window: N requests per window, counted in a key per window
+- sliding_window: the current window's count plus the previous window's count weighted by
+  how much of it still overlaps the sliding window (smooth, two counters per key)
+- token_bucket: a bucket of N tokens refilled at N per window (allows bursts up to N)
+Counters live in the RATE_LIMIT_CACHE_ALIAS cache: with django-redis every worker shares
+them, with locmem (tests, single process) each process counts on its own.
 """
+import math
+import threading
+import time
 import uuid
 import logging
-from django.core.cache import cache
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.cache import caches
 from rest_framework.response import Response
 from rest_framework import status
 from accounts.utils import get_client_ip
 
 logger = logging.getLogger('security')
 
+RATE_LIMIT_ALGORITHMS = ('fixed_window', 'sliding_window', 'token_bucket')
+DEFAULT_ALGORITHM = getattr(settings, 'RATE_LIMIT_ALGORITHM', 'sliding_window')
+
+
+@dataclass(frozen=True)
+class RateLimitResult:
+    allowed: bool
+    limit: int
+    remaining: int
+    reset: int  # seconds until the quota is fully available again
+    retry_after: int = 0  # seconds until a request would be allowed (0 if allowed)
+
+    def headers(self, window_seconds):
+        """RateLimit-* response headers (IETF draft), plus Retry-After when limited"""
+        headers = {
+            'RateLimit-Limit': str(self.limit),
+            'RateLimit-Remaining': str(self.remaining),
+            'RateLimit-Reset': str(self.reset),
+            'RateLimit-Policy': f'{self.limit};w={window_seconds}',
+        }
+        if not self.allowed:
+            headers['Retry-After'] = str(self.retry_after)
+        return headers
+
+
+def _window_start(now, window):
+    return int(now // window) * window
+
+
+def _sliding_result(allowed, count, previous, limit, window, now):
+    """Result of a sliding-window hit; ``count`` includes this request"""
+    start = _window_start(now, window)
+    weight = 1 - (now - start) / window
+    reset = max(1, math.ceil(start + window - now))
+    if allowed:
+        return RateLimitResult(True, limit, max(0, math.floor(limit - previous * weight - count)), reset)
+    if count <= limit and previous:
+        # Wait until enough of the previous window has slid out
+        retry_after = math.ceil(start + window * (1 - (limit - count) / previous) - now)
+    else:
+        retry_after = reset
+    return RateLimitResult(False, limit, 0, reset, max(1, retry_after))
+
+
+def _bucket_result(allowed, tokens, limit, window):
+    rate = limit / window
+    reset = max(0, math.ceil((limit - tokens) / rate))
+    retry_after = 0 if allowed else max(1, math.ceil((1 - tokens) / rate))
+    return RateLimitResult(allowed, limit, math.floor(tokens), reset, retry_after)
+
+
+class CacheRateLimitBackend:
+    """
+    Counters in any Django cache, changed with cache.incr (atomic in locmem, Redis and
+    memcached). Token buckets are read-modify-write under a process lock, so they are
+    exact with locmem but only per process with a shared cache; use Redis for those.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._bucket_lock = threading.Lock()
+
+    def _incr(self, key, timeout):
+        self.cache.add(key, 0, timeout)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            self.cache.add(key, 1, timeout)
+            return 1
+
+    def fixed_window(self, key, limit, window, now):
+        start = _window_start(now, window)
+        count = self._incr(f'{key}:{start}', window + 1)
+        reset = max(1, math.ceil(start + window - now))
+        if count <= limit:
+            return RateLimitResult(True, limit, limit - count, reset)
+        return RateLimitResult(False, limit, 0, reset, reset)
+
+    def sliding_window(self, key, limit, window, now):
+        start = _window_start(now, window)
+        current_key = f'{key}:{start}'
+        count = self._incr(current_key, 2 * window + 1)
+        previous = self.cache.get(f'{key}:{start - window}', 0)
+        weight = 1 - (now - start) / window
+        allowed = previous * weight + count <= limit
+        if not allowed:
+            # Rejected requests don't count against the next window
+            try:
+                self.cache.decr(current_key)
+            except ValueError:
+                pass
+        return _sliding_result(allowed, count, previous, limit, window, now)
+
+    def token_bucket(self, key, limit, window, now):
+        rate = limit / window
+        with self._bucket_lock:
+            tokens, updated = self.cache.get(key, (limit, now))
+            tokens = min(limit, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.cache.set(key, (tokens, now), window + 1)
+        return _bucket_result(allowed, tokens, limit, window)
+
+
+# KEYS[1] = counter; ARGV[1] = TTL
+FIXED_WINDOW_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then redis.call('EXPIRE', KEYS[1], ARGV[1]) end
+return count
+"""
+
+# KEYS = current, previous window; ARGV = limit, previous window weight, TTL
+SLIDING_WINDOW_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then redis.call('EXPIRE', KEYS[1], ARGV[3]) end
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+if previous * tonumber(ARGV[2]) + count > tonumber(ARGV[1]) then
+    redis.call('DECR', KEYS[1])
+    return {0, count, previous}
+end
+return {1, count, previous}
+"""
+
+# KEYS[1] = bucket hash; ARGV = capacity, tokens per second, TTL. Uses the server clock.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisRateLimitBackend:
+    """Counters in Redis (django-redis cache alias), each hit one Lua script call"""
+
+    def __init__(self, alias):
+        from django_redis import get_redis_connection
+
+        self.cache = caches[alias]
+        client = get_redis_connection(alias)
+        self._fixed_window = client.register_script(FIXED_WINDOW_SCRIPT)
+        self._sliding_window = client.register_script(SLIDING_WINDOW_SCRIPT)
+        self._token_bucket = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def fixed_window(self, key, limit, window, now):
+        start = _window_start(now, window)
+        count = int(self._fixed_window(keys=[self.cache.make_key(f'{key}:{start}')], args=[window + 1]))
+        reset = max(1, math.ceil(start + window - now))
+        if count <= limit:
+            return RateLimitResult(True, limit, limit - count, reset)
+        return RateLimitResult(False, limit, 0, reset, reset)
+
+    def sliding_window(self, key, limit, window, now):
+        start = _window_start(now, window)
+        weight = 1 - (now - start) / window
+        allowed, count, previous = self._sliding_window(
+            keys=[self.cache.make_key(f'{key}:{start}'), self.cache.make_key(f'{key}:{start - window}')],
+            args=[limit, repr(weight), 2 * window + 1],
+        )
+        return _sliding_result(bool(allowed), int(count), int(previous), limit, window, now)
+
+    def token_bucket(self, key, limit, window, now):
+        allowed, tokens = self._token_bucket(keys=[self.cache.make_key(key)], args=[limit, repr(limit / window), window + 1])
+        return _bucket_result(bool(allowed), float(tokens), limit, window)
+
+
+class RateLimiter:
+    """Counts hits against (limit, window) per key with the configured backend"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def hit(self, key, limit, window_seconds, algorithm=None, now=None):
+        """
+        Count one request for ``key`` and return a RateLimitResult.
+
+        Args:
+            key: what is limited (e.g. 'ip:1.2.3.4:/shop/api/cart/')
+            limit: requests allowed per window
+            window_seconds: window length
+            algorithm: one of RATE_LIMIT_ALGORITHMS (default RATE_LIMIT_ALGORITHM)
+            now: timestamp override for tests
+        """
+        algorithm = algorithm or DEFAULT_ALGORITHM
+        if algorithm not in RATE_LIMIT_ALGORITHMS:
+            raise ValueError(f'Unknown rate limit algorithm: {algorithm}')
+        now = time.time() if now is None else now
+        return getattr(self.backend, algorithm)(f'rl:{algorithm}:{key}', limit, window_seconds, now)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """Return the process-wide RateLimiter for RATE_LIMIT_CACHE_ALIAS."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        alias = getattr(settings, 'RATE_LIMIT_CACHE_ALIAS', 'default')
+        if settings.CACHES[alias]['BACKEND'].startswith('django_redis.'):
+            backend = RedisRateLimitBackend(alias)
+        else:
+            backend = CacheRateLimitBackend(caches[alias])
+        _rate_limiter = RateLimiter(backend)
+    return _rate_limiter
+
+
+def rate_limited_response(result, window_seconds, detail='Too many requests, please try again later.'):
+    """429 response carrying the RateLimit-* and Retry-After headers of ``result``"""
+    response = Response({'detail': detail}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    for header, value in result.headers(window_seconds).items():
+        response[header] = value
+    return response
+
 
 def validate_device_id(device_id):
     """
@@ -68,32 +310,20 @@ def check_rate_limit(request, max_requests_per_minute=50, window_seconds=60):
             }, status=status.HTTP_400_BAD_REQUEST)
         device_id = normalized_device_id
     
-    # Rate limit by IP address
-    ip_cache_key = f'rate_limit_ip_{client_ip}'
-    ip_count = cache.get(ip_cache_key, 0)
+    limiter = get_rate_limiter()
     
-    if ip_count >= max_requests_per_minute:
+    # Rate limit by IP address
+    result = limiter.hit(f'ip:{client_ip}', max_requests_per_minute, window_seconds)
+    if not result.allowed:
         logger.warning(f"Rate limit exceeded for IP: {client_ip}")
-        return Response({
-            'detail': 'Too many requests, please try again later.'
-        }, status=status.HTTP_429_TOO_MANY_REQUESTS)
-    
-    # Increment IP counter
-    cache.set(ip_cache_key, ip_count + 1, window_seconds)
+        return rate_limited_response(result, window_seconds)
     
     # Rate limit by device ID (for guest users)
     if device_id and not request.user.is_authenticated:
-        device_cache_key = f'rate_limit_device_{device_id}'
-        device_count = cache.get(device_cache_key, 0)
-        
-        if device_count >= max_requests_per_minute:
+        result = limiter.hit(f'device:{device_id}', max_requests_per_minute, window_seconds)
+        if not result.allowed:
             logger.warning(f"Rate limit exceeded for device ID: {device_id[:8]}...")
-            return Response({
-                'detail': 'Too many requests, please try again later.'
-            }, status=status.HTTP_429_TOO_MANY_REQUESTS)
-        
-        # Increment device ID counter
-        cache.set(device_cache_key, device_count + 1, window_seconds)
+            return rate_limited_response(result, window_seconds)
     
     # Rate limit passed
     return None
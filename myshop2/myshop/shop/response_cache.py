@@ -0,0 +1,112 @@
+"""
+Versioned response cache for read-only catalog endpoints.
+
+Responses are cached pre-rendered (body bytes + content type), keyed by host, path,
+normalized query parameters and a catalog "generation" counter. Product, category and
+offer signals bump the generation when their transaction commits, which retires every
+cached response at once without having to know which keys exist. Offers starting or
+ending change responses without any write, so entries never outlive the next offer
+start/end time. A cache hit returns the stored bytes directly, with an ETag;
+If-None-Match requests get a 304.
+
+The backend is the CACHES alias named by CATALOG_CACHE_ALIAS (locmem by default,
+Redis when REDIS_URL is configured), so the generation is shared between workers
+whenever the backend is.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, urlencode
+
+from .pricing import seconds_until_next_offer_change
+
+GENERATION_KEY = 'catalog:generation'
+RESPONSE_KEY_PREFIX = 'catalog:response:'
+CATALOG_CACHE_TIMEOUT = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 5 * 60)
+
+
+def _catalog_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def get_catalog_generation():
+    """Return the current catalog generation, initializing it if the backend lost it."""
+    cache = _catalog_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the clock so a lost counter never reuses an older generation
+        cache.add(GENERATION_KEY, int(time.time() * 1000), None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_catalog_generation():
+    """Retire every cached catalog response."""
+    cache = _catalog_cache()
+    try:
+        return cache.incr(GENERATION_KEY)
+    except ValueError:
+        return get_catalog_generation()
+
+
+def _response_key(request, generation):
+    query = urlencode(sorted((key, values) for key, values in request.GET.lists()), doseq=True)
+    raw = f'{generation}|{request.get_host()}|{request.path}|{query}'
+    return RESPONSE_KEY_PREFIX + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _response_from_entry(request, entry, cache_status):
+    etag = entry['etag']
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(entry['body'], content_type=entry['content_type'])
+    response['ETag'] = etag
+    response['X-Cache'] = cache_status
+    return response
+
+
+def cache_catalog_response(timeout=None):
+    """
+    Cache a read-only view's rendered response until the catalog generation changes or
+    the next offer starts or ends, whichever comes first.
+
+    Only successful GET/HEAD responses are cached. Browsable-API (text/html) requests
+    bypass the cache so JSON and HTML renderings never mix.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or 'text/html' in request.META.get('HTTP_ACCEPT', ''):
+                return view_func(request, *args, **kwargs)
+
+            cache = _catalog_cache()
+            key = _response_key(request, get_catalog_generation())
+            entry = cache.get(key)
+            if entry is not None:
+                return _response_from_entry(request, entry, 'HIT')
+
+            response = view_func(request, *args, **kwargs)
+            if response.status_code != 200 or response.streaming:
+                return response
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+
+            entry = {
+                'body': response.content,
+                'content_type': response['Content-Type'],
+                'etag': '"%s"' % hashlib.sha1(response.content).hexdigest(),
+            }
+            entry_timeout = timeout or CATALOG_CACHE_TIMEOUT
+            until_offer_change = seconds_until_next_offer_change()
+            if until_offer_change is not None:
+                entry_timeout = min(entry_timeout, until_offer_change)
+            cache.set(key, entry, entry_timeout)
+            return _response_from_entry(request, entry, 'MISS')
+        return wrapper
+    return decorator
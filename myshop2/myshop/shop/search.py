@@ -0,0 +1,265 @@
+"""
+Product full-text search.
+
+Every product has a ProductSearchDocument holding its name, model/SKU, brand, tags and
+category label, normalized with shop/persian.py so Persian and Arabic spellings, zero-width
+joiners and digit variants all match. Queries are normalized the same way, split into
+terms and matched as prefixes (every term must match), best matches first.
+
+The backend is pluggable (PRODUCT_SEARCH_BACKEND, a dotted path) and defaults by database:
+- PostgreSQL: a GIN-indexed tsvector (config 'simple'), ranked with SearchRank,
+- SQLite: an FTS5 virtual table, ranked with bm25(),
+- anything else: icontains over the document fields.
+
+Title matches outrank model/SKU/brand matches, which outrank tag and category matches.
+Documents are kept in sync by signals in shop/signals.py; rebuild with the
+build_search_index management command.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, FloatField, Q, Value, When
+from django.utils.module_loading import import_string
+
+from .models import Product, ProductAttribute, ProductAttributeValue, ProductSearchDocument
+from .persian import normalize_search_text, search_terms
+
+# Attribute keys whose values are indexed as the product's brand
+BRAND_ATTRIBUTE_KEYS = ('brand', 'برند')
+# Fields of Product that end up in its search document
+PRODUCT_DOCUMENT_FIELDS = frozenset({'name', 'model', 'sku', 'category', 'category_id'})
+DOCUMENT_FIELDS = ('title', 'codes', 'brand', 'tags', 'category')
+
+# Cap on ranked matches fetched by backends that rank outside the main query (SQLite)
+SEARCH_MAX_RESULTS = getattr(settings, 'SEARCH_MAX_RESULTS', 1000)
+POSTGRES_SEARCH_CONFIG = 'simple'
+FTS_TABLE = 'shop_productsearch_fts'
+
+
+def _join(values):
+    return ' '.join(normalize_search_text(value) for value in values if value)
+
+
+def build_search_documents(product_ids):
+    """Return unsaved ProductSearchDocument objects for the given products (four queries)."""
+    products = Product.objects.filter(pk__in=product_ids).values(
+        'id', 'name', 'model', 'sku', 'category__name', 'category__label'
+    )
+
+    brands = defaultdict(list)
+    for pav in ProductAttributeValue.objects.filter(
+        product_id__in=product_ids, attribute__key__in=BRAND_ATTRIBUTE_KEYS
+    ).select_related('attribute_value'):
+        brands[pav.product_id].append(pav.get_display_value())
+    for product_id, value in ProductAttribute.objects.filter(
+        product_id__in=product_ids, key__in=BRAND_ATTRIBUTE_KEYS
+    ).values_list('product_id', 'value'):
+        brands[product_id].append(value)
+
+    tags = defaultdict(list)
+    for product_id, name in Product.tags.through.objects.filter(
+        product_id__in=product_ids
+    ).values_list('product_id', 'tag__name'):
+        tags[product_id].append(name)
+
+    return [
+        ProductSearchDocument(
+            product_id=row['id'],
+            title=_join([row['name']]),
+            codes=_join([row['model'], row['sku']]),
+            # The same brand is often stored under both keys
+            brand=_join(dict.fromkeys(brands[row['id']])),
+            tags=_join(tags[row['id']]),
+            category=_join(dict.fromkeys([row['category__label'], row['category__name']])),
+        )
+        for row in products
+    ]
+
+
+def index_products(product_ids):
+    """Rebuild the search documents of the given products."""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return 0
+    documents = build_search_documents(product_ids)
+    backend = get_search_backend()
+    with transaction.atomic():
+        ProductSearchDocument.objects.filter(product_id__in=product_ids).delete()
+        ProductSearchDocument.objects.bulk_create(documents)
+        backend.remove(product_ids)
+        backend.index(documents)
+    return len(documents)
+
+
+def remove_products(product_ids):
+    """Drop deleted products from the backend index (document rows cascade with the product)."""
+    get_search_backend().remove(list(product_ids))
+
+
+def rebuild_search_index(batch_size=500):
+    """Rebuild every product's search document. Returns the number of documents written."""
+    backend = get_search_backend()
+    with transaction.atomic():
+        ProductSearchDocument.objects.all().delete()
+        backend.clear()
+    product_ids = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+    total = 0
+    for start in range(0, len(product_ids), batch_size):
+        total += index_products(product_ids[start:start + batch_size])
+    return total
+
+
+class BaseSearchBackend:
+    """Interface of a search backend; ProductSearchDocument rows are saved before index() runs"""
+
+    def index(self, documents):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def search(self, queryset, terms):
+        """Filter a Product queryset to documents matching every term, annotated with search_rank."""
+        raise NotImplementedError
+
+    @staticmethod
+    def no_results(queryset):
+        return queryset.none().annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """Substring matching over the document fields, for databases without full-text support"""
+
+    WEIGHTS = {'title': 4.0, 'codes': 2.0, 'brand': 2.0, 'tags': 1.0, 'category': 1.0}
+
+    def search(self, queryset, terms):
+        condition = Q()
+        rank = Value(0.0, output_field=FloatField())
+        for term in terms:
+            term_condition = Q()
+            for field, weight in self.WEIGHTS.items():
+                lookup = {f'search_document__{field}__contains': term}
+                term_condition |= Q(**lookup)
+                rank = rank + Case(When(**lookup, then=Value(weight)), default=Value(0.0),
+                                   output_field=FloatField())
+            condition &= term_condition
+        return queryset.filter(condition).annotate(search_rank=rank)
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """tsvector column on ProductSearchDocument with a GIN index, weighted A-C by field"""
+
+    def _vector(self):
+        from django.contrib.postgres.search import SearchVector
+
+        config = POSTGRES_SEARCH_CONFIG
+        return (
+            SearchVector('title', weight='A', config=config)
+            + SearchVector('codes', 'brand', weight='B', config=config)
+            + SearchVector('tags', 'category', weight='C', config=config)
+        )
+
+    def index(self, documents):
+        ProductSearchDocument.objects.filter(
+            product_id__in=[document.product_id for document in documents]
+        ).update(search_vector=self._vector())
+
+    def search(self, queryset, terms):
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+
+        # Terms are letters and digits only, so they are safe in a raw tsquery
+        query = SearchQuery(
+            ' & '.join(f'{term}:*' for term in terms), search_type='raw', config=POSTGRES_SEARCH_CONFIG
+        )
+        return queryset.filter(search_document__search_vector=query).annotate(
+            search_rank=SearchRank(F('search_document__search_vector'), query)
+        )
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """FTS5 virtual table keyed by product ID (rowid), ranked with bm25()"""
+
+    # bm25() column weights, in DOCUMENT_FIELDS order
+    WEIGHTS = (10.0, 5.0, 5.0, 2.0, 1.0)
+
+    def index(self, documents):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE} (rowid, {", ".join(DOCUMENT_FIELDS)}) VALUES (%s, %s, %s, %s, %s, %s)',
+                [
+                    [document.product_id] + [getattr(document, field) for field in DOCUMENT_FIELDS]
+                    for document in documents
+                ],
+            )
+
+    def remove(self, product_ids):
+        if not product_ids:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({", ".join(["%s"] * len(product_ids))})',
+                product_ids,
+            )
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+    def search(self, queryset, terms):
+        match = ' '.join(f'"{term}"*' for term in terms)
+        weights = ', '.join(str(weight) for weight in self.WEIGHTS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid, bm25({FTS_TABLE}, {weights}) AS score FROM {FTS_TABLE} '
+                f'WHERE {FTS_TABLE} MATCH %s ORDER BY score LIMIT %s',
+                [match, SEARCH_MAX_RESULTS],
+            )
+            scores = cursor.fetchall()
+        if not scores:
+            return self.no_results(queryset)
+        # bm25() is lower-is-better; flip it so search_rank sorts descending like SearchRank
+        return queryset.filter(pk__in=[product_id for product_id, _ in scores]).annotate(
+            search_rank=Case(
+                *[When(pk=product_id, then=Value(-score)) for product_id, score in scores],
+                default=Value(0.0),
+                output_field=FloatField(),
+            )
+        )
+
+
+_backends = {}
+
+
+def get_search_backend():
+    """Return the configured search backend, or the one matching the database vendor."""
+    path = getattr(settings, 'PRODUCT_SEARCH_BACKEND', None)
+    key = path or connection.vendor
+    if key not in _backends:
+        if path:
+            backend_class = import_string(path)
+        elif connection.vendor == 'postgresql':
+            backend_class = PostgresSearchBackend
+        elif connection.vendor == 'sqlite':
+            backend_class = SQLiteFTSBackend
+        else:
+            backend_class = SimpleSearchBackend
+        _backends[key] = backend_class()
+    return _backends[key]
+
+
+def search_products(queryset, query):
+    """
+    Filter a Product queryset by a free-text query.
+
+    Returns the matching products annotated with ``search_rank`` (higher is better); order
+    by ``-search_rank`` for relevance. A query without letters or digits matches nothing.
+    """
+    terms = search_terms(query)
+    backend = get_search_backend()
+    if not terms:
+        return backend.no_results(queryset)
+    return backend.search(queryset, terms)
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.db import models
 from .models import Product, ProductAttributeValue, ProductAttribute, Category, Wishlist, SpecialOffer, SpecialOfferProduct, ProductVariant
+from .pricing import get_active_offer, get_offer_price
 
 class LegacyProductAttributeSerializer(serializers.ModelSerializer):
     class Meta:
@@ -37,6 +38,77 @@ class CategorySerializer(serializers.ModelSerializer):
         model = Category
         fields = ['id', 'name']
 
+class ProductListContext:
+    """
+    Bulk-loaded data needed to serialize a page of products without per-row queries.
+
+    Loads variant counts, category attribute keys, images and attributes for every
+    product in one pass (offer prices come from shop.pricing), so serializing a page
+    costs a fixed number of queries regardless of its size.
+    """
+
+    def __init__(self, products):
+        from django.db.models import Prefetch
+        from .models import CategoryAttribute, ProductVariantImage
+
+        self.products = [p for p in products if p is not None]
+        product_ids = [p.pk for p in self.products]
+        self.product_ids = set(product_ids)
+
+        models.prefetch_related_objects(
+            self.products,
+            'category',
+            'images',
+            'legacy_attribute_set',
+            Prefetch(
+                'attribute_values',
+                queryset=ProductAttributeValue.objects.select_related('attribute', 'attribute_value'),
+            ),
+        )
+
+        # Active variants: counts, plus the default variant used as an image fallback
+        self.variants_count = {}
+        default_variant_ids = {}
+        variant_rows = ProductVariant.objects.filter(
+            product_id__in=product_ids, is_active=True
+        ).order_by('sku').values_list('id', 'product_id', 'is_default')
+        for variant_id, product_id, is_default in variant_rows:
+            self.variants_count[product_id] = self.variants_count.get(product_id, 0) + 1
+            if product_id not in default_variant_ids or (is_default and not default_variant_ids[product_id][1]):
+                default_variant_ids[product_id] = (variant_id, is_default)
+
+        self.category_keys = {}
+        category_ids = {p.category_id for p in self.products if p.category_id}
+        for category_id, key in CategoryAttribute.objects.filter(
+            category_id__in=category_ids
+        ).values_list('category_id', 'key'):
+            self.category_keys.setdefault(category_id, set()).add(key)
+
+        # Variant images are only needed for products without their own images
+        self.fallback_images = {}
+        fallback_variants = {
+            default_variant_ids[p.pk][0]: p.pk
+            for p in self.products
+            if p.pk in default_variant_ids and not p.images.all()
+        }
+        if fallback_variants:
+            for image in ProductVariantImage.objects.filter(variant_id__in=fallback_variants):
+                self.fallback_images.setdefault(fallback_variants[image.variant_id], image)
+
+    def __contains__(self, product):
+        return product.pk in self.product_ids
+
+
+class ProductListSerializer(serializers.ListSerializer):
+    """List serializer that bulk-loads a ProductListContext before serializing the page"""
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        products = list(iterable)
+        self.child.product_list_context = ProductListContext(products)
+        return super().to_representation(products)
+
+
 class ProductSerializer(serializers.ModelSerializer):
     price_toman = serializers.FloatField()
     price_usd = serializers.FloatField(allow_null=True)
@@ -68,6 +140,16 @@ class ProductSerializer(serializers.ModelSerializer):
             'original_price', 'discounted_price', 'discount_percentage_offer', 'has_discount',
             'variants_count'
         ]
+        list_serializer_class = ProductListSerializer
+
+    def _list_context(self, obj):
+        """Return the bulk-loaded context covering obj, building a single-product one if needed"""
+        for context in (getattr(self, 'product_list_context', None), self.context.get('product_list_context')):
+            if context is not None and obj in context:
+                return context
+        context = ProductListContext([obj])
+        self.product_list_context = context
+        return context
 
     def get_created_at(self, obj):
         # Return as seconds since 1970 for Swift Date compatibility
@@ -84,43 +166,17 @@ class ProductSerializer(serializers.ModelSerializer):
             return float(obj.reduced_price_toman)
         
         # Check if this product is in any active special offers
-        from django.utils import timezone
-        now = timezone.now()
-        
-        special_offer_product = obj.specialofferproduct_set.filter(
-            offer__enabled=True,
-            offer__is_active=True,
-            offer__valid_from__lte=now,
-            is_active=True
-        ).filter(
-            models.Q(offer__valid_until__isnull=True) | models.Q(offer__valid_until__gte=now)
-        ).first()
-        
-        if special_offer_product and special_offer_product.discount_percentage > 0:
-            original_price = special_offer_product.original_price or obj.price_toman
-            if original_price:
-                from decimal import Decimal
-                discount_decimal = Decimal(str(special_offer_product.discount_percentage)) / Decimal('100')
-                discounted_price = original_price * (Decimal('1') - discount_decimal)
-                return float(discounted_price)
+        offer_price = get_offer_price(obj)
+        if offer_price is not None:
+            return float(offer_price)
         
         return float(obj.price_toman) if obj.price_toman else None
     
     def get_discount_percentage_offer(self, obj):
         """Get the discount percentage from special offers (separate from product's own discount)"""
-        from django.utils import timezone
-        now = timezone.now()
-        
-        special_offer_product = obj.specialofferproduct_set.filter(
-            offer__enabled=True,
-            offer__is_active=True,
-            offer__valid_from__lte=now,
-            is_active=True
-        ).filter(
-            models.Q(offer__valid_until__isnull=True) | models.Q(offer__valid_until__gte=now)
-        ).first()
+        active_offer = get_active_offer(obj.pk)
         
-        return float(special_offer_product.discount_percentage) if special_offer_product else 0
+        return float(active_offer.discount_percentage) if active_offer else 0
     
     def get_has_discount(self, obj):
         """Check if product has an active discount (either own discount or special offer)"""
@@ -132,7 +188,12 @@ class ProductSerializer(serializers.ModelSerializer):
 
     def get_variants_count(self, obj):
         """Get the count of active variants for this product"""
-        return obj.variants.filter(is_active=True).count()
+        return self._list_context(obj).variants_count.get(obj.pk, 0)
+
+    def to_representation(self, instance):
+        # Make sure related data is bulk-loaded before any field touches it
+        self._list_context(instance)
+        return super().to_representation(instance)
 
     def get_images(self, obj):
         request = self.context.get('request', None)
@@ -143,28 +204,20 @@ class ProductSerializer(serializers.ModelSerializer):
                 url = request.build_absolute_uri(url)
             images.append({'url': url, 'is_primary': image.is_primary})
         
-        # If no direct product images, try to get from variants
+        # If no direct product images, try to get from the default variant
         if not images:
-            variants = ProductVariant.objects.filter(product=obj, is_active=True).order_by('sku')
-            default_variant = variants.filter(is_default=True).first()
-            if not default_variant:
-                default_variant = variants.first()
-            
-            if default_variant:
-                first_variant_image = default_variant.images.first()
-                if first_variant_image and first_variant_image.image:
-                    url = first_variant_image.image.url
-                    if request and not url.startswith(('http://', 'https://')):
-                        url = request.build_absolute_uri(url)
-                    images.append({'url': url, 'is_primary': True})
+            first_variant_image = self._list_context(obj).fallback_images.get(obj.pk)
+            if first_variant_image and first_variant_image.image:
+                url = first_variant_image.image.url
+                if request and not url.startswith(('http://', 'https://')):
+                    url = request.build_absolute_uri(url)
+                images.append({'url': url, 'is_primary': True})
         
         return images
 
     def get_attributes(self, obj):
         # Get allowed keys for this product's category
-        allowed_keys = set()
-        if obj.category:
-            allowed_keys = set(obj.category.category_attributes.values_list('key', flat=True))
+        allowed_keys = set(self._list_context(obj).category_keys.get(obj.category_id, set()))
         attributes = []
         
         # Collect from new system (attribute_values)
@@ -321,6 +374,17 @@ class WishlistSimpleSerializer(serializers.ModelSerializer):
         fields = ['id', 'product_id', 'product_name', 'product_price', 'created_at'] 
 
 
+class SpecialOfferProductListSerializer(serializers.ListSerializer):
+    """Bulk-loads the offer lines' products so each nested product costs no extra queries"""
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        offer_products = list(iterable)
+        models.prefetch_related_objects(offer_products, 'product')
+        self.child.product_list_context = ProductListContext([item.product for item in offer_products])
+        return super().to_representation(offer_products)
+
+
 class SpecialOfferProductSerializer(serializers.ModelSerializer):
     """Serializer for products in special offers"""
     product = serializers.SerializerMethodField()
@@ -332,10 +396,15 @@ class SpecialOfferProductSerializer(serializers.ModelSerializer):
             'id', 'product', 'discount_percentage', 'discount_amount', 
             'original_price', 'discounted_price', 'discount_display', 'display_order'
         ]
+        list_serializer_class = SpecialOfferProductListSerializer
     
     def get_product(self, instance):
         """Get product with special offer discount context"""
-        product_data = ProductSerializer(instance.product, context=self.context).data
+        context = dict(self.context)
+        list_context = getattr(self, 'product_list_context', None)
+        if list_context is not None:
+            context['product_list_context'] = list_context
+        product_data = ProductSerializer(instance.product, context=context).data
         
         # Override discount fields with this special offer's values
         original_price = instance.original_price if instance.original_price else instance.product.price_toman
@@ -1,10 +1,30 @@
 from typing import Iterable
 
-from django.db.models.signals import post_save, post_delete
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
-from .models import Category, CategoryAttribute, AttributeValue, SpecialOfferProduct, Product, SpecialOffer
+from .models import (
+    Category, CategoryAttribute, AttributeValue, SpecialOfferProduct, Product, SpecialOffer,
+    Attribute, NewAttributeValue, ProductAttribute, ProductAttributeValue, ProductAttributeIndex,
+    CategoryGender, ProductImage, ProductVariant, ProductVariantImage, Tag, Order, OrderItem, CartItem,
+)
+from .attribute_index import (
+    index_legacy_attribute, index_product_attribute_value, index_variant_attributes, normalize_attribute_value,
+)
+from .facets import invalidate_category_facets
+from .pricing import invalidate_offer_prices
+from .response_cache import bump_catalog_generation
+from .category_tree import (
+    detach_category_closure, invalidate_category_product_counts, sync_category_closure,
+)
+from .product_detail import drop_detail_documents, schedule_detail_rebuild
+from .search import BRAND_ATTRIBUTE_KEYS, PRODUCT_DOCUMENT_FIELDS, index_products, remove_products
+from .suggestions import suggestion_index
+from .variant_matrix import invalidate_variant_matrices
+from .inventory import release_cart_item
 
 
 def _iter_descendant_categories(category: Category) -> Iterable[Category]:
@@ -199,3 +219,425 @@ def update_products_on_offer_change(sender, instance: SpecialOffer, created, **k
         update_product_special_offer_status(product)
 
 
+# Saves touching only the analytics counters don't change what the catalog shows
+ANALYTICS_ONLY_FIELDS = frozenset({'views_count', 'clicks_count'})
+
+
+def _is_analytics_update(kwargs):
+    update_fields = kwargs.get('update_fields')
+    return bool(update_fields) and set(update_fields) <= ANALYTICS_ONLY_FIELDS
+
+
+def _product_category_id(product_id):
+    return Product.objects.filter(pk=product_id).values_list('category_id', flat=True).first()
+
+
+@receiver(post_save, sender=ProductAttribute)
+def index_legacy_attribute_on_save(sender, instance: ProductAttribute, **kwargs):
+    """Keep the attribute index row for a legacy attribute in sync"""
+    if kwargs.get("raw"):
+        return
+    invalidate_category_facets(index_legacy_attribute(instance))
+
+
+@receiver(post_save, sender=ProductAttributeValue)
+def index_product_attribute_value_on_save(sender, instance: ProductAttributeValue, **kwargs):
+    """Keep the attribute index row for a flexible attribute value in sync"""
+    if kwargs.get("raw"):
+        return
+    invalidate_category_facets(index_product_attribute_value(instance))
+
+
+@receiver(post_delete, sender=ProductAttribute)
+@receiver(post_delete, sender=ProductAttributeValue)
+def invalidate_facets_on_attribute_delete(sender, instance, **kwargs):
+    """Index rows cascade with their source row; only the facet cache needs dropping"""
+    invalidate_category_facets(_product_category_id(instance.product_id))
+
+
+@receiver(post_save, sender=Attribute)
+def reindex_attribute_key_change(sender, instance: Attribute, **kwargs):
+    """Propagate a renamed attribute key to its index rows"""
+    if kwargs.get("raw"):
+        return
+    stale = ProductAttributeIndex.objects.filter(
+        product_attribute_value__attribute=instance
+    ).exclude(attr_key=instance.key)
+    category_ids = set(stale.values_list('category_id', flat=True))
+    if category_ids:
+        stale.update(attr_key=instance.key)
+        invalidate_category_facets(*category_ids)
+
+
+@receiver(post_save, sender=NewAttributeValue)
+def reindex_predefined_value_change(sender, instance: NewAttributeValue, **kwargs):
+    """Propagate an edited predefined value to the index rows that reference it"""
+    if kwargs.get("raw"):
+        return
+    normalized = normalize_attribute_value(instance.value)
+    stale = ProductAttributeIndex.objects.filter(
+        product_attribute_value__attribute_value=instance
+    ).exclude(attr_value=normalized)
+    category_ids = set(stale.values_list('category_id', flat=True))
+    if category_ids:
+        stale.update(attr_value=normalized)
+        invalidate_category_facets(*category_ids)
+
+
+@receiver(post_save, sender=Product)
+def reindex_product_category_change(sender, instance: Product, created, **kwargs):
+    """Move a product's index rows along when its category changes and drop stale facets"""
+    if kwargs.get("raw"):
+        return
+    previous_category_id = instance.__dict__.pop('_previous_category_id', None)
+    if previous_category_id is not None:
+        ProductAttributeIndex.objects.filter(product=instance).exclude(
+            category_id=instance.category_id
+        ).update(category_id=instance.category_id)
+    invalidate_category_facets(instance.category_id, previous_category_id)
+
+
+@receiver(post_delete, sender=Product)
+def invalidate_facets_on_product_delete(sender, instance: Product, **kwargs):
+    """Drop the facet snapshot of a deleted product's category"""
+    invalidate_category_facets(instance.category_id)
+
+
+@receiver(post_save, sender=CategoryAttribute)
+@receiver(post_delete, sender=CategoryAttribute)
+def invalidate_facets_on_category_attribute_change(sender, instance: CategoryAttribute, **kwargs):
+    """Facet labels and ordering come from the category's attribute definitions"""
+    invalidate_category_facets(instance.category_id)
+
+
+@receiver(post_save, sender=AttributeValue)
+@receiver(post_delete, sender=AttributeValue)
+def invalidate_facets_on_attribute_value_change(sender, instance: AttributeValue, **kwargs):
+    """Facet value ordering comes from the category's predefined values"""
+    category_id = CategoryAttribute.objects.filter(pk=instance.attribute_id).values_list(
+        'category_id', flat=True
+    ).first()
+    invalidate_category_facets(category_id)
+
+
+@receiver(post_save, sender=SpecialOffer)
+@receiver(post_delete, sender=SpecialOffer)
+@receiver(post_save, sender=SpecialOfferProduct)
+@receiver(post_delete, sender=SpecialOfferProduct)
+def invalidate_offer_price_map(sender, instance, **kwargs):
+    """Rebuild the active offer price map after any offer change"""
+    if _is_analytics_update(kwargs):
+        return
+    # After commit: bumped earlier, another process could rebuild from the old rows
+    # under the new version and keep the old prices until the next change
+    transaction.on_commit(invalidate_offer_prices)
+
+
+@receiver(post_save, sender=Category)
+def sync_category_closure_on_save(sender, instance: Category, created, **kwargs):
+    """Keep the closure table in step with new categories and parent changes"""
+    # Fixtures may reference parents loaded later; run build_category_closure after loaddata
+    if kwargs.get("raw"):
+        return
+    sync_category_closure(instance, created=created)
+    invalidate_category_product_counts()
+
+
+@receiver(pre_delete, sender=Category)
+def detach_category_closure_on_delete(sender, instance: Category, **kwargs):
+    """Children of a deleted category become roots (parent is SET_NULL)"""
+    detach_category_closure(instance)
+
+
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_category_counts(sender, instance, **kwargs):
+    """Drop cached per-category product counts after category or product changes"""
+    if kwargs.get("raw") or _is_analytics_update(kwargs):
+        return
+    invalidate_category_product_counts()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=CategoryGender)
+@receiver(post_delete, sender=CategoryGender)
+@receiver(post_save, sender=SpecialOffer)
+@receiver(post_delete, sender=SpecialOffer)
+@receiver(post_save, sender=SpecialOfferProduct)
+@receiver(post_delete, sender=SpecialOfferProduct)
+def bump_catalog_generation_on_change(sender, instance, **kwargs):
+    """Retire cached catalog responses after any change they may include"""
+    if _is_analytics_update(kwargs):
+        return
+    # After commit, so no request caches the old rows under the new generation
+    transaction.on_commit(bump_catalog_generation)
+
+
+@receiver(post_save, sender=Product)
+def index_product_search_document(sender, instance: Product, **kwargs):
+    """Rebuild a product's search document when a searchable field may have changed"""
+    if kwargs.get("raw"):
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields and not set(update_fields) & PRODUCT_DOCUMENT_FIELDS:
+        return
+    index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_search_document(sender, instance: Product, **kwargs):
+    remove_products([instance.pk])
+
+
+def _is_cascade_delete(sender, kwargs):
+    """True when a post_delete comes from deleting another object (e.g. the product itself)"""
+    origin = kwargs.get('origin')
+    if origin is None:
+        return False
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return origin_model is not sender
+
+
+@receiver(post_save, sender=ProductAttributeValue)
+@receiver(post_delete, sender=ProductAttributeValue)
+def index_brand_attribute_value(sender, instance: ProductAttributeValue, **kwargs):
+    """Brand values are part of the search document"""
+    if kwargs.get("raw") or _is_cascade_delete(sender, kwargs):
+        return
+    if instance.attribute.key not in BRAND_ATTRIBUTE_KEYS:
+        return
+    index_products([instance.product_id])
+
+
+@receiver(post_save, sender=ProductAttribute)
+@receiver(post_delete, sender=ProductAttribute)
+def index_legacy_brand_attribute(sender, instance: ProductAttribute, **kwargs):
+    if kwargs.get("raw") or _is_cascade_delete(sender, kwargs):
+        return
+    if instance.key not in BRAND_ATTRIBUTE_KEYS:
+        return
+    index_products([instance.product_id])
+
+
+@receiver(post_save, sender=NewAttributeValue)
+def index_brand_value_change(sender, instance: NewAttributeValue, **kwargs):
+    """An edited predefined brand value changes every product that uses it"""
+    if kwargs.get("raw") or instance.attribute.key not in BRAND_ATTRIBUTE_KEYS:
+        return
+    index_products(ProductAttributeValue.objects.filter(
+        attribute_value=instance
+    ).values_list('product_id', flat=True))
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def index_product_tags_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Tags are part of the search and detail documents; either side of the relation may change"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        product_ids = [instance.pk]
+    elif pk_set:
+        product_ids = list(pk_set)
+    elif action == 'post_clear':
+        # pk_set is None after clear(); the tag's products are already unlinked
+        product_ids = instance.__dict__.pop('_search_cleared_product_ids', [])
+    else:
+        return
+    index_products(product_ids)
+    schedule_detail_rebuild(product_ids)
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def remember_tag_products_before_clear(sender, instance, action, reverse, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._search_cleared_product_ids = list(instance.products.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Tag)
+def index_renamed_tag(sender, instance: Tag, created, **kwargs):
+    if kwargs.get("raw") or created:
+        return
+    product_ids = list(instance.products.values_list('pk', flat=True))
+    index_products(product_ids)
+    schedule_detail_rebuild(product_ids)
+
+
+@receiver(post_save, sender=Category)
+def index_category_label_change(sender, instance: Category, created, **kwargs):
+    """Category name and label are part of the search document of its products"""
+    if kwargs.get("raw") or created:
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields and not set(update_fields) & {'name', 'label'}:
+        return
+    index_products(Product.objects.filter(category=instance).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Product)
+def rebuild_product_detail_document(sender, instance: Product, **kwargs):
+    """The product's own fields are part of its detail document"""
+    if kwargs.get("raw") or _is_analytics_update(kwargs):
+        return
+    schedule_detail_rebuild([instance.pk])
+
+
+@receiver(post_save, sender=ProductAttribute)
+@receiver(post_delete, sender=ProductAttribute)
+@receiver(post_save, sender=ProductAttributeValue)
+@receiver(post_delete, sender=ProductAttributeValue)
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def rebuild_detail_document_of_product(sender, instance, **kwargs):
+    """Attributes, variants and images are part of their product's detail document"""
+    if kwargs.get("raw") or _is_cascade_delete(sender, kwargs):
+        return
+    schedule_detail_rebuild([instance.product_id])
+
+
+@receiver(post_save, sender=ProductVariantImage)
+@receiver(post_delete, sender=ProductVariantImage)
+def rebuild_detail_document_of_variant(sender, instance: ProductVariantImage, **kwargs):
+    if kwargs.get("raw") or _is_cascade_delete(sender, kwargs):
+        return
+    schedule_detail_rebuild(
+        ProductVariant.objects.filter(pk=instance.variant_id).values_list('product_id', flat=True)
+    )
+
+
+@receiver(post_save, sender=NewAttributeValue)
+def rebuild_detail_documents_of_value(sender, instance: NewAttributeValue, created, **kwargs):
+    """An edited predefined value is shown on every product that uses it"""
+    if kwargs.get("raw") or created:
+        return
+    schedule_detail_rebuild(ProductAttributeValue.objects.filter(
+        attribute_value=instance
+    ).values_list('product_id', flat=True))
+
+
+@receiver(post_save, sender=Category)
+def drop_category_detail_documents(sender, instance: Category, created, **kwargs):
+    """Category name is in the detail documents of its products"""
+    if kwargs.get("raw") or created:
+        return
+    drop_detail_documents(Product.objects.filter(category=instance))
+
+
+@receiver(post_save, sender=CategoryAttribute)
+@receiver(post_delete, sender=CategoryAttribute)
+def drop_detail_documents_on_category_attribute_change(sender, instance: CategoryAttribute, **kwargs):
+    """Category attributes decide which attributes the detail documents show, and their labels"""
+    if kwargs.get("raw") or _is_cascade_delete(sender, kwargs):
+        return
+    drop_detail_documents(Product.objects.filter(category_id=instance.category_id))
+
+
+@receiver(post_save, sender=Attribute)
+def drop_detail_documents_on_attribute_change(sender, instance: Attribute, created, **kwargs):
+    if kwargs.get("raw") or created:
+        return
+    drop_detail_documents(Product.objects.filter(attribute_values__attribute=instance))
+
+
+@receiver(post_save, sender=ProductVariant)
+def index_variant_attributes_on_save(sender, instance: ProductVariant, **kwargs):
+    """Keep the VariantAttribute rows of a variant in sync (they cascade on delete)"""
+    if kwargs.get("raw"):
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields and 'attributes' not in update_fields:
+        return
+    index_variant_attributes(instance)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+def invalidate_product_variant_matrix(sender, instance, **kwargs):
+    """Variants, their attributes and prices, and the product's distinctive key make up the matrix"""
+    if kwargs.get("raw") or _is_analytics_update(kwargs):
+        return
+    product_id = instance.product_id if sender is ProductVariant else instance.pk
+    # After commit, so no request caches the old rows again once they are invalidated
+    transaction.on_commit(lambda: invalidate_variant_matrices([product_id]))
+
+
+@receiver(post_save, sender=ProductVariantImage)
+@receiver(post_delete, sender=ProductVariantImage)
+def invalidate_variant_matrix_on_image_change(sender, instance: ProductVariantImage, **kwargs):
+    if kwargs.get("raw") or _is_cascade_delete(sender, kwargs):
+        return
+    product_ids = list(ProductVariant.objects.filter(pk=instance.variant_id).values_list('product_id', flat=True))
+    transaction.on_commit(lambda: invalidate_variant_matrices(product_ids))
+
+
+@receiver(post_save, sender=CategoryAttribute)
+@receiver(post_delete, sender=CategoryAttribute)
+def invalidate_category_variant_matrices(sender, instance: CategoryAttribute, **kwargs):
+    """Axis order and labels come from the category's attributes"""
+    if kwargs.get("raw"):
+        return
+    category_id = instance.category_id
+    transaction.on_commit(lambda: invalidate_variant_matrices(
+        Product.objects.filter(category_id=category_id).values_list('pk', flat=True)
+    ))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def refresh_product_suggestions(sender, instance: Product, **kwargs):
+    """Product names and brand/tag/category counts feed the autocomplete index"""
+    if kwargs.get("raw") or _is_analytics_update(kwargs):
+        return
+    suggestion_index.products_changed([instance.pk])
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def refresh_product_popularity(sender, instance: OrderItem, **kwargs):
+    """Units sold weight product suggestions"""
+    if kwargs.get("raw"):
+        return
+    suggestion_index.products_changed([instance.product_id], facets=False)
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def refresh_order_totals(sender, instance: OrderItem, **kwargs):
+    """Keep Order.total_toman and Order.item_count equal to the sums over its items"""
+    if kwargs.get("raw"):
+        return
+    Order.objects.filter(pk=instance.order_id).refresh_totals()
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=ProductAttribute)
+@receiver(post_delete, sender=ProductAttribute)
+@receiver(post_save, sender=ProductAttributeValue)
+@receiver(post_delete, sender=ProductAttributeValue)
+@receiver(post_save, sender=NewAttributeValue)
+@receiver(m2m_changed, sender=Product.tags.through)
+def refresh_facet_suggestions(sender, instance, **kwargs):
+    """Brand, tag and category suggestions are reloaded on the next lookup"""
+    if kwargs.get("raw") or not kwargs.get('action', 'post_').startswith('post_'):
+        return
+    suggestion_index.facets_changed()
+
+
+@receiver(pre_delete, sender=CartItem)
+def release_cart_item_reservation(sender, instance: CartItem, **kwargs):
+    """Removed cart items give their reserved stock back (checkout claims reservations first)"""
+    release_cart_item(instance)
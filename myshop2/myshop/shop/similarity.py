@@ -0,0 +1,201 @@
+"""
+Offline similar-products index (the build_similarity_index command).
+
+Every product is a sparse vector of features: its tags, its attribute key:value pairs
+(legacy and new system, compared case-insensitively), its category and a price bucket
+within the category (powers of two of price_toman). Features are weighted by rarity
+(log(1 + N / document frequency)) and by kind - 'tags' similarity weights tags most,
+'attributes' similarity weights attribute values most - and products are compared by
+cosine similarity.
+
+Candidates for a product come from an inverted index: the products sharing a feature,
+at most MAX_CANDIDATES_PER_FEATURE of them per feature (the most recent), so common
+features such as a large category don't make the build quadratic. Candidates are then
+scored exactly and the top SIMILARITY_TOP_K active ones are stored in ProductSimilarity.
+
+A full build recomputes every product. An incremental build compares each product's
+feature signature with the one stored in ProductSimilarityState and recomputes the
+changed products, the products sharing a feature with them and the products that listed
+them, leaving everyone else's rows alone (their scores only drift as feature rarity
+changes, which the next full build corrects).
+"""
+import hashlib
+import math
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Product, ProductAttribute, ProductAttributeValue, ProductSimilarity, ProductSimilarityState
+
+KINDS = ('tags', 'attributes')
+# kind -> feature type -> weight
+KIND_WEIGHTS = {
+    'tags': {'tag': 1.0, 'attr': 0.3, 'cat': 0.5, 'price': 0.3},
+    'attributes': {'tag': 0.3, 'attr': 1.0, 'cat': 0.5, 'price': 0.3},
+}
+# Feature type counted as the overlap of each kind
+OVERLAP_FEATURE = {'tags': 'tag', 'attributes': 'attr'}
+
+TOP_K = getattr(settings, 'SIMILARITY_TOP_K', 12)
+MAX_CANDIDATES_PER_FEATURE = getattr(settings, 'SIMILARITY_MAX_CANDIDATES_PER_FEATURE', 500)
+
+
+def _price_bucket(price):
+    return int(math.log2(price)) if price and price > 0 else None
+
+
+def load_features():
+    """
+    {product_id: set of features} for every product, plus {product_id: is_active} and
+    the product IDs newest first. Five queries whatever the catalog size.
+    """
+    features = {}
+    is_active = {}
+    newest_first = []
+    for product_id, category_id, price, active in Product.objects.order_by('-created_at', '-pk').values_list(
+        'id', 'category_id', 'price_toman', 'is_active'
+    ):
+        product_features = set()
+        if category_id:
+            product_features.add(('cat', category_id))
+            bucket = _price_bucket(price)
+            if bucket is not None:
+                product_features.add(('price', category_id, bucket))
+        features[product_id] = product_features
+        is_active[product_id] = active
+        newest_first.append(product_id)
+
+    def add(product_id, feature):
+        if product_id in features:
+            features[product_id].add(feature)
+
+    for product_id, tag_id in Product.tags.through.objects.values_list('product_id', 'tag_id'):
+        add(product_id, ('tag', tag_id))
+    for product_id, key, value in ProductAttribute.objects.values_list('product_id', 'key', 'value'):
+        if value and value.strip():
+            add(product_id, ('attr', key, value.strip().lower()))
+    for pav in ProductAttributeValue.objects.select_related('attribute', 'attribute_value'):
+        value = pav.get_display_value()
+        if value and value.strip():
+            add(pav.product_id, ('attr', pav.attribute.key, value.strip().lower()))
+    return features, is_active, newest_first
+
+
+def signature(product_features, active):
+    """Hash of what a product's similarities depend on"""
+    digest = hashlib.sha256(repr((active, sorted(map(repr, product_features)))).encode())
+    return digest.hexdigest()
+
+
+class SimilarityIndex:
+    """Weighted vectors and an inverted index over the catalog, for computing neighbours."""
+
+    def __init__(self, features, is_active, newest_first, top_k=TOP_K):
+        self.features = features
+        self.is_active = is_active
+        self.top_k = top_k
+        document_frequency = Counter(feature for product_features in features.values() for feature in product_features)
+        total = len(features) or 1
+        self.vectors = {kind: {} for kind in KINDS}
+        self.norms = {kind: {} for kind in KINDS}
+        for product_id, product_features in features.items():
+            for kind in KINDS:
+                vector = {
+                    feature: KIND_WEIGHTS[kind][feature[0]] * math.log(1 + total / document_frequency[feature])
+                    for feature in product_features
+                }
+                self.vectors[kind][product_id] = vector
+                self.norms[kind][product_id] = math.sqrt(sum(weight * weight for weight in vector.values()))
+
+        # Only active products are neighbours; newest first, as they are cut off
+        self.postings = defaultdict(list)
+        for product_id in newest_first:
+            if is_active[product_id]:
+                for feature in features[product_id]:
+                    if len(self.postings[feature]) < MAX_CANDIDATES_PER_FEATURE:
+                        self.postings[feature].append(product_id)
+
+    def candidates(self, product_id):
+        found = set()
+        for feature in self.features[product_id]:
+            found.update(self.postings.get(feature, ()))
+        found.discard(product_id)
+        return found
+
+    def _score(self, kind, product_id, other_id):
+        vector, other = self.vectors[kind][product_id], self.vectors[kind][other_id]
+        if len(other) < len(vector):
+            vector, other = other, vector
+        dot = sum(weight * other[feature] for feature, weight in vector.items() if feature in other)
+        norms = self.norms[kind][product_id] * self.norms[kind][other_id]
+        return dot / norms if norms else 0.0
+
+    def neighbours(self, product_id):
+        """Unsaved ProductSimilarity rows of a product, best first per kind"""
+        candidates = self.candidates(product_id)
+        rows = []
+        for kind in KINDS:
+            overlap_type = OVERLAP_FEATURE[kind]
+            scored = sorted(
+                ((self._score(kind, product_id, other_id), other_id) for other_id in candidates),
+                key=lambda item: (-item[0], -item[1]),
+            )[:self.top_k]
+            for rank, (score, other_id) in enumerate(scored, start=1):
+                if score <= 0:
+                    break
+                shared = self.features[product_id] & self.features[other_id]
+                rows.append(ProductSimilarity(
+                    product_id=product_id, similar_id=other_id, kind=kind, rank=rank, score=score,
+                    overlap=sum(1 for feature in shared if feature[0] == overlap_type),
+                ))
+        return rows
+
+
+def _save(index, product_ids, batch_size):
+    total = 0
+    for start in range(0, len(product_ids), batch_size):
+        batch = product_ids[start:start + batch_size]
+        rows = [row for product_id in batch for row in index.neighbours(product_id)]
+        with transaction.atomic():
+            ProductSimilarity.objects.filter(product_id__in=batch).delete()
+            ProductSimilarity.objects.bulk_create(rows)
+            ProductSimilarityState.objects.filter(product_id__in=batch).delete()
+            ProductSimilarityState.objects.bulk_create([
+                ProductSimilarityState(
+                    product_id=product_id,
+                    signature=signature(index.features[product_id], index.is_active[product_id]),
+                )
+                for product_id in batch
+            ])
+        total += len(batch)
+    return total
+
+
+def build_similarity_index(changed_only=False, product_ids=None, top_k=TOP_K, batch_size=500):
+    """
+    Recompute similar products. By default every product; with ``changed_only``, the
+    products whose features changed since the last build and those they affect; with
+    ``product_ids``, those products (as if they changed) and those they affect.
+    Returns the number of products recomputed.
+    """
+    features, is_active, newest_first = load_features()
+    index = SimilarityIndex(features, is_active, newest_first, top_k=top_k)
+
+    if not changed_only and product_ids is None:
+        return _save(index, newest_first, batch_size)
+
+    changed = set(product_ids or ())
+    if changed_only:
+        stored = dict(ProductSimilarityState.objects.values_list('product_id', 'signature'))
+        changed |= {
+            product_id for product_id, product_features in features.items()
+            if stored.get(product_id) != signature(product_features, is_active[product_id])
+        }
+    changed &= features.keys()
+    affected = set(changed)
+    for product_id in changed:
+        affected |= index.candidates(product_id)
+    # Products that listed a changed product, even if they no longer share a feature
+    affected |= set(ProductSimilarity.objects.filter(similar_id__in=changed).values_list('product_id', flat=True))
+    return _save(index, sorted(affected), batch_size)
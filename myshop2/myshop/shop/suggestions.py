@@ -0,0 +1,389 @@
+"""
+Search-as-you-type suggestions.
+
+A per-process prefix index over product names, brands, tags and category labels,
+normalized with shop/persian.py. Every word start of a label is a key, so "کاسیو" finds
+"ساعت کاسیو". Each suggestion type keeps its keys in a sorted list (a prefix is one
+bisected range) plus score-ordered buckets for short prefixes that match many keys, so a
+lookup reads a handful of keys and never touches the database once the index is built.
+
+Entries are weighted: products by units sold, brands, tags and categories by their
+number of active products; matches at the start of a label count double.
+
+Signals mark changed products (and the brand/tag/category counts) dirty and the index
+applies those changes on the next lookup. Each change is also published in the catalog
+cache: a shared version counter plus a change-log entry per version listing the changed
+products. Other processes check the version (at most every
+SUGGESTIONS_VERSION_CHECK_SECONDS) and apply the logged changes since the version they
+are at; they only rebuild everything if entries are missing (evicted, or older than
+CHANGE_LOG_TIMEOUT) or too many versions behind.
+"""
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+
+from .persian import normalize_search_text
+
+VERSION_CACHE_KEY = 'suggestions:version'
+CHANGE_KEY_PREFIX = 'suggestions:change:'
+VERSION_CHECK_SECONDS = getattr(settings, 'SUGGESTIONS_VERSION_CHECK_SECONDS', 5)
+CHANGE_LOG_TIMEOUT = 60 * 60
+# Further behind than this many versions, a process rebuilds instead of replaying changes
+MAX_REPLAYED_CHANGES = 1000
+
+SUGGESTION_TYPES = ('product', 'brand', 'tag', 'category')
+# Prefix lengths with score-ordered buckets
+BUCKET_LENGTH = 3
+# Prefixes matching at most this many keys are scored directly instead of via a bucket
+SCAN_LIMIT = 200
+MAX_CHAR = '\U0010ffff'
+# Bound on memoized lookups; the memo is dropped whenever the index changes
+MEMO_SIZE = 5000
+
+
+@dataclass(frozen=True)
+class Suggestion:
+    type: str
+    id: object  # product/tag/category ID, normalized value for brands
+    label: str
+    weight: int
+    slug: Optional[str] = None
+
+    def to_dict(self):
+        data = {'type': self.type, 'id': self.id, 'label': self.label}
+        if self.type == 'product':
+            data['popularity'] = self.weight
+        else:
+            data['product_count'] = self.weight
+        if self.slug is not None:
+            data['slug'] = self.slug
+        return data
+
+
+def _cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def _change_key(version):
+    return f'{CHANGE_KEY_PREFIX}{version}'
+
+
+def _keys(suggestion):
+    """(key, word position) for every word start of the suggestion's label"""
+    words = normalize_search_text(suggestion.label).split(' ')
+    return [(' '.join(words[i:]), i) for i in range(len(words)) if words[i]]
+
+
+def _score(suggestion, position):
+    return suggestion.weight * (2 if position == 0 else 1)
+
+
+class _PrefixTable:
+    """
+    Prefix keys of one suggestion type.
+
+    ``keys`` is sorted by key, so the keys matching a prefix form one bisectable range.
+    ``buckets`` maps every key's first 1..BUCKET_LENGTH characters to its keys ordered by
+    score, so a prefix matching many keys is answered by reading the best few instead of
+    scoring the whole range.
+    """
+
+    def __init__(self, suggestions=()):
+        self.entries = {}
+        self.keys = []
+        self.buckets = defaultdict(list)
+        self._owned = None
+        for suggestion in suggestions:
+            self.entries[suggestion.id] = suggestion
+            for key, position in _keys(suggestion):
+                self.keys.append((key, position, suggestion.id))
+                for prefix in self._prefixes(key):
+                    self.buckets[prefix].append((-_score(suggestion, position), suggestion.id, key))
+        self.keys.sort()
+        for bucket in self.buckets.values():
+            bucket.sort()
+        self.buckets = dict(self.buckets)
+
+    @staticmethod
+    def _prefixes(key):
+        return {key[:n] for n in range(1, BUCKET_LENGTH + 1)}
+
+    def copy(self):
+        """Shallow copy whose buckets are copied on first write, for swap-in updates"""
+        table = _PrefixTable()
+        table.entries = dict(self.entries)
+        table.keys = list(self.keys)
+        table.buckets = dict(self.buckets)
+        table._owned = set()
+        return table
+
+    def _writable_bucket(self, prefix):
+        if prefix not in self._owned:
+            self.buckets[prefix] = list(self.buckets.get(prefix, ()))
+            self._owned.add(prefix)
+        return self.buckets[prefix]
+
+    @staticmethod
+    def _remove_sorted(items, item):
+        i = bisect_left(items, item)
+        if i < len(items) and items[i] == item:
+            del items[i]
+
+    def add(self, suggestion):
+        self.entries[suggestion.id] = suggestion
+        for key, position in _keys(suggestion):
+            insort(self.keys, (key, position, suggestion.id))
+            for prefix in self._prefixes(key):
+                insort(self._writable_bucket(prefix), (-_score(suggestion, position), suggestion.id, key))
+
+    def remove(self, entry_id):
+        suggestion = self.entries.pop(entry_id, None)
+        if suggestion is None:
+            return
+        for key, position in _keys(suggestion):
+            self._remove_sorted(self.keys, (key, position, entry_id))
+            for prefix in self._prefixes(key):
+                self._remove_sorted(self._writable_bucket(prefix), (-_score(suggestion, position), entry_id, key))
+
+    def top(self, prefix, limit):
+        """Best ``limit`` (score, suggestion) pairs with a key starting with ``prefix``"""
+        lo = bisect_left(self.keys, (prefix,))
+        hi = bisect_left(self.keys, (prefix + MAX_CHAR,), lo)
+        best = {}
+        if hi - lo <= SCAN_LIMIT:
+            for key, position, entry_id in self.keys[lo:hi]:
+                score = _score(self.entries[entry_id], position)
+                if score > best.get(entry_id, 0):
+                    best[entry_id] = score
+            ranked = sorted(best.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        else:
+            # Many matches: walk the bucket best-first until ``limit`` distinct entries match
+            for neg_score, entry_id, key in self.buckets.get(prefix[:BUCKET_LENGTH], ()):
+                if entry_id not in best and key.startswith(prefix):
+                    best[entry_id] = -neg_score
+                    if len(best) == limit:
+                        break
+            ranked = list(best.items())
+        return [(score, self.entries[entry_id]) for entry_id, score in ranked]
+
+
+class SuggestionIndex:
+    """Prefix tables per suggestion type with lazy incremental updates"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {kind: _PrefixTable() for kind in SUGGESTION_TYPES}
+        self._memo = {}
+        self._built = False
+        self._dirty_products = set()
+        self._facets_dirty = False
+        self._version = None
+        self._version_checked_at = None
+
+    def suggest(self, query, limit=10, types=SUGGESTION_TYPES):
+        """Return up to ``limit`` suggestions whose label has a word starting with ``query``."""
+        prefix = normalize_search_text(query)
+        if not prefix:
+            return []
+        self._ensure_current()
+        memo_key = (prefix, limit, tuple(types))
+        memo = self._memo
+        results = memo.get(memo_key)
+        if results is None:
+            results = self._lookup(prefix, limit, types)
+            if len(memo) >= MEMO_SIZE:
+                memo.clear()
+            memo[memo_key] = results
+        return results
+
+    def _lookup(self, prefix, limit, types):
+        ranked = []
+        for kind in types:
+            ranked.extend(self._tables[kind].top(prefix, limit))
+        ranked.sort(key=lambda item: (-item[0], item[1].label))
+        return [suggestion for _, suggestion in ranked[:limit]]
+
+    # Change tracking
+
+    def products_changed(self, product_ids, facets=True):
+        """Reload these products (and brand/tag/category counts) on the next lookup"""
+        product_ids = set(product_ids)
+        with self._lock:
+            self._dirty_products.update(product_ids)
+            self._facets_dirty = self._facets_dirty or facets
+        self._publish(products=product_ids, facets=facets)
+
+    def facets_changed(self):
+        """Reload brand, tag and category suggestions on the next lookup"""
+        with self._lock:
+            self._facets_dirty = True
+        self._publish(facets=True)
+
+    def invalidate(self):
+        """Rebuild the whole index on the next lookup, in every process"""
+        with self._lock:
+            self._built = False
+        self._publish(rebuild=True)
+
+    def _publish(self, products=(), facets=False, rebuild=False):
+        """Log a change under a new version for the other processes"""
+        cache = _cache()
+        try:
+            version = cache.incr(VERSION_CACHE_KEY)
+        except ValueError:
+            # Start from the clock so a lost counter never reuses an older version
+            cache.add(VERSION_CACHE_KEY, int(time.time() * 1000), None)
+            version = cache.incr(VERSION_CACHE_KEY)
+        cache.set(_change_key(version), {
+            'products': sorted(products), 'facets': facets, 'rebuild': rebuild,
+        }, CHANGE_LOG_TIMEOUT)
+        with self._lock:
+            # This process applied its own change already; if other processes published
+            # in between, stay behind so their changes are replayed
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+
+    def _catch_up(self, version):
+        """Apply the changes published by other processes up to ``version``"""
+        with self._lock:
+            if (version is None or self._version is None or not self._built
+                    or not 0 < version - self._version <= MAX_REPLAYED_CHANGES):
+                self._built = False
+            else:
+                keys = [_change_key(v) for v in range(self._version + 1, version + 1)]
+                changes = _cache().get_many(keys)
+                if len(changes) < len(keys):
+                    # Expired or evicted: the changes can't be known any more
+                    self._built = False
+                else:
+                    for change in changes.values():
+                        if change['rebuild']:
+                            self._built = False
+                        self._dirty_products.update(change['products'])
+                        self._facets_dirty = self._facets_dirty or change['facets']
+            self._version = version
+
+    def _ensure_current(self):
+        now = time.monotonic()
+        if self._version_checked_at is None or now - self._version_checked_at >= VERSION_CHECK_SECONDS:
+            version = _cache().get(VERSION_CACHE_KEY)
+            self._version_checked_at = now
+            if version != self._version:
+                self._catch_up(version)
+
+        if self._built and not self._dirty_products and not self._facets_dirty:
+            return
+
+        with self._lock:
+            if not self._built:
+                self._rebuild()
+            else:
+                if self._dirty_products:
+                    self._load_products(self._dirty_products)
+                if self._facets_dirty:
+                    self._load_facets()
+            self._dirty_products = set()
+            self._facets_dirty = False
+            self._memo = {}
+
+    # Loading
+
+    def _rebuild(self):
+        self._load_products(None)
+        self._load_facets()
+        self._built = True
+
+    def _load_products(self, product_ids):
+        """Replace product entries for the given IDs (all products when None)"""
+        from .models import Product
+
+        products = Product.objects.filter(is_active=True)
+        if product_ids is not None:
+            products = products.filter(pk__in=product_ids)
+        loaded = [
+            Suggestion('product', product_id, name, 1 + units_sold)
+            for product_id, name, units_sold in products.annotate(
+                units_sold=Coalesce(Sum('order_items__quantity'), 0)
+            ).values_list('id', 'name', 'units_sold')
+        ]
+
+        if product_ids is None:
+            table = _PrefixTable(loaded)
+        else:
+            # Update a copy, then swap it in, so concurrent lookups see a consistent table
+            table = self._tables['product'].copy()
+            for product_id in product_ids:
+                table.remove(product_id)
+            for suggestion in loaded:
+                table.add(suggestion)
+        self._tables['product'] = table
+
+    def _load_facets(self):
+        self._tables['brand'] = _PrefixTable(self._brand_suggestions())
+        self._tables['tag'] = _PrefixTable(self._tag_suggestions())
+        self._tables['category'] = _PrefixTable(self._category_suggestions())
+
+    @staticmethod
+    def _brand_suggestions():
+        from .attribute_index import normalize_attribute_value
+        from .models import ProductAttribute, ProductAttributeValue
+        from .search import BRAND_ATTRIBUTE_KEYS
+
+        rows = list(ProductAttributeValue.objects.filter(
+            attribute__key__in=BRAND_ATTRIBUTE_KEYS, product__is_active=True
+        ).values_list('product_id', 'attribute_value__value', 'custom_value'))
+        rows = [(product_id, value or custom) for product_id, value, custom in rows]
+        rows += list(ProductAttribute.objects.filter(
+            key__in=BRAND_ATTRIBUTE_KEYS, product__is_active=True
+        ).values_list('product_id', 'value'))
+
+        products = defaultdict(set)
+        labels = defaultdict(Counter)
+        for product_id, value in rows:
+            normalized = normalize_attribute_value(value)
+            if normalized:
+                products[normalized].add(product_id)
+                labels[normalized][' '.join(value.split())] += 1
+        return [
+            Suggestion('brand', normalized, labels[normalized].most_common(1)[0][0], len(product_ids))
+            for normalized, product_ids in products.items()
+        ]
+
+    @staticmethod
+    def _tag_suggestions():
+        from .models import Tag
+
+        return [
+            Suggestion('tag', tag_id, name, product_count, slug=slug)
+            for tag_id, name, slug, product_count in Tag.objects.annotate(
+                product_count=Count('products', filter=Q(products__is_active=True))
+            ).filter(product_count__gt=0).values_list('id', 'name', 'slug', 'product_count')
+        ]
+
+    @staticmethod
+    def _category_suggestions():
+        from .category_tree import CategoryTree
+
+        tree = CategoryTree()
+        suggestions = []
+        for category in tree.categories:
+            count = tree.product_count(category)
+            if category.is_visible and count:
+                suggestions.append(Suggestion('category', category.id, category.get_display_name(), count))
+        return suggestions
+
+
+suggestion_index = SuggestionIndex()
+
+
+def get_suggestions(query, limit=10, types=SUGGESTION_TYPES):
+    """Return mixed, weighted suggestions for a search-box prefix"""
+    return suggestion_index.suggest(query, limit=limit, types=types)
@@ -1,6 +1,55 @@
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.core.management import call_command
-from shop.models import Category, CategoryAttribute, AttributeValue
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.test import RequestFactory
+from shop.models import (
+    Category, CategoryAttribute, AttributeValue, Product, ProductAttribute,
+    Attribute, NewAttributeValue, ProductAttributeValue, ProductAttributeIndex,
+    ProductImage, ProductVariant, ProductVariantImage, SpecialOffer, SpecialOfferProduct,
+    Cart, CartItem, CategoryGender, CategoryClosure, SpecialOfferHourlyStats, Tag,
+    Order, OrderItem, StockReservation, IdempotencyRecord, ProductDetailDocument, Wishlist,
+    ProductSimilarity, VariantAttribute, ProductSearchDocument,
+)
+from shop.api_views import (
+    CategoryProductFilterView, api_category_facets, api_gender_category_tree, api_genders_list,
+)
+from shop.response_cache import get_catalog_generation
+from shop.offer_analytics import flush_offer_analytics
+from shop.cursor_pagination import InvalidCursor, paginate_by_cursor
+from shop.category_tree import descendant_ids
+from shop.search import get_search_backend, rebuild_search_index, search_products
+from shop.cart_snapshot import CartSnapshot
+from shop import idempotency
+from shop.middleware import GlobalRateLimitMiddleware
+from shop.rate_limiting import CacheRateLimitBackend, RateLimiter
+from shop.inventory import OutOfStock, commit_checkout, release_expired_reservations, reserve_cart_item
+from shop.suggestions import SuggestionIndex, suggestion_index
+from shop.views import api_search_suggest, api_simple_search
+from shop.serializers import ProductSerializer
+from shop.pricing import (
+    LOCAL_REFRESH_SECONDS, VERSION_CACHE_KEY, OfferPriceResolver, get_active_offer, get_offer_price,
+    invalidate_offer_prices, seconds_until_next_offer_change,
+)
+from shop.product_detail import rebuild_all_detail_documents
+from shop.similarity import build_similarity_index
+from accounts.models import Customer
+from shop.image_pipeline import file_sha256, process_pending_images
+from PIL import Image
 
 # Create your tests here.
 
@@ -137,3 +186,1272 @@ class CategoryAttributeInheritanceTest(TestCase):
             2, 
             "Two attributes should be inherited for the specific category"
         )
+
+
+class ProductAttributeIndexTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches['catalog'].clear()
+        self.category = Category.objects.create(name='کفش')
+        self.brand = Attribute.objects.create(name='Brand', key='brand')
+        self.nike = NewAttributeValue.objects.create(attribute=self.brand, value='Nike')
+
+        self.red_nike = Product.objects.create(name='Red Nike', category=self.category, price_toman=100)
+        ProductAttribute.objects.create(product=self.red_nike, key='color', value=' Red ')
+        ProductAttributeValue.objects.create(product=self.red_nike, attribute=self.brand, attribute_value=self.nike)
+
+        self.blue_nike = Product.objects.create(name='Blue Nike', category=self.category, price_toman=200)
+        ProductAttribute.objects.create(product=self.blue_nike, key='color', value='Blue')
+        ProductAttributeValue.objects.create(product=self.blue_nike, attribute=self.brand, custom_value='NIKE')
+
+        self.red_other = Product.objects.create(name='Red Other', category=self.category, price_toman=300)
+        ProductAttribute.objects.create(product=self.red_other, key='color', value='red')
+
+    def _filter(self, query):
+        request = RequestFactory().get(f'/api/categories/{self.category.id}/filter/', query)
+        response = CategoryProductFilterView.as_view()(request, category_id=self.category.id)
+        return {p['name'] for p in response.data['products']}
+
+    def test_signals_keep_index_in_sync(self):
+        self.assertEqual(ProductAttributeIndex.objects.count(), 5)
+        self.assertTrue(ProductAttributeIndex.objects.filter(
+            product=self.red_nike, attr_key='color', attr_value='red'
+        ).exists())
+
+        legacy = self.red_other.legacy_attribute_set.get(key='color')
+        legacy.value = 'Green'
+        legacy.save()
+        self.assertEqual(
+            list(ProductAttributeIndex.objects.filter(legacy_attribute=legacy).values_list('attr_value', flat=True)),
+            ['green'],
+        )
+
+        legacy.delete()
+        self.assertFalse(ProductAttributeIndex.objects.filter(product=self.red_other).exists())
+
+    def test_filters_match_across_sources_case_insensitively(self):
+        self.assertEqual(self._filter({'color': 'RED'}), {'Red Nike', 'Red Other'})
+        self.assertEqual(self._filter({'color': 'red', 'brand': 'nike'}), {'Red Nike'})
+        self.assertEqual(self._filter({'color': ['red', 'blue'], 'brand': 'Nike'}), {'Red Nike', 'Blue Nike'})
+
+    def test_build_attribute_index_command(self):
+        ProductAttributeIndex.objects.all().delete()
+        call_command('build_attribute_index', '--if-empty', stdout=StringIO())
+        self.assertEqual(ProductAttributeIndex.objects.count(), 5)
+        self.assertEqual(self._filter({'brand': 'nike'}), {'Red Nike', 'Blue Nike'})
+
+        # Deploys only build it once
+        with patch('shop.management.commands.build_attribute_index.rebuild_attribute_index') as rebuild:
+            call_command('build_attribute_index', '--if-empty', stdout=StringIO())
+        rebuild.assert_not_called()
+
+    def _facets(self, query=None):
+        request = RequestFactory().get(f'/api/category/{self.category.id}/facets/', query or {})
+        response = api_category_facets(request, category_id=self.category.id)
+        return response.data
+
+    def test_facet_counts_ignore_own_selection(self):
+        data = self._facets({'brand': 'nike'})
+        self.assertEqual(data['total_products'], 2)
+        self.assertEqual(data['price_range'], {'min': 100.0, 'max': 200.0})
+
+        facets = {f['key']: {v['value']: v['count'] for v in f['values']} for f in data['facets']}
+        self.assertEqual(facets['brand'], {'Nike': 2})
+        self.assertEqual(facets['color'], {'Red': 1, 'Blue': 1})
+
+    def test_facets_invalidated_by_attribute_changes(self):
+        self.assertEqual(self._facets()['total_products'], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductAttribute.objects.create(product=self.red_other, key='size', value='42')
+            # Dropped only once the change commits, so no reader re-caches the old rows
+            self.assertNotIn('size', {f['key'] for f in self._facets()['facets']})
+        facets = {f['key'] for f in self._facets()['facets']}
+        self.assertIn('size', facets)
+
+
+class ProductSerializerQueryCountTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='ساعت')
+        CategoryAttribute.objects.create(category=self.category, key='brand', label_fa='برند')
+        self.brand = Attribute.objects.create(name='Brand', key='brand')
+        self.offer = SpecialOffer.objects.create(
+            title='Flash', offer_type='flash_sale', display_style='grid',
+            valid_from=timezone.now() - timezone.timedelta(days=1),
+        )
+
+    def _create_products(self, count):
+        for i in range(count):
+            product = Product.objects.create(name=f'Watch {i}', category=self.category, price_toman=1000)
+            ProductAttribute.objects.create(product=product, key='color', value='black')
+            ProductAttributeValue.objects.create(product=product, attribute=self.brand, custom_value='Casio')
+            SpecialOfferProduct.objects.create(offer=self.offer, product=product, discount_percentage=10)
+            variant = ProductVariant.objects.create(product=product, sku=f'W{i}', price_toman=1000, is_default=True)
+            if i % 2:
+                ProductImage.objects.bulk_create([ProductImage(product=product, image=f'product_images/{i}.webp')])
+            else:
+                ProductVariantImage.objects.bulk_create([
+                    ProductVariantImage(variant=variant, image=f'variant_images/{i}.webp')
+                ])
+
+    def _count_queries(self):
+        products = Product.objects.filter(category=self.category).order_by('id')
+        with CaptureQueriesContext(connection) as ctx:
+            data = ProductSerializer(products, many=True).data
+        return len(ctx.captured_queries), data
+
+    def test_query_count_independent_of_page_size(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self._create_products(3)
+        small_count, small_data = self._count_queries()
+        with self.captureOnCommitCallbacks(execute=True):
+            self._create_products(12)
+        large_count, large_data = self._count_queries()
+
+        self.assertEqual(len(large_data), 15)
+        self.assertEqual(small_count, large_count)
+
+        first = large_data[0]
+        self.assertEqual(first['discounted_price'], 900.0)
+        self.assertTrue(first['has_discount'])
+        self.assertEqual(first['variants_count'], 1)
+        self.assertEqual(first['attributes'], [{'key': 'brand', 'value': 'Casio'}])
+        self.assertEqual(first['images'], [{'url': '/media/variant_images/0.webp', 'is_primary': True}])
+        self.assertEqual(large_data[1]['images'], [{'url': '/media/product_images/1.webp', 'is_primary': False}])
+
+
+class OfferPriceResolverTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_offer_prices()
+        self.category = Category.objects.create(name='ساعت')
+        self.product = Product.objects.create(name='Watch', category=self.category, price_toman=1000)
+        self.now = timezone.now()
+
+    def _add_offer(self, discount, **window):
+        offer = SpecialOffer.objects.create(
+            title='Flash', offer_type='flash_sale', display_style='grid',
+            valid_from=window.get('valid_from', self.now - timezone.timedelta(days=1)),
+            valid_until=window.get('valid_until'),
+        )
+        return SpecialOfferProduct.objects.create(offer=offer, product=self.product, discount_percentage=discount)
+
+    def test_offer_changes_invalidate_prices(self):
+        self.assertIsNone(get_offer_price(self.product))
+        with self.captureOnCommitCallbacks(execute=True):
+            line = self._add_offer(20)
+        self.assertEqual(get_offer_price(self.product), 800)
+        line.is_active = False
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            line.save()
+        # Other processes only hear about the change once it is committed
+        self.assertTrue(callbacks)
+        self.assertIsNone(get_active_offer(self.product.pk))
+
+    def test_other_processes_follow_offer_changes(self):
+        other = OfferPriceResolver()
+        self.assertIsNone(other.get(self.product.pk))
+        with patch('shop.pricing.is_shared_cache', return_value=True):
+            shared = OfferPriceResolver()
+            self.assertIsNone(shared.get(self.product.pk))
+            with self.captureOnCommitCallbacks(execute=True):
+                self._add_offer(20)
+            # The version bump is in the catalog cache, where every process sees it
+            self.assertTrue(caches['catalog'].get(VERSION_CACHE_KEY))
+            shared._version_checked_at = None
+            self.assertIsNotNone(shared.get(self.product.pk))
+
+        # A per-process cache can't carry the bump: the map is rebuilt after a short time
+        self.assertIsNone(other.get(self.product.pk))
+        later = timezone.now() + timezone.timedelta(seconds=LOCAL_REFRESH_SECONDS)
+        with patch('shop.pricing.timezone.now', return_value=later):
+            self.assertIsNotNone(other.get(self.product.pk))
+
+    def test_offer_window_transitions_without_invalidation(self):
+        self._add_offer(10, valid_until=self.now + timezone.timedelta(hours=1))
+        self._add_offer(30, valid_from=self.now + timezone.timedelta(hours=2))
+        self.assertEqual(get_offer_price(self.product), 900)
+
+        with patch('shop.pricing.timezone.now', return_value=self.now + timezone.timedelta(hours=1, minutes=30)):
+            self.assertIsNone(get_active_offer(self.product.pk))
+        with patch('shop.pricing.timezone.now', return_value=self.now + timezone.timedelta(hours=3)):
+            self.assertEqual(get_offer_price(self.product), 700)
+
+    def test_cart_unit_price_uses_active_offer(self):
+        self._add_offer(25)
+        cart = Cart.objects.create(session_key='device-1')
+        item = CartItem.objects.create(cart=cart, product=self.product, quantity=2, unit_price=1000)
+        self.assertEqual(item.get_unit_price_toman(), 750.0)
+        self.assertEqual(cart.get_total_price(), 1500.0)
+
+
+class CategoryClosureTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches['catalog'].clear()
+        self.men = CategoryGender.objects.create(name='men', display_name='مردانه')
+        self.root = Category.objects.create(name='پوشاک')
+        self.shirts = Category.objects.create(name='پیراهن', parent=self.root)
+        self.men_shirts = Category.objects.create(name='پیراهن مردانه', parent=self.shirts, gender=self.men)
+        self.shoes = Category.objects.create(name='کفش', parent=self.root, gender=self.men)
+        Product.objects.create(name='Shirt', category=self.men_shirts, price_toman=1000)
+        Product.objects.create(name='Shoe', category=self.shoes, price_toman=1000)
+        Product.objects.create(name='Old shoe', category=self.shoes, price_toman=1000, is_active=False)
+
+    def test_descendants_follow_moves_and_deletes(self):
+        self.assertCountEqual(descendant_ids(self.root.id),
+                              [self.root.id, self.shirts.id, self.men_shirts.id, self.shoes.id])
+
+        self.shoes.parent = self.shirts
+        self.shoes.save()
+        self.assertCountEqual(descendant_ids(self.shirts.id, include_self=False), [self.men_shirts.id, self.shoes.id])
+        self.assertEqual(
+            CategoryClosure.objects.get(ancestor=self.root, descendant=self.shoes).depth, 2
+        )
+
+        self.shirts.delete()
+        self.assertEqual(descendant_ids(self.root.id), [self.root.id])
+        self.assertCountEqual(
+            CategoryClosure.objects.filter(descendant=self.men_shirts).values_list('ancestor_id', flat=True),
+            [self.men_shirts.id]
+        )
+
+    def test_rebuild_matches_signal_maintained_rows(self):
+        expected = set(CategoryClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+        call_command('build_category_closure', stdout=StringIO())
+        self.assertEqual(set(CategoryClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')), expected)
+
+    def test_product_counts_are_recursive_for_containers(self):
+        self.assertEqual(self.root.get_product_count(), 2)
+        self.assertEqual(self.shoes.get_product_count(), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name='Boot', category=self.shoes, price_toman=1000)
+        self.assertEqual(self.root.get_product_count(), 3)
+
+    def test_gender_tree_built_from_single_fetch(self):
+        request = RequestFactory().get('/api/gender-category-tree/')
+        api_gender_category_tree(request)
+        Category.objects.create(name='جوراب مردانه', parent=self.shoes, gender=self.men)
+        with CaptureQueriesContext(connection) as ctx:
+            response = api_gender_category_tree(request)
+        # genders, categories and the (rebuilt) product counts
+        self.assertLessEqual(len(ctx.captured_queries), 4)
+
+        categories = response.data['gender_category_tree'][0]['categories']
+        shoes = next(c for c in categories if c['id'] == self.shoes.id)
+        self.assertEqual(shoes['product_count'], 1)
+        self.assertEqual([c['name'] for c in shoes['subcategories']], ['جوراب مردانه'])
+
+
+class CatalogResponseCacheTest(TestCase):
+    def setUp(self):
+        caches['catalog'].clear()
+        self.factory = RequestFactory()
+        CategoryGender.objects.create(name='men', display_name='مردانه')
+
+    def test_hit_skips_view_and_honours_etag(self):
+        first = api_genders_list(self.factory.get('/api/genders/', {'b': '2', 'a': '1'}))
+        self.assertEqual(first['X-Cache'], 'MISS')
+
+        with CaptureQueriesContext(connection) as ctx:
+            second = api_genders_list(self.factory.get('/api/genders/', {'a': '1', 'b': '2'}))
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.content, first.content)
+
+        not_modified = api_genders_list(self.factory.get('/api/genders/', HTTP_IF_NONE_MATCH=first['ETag']))
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_catalog_changes_retire_cached_responses(self):
+        api_genders_list(self.factory.get('/api/genders/'))
+        with self.captureOnCommitCallbacks(execute=True):
+            CategoryGender.objects.create(name='women', display_name='زنانه')
+        response = api_genders_list(self.factory.get('/api/genders/'))
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertIn('زنانه', response.content.decode())
+
+    def test_offer_view_counters_do_not_bump_generation(self):
+        offer = SpecialOffer.objects.create(
+            title='Flash', offer_type='flash_sale', display_style='grid',
+            valid_from=timezone.now() - timezone.timedelta(days=1),
+        )
+        generation = get_catalog_generation()
+        offer.increment_views()
+        self.assertEqual(get_catalog_generation(), generation)
+
+    def test_cached_responses_expire_when_an_offer_starts_or_ends(self):
+        now = timezone.now()
+        SpecialOffer.objects.create(
+            title='Later', offer_type='flash_sale', display_style='grid',
+            valid_from=now + timedelta(minutes=2),
+        )
+        SpecialOffer.objects.create(
+            title='Ending', offer_type='flash_sale', display_style='grid',
+            valid_from=now - timedelta(days=1), valid_until=now + timedelta(seconds=90),
+        )
+        self.assertEqual(seconds_until_next_offer_change(now), 91)
+
+        catalog_cache = caches['catalog']
+        with patch.object(catalog_cache, 'set', wraps=catalog_cache.set) as cache_set:
+            response = self.client.get('/shop/api/special-offers/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertLessEqual(cache_set.call_args.args[2], 91)
+
+        SpecialOffer.objects.all().delete()
+        self.assertIsNone(seconds_until_next_offer_change(now))
+
+
+class OfferAnalyticsBufferTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.offer = SpecialOffer.objects.create(
+            title='Flash', offer_type='flash_sale', display_style='grid',
+            valid_from=timezone.now() - timezone.timedelta(days=1),
+        )
+
+    @patch('shop.offer_analytics._ensure_flush_thread')
+    @patch('shop.offer_analytics.buffering_enabled', return_value=True)
+    def test_counts_are_buffered_then_flushed_in_bulk(self, *mocks):
+        with CaptureQueriesContext(connection) as ctx:
+            for _ in range(3):
+                self.offer.increment_views()
+            self.offer.increment_clicks()
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+        totals = flush_offer_analytics()
+        self.assertEqual(totals, {'views': 3, 'clicks': 1})
+        self.offer.refresh_from_db()
+        self.assertEqual((self.offer.views_count, self.offer.clicks_count), (3, 1))
+
+        stats = SpecialOfferHourlyStats.objects.get(offer=self.offer)
+        self.assertEqual((stats.views, stats.clicks), (3, 1))
+        self.assertEqual(stats.click_through_rate, 33.33)
+
+        # Later increments in the same hour add to the same bucket
+        self.offer.increment_views()
+        call_command('flush_offer_analytics', stdout=StringIO())
+        stats.refresh_from_db()
+        self.assertEqual(stats.views, 4)
+        self.assertEqual(flush_offer_analytics(), {'views': 0, 'clicks': 0})
+
+    def test_counts_are_written_directly_without_a_shared_cache(self):
+        # The test settings use locmem, which another process could never flush
+        for _ in range(2):
+            self.offer.increment_views()
+        self.offer.increment_clicks()
+        self.offer.refresh_from_db()
+        self.assertEqual((self.offer.views_count, self.offer.clicks_count), (2, 1))
+        stats = SpecialOfferHourlyStats.objects.get(offer=self.offer)
+        self.assertEqual((stats.views, stats.clicks), (2, 1))
+        self.assertEqual(flush_offer_analytics(), {'views': 0, 'clicks': 0})
+
+
+class CursorPaginationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='ساعت')
+        self.products = [
+            Product.objects.create(name=f'Watch {i}', category=self.category, price_toman=price)
+            for i, price in enumerate([300, 100, 200, 200, 100, 300, 200])
+        ]
+
+    def _walk(self, sort_field, descending, page_size=3):
+        ids, cursor, pages = [], '', []
+        while True:
+            page = paginate_by_cursor(Product.objects.all(), sort_field, descending, cursor, page_size)
+            pages.append(page)
+            ids.extend(p.id for p in page.items)
+            if not page.has_next:
+                return ids, pages
+            cursor = page.next_cursor
+
+    def test_walks_ties_in_both_directions(self):
+        ids, pages = self._walk('price_toman', True)
+        expected = [p.id for p in sorted(self.products, key=lambda p: (-p.price_toman, -p.id))]
+        self.assertEqual(ids, expected)
+        self.assertFalse(pages[0].has_previous)
+
+        back = paginate_by_cursor(Product.objects.all(), 'price_toman', True, pages[-1].previous_cursor, 3)
+        self.assertEqual([p.id for p in back.items], [p.id for p in pages[-2].items])
+
+    def test_cursor_must_match_sort_order(self):
+        _, pages = self._walk('name', False)
+        with self.assertRaises(InvalidCursor):
+            paginate_by_cursor(Product.objects.all(), 'name', True, pages[0].next_cursor, 3)
+
+    def test_category_filter_view_cursor_mode(self):
+        view = CategoryProductFilterView.as_view()
+        response = view(RequestFactory().get('/', {'cursor': '', 'per_page': 4, 'count': 'exact',
+                                                   'sort_by': 'price_toman', 'sort_order': 'asc'}),
+                        category_id=self.category.id)
+        pagination = response.data['pagination']
+        self.assertEqual(len(response.data['products']), 4)
+        self.assertEqual(pagination['total_items'], 7)
+        self.assertTrue(pagination['has_next'])
+
+        response = view(RequestFactory().get('/', {'cursor': pagination['next_cursor'], 'per_page': 4,
+                                                   'sort_by': 'price_toman', 'sort_order': 'asc'}),
+                        category_id=self.category.id)
+        self.assertEqual([p['price_toman'] for p in response.data['products']], [200.0, 300.0, 300.0])
+        self.assertNotIn('total_items', response.data['pagination'])
+
+        response = view(RequestFactory().get('/', {'cursor': 'garbage'}), category_id=self.category.id)
+        self.assertEqual(response.status_code, 400)
+
+
+class ProductSearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='watches', label='ساعت مچی')
+        self.brand = Attribute.objects.create(name='برند', key='brand')
+        self.casio = Product.objects.create(name='ساعت کاسيو مدل ۱۲۳', category=self.category, sku='CA_100')
+        ProductAttributeValue.objects.create(product=self.casio, attribute=self.brand, custom_value='Casio')
+        self.strap = Product.objects.create(name='بند چرمی', category=self.category, model='Leather')
+        self.strap.tags.add(Tag.objects.create(name='کاسیو'))
+
+    def _ids(self, query):
+        return list(search_products(Product.objects.all(), query).order_by('-search_rank').values_list('id', flat=True))
+
+    def test_normalizes_persian_variants_and_ranks_title_first(self):
+        # Arabic yeh in the name, Persian digits, prefix match on the brand
+        self.assertEqual(self._ids('كاسیو 123'), [self.casio.id])
+        self.assertEqual(self._ids('کاسیو'), [self.casio.id, self.strap.id])
+        self.assertEqual(self._ids('cas'), [self.casio.id])
+        self.assertEqual(self._ids('ca_100'), [self.casio.id])
+        self.assertCountEqual(self._ids('مچی'), [self.casio.id, self.strap.id])
+
+    def test_documents_follow_signals_and_rebuild(self):
+        self.strap.tags.clear()
+        self.assertEqual(self._ids('کاسیو'), [self.casio.id])
+        self.casio.name = 'ساعت دیجیتال'
+        self.casio.save()
+        self.assertEqual(self._ids('دیجیتال'), [self.casio.id])
+        self.casio.delete()
+        self.assertEqual(self._ids('دیجیتال'), [])
+
+        self.assertEqual(rebuild_search_index(), 1)
+        self.assertEqual(self._ids('leather'), [self.strap.id])
+
+    def test_build_search_index_command(self):
+        # State right after migration 0052: no documents and an empty backend index
+        ProductSearchDocument.objects.all().delete()
+        get_search_backend().clear()
+        self.assertEqual(self._ids('leather'), [])
+        call_command('build_search_index', '--if-empty', stdout=StringIO())
+        self.assertEqual(self._ids('leather'), [self.strap.id])
+
+        # Deploys only build it once
+        with patch('shop.management.commands.build_search_index.rebuild_search_index') as rebuild:
+            call_command('build_search_index', '--if-empty', stdout=StringIO())
+        rebuild.assert_not_called()
+
+    def test_simple_search_view_accepts_underscore(self):
+        response = api_simple_search(RequestFactory().get('/', {'q': 'CA_100'}))
+        data = json.loads(response.content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['id'] for p in data['products']], [self.casio.id])
+
+
+class SearchSuggestionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        suggestion_index.invalidate()
+        self.category = Category.objects.create(name='watches', label='ساعت مچی')
+        brand = Attribute.objects.create(name='برند', key='brand')
+        self.casio = Product.objects.create(name='ساعت کاسیو', category=self.category)
+        self.classic = Product.objects.create(name='کاسکت کلاسیک', category=self.category)
+        for product in (self.casio, self.classic):
+            ProductAttributeValue.objects.create(product=product, attribute=brand, custom_value='Casio')
+        self.casio.tags.add(Tag.objects.create(name='کاسیو اصل'))
+
+    def _suggest(self, query, **kwargs):
+        return [(s.type, s.id) for s in suggestion_index.suggest(query, **kwargs)]
+
+    def test_mixed_weighted_suggestions(self):
+        order = Order.objects.create(first_name='a', last_name='b', email='a@b.c', address='x',
+                                     postal_code='1', city='c')
+        OrderItem.objects.create(order=order, product=self.classic, price=1, quantity=3)
+
+        # Arabic kaf in the query; the best seller first, word-start matches after label starts
+        self.assertEqual(self._suggest('كاس'), [
+            ('product', self.classic.id), ('tag', self.casio.tags.get().id), ('product', self.casio.id),
+        ])
+        # Word starts match too, and lookups come from memory
+        with self.assertNumQueries(0):
+            self.assertEqual(self._suggest('مچ'), [('category', self.category.id)])
+            self.assertEqual(self._suggest('cas', types=('brand',)), [('brand', 'casio')])
+
+    def test_incremental_updates(self):
+        self._suggest('x')
+        self.casio.is_active = False
+        self.casio.save()
+        self.assertEqual(self._suggest('ساعت', types=('product',)), [])
+        Product.objects.create(name='ساعت دیواری', category=self.category)
+        self.assertEqual(len(self._suggest('ساعت', types=('product',))), 1)
+        # A fresh process rebuilds from the database
+        self.assertEqual(
+            [s.label for s in SuggestionIndex().suggest('ساعت', types=('product', 'category'))],
+            ['ساعت مچی', 'ساعت دیواری'],
+        )
+
+    def test_other_processes_replay_published_changes(self):
+        other = SuggestionIndex()
+        other.suggest('x')
+        watch = Product.objects.create(name='ساعت دیواری', category=self.category)
+        self.casio.is_active = False
+        self.casio.save(update_fields=['is_active'])
+        suggestion_index.products_changed([watch.pk, self.casio.pk], facets=False)
+
+        other._version_checked_at = None
+        with patch.object(other, '_rebuild') as rebuild:
+            labels = [s.label for s in other.suggest('ساعت', types=('product',))]
+        rebuild.assert_not_called()
+        self.assertEqual(labels, ['ساعت دیواری'])
+
+        # Changes no longer in the log can't be replayed
+        caches['catalog'].clear()
+        suggestion_index.products_changed([watch.pk])
+        other._version_checked_at = None
+        with patch.object(other, '_rebuild', wraps=other._rebuild) as rebuild:
+            other.suggest('ساعت')
+        rebuild.assert_called_once()
+
+    def test_suggest_view(self):
+        response = api_search_suggest(RequestFactory().get('/', {'q': 'CAS', 'types': 'brand,tag'}))
+        data = json.loads(response.content)
+        self.assertEqual([s['label'] for s in data['suggestions']], ['Casio'])
+        self.assertEqual(data['suggestions'][0]['product_count'], 2)
+        response = api_search_suggest(RequestFactory().get('/', {'q': 'x', 'types': 'nope'}))
+        self.assertEqual(response.status_code, 400)
+
+
+class CartSnapshotTest(TestCase):
+    device_id = '6f1c2b9e-3a4d-4e5f-8a7b-9c0d1e2f3a4b'
+
+    def setUp(self):
+        cache.clear()
+        invalidate_offer_prices()
+        self.category = Category.objects.create(name='ساعت')
+        CategoryAttribute.objects.create(category=self.category, key='color', label_fa='رنگ', display_in_basket=True)
+        self.cart = Cart.objects.create(session_key=self.device_id)
+
+    def _add_items(self, count):
+        for i in range(count):
+            product = Product.objects.create(name=f'Watch {i}', category=self.category, price_toman=1000)
+            ProductAttribute.objects.create(product=product, key='color', value='مشکی')
+            variant = ProductVariant.objects.create(product=product, sku=f'W{i}-BLK', attributes={'color': 'مشکی'},
+                                                    price_toman=1200, stock_quantity=5)
+            CartItem.objects.create(cart=self.cart, product=product, variant=variant, quantity=2, unit_price=1200)
+
+    def _get_cart(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/shop/api/customer/cart/', HTTP_X_DEVICE_ID=self.device_id)
+        return response.json(), len(queries)
+
+    def test_query_count_does_not_grow_with_items(self):
+        self._add_items(2)
+        _, small = self._get_cart()
+        self._add_items(6)
+        data, large = self._get_cart()
+        self.assertEqual(small, large)
+        self.assertEqual(len(data['items']), 8)
+        self.assertEqual(data['total_price_toman'], 8 * 2400)
+        item = data['items'][0]
+        self.assertEqual(item['variant']['attributes'][0]['display_name'], 'رنگ')
+        self.assertEqual(item['product']['attributes'], [{'key': 'color', 'value': 'مشکی', 'display_name': 'رنگ'}])
+
+    def test_totals_shared_with_cart_model(self):
+        self._add_items(3)
+        snapshot = CartSnapshot.load(self.cart, details=False)
+        self.assertEqual(snapshot.total_items, 6)
+        self.assertEqual(snapshot.total_price, self.cart.get_total_price())
+        with self.assertNumQueries(1):
+            self.cart.get_total_price()
+
+
+class StockReservationTest(TestCase):
+    device_id = '0b8e7c6d-5f4a-4b3c-9d2e-1f0a9b8c7d6e'
+
+    def setUp(self):
+        cache.clear()
+        invalidate_offer_prices()
+        self.category = Category.objects.create(name='ساعت')
+        self.product = Product.objects.create(name='Watch', category=self.category, price_toman=1000)
+        self.variant = ProductVariant.objects.create(product=self.product, sku='W-BLK', attributes={'color': 'مشکی'},
+                                                     price_toman=1000, stock_quantity=3)
+
+    def _cart_request(self, method, **data):
+        return getattr(self.client, method)(
+            '/shop/api/customer/cart/', data=json.dumps(data), content_type='application/json',
+            HTTP_X_DEVICE_ID=self.device_id,
+        )
+
+    def _stock(self):
+        self.variant.refresh_from_db()
+        return self.variant.stock_quantity
+
+    def _checkout(self):
+        return self.client.post(
+            '/shop/api/customer/checkout/', data=json.dumps({
+                'email': 'guest@example.com', 'receiver_name': 'Guest User', 'street_address': 'Street 1',
+                'city': 'Tehran', 'phone': '09120000000',
+            }), content_type='application/json', HTTP_X_DEVICE_ID=self.device_id,
+        )
+
+    def test_add_reserves_and_remove_releases(self):
+        response = self._cart_request('post', product_id=self.product.id, variant_id=self.variant.id, quantity=2)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self._stock(), 1)
+        item = CartItem.objects.get()
+        self.assertEqual(item.reservation.quantity, 2)
+
+        response = self._cart_request('post', product_id=self.product.id, variant_id=self.variant.id, quantity=2)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['available_stock'], 1)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+        item.delete()
+        self.assertEqual(self._stock(), 3)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_update_resizes_reservation(self):
+        self._cart_request('post', product_id=self.product.id, variant_id=self.variant.id, quantity=1)
+        item = CartItem.objects.get()
+        self.assertEqual(self._cart_request('put', item_id=item.id, quantity=3).status_code, 200)
+        self.assertEqual(self._stock(), 0)
+        self.assertEqual(self._cart_request('put', item_id=item.id, quantity=4).status_code, 400)
+        self.assertEqual(CartItem.objects.get().quantity, 3)
+        self._cart_request('put', item_id=item.id, quantity=1)
+        self.assertEqual(self._stock(), 2)
+
+    def test_expired_reservations_are_released(self):
+        self._cart_request('post', product_id=self.product.id, variant_id=self.variant.id, quantity=2)
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(release_expired_reservations(), 1)
+        self.assertEqual(self._stock(), 3)
+        self.assertEqual(release_expired_reservations(), 0)
+
+    def test_short_stock_releases_expired_reservations_of_other_carts(self):
+        other_cart = Cart.objects.create(session_key='other-device')
+        abandoned = CartItem.objects.create(cart=other_cart, product=self.product, variant=self.variant, quantity=3,
+                                            unit_price=1000)
+        StockReservation.objects.create(cart_item=abandoned, product=self.product, variant=self.variant, quantity=3,
+                                        expires_at=timezone.now() - timedelta(seconds=1))
+        ProductVariant.objects.filter(pk=self.variant.pk).update(stock_quantity=0)
+
+        response = self._cart_request('post', product_id=self.product.id, variant_id=self.variant.id, quantity=2)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self._stock(), 1)
+        self.assertFalse(StockReservation.objects.filter(cart_item=abandoned).exists())
+
+    def test_decreasing_quantity_shrinks_reservation(self):
+        customer = Customer.objects.create_user(username='c', email='c@example.com', password='pw')
+        cart = Cart.objects.create(customer=customer)
+        item = CartItem.objects.create(cart=cart, product=self.product, variant=self.variant, quantity=3,
+                                       unit_price=1000)
+        reserve_cart_item(item)
+        self.client.force_login(customer)
+        response = self.client.delete('/shop/api/customer/cart/remove/', data=json.dumps({
+            'item_id': item.id, 'quantity': 2,
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(StockReservation.objects.get().quantity, 1)
+        self.assertEqual(self._stock(), 2)
+
+    def test_checkout_keeps_items_added_after_the_snapshot(self):
+        self._cart_request('post', product_id=self.product.id, variant_id=self.variant.id, quantity=1)
+        other = Product.objects.create(name='Strap', category=self.category, price_toman=100, stock_quantity=5)
+        load = CartSnapshot.load
+
+        def load_then_add(cart, **kwargs):
+            snapshot = load(cart, **kwargs)
+            CartItem.objects.create(cart=cart, product=other, quantity=1, unit_price=100)
+            return snapshot
+
+        with patch('shop.views.CartSnapshot.load', side_effect=load_then_add):
+            response = self._checkout()
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(OrderItem.objects.get().product, self.product)
+        self.assertEqual(CartItem.objects.get().product, other)
+
+    def test_checkout_claims_reservation(self):
+        self._cart_request('post', product_id=self.product.id, variant_id=self.variant.id, quantity=2)
+        response = self._checkout()
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(self._stock(), 1)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(OrderItem.objects.get().quantity, 2)
+
+    def test_checkout_is_all_or_nothing(self):
+        other = Product.objects.create(name='Strap', category=self.category, price_toman=100, stock_quantity=1)
+        cart = Cart.objects.create(session_key=self.device_id)
+        CartItem.objects.create(cart=cart, product=self.product, variant=self.variant, quantity=2, unit_price=1000)
+        CartItem.objects.create(cart=cart, product=other, quantity=2, unit_price=100)
+
+        response = self._checkout()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['product_id'], other.id)
+        self.assertEqual(self._stock(), 3)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.count(), 2)
+
+
+class ConcurrentCheckoutTest(TransactionTestCase):
+    def test_parallel_checkouts_never_oversell(self):
+        category = Category.objects.create(name='ساعت')
+        product = Product.objects.create(name='Watch', category=category, price_toman=1000, stock_quantity=5)
+        carts = []
+        for i in range(10):
+            cart = Cart.objects.create(session_key=f'device-{i}')
+            CartItem.objects.create(cart=cart, product=product, quantity=1, unit_price=1000)
+            carts.append(cart)
+
+        results = []
+        barrier = threading.Barrier(len(carts))
+
+        def checkout(cart):
+            barrier.wait()
+            try:
+                for _ in range(500):
+                    try:
+                        with transaction.atomic():
+                            order = Order.objects.create(first_name='Guest', last_name='', email='guest@example.com',
+                                                         address='Street 1', postal_code='00000', city='Tehran')
+                            commit_checkout(order, CartSnapshot.load(cart, details=False).lines)
+                        results.append(True)
+                        return
+                    except OutOfStock:
+                        results.append(False)
+                        return
+                    except OperationalError:
+                        # SQLite allows one writer at a time; retry like a client would
+                        time.sleep(0.005)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(cart,)) for cart in carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        self.assertEqual(results.count(True), 5)
+        self.assertEqual(results.count(False), 5)
+        self.assertEqual(product.stock_quantity, 0)
+        self.assertEqual(Order.objects.filter(items__isnull=False).count(), 5)
+
+
+class IdempotencyKeyTest(TestCase):
+    device_id = '3c2b1a0f-9e8d-4c7b-8a69-5f4e3d2c1b0a'
+
+    def setUp(self):
+        cache.clear()
+        invalidate_offer_prices()
+        category = Category.objects.create(name='ساعت')
+        self.product = Product.objects.create(name='Watch', category=category, price_toman=1000, stock_quantity=10)
+        cart = Cart.objects.create(session_key=self.device_id)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=1, unit_price=1000)
+
+    def _checkout(self, key, **extra):
+        data = {'email': 'guest@example.com', 'receiver_name': 'Guest User', 'street_address': 'Street 1',
+                'city': 'Tehran', 'phone': '09120000000', **extra}
+        return self.client.post('/shop/api/customer/checkout/', data=json.dumps(data), content_type='application/json',
+                                HTTP_X_DEVICE_ID=self.device_id, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_stored_response(self):
+        first = self._checkout('key-1')
+        self.assertEqual(first.status_code, 201, first.content)
+        with self.assertNumQueries(0):
+            second = self._checkout('key-1')
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second[idempotency.REPLAY_HEADER], 'true')
+        self.assertEqual(Order.objects.count(), 1)
+
+        # Without the cache the stored row answers
+        cache.clear()
+        self.assertEqual(self._checkout('key-1').json(), first.json())
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_key_reused_for_other_request(self):
+        self._checkout('key-1')
+        self.assertEqual(self._checkout('key-1', city='Shiraz').status_code, 422)
+
+    def test_keys_are_scoped_per_device(self):
+        self._checkout('key-1')
+        other = self.client.post('/shop/api/customer/checkout/', data='{}', content_type='application/json',
+                                 HTTP_X_DEVICE_ID='9a8b7c6d-5e4f-4a3b-8c2d-1e0f9a8b7c6d', HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(other.status_code, 400)  # ran the view: that device's cart is empty
+
+    def test_duplicate_in_flight_waits_for_first_request(self):
+        data = {'email': 'guest@example.com', 'receiver_name': 'Guest User', 'street_address': 'Street 1',
+                'city': 'Tehran', 'phone': '09120000000'}
+        request = RequestFactory().post('/shop/api/customer/checkout/', data=json.dumps(data),
+                                        content_type='application/json')
+        scope = idempotency._hash('device', self.device_id)
+        request_hash = idempotency.request_fingerprint(request)
+        # Another worker is running the same request
+        self.assertIsNone(idempotency.begin(scope, 'key-1', request_hash))
+
+        with patch.object(idempotency, 'WAIT_SECONDS', 0):
+            response = self._checkout('key-1')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+
+        idempotency.complete(scope, 'key-1', request_hash, HttpResponse(b'{"done": true}', status=201,
+                                                                          content_type='application/json'))
+        response = self._checkout('key-1')
+        self.assertEqual((response.status_code, response.json()), (201, {'done': True}))
+        self.assertFalse(Order.objects.exists())
+
+    def test_errors_and_expired_keys_are_not_replayed(self):
+        with patch('shop.views.commit_checkout', side_effect=RuntimeError('boom')):
+            self.assertEqual(self._checkout('key-1').status_code, 500)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+        self.assertEqual(self._checkout('key-1').status_code, 201)
+
+        IdempotencyRecord.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        cache.clear()
+        self.assertEqual(idempotency.purge_expired_keys(), 1)
+
+
+class RateLimiterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.limiter = RateLimiter(CacheRateLimitBackend(cache))
+
+    def _hits(self, count, algorithm, limit, window, now):
+        return [self.limiter.hit('k', limit, window, algorithm, now=now) for _ in range(count)]
+
+    def test_fixed_window(self):
+        results = self._hits(4, 'fixed_window', 3, 60, now=1000)
+        self.assertEqual([r.allowed for r in results], [True, True, True, False])
+        self.assertEqual(results[2].remaining, 0)
+        self.assertEqual(results[3].retry_after, 20)  # window 960-1020
+        self.assertTrue(self.limiter.hit('k', 3, 60, 'fixed_window', now=1020).allowed)
+
+    def test_sliding_window_weights_previous_window(self):
+        results = self._hits(11, 'sliding_window', 10, 60, now=60)
+        self.assertEqual(sum(r.allowed for r in results), 10)
+        # Halfway through the next window half of the previous window still counts
+        results = self._hits(6, 'sliding_window', 10, 60, now=150)
+        self.assertEqual([r.allowed for r in results], [True] * 5 + [False])
+        self.assertEqual(results[-1].retry_after, 6)
+
+    def test_token_bucket_refills(self):
+        results = self._hits(3, 'token_bucket', 2, 10, now=100)
+        self.assertEqual([r.allowed for r in results], [True, True, False])
+        self.assertEqual(results[2].retry_after, 5)
+        self.assertTrue(self.limiter.hit('k', 2, 10, 'token_bucket', now=105).allowed)
+        self.assertFalse(self.limiter.hit('k', 2, 10, 'token_bucket', now=105).allowed)
+
+    def test_concurrent_hits_are_counted_exactly(self):
+        allowed = []
+        barrier = threading.Barrier(20)
+
+        def hit():
+            barrier.wait()
+            allowed.append(self.limiter.hit('k', 10, 60, 'fixed_window', now=1000).allowed)
+
+        threads = [threading.Thread(target=hit) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(allowed.count(True), 10)
+
+    def test_middleware_matches_first_rule_and_sets_headers(self):
+        class Middleware(GlobalRateLimitMiddleware):
+            RATE_LIMIT_RULES = [
+                (r'^/api/orders/(\d+)/cancel/', 1, 60, 'Cancel', 'fixed_window'),
+                (r'^/api/orders/', 2, 60, 'Orders'),
+                (r'^/.*api/.*', 100, 60, 'General API'),
+            ]
+
+        middleware = Middleware(lambda request: HttpResponse('ok'))
+        self.assertEqual(middleware._get_rate_limit('/api/orders/5/cancel/'), (1, 60, 'Cancel'))
+        self.assertEqual(middleware._get_rate_limit('/api/orders/'), (2, 60, 'Orders'))
+        self.assertEqual(middleware._get_rate_limit('/shop/api/x/'), (100, 60, 'General API'))
+        self.assertIsNone(middleware._get_rate_limit('/shop/products/'))
+        self.assertTrue(middleware._is_excluded('/admin/api/'))
+
+        factory = RequestFactory()
+        first = middleware(factory.get('/api/orders/'))
+        self.assertEqual((first['RateLimit-Limit'], first['RateLimit-Remaining']), ('2', '1'))
+        middleware(factory.get('/api/orders/'))
+        limited = middleware(factory.get('/api/orders/'))
+        self.assertEqual(limited.status_code, 429)
+        self.assertEqual(limited['RateLimit-Remaining'], '0')
+        self.assertIn('Retry-After', limited)
+
+
+class ImagePipelineTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = self.settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        category = Category.objects.create(name='ساعت')
+        self.product = Product.objects.create(name='Watch', category=category, price_toman=1000)
+        self.variant = ProductVariant.objects.create(product=self.product, sku='W1', price_toman=1000)
+
+    def _upload(self, name, size=(2400, 1200)):
+        output = BytesIO()
+        Image.new('RGB', size, 'red').save(output, format='JPEG')
+        return SimpleUploadedFile(name, output.getvalue(), content_type='image/jpeg')
+
+    def test_upload_is_stored_as_is_and_converted_later(self):
+        upload = self._upload('watch.jpg')
+        expected_hash = file_sha256(upload)
+        image = ProductImage.create(product=self.product, image=upload, order=1)
+        variant_image = ProductVariantImage.create(variant=self.variant, image=self._upload('red.jpg'), order=1)
+
+        image.refresh_from_db()
+        self.assertTrue(image.processing)
+        self.assertTrue(image.image.name.endswith('.jpg'))
+        self.assertEqual(image.image_hash, expected_hash)
+        original_name = image.image.name
+        # The same upload again is detected as a duplicate
+        self.assertEqual(ProductImage.create(product=self.product, image=self._upload('watch.jpg'), order=2), image)
+
+        generation = get_catalog_generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(process_pending_images(batch_size=10), (2, 2))
+
+        image.refresh_from_db()
+        variant_image.refresh_from_db()
+        self.assertFalse(image.processing or variant_image.processing)
+        self.assertTrue(image.image.name.endswith('.webp'))
+        self.assertTrue(variant_image.image.name.endswith('.webp'))
+        self.assertFalse(image.image.storage.exists(original_name))
+        with Image.open(image.image.path) as converted:
+            self.assertEqual((converted.format, converted.size), ('WEBP', (1600, 800)))
+        self.assertNotEqual(get_catalog_generation(), generation)
+        self.assertEqual(process_pending_images(), (0, 0))
+
+    def test_broken_upload_keeps_original(self):
+        upload = SimpleUploadedFile('broken.jpg', b'not an image', content_type='image/jpeg')
+        image = ProductImage.objects.create(product=self.product, image=upload, order=1)
+
+        self.assertEqual(process_pending_images(), (1, 1))
+        image.refresh_from_db()
+        self.assertFalse(image.processing)
+        self.assertTrue(image.image.name.endswith('.jpg'))
+        self.assertTrue(image.image.storage.exists(image.image.name))
+
+    def test_images_claimed_by_another_worker_are_skipped(self):
+        image = ProductImage.create(product=self.product, image=self._upload('watch.jpg'), order=1)
+        cache.add(f'image_pipeline:claim:shop.productimage:{image.pk}', True)
+
+        self.assertEqual(process_pending_images(), (0, 0))
+        image.refresh_from_db()
+        self.assertTrue(image.processing)
+
+
+class ProductDetailDocumentTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='ساعت')
+        CategoryAttribute.objects.create(category=self.category, key='brand', label_fa='برند', display_order=1)
+        CategoryAttribute.objects.create(category=self.category, key='color', label_fa='رنگ', display_order=2)
+        brand = Attribute.objects.create(name='Brand', key='brand')
+        self.product = Product.objects.create(name='Watch', category=self.category, price_toman=1000,
+                                              stock_quantity=3)
+        ProductAttributeValue.objects.create(product=self.product, attribute=brand, custom_value='Casio')
+        ProductAttribute.objects.create(product=self.product, key='color', value='black')
+        self.product.tags.add(Tag.objects.create(name='sport'))
+        self.variant = ProductVariant.objects.create(product=self.product, sku='W1', price_toman=1000,
+                                                     stock_quantity=5, attributes={'color': 'black'})
+        ProductImage.objects.bulk_create([ProductImage(product=self.product, image='product_images/1.webp')])
+        self.other = Product.objects.create(name='Other', category=self.category, price_toman=500)
+        self.url = f'/shop/api/product/{self.product.pk}/detail/'
+
+    def _get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_document_is_built_once_and_served(self):
+        data = self._get()
+        self.assertEqual(data['attributes'], [{'key': 'brand', 'value': 'Casio'}, {'key': 'color', 'value': 'black'}])
+        self.assertEqual([a['value'] for a in data['display_attributes']], ['Casio', 'black'])
+        self.assertEqual(data['variants'][0]['attributes'], [
+            {'key': 'color', 'value': 'black', 'isDistinctive': True, 'display_name': 'رنگ', 'priority': 2}
+        ])
+        self.assertEqual(data['images'][0]['url'], 'http://testserver/media/product_images/1.webp')
+        self.assertEqual(data['tags'][0]['name'], 'sport')
+        self.assertEqual([p['id'] for p in data['similar_products']], [self.other.pk])
+        self.assertNotIn('is_in_wishlist', data)
+        self.assertTrue(ProductDetailDocument.objects.filter(product=self.product).exists())
+
+        with CaptureQueriesContext(connection) as ctx:
+            self._get()
+        # Document with product stock, variant stock, similar products and their images
+        self.assertLessEqual(len(ctx.captured_queries), 4)
+
+    def test_stock_and_wishlist_are_live(self):
+        self._get()
+        ProductVariant.objects.filter(pk=self.variant.pk).update(stock_quantity=1)
+        Product.objects.filter(pk=self.product.pk).update(stock_quantity=0)
+        customer = Customer.objects.create_user(username='c', email='c@example.com', password='pw')
+        Wishlist.objects.create(customer=customer, product=self.product)
+        self.client.force_login(customer)
+
+        data = self._get()
+        self.assertEqual((data['stock_quantity'], data['total_stock']), (0, 1))
+        self.assertTrue(data['is_in_wishlist'])
+
+    def test_signals_rebuild_changed_products(self):
+        self._get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Renamed'
+            self.product.save()
+            self.variant.price_toman = 2000
+            self.variant.save()
+            self.product.tags.clear()
+        data = ProductDetailDocument.objects.get(product=self.product).data
+        self.assertEqual((data['name'], data['variants'][0]['price_toman'], data['tags']), ('Renamed', 2000.0, []))
+
+        # Category-wide changes drop the documents; the next request rebuilds them
+        self.category.name = 'ساعت مچی'
+        self.category.save()
+        self.assertFalse(ProductDetailDocument.objects.exists())
+        self.assertEqual(self._get()['category']['name'], 'ساعت مچی')
+
+    def test_inactive_product_is_not_found(self):
+        Product.objects.filter(pk=self.product.pk).update(is_active=False)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(rebuild_all_detail_documents(), 2)
+
+
+class SimilarityIndexTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='ساعت')
+        self.sport, self.gold = Tag.objects.create(name='sport'), Tag.objects.create(name='gold')
+        self.watch = self._product('Watch', [self.sport], 'Casio')
+        self.twin = self._product('Twin', [self.sport], 'Casio')
+        self.other = self._product('Other', [self.gold], 'Seiko')
+        self.plain = self._product('Plain', [], '')
+
+    def _product(self, name, tags, brand, price=1000):
+        product = Product.objects.create(name=name, category=self.category, price_toman=price)
+        product.tags.set(tags)
+        if brand:
+            ProductAttribute.objects.create(product=product, key='brand', value=brand)
+        return product
+
+    def _neighbours(self, product, kind):
+        return list(ProductSimilarity.objects.filter(product=product, kind=kind).order_by('rank')
+                    .values_list('similar_id', 'overlap'))
+
+    def test_full_build_ranks_shared_features_first(self):
+        self.assertEqual(build_similarity_index(), 4)
+        neighbours = self._neighbours(self.watch, 'tags')
+        self.assertEqual(neighbours[0], (self.twin.pk, 1))
+        # Products sharing only the category are still listed, without overlap
+        self.assertCountEqual([pk for pk, overlap in neighbours[1:]], [self.other.pk, self.plain.pk])
+        self.assertEqual(self._neighbours(self.watch, 'attributes')[0], (self.twin.pk, 1))
+
+        response = self.client.get(f'/shop/product/{self.watch.pk}/similar-by-tags/').json()
+        self.assertEqual(response['similar_products'][0]['id'], self.twin.pk)
+        self.assertEqual(response['similar_products'][0]['similarity_type'], 'tags')
+        self.assertEqual(response['similar_products'][-1]['similarity_type'], 'category')
+        response = self.client.get(f'/shop/product/{self.watch.pk}/similar-by-attributes/').json()
+        self.assertEqual(response['similar_products'][0]['attribute_overlap'], 1)
+
+    def test_incremental_build_follows_changes(self):
+        build_similarity_index()
+        self.assertEqual(build_similarity_index(changed_only=True), 0)
+
+        self.other.tags.add(self.sport)
+        Product.objects.filter(pk=self.twin.pk).update(is_active=False)
+        self.assertGreater(build_similarity_index(changed_only=True), 0)
+        neighbours = self._neighbours(self.watch, 'tags')
+        self.assertEqual(neighbours[0], (self.other.pk, 1))
+        self.assertNotIn(self.twin.pk, [pk for pk, _ in neighbours])
+
+    def test_unindexed_product_falls_back_to_category(self):
+        response = self.client.get(f'/shop/product/{self.watch.pk}/similar-by-tags/').json()
+        self.assertEqual(response['total_found'], 3)
+        self.assertEqual({p['similarity_type'] for p in response['similar_products']}, {'category'})
+
+
+class VariantMatrixTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='تیشرت')
+        CategoryAttribute.objects.create(category=category, key='size', label_fa='سایز', display_order=2)
+        CategoryAttribute.objects.create(category=category, key='color', label_fa='رنگ', display_order=1)
+        self.product = Product.objects.create(name='Shirt', category=category, price_toman=1000,
+                                              distinctive_attribute_key='color')
+        self.red_s = self._variant('R-S', 'Red', 'S', 2)
+        self.red_m = self._variant('R-M', 'Red', 'M', 0)
+        self.blue_s = self._variant('B-S', 'Blue', 'S', 1)
+        ProductVariantImage.objects.bulk_create([ProductVariantImage(variant=self.blue_s, image='variant_images/blue.webp')])
+        self.url = f'/shop/api/products/{self.product.pk}/variant-matrix/'
+
+    def _variant(self, sku, color, size, stock):
+        return ProductVariant.objects.create(product=self.product, sku=sku, price_toman=1000, stock_quantity=stock,
+                                             attributes={'color': color, 'size': size})
+
+    def test_matrix_axes_bitmap_and_image_groups(self):
+        data = self.client.get(self.url).json()
+        self.assertEqual([(a['key'], a['values']) for a in data['axes']],
+                         [('color', ['Blue', 'Red']), ('size', ['S', 'M'])])
+        self.assertEqual(data['combination_count'], 4)
+        # Blue-S (index 0) and Red-S (index 2) are in stock; Red-M (3) is not, Blue-M (1) doesn't exist
+        self.assertEqual(int(data['available'], 16), 0b0101)
+        self.assertEqual(data['image_groups'][0]['value'], 'Blue')
+        self.assertEqual(data['image_groups'][0]['images'], ['http://testserver/media/variant_images/blue.webp'])
+        self.assertEqual(data['image_groups'][1]['images'], [])
+
+    def test_structure_is_cached_and_stock_is_live(self):
+        self.client.get(self.url)
+        ProductVariant.objects.filter(pk=self.red_m.pk).update(stock_quantity=4)
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.get(self.url).json()
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(int(data['available'], 16), 0b1101)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.red_m.price_toman = 1500
+            self.red_m.save()
+            # Not invalidated before the change commits
+            prices = {c['sku']: c['price_toman'] for c in self.client.get(self.url).json()['combinations']}
+            self.assertEqual(prices['R-M'], 1000.0)
+        for callback in callbacks:
+            callback()
+        prices = {c['sku']: c['price_toman'] for c in self.client.get(self.url).json()['combinations']}
+        self.assertEqual(prices['R-M'], 1500.0)
+
+    def test_variants_are_filtered_through_the_attribute_index(self):
+        self.assertEqual(VariantAttribute.objects.filter(variant=self.red_s).count(), 2)
+        self.red_s.attributes = {'color': 'Green', 'size': 'S'}
+        self.red_s.save()
+
+        response = self.client.get('/shop/api/variants/', {'attr_color': 'green ', 'attr_size': 's'}).json()
+        self.assertEqual([v['sku'] for v in response['variants']], ['R-S'])
+        response = self.client.get('/shop/api/variants/', {'attr_size': 'S'}).json()
+        self.assertEqual([v['sku'] for v in response['variants']], ['B-S', 'R-S'])
+        self.assertTrue(response['variants'][0]['image_url'].endswith('/media/variant_images/blue.webp'))
+
+        # Blank and unknown attribute filters are dropped rather than matching nothing
+        response = self.client.get('/shop/api/variants/', {'attr_size': 'S', 'attr_': 'x', 'attr_color': ' ',
+                                                           'attr_utm_source': 'ad'}).json()
+        self.assertEqual([v['sku'] for v in response['variants']], ['B-S', 'R-S'])
+
+    def test_variant_filters_apply_before_the_index_is_built(self):
+        VariantAttribute.objects.all().delete()
+        response = self.client.get('/shop/api/variants/', {'attr_size': 'S', 'attr_color': 'Red'}).json()
+        self.assertEqual([v['sku'] for v in response['variants']], ['R-S'])
+
+
+class OrderExportTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        product = Product.objects.create(name='Mug', category=Category.objects.create(name='Kitchen'), price_toman=100)
+        self.paid = Order.objects.create(first_name='Ali', last_name='Rezaei', email='a@example.com',
+                                         address='x', postal_code='1', city='Tehran', paid=True)
+        OrderItem.objects.create(order=self.paid, product=product, price='10.50', quantity=2)
+        OrderItem.objects.create(order=self.paid, product=product, price='4.00', quantity=1)
+        self.unpaid = Order.objects.create(first_name='Sara', last_name='Karimi', email='s@example.com',
+                                           address='x', postal_code='1', city='Tehran')
+        Order.objects.filter(pk=self.unpaid.pk).update(created=timezone.now() - timedelta(days=10))
+
+    def _csv_rows(self, response):
+        import csv
+        return list(csv.reader(StringIO(b''.join(response.streaming_content).decode())))
+
+    def test_csv_is_streamed_with_totals_from_one_query(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/shop/api/orders/export/stream/csv/')
+            rows = self._csv_rows(response)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="orders.csv"')
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(rows[0][-2:], ['item_count', 'grand_total'])
+        self.assertEqual(rows[1][0], str(self.paid.pk))
+        self.assertEqual(rows[1][-3:], ['True', '3', '25.00'])
+        self.assertEqual(rows[2][-2:], ['0', '0.00'])
+
+    def test_filters_and_gzip(self):
+        import gzip
+        today = timezone.localdate().isoformat()
+        response = self.client.get('/shop/api/orders/export/stream/csv/', {'date_from': today, 'gzip': 'true'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        text = gzip.decompress(b''.join(response.streaming_content)).decode()
+        self.assertEqual(len(text.splitlines()), 2)
+
+        rows = self._csv_rows(self.client.get('/shop/api/orders/export/stream/csv/', {'paid': 'false'}))
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.unpaid.pk)])
+
+        self.assertEqual(self.client.get('/shop/api/orders/export/stream/csv/', {'date_to': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get('/shop/api/orders/export/stream/pdf/').status_code, 400)
+
+    def test_csv_route_keeps_the_json_wrapper(self):
+        import csv
+        data = self.client.get('/shop/api/orders/export/csv/', {'paid': 'true'}).json()
+        self.assertEqual((data['success'], data['content_type'], data['filename']), (True, 'text/csv', 'orders.csv'))
+        rows = list(csv.reader(StringIO(data['data'])))
+        self.assertEqual(rows[0][0], 'id')
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.paid.pk)])
+
+
+class OrderTotalsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Mug', category=Category.objects.create(name='Kitchen'),
+                                              price_toman=100)
+        self.customer = Customer.objects.create_user(username='c', email='c@example.com', password='pw')
+
+    def _order(self, *lines):
+        order = Order.objects.create(first_name='C', last_name='D', email='c@example.com',
+                                     address='x', postal_code='1', city='Tehran')
+        for price, quantity in lines:
+            OrderItem.objects.create(order=order, product=self.product, price=price, quantity=quantity)
+        return order
+
+    def test_totals_follow_item_writes(self):
+        order = self._order(('10.00', 2), ('2.50', 1))
+        order.refresh_from_db()
+        self.assertEqual((order.total_toman, order.item_count), (Decimal('22.50'), 3))
+
+        item = order.items.first()
+        item.quantity = 5
+        item.save()
+        order.items.last().delete()
+        order.refresh_from_db()
+        self.assertEqual((order.get_total_cost(), order.item_count), (Decimal('50.00'), 5))
+
+    def test_queryset_helpers(self):
+        order = self._order(('10.00', 2))
+        self._order()
+        Order.objects.filter(pk=order.pk).update(total_toman=0, item_count=0)
+        live = Order.objects.with_totals().get(pk=order.pk)
+        self.assertEqual((live.items_total, live.items_quantity), (Decimal('20.00'), 2))
+
+        self.assertEqual(Order.objects.refresh_totals(), 2)
+        self.assertEqual(Order.objects.summary(),
+                         {'order_count': 2, 'total_toman': Decimal('20.00'), 'item_count': 2})
+
+    def test_customer_order_list_is_paginated_with_the_total_count(self):
+        for _ in range(3):
+            self._order(('10.00', 1), ('5.00', 2))
+        self.client.force_login(self.customer)
+
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.get('/shop/api/customer/orders/', {'limit': 2}).json()
+        order_queries = [q for q in ctx.captured_queries if 'shop_order' in q['sql']]
+        self.assertEqual(len(order_queries), 3)
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual((data['count'], data['pagination']['total_items']), (3, 3))
+        self.assertEqual(data['results'][0]['total_amount'], 20.0)
+        self.assertEqual([i['product_name'] for i in data['results'][0]['items']], ['Mug', 'Mug'])
+        self.assertTrue(data['pagination']['has_next'])
+
+        rest = self.client.get('/shop/api/customer/orders/', {'limit': 2, 'cursor': data['pagination']['next_cursor']}).json()
+        self.assertEqual((len(rest['results']), rest['count']), (1, 3))
+        self.assertFalse(rest['pagination']['has_next'])
@@ -10,15 +10,15 @@ from .api_views import (
     api_improved_categories, api_group_products, api_genders_list, api_categories_by_gender,
     api_products_by_gender_table, api_gender_category_tree, api_gender_statistics,
     api_parent_categories_by_gender, api_child_categories_by_gender, api_child_categories_by_parent_and_gender, api_flattened_categories_by_gender,
-    api_category_attribute_values_with_products, api_category_attribute_values, api_category_dynamic_attribute_values,
+    api_category_attribute_values_with_products, api_category_attribute_values, api_category_dynamic_attribute_values, api_category_facets,
     api_category_categorization_key, api_leaf_categories, api_special_offer_categories, SpecialOffersAPIView, SpecialOfferDetailAPIView, SpecialOfferClickAPIView,
     SpecialOffersByTypeAPIView, FlashSalesAPIView, DiscountsAPIView, BundleDealsAPIView, FreeShippingAPIView, 
     SeasonalOffersAPIView, ClearanceOffersAPIView, CouponOffersAPIView, AdminSpecialOffersAPIView, 
     AdminSpecialOfferDetailAPIView, AdminSpecialOfferProductsAPIView, ProductsWithSaleInfoAPIView,
     # Order APIs
-    api_orders_list, api_orders_detail, api_orders_update_paid, api_orders_export_csv,
+    api_orders_list, api_orders_detail, api_orders_update_paid, api_orders_export_csv, api_orders_export,
     # Product Variants APIs
-    api_products_with_variants, api_product_variants, api_variants_by_attributes
+    api_products_with_variants, api_product_variants, api_product_variant_matrix, api_variants_by_attributes
 )
 
 # Custom converter for hierarchical category paths
@@ -50,6 +50,7 @@ urlpatterns = [
     path('api/products/by-tags/', views.get_products_by_tags, name='products_by_tags'),
     path('api/tags/popular/', views.get_popular_tags, name='popular_tags'),
     path('api/tags/suggest/', views.get_tag_suggestions, name='tag_suggestions'),
+    path('api/search/suggest/', views.api_search_suggest, name='api_search_suggest'),
     path('product/<int:product_id>/delete/', views.delete_product, name='delete_product'),
     path('api/products/', views.api_products, name='api_products'),
     path('api/products/advanced-search/', views.api_advanced_search, name='api_advanced_search'),
@@ -69,6 +70,7 @@ urlpatterns = [
     path('api/category/<int:category_id>/dynamic-attribute-values/', api_category_dynamic_attribute_values, name='api_category_dynamic_attribute_values'),
     path('api/category/<int:category_id>/categorization-key/', api_category_categorization_key, name='api_category_categorization_key'),
     path('api/category/<int:category_id>/filter/', CategoryProductFilterView.as_view(), name='category-product-filter'),
+    path('api/category/<int:category_id>/facets/', api_category_facets, name='api_category_facets'),
     path('api/products/filter/', ProductsFilterView.as_view(), name='products-filter'),
     path('api/debug/category1-attributes/', debug_category1_attributes),
     path('api/debug/category/<int:category_id>/attributes-structure/', debug_category_attributes_structure),
@@ -169,12 +171,15 @@ urlpatterns = [
     # Order APIs
     path('api/orders/', api_orders_list, name='api_orders_list'),
     path('api/orders/export/csv/', api_orders_export_csv, name='api_orders_export_csv'),
+    path('api/orders/export/stream/<str:file_type>/', api_orders_export, name='api_orders_export'),
     path('api/orders/<int:order_id>/', api_orders_detail, name='api_orders_detail'),
     path('api/orders/<int:order_id>/paid/', api_orders_update_paid, name='api_orders_update_paid'),
     
     # Product Variants APIs
     path('api/products-with-variants/', api_products_with_variants, name='api_products_with_variants'),
     path('api/products/<int:product_id>/variants/', api_product_variants, name='api_product_variants'),
+    path('api/products/<int:product_id>/variant-matrix/', api_product_variant_matrix,
+         name='api_product_variant_matrix'),
     path('api/variants/', api_variants_by_attributes, name='api_variants_by_attributes'),
     
     # Customer API endpoints
@@ -53,40 +53,10 @@ def compress_image(image_file, max_size=1600):
     if hasattr(image_file, 'size') and image_file.size > 20 * 1024 * 1024:
         return image_file
         
-    # Open the image using PIL with ICC profile handling
-    img = safe_open_image(image_file)
-    
-    # Convert to RGB if necessary
-    if img.mode in ('RGBA', 'P'):
-        img = img.convert('RGB')
-    
-    # Calculate new dimensions while maintaining aspect ratio
-    width, height = img.size
-    if width > max_size or height > max_size:
-        if width > height:
-            new_width = max_size
-            new_height = int(height * (max_size / width))
-        else:
-            new_height = max_size
-            new_width = int(width * (max_size / height))
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    # Create a BytesIO object to store the compressed image
-    output = BytesIO()
-    
-    # Save the image in WebP format with specified settings
-    img.save(
-        output,
-        format='WEBP',
-        quality=80,
-        method=6,
-        optimize=True,
-        lossless=False,
-        icc_profile=None  # Explicitly exclude ICC profile
-    )
-    
-    # Reset the pointer to the beginning of the BytesIO object
-    output.seek(0)
+    # Same encoding as the background image pipeline
+    from .image_pipeline import encode_webp
+    image_file.seek(0)
+    output = BytesIO(encode_webp(image_file.read(), max_size))
     
     # Create a new InMemoryUploadedFile with the original file name
     original_name = image_file.name
@@ -0,0 +1,157 @@
+"""
+Variant matrix of a product (the variant-matrix endpoint).
+
+Everything the app needs to pick a variant, in one response:
+- axes: the attribute keys of the product's active variants, in category display order,
+  each with its distinct values in first-seen order (variants by SKU);
+- combinations: one entry per active variant with the index of its value on each axis
+  (-1 when it has none), its price and its stock;
+- available: a bitmap over all combinations of axis values, as a hex number. Bit i is set
+  if an in-stock variant has combination i, where i reads the value indexes as a
+  mixed-radix number with the first axis most significant;
+- image_groups: the images per value of the distinctive attribute
+  (Product.distinctive_attribute_key, or the only axis), taken from the variant flagged
+  isDistinctive for that value, else the default one, else the first with images.
+
+The structure is cached per product until one of its variants, their images, the product
+or its category's attributes change (signals in shop/signals.py, once the change commits).
+Those deletes only reach every worker when CATALOG_CACHE_ALIAS is a shared cache (Redis);
+with a per-process cache the entries are kept for VARIANT_MATRIX_LOCAL_CACHE_TIMEOUT
+seconds only, so other workers catch up quickly. Stock is not cached:
+it moves with conditional UPDATEs that send no signals, so it is read on every request
+with one query and the bitmap is computed from it.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+from accounts.utils import is_shared_cache
+
+from .models import Product, ProductVariant
+
+MATRIX_CACHE_TIMEOUT = getattr(settings, 'VARIANT_MATRIX_CACHE_TIMEOUT', 24 * 60 * 60)
+# With a per-process cache other workers miss the invalidation, so keep entries briefly
+LOCAL_CACHE_TIMEOUT = getattr(settings, 'VARIANT_MATRIX_LOCAL_CACHE_TIMEOUT', 60)
+# Products with more axis-value combinations than this get no bitmap
+MAX_BITMAP_COMBINATIONS = 1 << 16
+
+
+def _cache_alias():
+    return getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')
+
+
+def _cache():
+    return caches[_cache_alias()]
+
+
+def _cache_timeout():
+    return MATRIX_CACHE_TIMEOUT if is_shared_cache(_cache_alias()) else LOCAL_CACHE_TIMEOUT
+
+
+def _cache_key(product_id):
+    return f'variant_matrix:{product_id}'
+
+
+def invalidate_variant_matrices(product_ids):
+    _cache().delete_many([_cache_key(product_id) for product_id in product_ids if product_id])
+
+
+def build_variant_matrix(product_id):
+    """The stock-independent part of a product's matrix, or None if the product isn't active."""
+    product = Product.objects.filter(pk=product_id, is_active=True).select_related('category').first()
+    if product is None:
+        return None
+    variants = list(ProductVariant.objects.filter(product=product, is_active=True).prefetch_related(
+        'images'
+    ).order_by('sku'))
+    category_attributes = {
+        attribute.key: attribute
+        for attribute in (product.category.category_attributes.all() if product.category else ())
+    }
+
+    values = {}
+    for variant in variants:
+        for key, value in (variant.attributes or {}).items():
+            if value is not None and str(value).strip() != '':
+                values.setdefault(key, {}).setdefault(str(value), None)
+    keys = sorted(values, key=lambda key: (
+        key not in category_attributes,
+        category_attributes[key].display_order if key in category_attributes else 0,
+    ))
+    axes = [
+        {
+            'key': key,
+            'display_name': category_attributes[key].label_fa if key in category_attributes else key,
+            'values': list(values[key]),
+        }
+        for key in keys
+    ]
+    index_of = {axis['key']: {value: i for i, value in enumerate(axis['values'])} for axis in axes}
+
+    combinations = []
+    for variant in variants:
+        attributes = variant.attributes or {}
+        combinations.append({
+            'variant_id': variant.id,
+            'sku': variant.sku,
+            'values': [index_of[key].get(str(attributes[key]), -1) if key in attributes else -1 for key in keys],
+            'price_toman': float(variant.price_toman),
+            'is_default': variant.is_default,
+        })
+
+    distinctive_key = product.distinctive_attribute_key or (keys[0] if len(keys) == 1 else None)
+    image_groups = []
+    if distinctive_key in index_of:
+        for value in index_of[distinctive_key]:
+            group = [
+                variant for variant in variants
+                if str((variant.attributes or {}).get(distinctive_key)) == value and variant.images.all()
+            ]
+            group.sort(key=lambda variant: (not variant.isDistinctive, not variant.is_default))
+            image_groups.append({
+                'value': value,
+                'variant_id': group[0].id if group else None,
+                'images': [image.image.url for image in group[0].images.all() if image.image] if group else [],
+            })
+
+    return {
+        'product': {'id': product.id, 'name': product.name},
+        'axes': axes,
+        'distinctive_key': distinctive_key if distinctive_key in index_of else None,
+        'combinations': combinations,
+        'image_groups': image_groups,
+    }
+
+
+def get_variant_matrix(product_id):
+    """The cached matrix of an active product, with live stock; None if not found."""
+    cache = _cache()
+    matrix = cache.get(_cache_key(product_id))
+    if matrix is None:
+        matrix = build_variant_matrix(product_id)
+        if matrix is None:
+            return None
+        cache.set(_cache_key(product_id), matrix, _cache_timeout())
+
+    stock = dict(ProductVariant.objects.filter(
+        product_id=product_id, is_active=True
+    ).values_list('id', 'stock_quantity'))
+    combinations = [
+        {**combination, 'stock_quantity': stock.get(combination['variant_id'], 0)}
+        for combination in matrix['combinations']
+    ]
+
+    sizes = [len(axis['values']) for axis in matrix['axes']]
+    total = 1
+    for size in sizes:
+        total *= size
+    available = None
+    if sizes and total <= MAX_BITMAP_COMBINATIONS:
+        bits = 0
+        for combination in combinations:
+            if combination['stock_quantity'] > 0 and -1 not in combination['values']:
+                index = 0
+                for size, value in zip(sizes, combination['values']):
+                    index = index * size + value
+                bits |= 1 << index
+        available = format(bits, 'x')
+    return {**matrix, 'combinations': combinations, 'combination_count': total if sizes else 0, 'available': available}
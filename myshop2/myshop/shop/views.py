@@ -22,7 +22,13 @@ import subprocess
 import psutil
 import humanize
 from django.views.decorators.cache import never_cache
-from .models import ProductAttributeValue
+from .models import ProductAttributeValue, ProductSimilarity, ProductSimilarityState
+from .response_cache import cache_catalog_response
+from .cursor_pagination import InvalidCursor, cursor_pagination_data, paginate_by_cursor, resolve_keyset_sort
+from .search import search_products
+from .suggestions import SUGGESTION_TYPES, get_suggestions
+from .cart_snapshot import CartSnapshot
+from .inventory import OutOfStock, commit_checkout, reserve_cart_item
 
 def home(request):
     """Home page view showing featured products and categories."""
@@ -110,6 +116,7 @@ def new_arrivals(request):
     }
     return render(request, 'shop/new_arrivals.html', context)
 
+@cache_catalog_response()
 def api_new_arrivals(request):
     """API endpoint for new arrivals products."""
     limit = request.GET.get('limit', 10)
@@ -465,18 +472,18 @@ def product_detail(request, product_id):
             is_active=True
         ).exclude(id=product.id).annotate(
             tag_overlap=Count('tags', filter=Q(tags__in=product_tags))
-        ).order_by('-tag_overlap', '-created_at')[:4]
+        ).order_by('-tag_overlap', '-created_at').prefetch_related('images', 'tags')[:4]
     else:
         # Fallback to category-based similarity
         similar_products = Product.objects.filter(
             category=product.category,
             is_active=True
-        ).exclude(id=product.id)[:4]
+        ).exclude(id=product.id).prefetch_related('images', 'tags')[:4]
     
     # Format similar products data
     similar_products_data = []
     for similar in similar_products:
-        similar_image = ProductImage.objects.filter(product=similar).first()
+        similar_image = next(iter(similar.images.all()), None)
         image_url = None
         if similar_image and similar_image.image:
             try:
@@ -488,7 +495,7 @@ def product_detail(request, product_id):
                 print(f"Error getting similar product image URL: {e}")
         
         # Get tags for similar product
-        similar_tags = list(similar.tags.values('id', 'name'))
+        similar_tags = [{'id': tag.id, 'name': tag.name} for tag in similar.tags.all()]
         
         similar_products_data.append({
             'id': similar.id,
@@ -613,22 +620,17 @@ def get_tag_suggestions(request):
     try:
         query = query.strip()
         
-        # Search for tags that match the query
-        from django.db.models import Count, Q
-        matching_tags = Tag.objects.filter(
-            name__icontains=query
-        ).annotate(
-            product_count=Count('products', filter=Q(products__is_active=True))
-        ).order_by('-product_count', 'name')[:limit]
+        # Tags with a word starting with the query, from the in-memory suggestion index
+        matching_tags = get_suggestions(query, limit=limit, types=('tag',))
         
         # Format response
         tags_data = []
         for tag in matching_tags:
             tags_data.append({
                 'id': tag.id,
-                'name': tag.name,
+                'name': tag.label,
                 'slug': tag.slug,
-                'product_count': tag.product_count
+                'product_count': tag.weight
             })
         
         return JsonResponse({
@@ -641,6 +643,34 @@ def get_tag_suggestions(request):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+@require_http_methods(["GET"])
+def api_search_suggest(request):
+    """
+    Search-as-you-type suggestions: products, brands, tags and categories with a word
+    starting with the query, most popular first. Served from an in-memory prefix index.
+    Example: /shop/api/search/suggest/?q=کاس&limit=8&types=product,brand
+    """
+    query = request.GET.get('q', '').strip()
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 20)
+    except ValueError:
+        limit = 10
+    
+    types = SUGGESTION_TYPES
+    if request.GET.get('types'):
+        types = tuple(t for t in SUGGESTION_TYPES if t in request.GET['types'].split(','))
+        if not types:
+            return JsonResponse({'error': f'types must be a comma-separated subset of {", ".join(SUGGESTION_TYPES)}'}, status=400)
+    
+    if len(query) > 100:
+        return JsonResponse({'error': 'Query too long (maximum 100 characters)'}, status=400)
+    
+    suggestions = get_suggestions(query, limit=limit, types=types) if query else []
+    return JsonResponse({
+        'query': query,
+        'suggestions': [suggestion.to_dict() for suggestion in suggestions],
+    })
+
 def get_products_by_tags(request):
     """
     Get products filtered by specific tags
@@ -708,6 +738,37 @@ def get_products_by_tags(request):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+def _indexed_similar_products(product, kind, prefetch, limit=6):
+    """
+    (similar product, overlap) pairs from the similarity index (build_similarity_index),
+    falling back to the newest products of the category for a product not indexed yet.
+    """
+    rows = ProductSimilarity.objects.filter(
+        product=product, kind=kind, similar__is_active=True
+    ).select_related('similar').prefetch_related(
+        *(f'similar__{lookup}' for lookup in prefetch)
+    ).order_by('rank')[:limit]
+    pairs = [(row.similar, row.overlap) for row in rows]
+    if pairs or ProductSimilarityState.objects.filter(product=product).exists():
+        return pairs
+    similar_products = Product.objects.filter(
+        category=product.category,
+        is_active=True
+    ).exclude(id=product.id).prefetch_related(*prefetch).order_by('-created_at')[:limit]
+    return [(similar, 0) for similar in similar_products]
+
+
+def _similar_product_data(request, similar):
+    similar_image = next(iter(similar.images.all()), None)
+    return {
+        'id': similar.id,
+        'name': similar.name,
+        'price_toman': float(similar.price_toman),
+        'price_usd': float(similar.price_usd) if similar.price_usd else None,
+        'image_url': request.build_absolute_uri(similar_image.image.url) if similar_image else None,
+    }
+
+
 def get_similar_products_by_tags(request, product_id):
     """
     Get similar products based on tag similarity
@@ -715,55 +776,14 @@ def get_similar_products_by_tags(request, product_id):
     """
     try:
         product = Product.objects.get(id=product_id)
-        product_tags = set(product.tags.values_list('id', flat=True))
-        
-        if not product_tags:
-            # Fallback to category-based similarity if no tags
-            similar_products = Product.objects.filter(
-                category=product.category,
-                is_active=True
-            ).exclude(id=product.id).order_by('-created_at')[:6]
-            
-            similar_data = []
-            for similar in similar_products:
-                similar_image = similar.images.first()
-                similar_data.append({
-                    'id': similar.id,
-                    'name': similar.name,
-                    'price_toman': float(similar.price_toman),
-                    'price_usd': float(similar.price_usd) if similar.price_usd else None,
-                    'image_url': request.build_absolute_uri(similar_image.image.url) if similar_image else None,
-                    'tag_overlap': 0,
-                    'similarity_type': 'category',
-                    'tags': []
-                })
-        else:
-            # Find products with overlapping tags, ordered by tag overlap
-            from django.db.models import Count, Q
-            
-            similar_products = Product.objects.filter(
-                tags__in=product_tags,
-                is_active=True
-            ).exclude(id=product.id).annotate(
-                tag_overlap=Count('tags', filter=Q(tags__in=product_tags))
-            ).order_by('-tag_overlap', '-created_at')[:6]
-            
-            # Format response with tag information
-            similar_data = []
-            for similar in similar_products:
-                similar_image = similar.images.first()
-                similar_tags = list(similar.tags.values('id', 'name'))
-                
-                similar_data.append({
-                    'id': similar.id,
-                    'name': similar.name,
-                    'price_toman': float(similar.price_toman),
-                    'price_usd': float(similar.price_usd) if similar.price_usd else None,
-                    'image_url': request.build_absolute_uri(similar_image.image.url) if similar_image else None,
-                    'tag_overlap': getattr(similar, 'tag_overlap', 0),
-                    'similarity_type': 'tags',
-                    'tags': similar_tags
-                })
+        similar_data = []
+        for similar, overlap in _indexed_similar_products(product, 'tags', ['images', 'tags']):
+            similar_data.append({
+                **_similar_product_data(request, similar),
+                'tag_overlap': overlap,
+                'similarity_type': 'tags' if overlap else 'category',
+                'tags': [{'id': tag.id, 'name': tag.name} for tag in similar.tags.all()] if overlap else []
+            })
         
         return JsonResponse({
             'product_id': product_id,
@@ -783,7 +803,9 @@ def get_similar_products_by_attributes(request, product_id):
     Example: /shop/product/123/similar-by-attributes/
     """
     try:
-        product = Product.objects.get(id=product_id)
+        product = Product.objects.prefetch_related(
+            'attribute_values__attribute', 'attribute_values__attribute_value', 'legacy_attribute_set'
+        ).get(id=product_id)
         
         # Import the helper function
         from shop.api_views import get_product_attributes
@@ -805,80 +827,16 @@ def get_similar_products_by_attributes(request, product_id):
             if value and value.strip():
                 product_attributes.add((key, value.strip()))
         
-        if not product_attributes:
-            # Fallback to category-based similarity if no attributes
-            similar_products = Product.objects.filter(
-                category=product.category,
-                is_active=True
-            ).exclude(id=product.id).order_by('-created_at')[:6]
-            
-            similar_data = []
-            for similar in similar_products:
-                similar_image = similar.images.first()
-                similar_data.append({
-                    'id': similar.id,
-                    'name': similar.name,
-                    'price_toman': float(similar.price_toman),
-                    'price_usd': float(similar.price_usd) if similar.price_usd else None,
-                    'image_url': request.build_absolute_uri(similar_image.image.url) if similar_image else None,
-                    'attribute_overlap': 0,
-                    'similarity_type': 'category',
-                    'attributes': get_product_attributes(similar)
-                })
-        else:
-            # Find products with overlapping attributes
-            from django.db.models import Count, Q
-            
-            # Build query for attribute overlap
-            attribute_conditions = Q()
-            for attr_key, attr_value in product_attributes:
-                # Match in legacy system
-                attribute_conditions |= Q(
-                    legacy_attribute_set__key=attr_key, 
-                    legacy_attribute_set__value__iexact=attr_value
-                )
-                # Match in new system (attribute_value)
-                attribute_conditions |= Q(
-                    attribute_values__attribute__key=attr_key, 
-                    attribute_values__attribute_value__value__iexact=attr_value
-                )
-                # Match in new system (custom_value)
-                attribute_conditions |= Q(
-                    attribute_values__attribute__key=attr_key, 
-                    attribute_values__custom_value__iexact=attr_value
-                )
-            
-            # Count attribute overlaps for scoring
-            overlap_conditions = Q()
-            for attr_key, attr_value in product_attributes:
-                overlap_conditions |= Q(
-                    legacy_attribute_set__key=attr_key, 
-                    legacy_attribute_set__value__iexact=attr_value
-                )
-            
-            similar_products = Product.objects.filter(
-                attribute_conditions,
-                is_active=True
-            ).exclude(id=product.id).annotate(
-                attribute_overlap=Count('legacy_attribute_set', filter=overlap_conditions)
-            ).order_by('-attribute_overlap', '-created_at')[:6]
-            
-            # Format response with attribute information
-            similar_data = []
-            for similar in similar_products:
-                similar_image = similar.images.first()
-                similar_attributes = get_product_attributes(similar)
-                
-                similar_data.append({
-                    'id': similar.id,
-                    'name': similar.name,
-                    'price_toman': float(similar.price_toman),
-                    'price_usd': float(similar.price_usd) if similar.price_usd else None,
-                    'image_url': request.build_absolute_uri(similar_image.image.url) if similar_image else None,
-                    'attribute_overlap': getattr(similar, 'attribute_overlap', 0),
-                    'similarity_type': 'attributes',
-                    'attributes': similar_attributes
-                })
+        similar_data = []
+        for similar, overlap in _indexed_similar_products(
+            product, 'attributes', ['images', 'attribute_values__attribute', 'attribute_values__attribute_value']
+        ):
+            similar_data.append({
+                **_similar_product_data(request, similar),
+                'attribute_overlap': overlap,
+                'similarity_type': 'attributes' if overlap else 'category',
+                'attributes': get_product_attributes(similar)
+            })
         
         return JsonResponse({
             'product_id': product_id,
@@ -1141,9 +1099,12 @@ def api_advanced_search(request):
 def api_simple_search(request):
     """
     Flexible product API endpoint that supports:
-    - Optional text search in name, description, SKU, brand, and model
+    - Optional ranked text search in name, model, SKU, brand, tags and category label, with
+      Persian/Arabic spelling variants normalized; results are ordered by relevance unless
+      sort_by is given
     - Category filtering
-    - Pagination
+    - Pagination: page numbers, or keyset cursors with ?cursor= (empty for the first page)
+      plus optional ?count=exact|approx; cursor mode has no page cap and no total count by default
     - Sorting by price, date, or name
     - Can be used as search API (with q parameter) or category browsing API (without q parameter)
     """
@@ -1181,8 +1142,9 @@ def api_simple_search(request):
                     }
                 }, status=400)
             
-            # 3. Sanitize search query (remove dangerous characters and normalize)
-            suspicious_patterns = ['%', '_', '[', ']', '--', '/*', '*/', 'xp_', 'sp_']
+            # 3. Reject comment/bracket sequences (the search backend tokenizes the query,
+            #    so % and _ are ordinary characters, e.g. in SKUs)
+            suspicious_patterns = ['[', ']', '--', '/*', '*/']
             if any(pattern in search_query.lower() for pattern in suspicious_patterns):
                 return JsonResponse({
                     'error': 'Search query contains invalid characters. Please use only letters, numbers, and basic punctuation.',
@@ -1238,8 +1200,10 @@ def api_simple_search(request):
                 }
             }, status=400)
         
+        cursor_mode = 'cursor' in request.GET
+        
         # SECURITY: Limit maximum page number to prevent deep pagination abuse
-        if page > 1000:
+        if page > 1000 and not cursor_mode:
             return JsonResponse({
                 'error': 'Page number too high. Please use a page number between 1 and 1000.',
                 'pagination': {
@@ -1313,53 +1277,57 @@ def api_simple_search(request):
         if category_id:
             print(f"DEBUG: Filtering by category ID: {category_id}")
             queryset = queryset.filter(category_id=category_id)
-            print(f"DEBUG: Products after category filter: {queryset.count()}")
         
         # Apply search if query exists
+        fuzzy_results = False
         if search_query:
-            # First try exact matching including tags
-            exact_queryset = queryset.filter(
-                Q(name__icontains=search_query) |
-                Q(sku__icontains=search_query) |
-                Q(model__icontains=search_query) |
-                Q(tags__name__icontains=search_query)  # Add tag-based search
-            )
-            
-            # If no results and fuzzy matching is enabled, try fuzzy matching
-            if exact_queryset.count() == 0 and use_fuzzy:
-                from django.db import connection
-                if connection.vendor == 'postgresql':
-                    from django.contrib.postgres.search import TrigramSimilarity
-                    queryset = queryset.annotate(
-                        name_similarity=TrigramSimilarity('name', search_query),
-                        model_similarity=TrigramSimilarity('model', search_query),
-                        sku_similarity=TrigramSimilarity('sku', search_query)
-                    ).filter(
-                        Q(name_similarity__gt=0.3) |
-                        Q(model_similarity__gt=0.3) |
-                        Q(sku_similarity__gt=0.3)
-                    ).order_by(
-                        '-name_similarity',
-                        '-model_similarity',
-                        '-sku_similarity'
-                    )
-                else:
-                    # For non-PostgreSQL databases, try to find products by tag names
-                    queryset = queryset.filter(
-                        Q(tags__name__icontains=search_query)
-                    ).distinct()
+            # Ranked full-text match over the precomputed search documents
+            search_queryset = search_products(queryset, search_query)
+            
+            # If no results and fuzzy matching is enabled, try trigram similarity (PostgreSQL only)
+            from django.db import connection
+            fuzzy_results = use_fuzzy and connection.vendor == 'postgresql' and not search_queryset.exists()
+            if fuzzy_results:
+                from django.contrib.postgres.search import TrigramSimilarity
+                queryset = queryset.annotate(
+                    name_similarity=TrigramSimilarity('name', search_query),
+                    model_similarity=TrigramSimilarity('model', search_query),
+                    sku_similarity=TrigramSimilarity('sku', search_query)
+                ).filter(
+                    Q(name_similarity__gt=0.3) |
+                    Q(model_similarity__gt=0.3) |
+                    Q(sku_similarity__gt=0.3)
+                ).order_by(
+                    '-name_similarity',
+                    '-model_similarity',
+                    '-sku_similarity'
+                )
             else:
-                queryset = exact_queryset
+                queryset = search_queryset
         
-        # Apply sorting (only if not using fuzzy matching)
-        if not (use_fuzzy and search_query and exact_queryset.count() == 0):
+        # Apply sorting: fuzzy matches keep their similarity order, searches without an
+        # explicit sort_by are ordered by relevance
+        if search_query and not fuzzy_results and 'sort_by' not in request.GET:
+            queryset = queryset.order_by('-search_rank', '-created_at')
+        elif not fuzzy_results:
             queryset = queryset.order_by(sort_field)
-        else:
-            queryset = queryset.order_by('-created_at')
+        
+        if cursor_mode:
+            # Keyset pagination: constant cost per page, so neither the result cap nor a count is needed.
+            # Similarity ordering can't be paginated by keyset; fuzzy results use the requested sort instead.
+            sort_by = resolve_keyset_sort(sort_by)
+            try:
+                cursor_page = paginate_by_cursor(
+                    queryset, sort_by, sort_order != 'asc', request.GET.get('cursor'), per_page
+                )
+            except InvalidCursor as e:
+                return JsonResponse({'error': str(e), 'products': []}, status=400)
+            page_products = cursor_page.items
+            pagination = cursor_pagination_data(cursor_page, per_page, queryset, request.GET.get('count'))
         
         # FINAL SECURITY CHECK: Limit total results to prevent massive data dumps
-        total_results = queryset.count()
-        if total_results > 10000:
+        total_results = None if cursor_mode else queryset.count()
+        if total_results is not None and total_results > 10000:
             return JsonResponse({
                 'error': f'Search returned too many results ({total_results:,} products). Please use a more specific search term to narrow down results.',
                 'products': [],
@@ -1373,38 +1341,49 @@ def api_simple_search(request):
             }, status=400)
         
         # Apply pagination
-        paginator = Paginator(queryset, per_page)
+        if not cursor_mode:
+            paginator = Paginator(queryset, per_page)
+            paginator.count = total_results  # already counted above
+            
+            try:
+                products_page = paginator.page(page)
+            except (ValueError, TypeError):
+                # Invalid page number (non-integer or negative)
+                return JsonResponse({
+                    'error': 'Invalid page number. Page must be a positive integer.',
+                    'pagination': {
+                        'current_page': 1,
+                        'total_pages': paginator.num_pages,
+                        'total_items': paginator.count,
+                        'has_next': paginator.num_pages > 1,
+                        'has_previous': False,
+                    }
+                }, status=400)
+            except EmptyPage:
+                # Page number is out of range
+                return JsonResponse({
+                    'error': f'Page {page} does not exist. Available pages: 1 to {paginator.num_pages}',
+                    'pagination': {
+                        'current_page': page,
+                        'total_pages': paginator.num_pages,
+                        'total_items': paginator.count,
+                        'has_next': False,
+                        'has_previous': paginator.num_pages > 0,
+                    }
+                }, status=404)
         
-        try:
-            products_page = paginator.page(page)
-        except (ValueError, TypeError):
-            # Invalid page number (non-integer or negative)
-            return JsonResponse({
-                'error': 'Invalid page number. Page must be a positive integer.',
-                'pagination': {
-                    'current_page': 1,
-                    'total_pages': paginator.num_pages,
-                    'total_items': paginator.count,
-                    'has_next': paginator.num_pages > 1,
-                    'has_previous': False,
-                }
-            }, status=400)
-        except EmptyPage:
-            # Page number is out of range
-            return JsonResponse({
-                'error': f'Page {page} does not exist. Available pages: 1 to {paginator.num_pages}',
-                'pagination': {
-                    'current_page': page,
-                    'total_pages': paginator.num_pages,
-                    'total_items': paginator.count,
-                    'has_next': False,
-                    'has_previous': paginator.num_pages > 0,
-                }
-            }, status=404)
+            page_products = products_page
+            pagination = {
+                'current_page': products_page.number,
+                'total_pages': paginator.num_pages,
+                'total_items': paginator.count,
+                'has_next': products_page.has_next(),
+                'has_previous': products_page.has_previous(),
+            }
         
         # Prepare response data
         products_data = []
-        for product in products_page:
+        for product in page_products:
             # Get all images for the product
             images = []
             for image in product.images.all().order_by('-is_primary', 'order'):
@@ -1512,7 +1491,7 @@ def api_simple_search(request):
                 product_data['brand_image'] = None
             
             # Add similarity scores if using fuzzy matching
-            if use_fuzzy and search_query and exact_queryset.count() == 0:
+            if fuzzy_results:
                 product_data['similarity_scores'] = {
                     'name': float(getattr(product, 'name_similarity', 0)),
                     'model': float(getattr(product, 'model_similarity', 0)),
@@ -1523,13 +1502,7 @@ def api_simple_search(request):
         
         response_data = {
             'products': products_data,
-            'pagination': {
-                'current_page': products_page.number,
-                'total_pages': paginator.num_pages,
-                'total_items': paginator.count,
-                'has_next': products_page.has_next(),
-                'has_previous': products_page.has_previous(),
-            },
+            'pagination': pagination,
             'sorting_applied': {
                 'sort_by': sort_by,
                 'sort_order': sort_order
@@ -2372,247 +2345,18 @@ def product_list_with_wishlist(request):
     return render(request, 'shop/product_list.html', context)
 
 def public_product_detail(request, product_id):
-    """Get public product details for API"""
+    """Get public product details for API, served from the product's detail document"""
+    from accounts.utils import request_user_id
+    from .product_detail import get_active_detail_document, render_detail_document
+
     try:
-        product = Product.objects.select_related(
-            'category', 'supplier'
-        ).prefetch_related(
-            'images',
-            'attribute_values',
-            'attribute_values__attribute',
-            'legacy_attribute_set',
-            'tags'
-        ).get(id=product_id, is_active=True)
-        
-        # Prepare product images
-        product_images = []
-        for image in product.images.all():
-            try:
-                image_url = request.build_absolute_uri(image.image.url)
-                product_images.append({
-                    'id': image.id,
-                    'url': image_url,
-                    'is_primary': image.is_primary
-                })
-            except Exception as e:
-                print(f"Error getting image URL: {e}")
-        
-        # Prepare attributes (new system)
-        new_attributes = []
-        for attr_value in product.attribute_values.all():
-            new_attributes.append({
-                'key': attr_value.attribute.key,
-                'key_fa': attr_value.attribute.label_fa,
-                'value': attr_value.get_display_value(),
-                'type': attr_value.attribute.type
-            })
-        
-        # Build attributes list (non-empty, category-allowed), preferring new system values
-        combined_attributes = []
-        allowed_keys = []
-        if product.category:
-            allowed_keys = list(product.category.category_attributes.values_list('key', flat=True))
-        for key in allowed_keys:
-            value = None
-            # Prefer new system (ProductAttributeValue)
-            pav = product.attribute_values.filter(attribute__key=key).first()
-            if pav and hasattr(pav, 'get_display_value') and pav.get_display_value():
-                value = pav.get_display_value()
-            else:
-                # Fallback to legacy
-                legacy = product.legacy_attribute_set.filter(key=key).first()
-                if legacy and legacy.value and str(legacy.value).strip() != '':
-                    value = legacy.value
-            if value is not None and value != "":
-                combined_attributes.append({'key': key, 'value': value})
-        
-        # Prepare tags
-        tags = list(product.tags.values('id', 'name'))
-        
-        # Prepare variants with prefetch_related for images to avoid N+1 queries
-        variants = ProductVariant.objects.filter(
-            product=product, 
-            is_active=True
-        ).prefetch_related(
-            'images'
-        ).order_by('sku')
-        
-        # Get CategoryAttribute mapping for display names
-        category_attributes_map = {}
-        if product.category:
-            category_attrs = CategoryAttribute.objects.filter(category=product.category)
-            category_attributes_map = {ca.key: ca for ca in category_attrs}
-        
-        variants_data = []
-        for variant in variants:
-            # Get variant images - explicitly filter by variant to ensure correct images
-            variant_images = []
-            try:
-                # Explicitly filter images by variant ID to ensure we only get images for this variant
-                variant_image_queryset = variant.images.all().order_by('-is_primary', 'order', 'created_at')
-                for variant_image in variant_image_queryset:
-                    if variant_image.image and variant_image.variant_id == variant.id:
-                        image_url = request.build_absolute_uri(variant_image.image.url)
-                        variant_images.append({
-                            'id': variant_image.id,
-                            'url': image_url,
-                            'is_primary': variant_image.is_primary,
-                            'order': variant_image.order
-                        })
-            except Exception as e:
-                print(f"Error getting variant images for variant {variant.id} (SKU: {variant.sku}): {e}")
-                import traceback
-                traceback.print_exc()
-            
-            # Convert attributes dictionary to array format
-            attributes_array = []
-            if variant.attributes:
-                # Get the distinctive attribute key from product
-                distinctive_key = getattr(product, 'distinctive_attribute_key', None)
-                
-                # If no distinctive key is set and there's only one attribute, auto-mark it as distinctive
-                if not distinctive_key and len(variant.attributes) == 1:
-                    distinctive_key = list(variant.attributes.keys())[0]
-                    print(f"🎯 Auto-detected distinctive attribute: {distinctive_key} (only one attribute)")
-                
-                for key, value in variant.attributes.items():
-                    # Check if this specific attribute is the distinctive one
-                    is_distinctive = (distinctive_key and key == distinctive_key)
-                    
-                    # Get display information from CategoryAttribute
-                    display_name = None
-                    priority = None
-                    if key in category_attributes_map:
-                        ca = category_attributes_map[key]
-                        display_name = ca.label_fa
-                        priority = ca.display_order
-                    
-                    attributes_array.append({
-                        'key': key,
-                        'value': value,
-                        'isDistinctive': is_distinctive
-                    })
-                    # Add display_name if available
-                    if display_name:
-                        attributes_array[-1]['display_name'] = display_name
-                    if priority is not None:
-                        attributes_array[-1]['priority'] = priority
-            
-            variants_data.append({
-                'id': variant.id,
-                'sku': variant.sku,
-                'attributes': attributes_array,
-                'price_toman': float(variant.price_toman),
-                'stock_quantity': variant.stock_quantity,
-                'is_active': variant.is_active,
-                'is_default': variant.is_default,
-                'isDistinctive': variant.isDistinctive,
-                'images': variant_images
-            })
-        
-        # Prepare display attributes (only those marked for product view with actual product values)
-        display_attributes = []
-        category_attributes = CategoryAttribute.objects.filter(
-            category=product.category,
-            is_displayed_in_product=True
-        ).order_by('display_order', 'key')
-        
-        for cat_attr in category_attributes:
-            # Find the actual values assigned to this specific product
-            product_attribute_values = set()
-
-            # Check variants for actual values
-            for variant in variants:
-                if variant.attributes and cat_attr.key in variant.attributes:
-                    if str(variant.attributes[cat_attr.key]).strip() != '':
-                        product_attribute_values.add(variant.attributes[cat_attr.key])
-
-            # Check legacy attributes for actual values
-            for legacy_attr in product.legacy_attribute_set.all():
-                if legacy_attr.key == cat_attr.key and legacy_attr.value and str(legacy_attr.value).strip() != '':
-                    product_attribute_values.add(legacy_attr.value)
-
-            # Check new attribute system for actual values
-            for attr_value in product.attribute_values.all():
-                if attr_value.attribute.key == cat_attr.key:
-                    display_val = attr_value.get_display_value()
-                    if display_val is not None and str(display_val).strip() != '':
-                        product_attribute_values.add(display_val)
-
-            # Include only if the product actually has a value for this attribute
-            if product_attribute_values:
-                single_value = list(product_attribute_values)[0]
-                display_attributes.append({
-                    'key': cat_attr.key,
-                    'display_name': cat_attr.label_fa,
-                    'priority': cat_attr.display_order,
-                    'value': single_value
-                })
-        
-        # Prepare similar products
-        similar_products = Product.objects.filter(
-            category=product.category,
-            is_active=True
-        ).exclude(id=product.id)[:4]
-        
-        similar_products_data = []
-        for similar in similar_products:
-            similar_image = similar.images.first()
-            similar_products_data.append({
-                'id': similar.id,
-                'name': similar.name,
-                'price_toman': float(similar.price_toman),
-                'price_usd': float(similar.price_usd) if similar.price_usd else None,
-                'reduced_price_toman': float(similar.reduced_price_toman) if similar.reduced_price_toman else None,
-                'discount_percentage': float(similar.discount_percentage) if similar.discount_percentage else None,
-                'image_url': request.build_absolute_uri(similar_image.image.url) if similar_image else None
-            })
-        
-        # Prepare full product data
-        product_data = {
-            'id': product.id,
-            'name': product.name,
-            'description': product.description or '',
-            'price_toman': float(product.price_toman),
-            'price_usd': float(product.price_usd) if product.price_usd else None,
-            'reduced_price_toman': float(product.reduced_price_toman) if product.reduced_price_toman else None,
-            'discount_percentage': float(product.discount_percentage) if product.discount_percentage else None,
-            'model': product.model,
-            'sku': product.sku,
-            'stock_quantity': product.stock_quantity,
-            'created_at': product.created_at.timestamp(),
-            
-            # Category and supplier
-            'category': {
-                'id': product.category.id,
-                'name': product.category.name
-            },
-            'supplier': {
-                'id': product.supplier.id,
-                'name': str(product.supplier)
-            } if product.supplier else None,
-            
-            # Images and attributes
-            'images': product_images,
-            'attributes': combined_attributes,
-            'display_attributes': display_attributes,
-            
-            # Variants
-            'variants': variants_data,
-            'variants_count': len(variants_data),
-            'total_stock': sum(v['stock_quantity'] for v in variants_data),
-            
-            # Additional details
-            'tags': tags,
-            'similar_products': similar_products_data
-        }
-        
-        return JsonResponse(product_data)
-    
-    except Product.DoesNotExist:
-        return JsonResponse({
-            'error': 'Product not found'
-        }, status=404)
+        document = get_active_detail_document(product_id)
+        if document is None:
+            return JsonResponse({
+                'error': 'Product not found'
+            }, status=404)
+        data, stock_quantity = document
+        return JsonResponse(render_detail_document(request, data, stock_quantity, request_user_id(request)))
     except Exception as e:
         return JsonResponse({
             'error': str(e)
@@ -2823,13 +2567,23 @@ def api_customer_products(request):
         if max_price:
             products = products.filter(price_toman__lte=max_price)
         
-        # Pagination
+        # Pagination: keyset cursors with ?cursor= (empty for the first page), page/limit otherwise
         page = int(request.GET.get('page', 1))
         limit = int(request.GET.get('limit', 20))
-        start = (page - 1) * limit
-        end = start + limit
+        cursor_mode = 'cursor' in request.GET
         
-        products_page = products[start:end]
+        if cursor_mode:
+            sort_by = resolve_keyset_sort(request.GET.get('sort_by', 'created_at'))
+            descending = request.GET.get('sort_order', 'desc') != 'asc'
+            try:
+                cursor_page = paginate_by_cursor(products, sort_by, descending, request.GET.get('cursor'), limit)
+            except InvalidCursor as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            products_page = cursor_page.items
+        else:
+            start = (page - 1) * limit
+            end = start + limit
+            products_page = products[start:end]
         
         # Serialize products
         products_data = []
@@ -2867,6 +2621,13 @@ def api_customer_products(request):
             }
             products_data.append(product_data)
         
+        if cursor_mode:
+            return Response({
+                'results': products_data,
+                'limit': limit,
+                'pagination': cursor_pagination_data(cursor_page, limit, products, request.GET.get('count'))
+            })
+        
         return Response({
             'results': products_data,
             'count': products.count(),
@@ -2950,14 +2711,12 @@ def api_customer_cart(request):
             print(f"🛒 Cart API Debug for: {user_info}")
             print(f"📦 Database cart: Found cart ID {cart.id}")
             
-            from .models import CartItem
+            # Items, images, attributes and prices in a fixed number of queries
+            snapshot = CartSnapshot.load(cart)
             
             cart_items = []
-            total_items = 0
-            total_price = 0
-            total_original_price = 0
-            
-            for item in cart.items.all():
+            for line in snapshot.lines:
+                item = line.item
                 try:
                     # Prepare variant data in the desired format
                     variant_data = None
@@ -2965,41 +2724,28 @@ def api_customer_cart(request):
                         # Transform attributes from dict to array format
                         attributes_array = []
                         if isinstance(item.variant.attributes, dict):
-                            # Get category for lookup of attribute display names
-                            category = item.product.category if item.product.category else None
                             for key, value in item.variant.attributes.items():
-                                # Try to get display_name from CategoryAttribute
-                                display_name = None
-                                if category:
-                                    try:
-                                        cat_attr = category.category_attributes.get(key=key)
-                                        display_name = cat_attr.label_fa
-                                    except:
-                                        # If CategoryAttribute doesn't exist, use key as fallback
-                                        pass
-                                
                                 attr_dict = {
                                     'key': key,
                                     'value': value,
                                     'isDistinctive': getattr(item.variant, 'isDistinctive', False)
                                 }
-                                # Only include display_name if it exists
+                                # Only include display_name if the category defines one
+                                display_name = line.attribute_labels.get(key)
                                 if display_name:
                                     attr_dict['display_name'] = display_name
                                 
                                 attributes_array.append(attr_dict)
                         
                         # Get variant images
-                        variant_images = []
-                        if hasattr(item.variant, 'images'):
-                            variant_images = [
-                                {
-                                    'id': img.id,
-                                    'image': _build_image_url(request, img.image.url) if img.image and img.image.url else '',
-                                    'is_primary': img.is_primary,
-                                    'display_order': img.order
-                                } for img in item.variant.images.all()
-                            ]
+                        variant_images = [
+                            {
+                                'id': img.id,
+                                'image': _build_image_url(request, img.image.url) if img.image and img.image.url else '',
+                                'is_primary': img.is_primary,
+                                'display_order': img.order
+                            } for img in item.variant.images.all()
+                        ]
                         
                         variant_data = {
                             'id': item.variant.id,
@@ -3010,55 +2756,10 @@ def api_customer_cart(request):
                             'images': variant_images
                         }
                     
-                    # Get attributes marked for basket display (max 2)
-                    product_attributes = []
-                    try:
-                        # Get category attributes marked for basket display
-                        basket_attributes = item.product.category.category_attributes.filter(
-                            display_in_basket=True
-                        ).order_by('display_order')[:2]
-                        
-                        # Get product attribute values for these attributes
-                        for cat_attr in basket_attributes:
-                            # Try to find the attribute value for this product
-                            attr_value = None
-                            
-                            # Check in new system (attribute_values)
-                            if hasattr(item.product, 'attribute_values'):
-                                for av in item.product.attribute_values.all():
-                                    if av.attribute.key == cat_attr.key:
-                                        attr_value = av.get_display_value()
-                                        break
-                            
-                            # Check in legacy system (legacy_attribute_set)
-                            if not attr_value and hasattr(item.product, 'legacy_attribute_set'):
-                                for legacy in item.product.legacy_attribute_set.all():
-                                    if legacy.key == cat_attr.key:
-                                        attr_value = legacy.value
-                                        break
-                            
-                            # Add to display attributes if value exists
-                            if attr_value and str(attr_value).strip():
-                                product_attributes.append({
-                                    'key': cat_attr.key,
-                                    'value': str(attr_value),
-                                    'display_name': cat_attr.label_fa
-                                })
-                        
-                    except Exception as e:
-                        print(f"❌ Error getting product attributes for {item.product.id}: {e}")
-                        product_attributes = []
-                    
                     # Determine final price (use reduced price if available, otherwise original price)
                     final_price_toman = float(item.product.reduced_price_toman) if item.product.reduced_price_toman else (float(item.product.price_toman) if item.product.price_toman else 0)
                     original_price_toman = float(item.product.price_toman) if item.product.price_toman else 0
                     
-                    # Calculate original total price for this item (using original price, not reduced)
-                    if item.variant and item.variant.price_toman:
-                        original_item_price = float(item.variant.price_toman) * item.quantity
-                    else:
-                        original_item_price = original_price_toman * item.quantity
-                    
                     cart_items.append({
                         'id': item.id,  # Use actual CartItem database ID
                         'product': {
@@ -3075,7 +2776,7 @@ def api_customer_cart(request):
                                 'id': item.product.category.id if item.product.category else None,
                                 'name': item.product.category.name if item.product.category else None
                             },
-                            'attributes': product_attributes,
+                            'attributes': line.basket_attributes,
                             'images': [
                                 {
                                     'id': img.id,
@@ -3085,16 +2786,12 @@ def api_customer_cart(request):
                                 } for img in item.product.images.all()
                             ]
                         },
-                    'variant': variant_data,
+                        'variant': variant_data,
                         'quantity': item.quantity,
-                        'total_price_toman': float(item.get_total_price()),
+                        'total_price_toman': float(line.total_price),
                         'total_price_usd': None,
                         'added_at': item.created_at.isoformat()
                     })
-                    
-                    total_items += item.quantity
-                    total_price += float(item.get_total_price())
-                    total_original_price += original_item_price
                 except Exception as e:
                     print(f"❌ Error processing cart item {item.id}: {e}")
                     continue
@@ -3104,9 +2801,9 @@ def api_customer_cart(request):
             return Response({
                 'id': cart.id,
                 'items': cart_items,
-                'total_items': total_items,
-                'total_price_toman': total_price,
-                'total_original_price_toman': total_original_price,
+                'total_items': snapshot.total_items,
+                'total_price_toman': float(snapshot.total_price),
+                'total_original_price_toman': float(snapshot.total_original_price),
                 'total_price_usd': None,
                 'created_at': cart.created_at.isoformat(),
                 'updated_at': cart.updated_at.isoformat()
@@ -3181,8 +2878,8 @@ def api_customer_cart(request):
                         'api_endpoint': f'/shop/api/products/{product_id}/variants/'
                     }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Use database transaction with locking to prevent race conditions
-            # This ensures only one request can check and add stock at a time
+            # Add the item and reserve its stock in one transaction; stock is only taken with
+            # a conditional UPDATE, so concurrent requests can't both get the last unit
             with transaction.atomic():
                 # Get or create cart (works for authenticated and guest users)
                 cart, is_authenticated, error_response = get_or_create_cart(request)
@@ -3197,12 +2894,11 @@ def api_customer_cart(request):
                 
                 print(f"📦 Add to cart - Database cart: Found cart ID {cart.id}")
                 
-                # Check if variant exists - WITH LOCK to prevent race conditions
+                # Check if variant exists
                 variant = None
                 if variant_id:
                     try:
-                        # Lock the variant row to prevent concurrent access
-                        variant = ProductVariant.objects.select_for_update().get(
+                        variant = ProductVariant.objects.get(
                             id=variant_id, 
                             product=product, 
                             is_active=True
@@ -3210,23 +2906,6 @@ def api_customer_cart(request):
                     except ProductVariant.DoesNotExist:
                         return Response({'error': 'Variant not found'}, status=status.HTTP_404_NOT_FOUND)
                 
-                # Check stock availability WITH LOCK held (prevents race condition)
-                if variant and hasattr(variant, 'stock_quantity'):
-                    available_stock = variant.stock_quantity
-                    if available_stock <= 0:
-                        return Response({
-                            'error': 'This variant is out of stock',
-                            'variant_id': variant_id
-                        }, status=status.HTTP_400_BAD_REQUEST)
-                    
-                    # Check if adding quantity would exceed available stock
-                    if quantity > available_stock:
-                        return Response({
-                            'error': f'Only {available_stock} items available in stock',
-                            'available_stock': available_stock,
-                            'requested_quantity': quantity
-                        }, status=status.HTTP_400_BAD_REQUEST)
-                
                 # Check cart limits
                 total_unique_items = cart.items.count()
                 
@@ -3266,22 +2945,25 @@ def api_customer_cart(request):
                             'max_quantity_per_item': MAX_QUANTITY_PER_ITEM
                         }, status=status.HTTP_400_BAD_REQUEST)
                     
-                    # Check stock again for variants (with lock still held)
-                    if variant and hasattr(variant, 'stock_quantity'):
-                        # Re-read variant with lock to ensure we have latest stock
-                        variant.refresh_from_db()
-                        if new_total_quantity > variant.stock_quantity:
-                            return Response({
-                                'error': f'Cannot add more items. Available stock: {variant.stock_quantity}',
-                                'current_in_cart': cart_item.quantity,
-                                'available_stock': variant.stock_quantity
-                            }, status=status.HTTP_400_BAD_REQUEST)
-                    
                     cart_item.quantity = new_total_quantity
                     cart_item.save()
-                    print(f"🔄 Updated existing cart item: {cart_item}")
-                else:
+                
+                # Reserve stock for the item's new quantity
+                try:
+                    reserve_cart_item(cart_item)
+                except OutOfStock as e:
+                    transaction.set_rollback(True)
+                    return Response({
+                        'error': 'This item is out of stock' if e.available <= 0 else f'Only {e.available} more items available in stock',
+                        'variant_id': variant_id,
+                        'available_stock': e.available,
+                        'requested_quantity': quantity
+                    }, status=status.HTTP_400_BAD_REQUEST)
+                
+                if item_created:
                     print(f"➕ Created new cart item: {cart_item}")
+                else:
+                    print(f"🔄 Updated existing cart item: {cart_item}")
             
             # Return success response
             return Response({
@@ -3317,13 +2999,21 @@ def api_customer_cart(request):
             from .models import CartItem
             
             try:
-                cart_item = CartItem.objects.get(id=item_id, cart=cart)
-                cart_item.quantity = quantity
-                cart_item.save()
+                with transaction.atomic():
+                    cart_item = CartItem.objects.get(id=item_id, cart=cart)
+                    cart_item.quantity = quantity
+                    cart_item.save()
+                    # Grow or shrink the stock reservation with the quantity
+                    reserve_cart_item(cart_item)
                 
                 return Response({'message': 'Cart item updated successfully'})
             except CartItem.DoesNotExist:
                 return Response({'error': 'Cart item not found'}, status=status.HTTP_404_NOT_FOUND)
+            except OutOfStock as e:
+                return Response({
+                    'error': f'Only {e.available} more items available in stock',
+                    'available_stock': e.available
+                }, status=status.HTTP_400_BAD_REQUEST)
         
         elif request.method == 'DELETE':
             # Remove from cart
@@ -3393,9 +3083,18 @@ def api_customer_cart_remove(request):
                 cart_item.delete()
                 return Response({'message': 'Cart item removed successfully'})
             else:
-                # Update quantity
-                cart_item.quantity = new_quantity
-                cart_item.save()
+                # Update quantity and shrink its stock reservation to match
+                try:
+                    with transaction.atomic():
+                        cart_item.quantity = new_quantity
+                        cart_item.save()
+                        reserve_cart_item(cart_item)
+                except OutOfStock as e:
+                    # The reservation had expired and its stock was sold meanwhile
+                    return Response({
+                        'error': f'Only {e.available} more items available in stock',
+                        'available_stock': e.available
+                    }, status=status.HTTP_400_BAD_REQUEST)
                 return Response({
                     'message': 'Cart item quantity decreased successfully',
                     'new_quantity': new_quantity
@@ -3423,7 +3122,6 @@ def api_customer_checkout(request):
         
         from .models import Cart, CartItem, Order, OrderItem
         from accounts.models import Address
-        from decimal import InvalidOperation
         
         # Get cart (works for authenticated and guest users)
         cart, is_authenticated, error_response = get_or_create_cart(request)
@@ -3436,7 +3134,9 @@ def api_customer_checkout(request):
                 'detail': 'Device ID required for guest users. Send X-Device-ID header.'
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        if not cart.items.exists():
+        # Cart lines priced once, shared by the subtotal and the order items
+        snapshot = CartSnapshot.load(cart, details=False)
+        if not snapshot.lines:
             return Response({'error': 'Cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
         
         data = request.data
@@ -3511,17 +3211,7 @@ def api_customer_checkout(request):
         discount_code = data.get('discount_code', '')
         delivery_notes = data.get('delivery_notes', '')
         
-        # Calculate totals safely
-        try:
-            subtotal_toman = cart.get_total_price()
-        except (TypeError, ValueError, AttributeError, InvalidOperation) as e:
-            print(f"⚠️ Error calculating cart total: {e}")
-            subtotal_toman = 0
-            for item in cart.items.all():
-                try:
-                    subtotal_toman += item.get_total_price()
-                except:
-                    continue
+        subtotal_toman = snapshot.total_price
         
         # Calculate shipping cost based on delivery option
         shipping_cost_toman = 0
@@ -3563,33 +3253,31 @@ def api_customer_checkout(request):
             first_name_final = default_first_name or 'Guest'
             last_name_final = default_last_name or ''
         
-        order = Order.objects.create(
-            first_name=first_name_final,
-            last_name=last_name_final,
-            email=default_email,
-            address=delivery_address_str,
-            postal_code=postal_code,
-            city=city,
-            paid=is_paid
-        )
-        
-        # Create order items from cart items
-        for cart_item in cart.items.all():
-            try:
-                unit_price = cart_item.get_unit_price_toman()
-                
-                OrderItem.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    price=unit_price,
-                    quantity=cart_item.quantity
+        # Order, stock and order items succeed or fail together
+        try:
+            with transaction.atomic():
+                order = Order.objects.create(
+                    first_name=first_name_final,
+                    last_name=last_name_final,
+                    email=default_email,
+                    address=delivery_address_str,
+                    postal_code=postal_code,
+                    city=city,
+                    paid=is_paid
                 )
-            except Exception as e:
-                print(f"⚠️ Error creating order item: {e}")
-                continue
-        
-        # Clear cart after successful order creation
-        cart.items.all().delete()
+                
+                # Claim the cart's stock reservations and create the order items
+                commit_checkout(order, snapshot.lines)
+                
+                # Clear the ordered items; one added since the snapshot stays in the cart
+                cart.items.filter(pk__in=[line.item.id for line in snapshot.lines]).delete()
+        except OutOfStock as e:
+            return Response({
+                'error': 'Some items in your cart are no longer in stock',
+                'product_id': e.product_id,
+                'variant_id': e.variant_id,
+                'available_stock': e.available
+            }, status=status.HTTP_409_CONFLICT)
         
         return Response({
             'success': True,
@@ -3597,7 +3285,7 @@ def api_customer_checkout(request):
                 'id': order.id,
                 'order_number': f"ORD-{order.id:06d}",
                 'status': 'paid' if order.paid else 'pending',
-                'total_toman': float(order.get_total_cost()),
+                'total_toman': float(order.total_toman),
                 'created_at': order.created.isoformat()
             }
         }, status=status.HTTP_201_CREATED)
@@ -3615,54 +3303,68 @@ def api_customer_checkout(request):
 @csrf_exempt
 @login_required
 def api_customer_orders(request):
-    """Get customer orders"""
+    """
+    Get customer orders, newest first, one page at a time.
+    Parameters:
+        - limit: orders per page (default 20, at most 100)
+        - cursor: ``next_cursor``/``previous_cursor`` of a previous page
+    ``count`` is the customer's total number of orders, as before pagination (also in
+    pagination.total_items). Three queries: that count, the page of orders with their
+    stored totals, and their items with products.
+    """
     try:
-        from .models import Order
-        
-        print(f"🔍 Getting orders for user: {request.user.email}")
-        
-        # Get orders for the current user
-        orders = Order.objects.filter(email=request.user.email).order_by('-created')
-        print(f"📋 Found {orders.count()} orders")
-        
-        orders_data = []
-        for order in orders:
-            try:
-                order_data = {
-                    'id': order.id,
-                    'order_number': f"ORD-{order.id:06d}",
-                    'first_name': order.first_name,
-                    'last_name': order.last_name,
-                    'email': order.email,
-                    'address': order.address,
-                    'postal_code': order.postal_code,
-                    'city': order.city,
-                    'total_amount': float(order.get_total_cost()),
-                    'status': 'paid' if order.paid else 'pending',
-                    'payment_method': 'COD' if order.paid else 'PENDING',  # Default based on status
-                    'created_at': order.created.isoformat(),
-                    'updated_at': order.updated.isoformat(),
-                    'items': [
-                        {
-                            'id': item.id,
-                            'product_name': item.product.name,
-                            'product_id': item.product.id,
-                            'price': float(item.price),
-                            'quantity': item.quantity,
-                            'total': float(item.get_cost())
-                        } for item in order.items.all()
-                    ]
-                }
-                orders_data.append(order_data)
-                print(f"✅ Processed order {order.id}")
-            except Exception as e:
-                print(f"❌ Error processing order {order.id}: {str(e)}")
-                continue
-        
-        print(f"📊 Returning {len(orders_data)} orders")
+        from .models import Order, OrderItem
+        from django.db.models import Prefetch
+
+        try:
+            limit = min(max(int(request.GET.get('limit', 20)), 1), 100)
+        except ValueError:
+            return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+
+        orders = Order.objects.filter(email=request.user.email).prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.select_related('product').order_by('pk'))
+        )
+        try:
+            page = paginate_by_cursor(orders, 'created', True, request.GET.get('cursor'), limit)
+        except InvalidCursor as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        orders_data = [
+            {
+                'id': order.id,
+                'order_number': f"ORD-{order.id:06d}",
+                'first_name': order.first_name,
+                'last_name': order.last_name,
+                'email': order.email,
+                'address': order.address,
+                'postal_code': order.postal_code,
+                'city': order.city,
+                'total_amount': float(order.total_toman),
+                'item_count': order.item_count,
+                'status': 'paid' if order.paid else 'pending',
+                'payment_method': 'COD' if order.paid else 'PENDING',  # Default based on status
+                'created_at': order.created.isoformat(),
+                'updated_at': order.updated.isoformat(),
+                'items': [
+                    {
+                        'id': item.id,
+                        'product_name': item.product.name,
+                        'product_id': item.product_id,
+                        'price': float(item.price),
+                        'quantity': item.quantity,
+                        'total': float(item.get_cost())
+                    } for item in order.items.all()
+                ]
+            }
+            for order in page.items
+        ]
+        total = orders.count()
+        pagination = cursor_pagination_data(page, limit)
+        pagination.update(total_items=total, total_is_approximate=False)
         return Response({
             'results': orders_data,
-            'count': len(orders_data)
+            'count': total,
+            'pagination': pagination,
         })
         
     except Exception as e:
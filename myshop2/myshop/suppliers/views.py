@@ -27,6 +27,7 @@ from django.core.management import call_command
 from .models import BackupLog, Supplier, SupplierInvitation, SupplierAdmin, Store
 from shop.models import Product, Category, ProductImage, ProductAttribute, OrderItem, Order, Tag, CategoryAttribute
 from shop.forms import ProductForm
+from shop.persian import clean_persian_text
 from django.db import transaction
 from .forms import SupplierRegistrationForm, SupplierLoginForm
 
@@ -91,13 +92,7 @@ def test_save_product(request):
 # --- Helpers for robust Persian attribute handling ---
 def _normalize_persian_key(text: str) -> str:
     """Normalize attribute keys to handle Persian ZWNJ and whitespace variants."""
-    if not isinstance(text, str):
-        return text
-    # Remove zero-width joiner characters
-    text = text.replace('\u200c', '').replace('\u200d', '')
-    # Collapse whitespace and trim
-    text = ' '.join(text.split()).strip()
-    return text
+    return clean_persian_text(text, digits=False)
 
 def _build_normalized_attr_map(post_data) -> dict:
     """Build a map of normalized attribute key -> value(s) from POST data."""